@@ -3,7 +3,9 @@
 # pylint: disable=line-too-long
 from os import environ as ENV
 import datetime
+import time
 from datetime import timedelta
+from urllib.parse import urljoin
 from flask import cli
 import pandas as pd
 import altair as alt
@@ -17,14 +19,18 @@ from email_validator import validate_email, EmailNotValidError
 
 
 from queries import (get_most_negative_word,
-                     get_most_positive_word, get_most_mentioned_word)
-from combined_data import main_combine
+                     get_most_positive_word, get_most_mentioned_word,
+                     choose_rollup, get_first_rollup_period, get_rollups)
 from predict_mentions import main_predict
 
 
 load_dotenv()
 pd.set_option('display.precision', 2)
 API_ENDPOINT = ENV["API_ENDPOINT"]
+JOB_POLL_SECONDS = 2
+JOB_TIMEOUT_SECONDS = 600
+# Enough hourly rollups to compare the latest hour with 12 hours before
+RECENT_HOURS = pd.Timedelta(hours=13)
 COLOUR_PALETTE = ['#C4D6B0', '#477998', '#F64740', '#A3333D']
 COLOUR_IMAGES = ["https://www.colorhexa.com/c4d6b0.png",
                  "https://www.colorhexa.com/477998.png"]
@@ -116,11 +122,29 @@ def insert_user(first_name: str, last_name: str, email: str) -> None:
     execute_query(query, (first_name, last_name, email))
 
 
+def wait_for_job(job_url: str) -> dict:
+    """Poll the API until a queued topic job has finished"""
+    deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+    job = {}
+    while time.monotonic() < deadline:
+        job = requests.get(job_url, timeout=10).json()
+        if job.get("status") in ("succeeded", "failed"):
+            break
+        time.sleep(JOB_POLL_SECONDS)
+    return job
+
+
 def submit_topic(data: dict) -> None:
-    """Submit topic details to the API"""
+    """Submit topic details to the API and wait for its data to be collected"""
     try:
-        response = requests.post(API_ENDPOINT, json=data, timeout=1000)
-        if response.status_code == 200:
+        response = requests.post(API_ENDPOINT, json=data, timeout=30)
+        if response.status_code in (200, 202):
+            with st.spinner("Collecting the latest data for your topic..."):
+                job = wait_for_job(
+                    urljoin(API_ENDPOINT, response.headers["Location"]))
+            if job.get("status") == "failed":
+                st.error(f"Error: {job.get('error', 'Unknown error')}")
+                return
             st.success("✅ Topic submitted successfully!")
             st.session_state.clicked_nodes.clear()
         else:
@@ -585,14 +609,14 @@ def plot_total_mentions(keywords: list, data: pd.DataFrame) -> alt.Chart:
     filtered_data = add_keyword_column(keywords, data)
 
     chart = alt.Chart(filtered_data, title='Mentions Over Time').mark_line().encode(
-        x=alt.X('6_hour_block:T', title='Date',
+        x=alt.X('date_and_hour:T', title='Date',
                 axis=alt.Axis(format='%I%p (%d-%m)')),
-        y=alt.Y('total_mentions:Q', title='Total Mentions'),
+        y=alt.Y('mentions_per_hour:Q', title='Mentions per Hour'),
         color=alt.Color('keyword:N', title='Keyword:',
                         scale=alt.Scale(range=COLOUR_PALETTE)),
         tooltip=[alt.Tooltip('keyword:N', title='Keyword'),
-                 alt.Tooltip('total_mentions:Q', title='Total Mentions'),
-                 alt.Tooltip('6_hour_block:T', title='Date')]
+                 alt.Tooltip('mentions_per_hour:Q', title='Mentions per Hour'),
+                 alt.Tooltip('date_and_hour:T', title='Date')]
     ).properties(width=800, height=400).configure_title(fontSize=24).interactive()
     return chart
 
@@ -602,14 +626,14 @@ def plot_avg_sentiment_over_time(keywords: list, data: pd.DataFrame) -> alt.Char
     filtered_data = add_keyword_column(keywords, data)
 
     chart = alt.Chart(filtered_data, title='Average Sentiment Over Time').mark_line().encode(
-        x=alt.X('6_hour_block:T', title='Time',
+        x=alt.X('date_and_hour:T', title='Time',
                 axis=alt.Axis(format='%I%p (%d-%m)')),
         y=alt.Y('avg_sentiment:Q', title='Average Sentiment'),
         color=alt.Color('keyword:N', title='Keyword:',
                         scale=alt.Scale(range=COLOUR_PALETTE)),
         tooltip=[alt.Tooltip('keyword:N', title='Keyword'),
                  alt.Tooltip('avg_sentiment:Q', title='Average Sentiment'),
-                 alt.Tooltip('6_hour_block:T', title='6-hour time block')]
+                 alt.Tooltip('date_and_hour:T', title='Period starting')]
     ).properties(width=800, height=400).configure_title(fontSize=24).interactive()
 
     return chart
@@ -733,21 +757,22 @@ def main() -> None:
                 '<hr style="width: 100%; height: 2px; color: #291f1e; background-color: #291f1e; margin-top:0;"/>', unsafe_allow_html=True)
 
             # Organise data for different visualisations
-            combined_data = main_combine()
-            filtered_data_list = filter_by_keyword(
-                selected_keywords, combined_data)
-            filtered_data = pd.concat(filtered_data_list)
+            keyword_ids = [fetch_keyword_id(keyword)['keywords_id']
+                           for keyword in existing_keywords]
+            now = pd.Timestamp.now()
+            recent_data = get_rollups(
+                keyword_ids, 'keyword_rollups_1h', now - RECENT_HOURS, cursor)
+            filtered_data = pd.concat(
+                filter_by_keyword(selected_keywords, recent_data))
             data_12 = get_percentage_change_mentions_sentiment(
-                existing_keywords, combined_data)
-            filtered_data['date_and_hour'] = pd.to_datetime(
-                filtered_data['date_and_hour'])
-            filtered_data['6_hour_block'] = filtered_data['date_and_hour'].dt.floor(
-                '6H')
-            grouped_df = filtered_data.groupby(['keywords_id', '6_hour_block'], as_index=False).agg({
-                'total_mentions': 'mean',
-                'avg_sentiment': 'mean'
-            })
-            grouped_df['total_mentions'] = grouped_df['total_mentions'].round(
+                existing_keywords, recent_data)
+
+            # The whole history is charted from the coarsest rollup that fits it
+            first_period = get_first_rollup_period(
+                keyword_ids, cursor) or now - RECENT_HOURS
+            grouped_df = pd.concat(filter_by_keyword(selected_keywords, get_rollups(
+                keyword_ids, choose_rollup(first_period, now), first_period, cursor)))
+            grouped_df['mentions_per_hour'] = grouped_df['mentions_per_hour'].round(
                 2)
             grouped_df['avg_sentiment'] = grouped_df['avg_sentiment'].round(2)
 
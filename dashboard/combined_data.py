@@ -1,12 +1,17 @@
 """Combine keyword_recordings in S3 and RDS"""
 from os import environ as ENV
+import io
+import json
 import logging
 import boto3
+from botocore.exceptions import ClientError
 import pandas as pd
-import os
 import psycopg2
 from dotenv import load_dotenv
 
+# The columns of the archive's Parquet files and of keyword_recordings
+ARCHIVE_COLUMNS = ["keyword_recordings_id", "keywords_id", "total_mentions", "sentiment_sum",
+                   "sentiment_sum_squares", "avg_sentiment", "date_and_hour"]
 
 def get_connection():
     """Function to connect to RDS."""
@@ -29,24 +34,51 @@ def get_connection():
     return conn
 
 
-def download_csv_from_s3_to_dataframe(bucket_name, folder_name, file_name) -> pd.DataFrame:
-    """Downloads a CSV file from a specific folder in an S3 bucket and loads it into a Pandas DataFrame"""
-    s3_client = boto3.client('s3')
-
-    object_key = f"{folder_name}/{file_name}"
+def read_archive_file(s3_client, bucket_name: str, entry: dict) -> pd.DataFrame:
+    """Reads one archive file listed in the manifest into a Pandas DataFrame with the
+    archive's columns. The legacy CSV archive predates the sentiment sums, so its sum is
+    worked out from the average and its sum of squares is unknown."""
+    body = io.BytesIO(s3_client.get_object(Bucket=bucket_name, Key=entry["key"])["Body"].read())
+    if entry.get("format") != "csv":
+        return pd.read_parquet(body).reindex(columns=ARCHIVE_COLUMNS)
+    df = pd.read_csv(body)
+    if "sentiment_sum" not in df and {"avg_sentiment", "total_mentions"} <= set(df):
+        df["sentiment_sum"] = df["avg_sentiment"] * df["total_mentions"]
+    return df.reindex(columns=ARCHIVE_COLUMNS)
 
-    temp_file_path = os.path.join(os.getcwd(), file_name)
 
+def list_archive_files(s3_client, bucket_name: str, folder_name: str) -> list[dict]:
+    """Returns the manifest's list of archive files, oldest first. A folder archived before
+    the manifest existed only holds legacy CSV files, which are listed oldest first instead."""
     try:
-        s3_client.download_file(bucket_name, object_key, temp_file_path)
-        logging.info("File downloaded successfully: %s", temp_file_path)
+        return json.loads(s3_client.get_object(
+            Bucket=bucket_name, Key=f"{folder_name}/manifest.json")["Body"].read())["files"]
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+
+    logging.info("No archive manifest, reading the legacy CSV files.")
+    objects = [obj for page in s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket_name, Prefix=f"{folder_name}/") for obj in page.get("Contents", [])]
+    return [{"key": obj["Key"], "format": "csv"}
+            for obj in sorted(objects, key=lambda obj: obj["LastModified"])
+            if obj["Key"].endswith(".csv")]
+
+
+def download_archive_from_s3_to_dataframe(bucket_name, folder_name) -> pd.DataFrame:
+    """Loads every archive file in an S3 folder into a Pandas DataFrame.
+    A keyword and hour archived twice keeps its latest copy."""
+    s3_client = boto3.client('s3')
 
-        df = pd.read_csv(temp_file_path)
-        logging.info("File loaded into Pandas DataFrame successfully.")
+    try:
+        frames = [read_archive_file(s3_client, bucket_name, entry)
+                  for entry in list_archive_files(s3_client, bucket_name, folder_name)]
+        logging.info("Read %s archive files.", len(frames))
 
-        os.remove(temp_file_path)
-        logging.info("Temporary file removed.")
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+            columns=ARCHIVE_COLUMNS)
         df['date_and_hour'] = pd.to_datetime(df['date_and_hour'])
+        df = df.drop_duplicates(["keywords_id", "date_and_hour"], keep="last")
         return df
     except Exception as e:
         logging.error("An error occurred: %s", e)
@@ -61,7 +93,8 @@ def fetch_keyword_recordings_as_dataframe():
 
         query = f"""
         SET search_path TO {ENV["SCHEMA_NAME"]};
-        SELECT keyword_recordings_id, keywords_id, total_mentions, avg_sentiment, date_and_hour
+        SELECT keyword_recordings_id, keywords_id, total_mentions, sentiment_sum,
+               sentiment_sum_squares, avg_sentiment, date_and_hour
         FROM keyword_recordings;
         """
 
@@ -77,19 +110,19 @@ def fetch_keyword_recordings_as_dataframe():
 
 
 def main_combine() -> pd.DataFrame:
-    """Main function to produce dataframe from S3 bucket."""
+    """Main function to produce a dataframe of the archive in S3 and the recordings in RDS,
+    with the columns of the archive."""
     load_dotenv()
 
     BUCKET_NAME = ENV["S3_BUCKET_NAME"]
     FOLDER_NAME = ENV["S3_FOLDER_NAME"]
-    FILE_NAME = ENV["S3_FILE_NAME"]
 
-    s3_df = download_csv_from_s3_to_dataframe(
-        BUCKET_NAME, FOLDER_NAME, FILE_NAME)
+    s3_df = download_archive_from_s3_to_dataframe(BUCKET_NAME, FOLDER_NAME)
     db_df = fetch_keyword_recordings_as_dataframe()
 
     if s3_df is not None and db_df is not None:
-        combined_df = pd.concat([s3_df, db_df], ignore_index=True)
+        combined_df = pd.concat([s3_df.reindex(columns=ARCHIVE_COLUMNS),
+                                 db_df.reindex(columns=ARCHIVE_COLUMNS)], ignore_index=True)
         logging.info("Combined DataFrame from S3 created successfully.")
         return combined_df
     else:
@@ -5,6 +5,16 @@ import psycopg2
 from psycopg2.extensions import cursor
 from psycopg2.extras import RealDictCursor, RealDictRow
 
+# Rollup tables and the length of their periods, coarsest first
+ROLLUPS = {
+    "keyword_rollups_1d": pd.Timedelta(days=1),
+    "keyword_rollups_6h": pd.Timedelta(hours=6),
+    "keyword_rollups_1h": pd.Timedelta(hours=1)
+}
+MIN_CHART_POINTS = 24
+ROLLUP_COLUMNS = ['keywords_id', 'date_and_hour', 'total_mentions', 'mentions_per_hour',
+                  'avg_sentiment']
+
 
 def get_connection() -> tuple:
     """Establish and return a database connection"""
@@ -112,7 +122,8 @@ def get_keyword_id(keyword: str, cursor: cursor) -> int:
 def get_most_mentioned_word(cursor: cursor) -> RealDictRow:
     """Function returns most mentioned word (highest total_mentions)."""
     query = """
-    SELECT k.keyword, SUM(kr.total_mentions) AS total_mentions, AVG(kr.avg_sentiment)
+    SELECT k.keyword, SUM(kr.total_mentions) AS total_mentions,
+           SUM(kr.sentiment_sum) / NULLIF(SUM(kr.total_mentions), 0) AS avg_sentiment
     FROM keyword_recordings AS kr
     JOIN keywords AS k ON k.keywords_id = kr.keywords_id
     WHERE kr.date_and_hour >= NOW() - INTERVAL '24 HOURS'
@@ -153,3 +164,38 @@ def get_most_negative_word(cursor: cursor) -> RealDictRow:
         """
     cursor.execute(query)
     return cursor.fetchall()
+
+
+def choose_rollup(start: pd.Timestamp, end: pd.Timestamp) -> str:
+    """Returns the coarsest rollup with at least MIN_CHART_POINTS periods between start and end."""
+    for table, period in ROLLUPS.items():
+        if (end - start) / period >= MIN_CHART_POINTS:
+            return table
+    return "keyword_rollups_1h"
+
+
+def get_first_rollup_period(keyword_ids: list, cursor: cursor) -> pd.Timestamp:
+    """Returns the start of the first day recorded for any of the keywords, or None."""
+    query = """
+        SELECT MIN(period_start) AS first_period
+        FROM keyword_rollups_1d
+        WHERE keywords_id = ANY(%s);
+        """
+    cursor.execute(query, (keyword_ids,))
+    first_period = cursor.fetchone()['first_period']
+    return pd.Timestamp(first_period) if first_period else None
+
+
+def get_rollups(keyword_ids: list, table: str, start: pd.Timestamp, cursor: cursor) -> pd.DataFrame:
+    """Returns the mentions, mean mentions per hour and average sentiment of the keywords in each period of a rollup from start onwards."""
+    query = f"""
+        SELECT keywords_id, period_start AS date_and_hour, total_mentions,
+               total_mentions::FLOAT / hours_recorded AS mentions_per_hour, avg_sentiment
+        FROM {table}
+        WHERE keywords_id = ANY(%s) AND period_start >= %s
+        ORDER BY keywords_id, period_start;
+        """
+    cursor.execute(query, (keyword_ids, start.to_pydatetime()))
+    data = pd.DataFrame(cursor.fetchall(), columns=ROLLUP_COLUMNS)
+    data['date_and_hour'] = pd.to_datetime(data['date_and_hour'])
+    return data
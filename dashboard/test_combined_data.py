@@ -1,12 +1,17 @@
 """Test script for combined_data.py"""
 
+import io
+import json
 import logging
+from datetime import datetime
 from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
 import pandas as pd
 import pytest
 import psycopg2
 from combined_data import (
-    get_connection, download_csv_from_s3_to_dataframe, fetch_keyword_recordings_as_dataframe, main_combine)
+    get_connection, download_archive_from_s3_to_dataframe, fetch_keyword_recordings_as_dataframe, main_combine,
+    ARCHIVE_COLUMNS)
 
 
 @pytest.fixture
@@ -20,8 +25,7 @@ def aws_env_vars():
         "DB_PASSWORD": "password",
         "SCHEMA_NAME": "schema",
         "S3_BUCKET_NAME": "bucket_name",
-        "S3_FOLDER_NAME": "folder_name",
-        "S3_FILE_NAME": "file_name"
+        "S3_FOLDER_NAME": "folder_name"
 
     }):
         yield
@@ -67,50 +71,98 @@ def test_postgres_connection_exception(mock_connect, aws_env_vars, caplog):
         assert record.levelname == 'ERROR'
 
 
-@patch('combined_data.os.remove')
-@patch('combined_data.pd.read_csv')
-@patch('os.getcwd', return_value='/mock/directory')
 @patch('combined_data.boto3.client')
-def test_successful_download_csv(mock_client, mock_getcwd, mock_readcsv, mock_remove):
-    """Test the successful download of a csv from S3 bucket to a data frame."""
-    mock_client.download_file.return_value = None
-    mock_readcsv.return_value = pd.DataFrame(
-        {"date_and_hour": ["2024-12-12 10:00:00"]})
+def test_successful_download_archive(mock_client):
+    """Test every file in the archive manifest is read, keeping the latest copy of a recording."""
+    parquet = io.BytesIO()
+    pd.DataFrame({"keyword_recordings_id": [1, 2], "keywords_id": [10, 10], "total_mentions": [7, 8],
+                  "date_and_hour": pd.to_datetime(["2024-12-12 10:00", "2024-12-12 11:00"])}
+                 ).to_parquet(parquet, index=False)
+    objects = {
+        "test-folder/manifest.json": json.dumps({"files": [
+            {"key": "test-folder/keyword_recording.csv", "format": "csv"},
+            {"key": "test-folder/recordings/part.parquet", "format": "parquet"}]}).encode(),
+        "test-folder/keyword_recording.csv":
+            b"keyword_recordings_id,keywords_id,total_mentions,avg_sentiment,date_and_hour\n"
+            b"1,10,5,0.5,2024-12-12 10:00:00\n3,10,4,-0.25,2024-12-12 09:00:00\n",
+        "test-folder/recordings/part.parquet": parquet.getvalue()
+    }
     mock_s3 = MagicMock()
+    mock_s3.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(objects[Key])}
     mock_client.return_value = mock_s3
 
-    bucket_name = "test-bucket"
-    folder_name = "test-folder"
-    file_name = "temp_file.csv"
-    df = download_csv_from_s3_to_dataframe(
-        bucket_name, folder_name, file_name)
+    df = download_archive_from_s3_to_dataframe("test-bucket", "test-folder")
 
     mock_client.assert_called_once_with("s3")
-    mock_s3.download_file.assert_called_once_with(
-        bucket_name, f"{folder_name}/{file_name}", "/mock/directory/temp_file.csv")
-    mock_readcsv.assert_called_once_with("/mock/directory/temp_file.csv")
-    mock_remove.assert_called_once_with("/mock/directory/temp_file.csv")
-    assert isinstance(df, pd.DataFrame)
-    assert "date_and_hour" in df.columns
+    assert list(df.columns) == ARCHIVE_COLUMNS
+    assert df["keyword_recordings_id"].tolist() == [3, 1, 2]
+    assert df["total_mentions"].tolist() == [4, 7, 8]
+    assert df["sentiment_sum"].tolist()[0] == -1.0
+    assert pd.api.types.is_datetime64_any_dtype(df["date_and_hour"])
+
+
+@patch('combined_data.boto3.client')
+def test_download_archive_keeps_latest_keyword_hour(mock_client):
+    """Test a keyword and hour archived twice under different recording ids keeps the latest copy."""
+    objects = {
+        "test-folder/manifest.json": json.dumps({"files": [
+            {"key": "test-folder/old.csv", "format": "csv"},
+            {"key": "test-folder/new.csv", "format": "csv"}]}).encode(),
+        "test-folder/old.csv": b"keyword_recordings_id,keywords_id,total_mentions,avg_sentiment,date_and_hour\n"
+                               b"1,10,5,0.5,2024-12-12 10:00:00\n",
+        "test-folder/new.csv": b"keyword_recordings_id,keywords_id,total_mentions,avg_sentiment,date_and_hour\n"
+                               b"7,10,6,0.5,2024-12-12 10:00:00\n"
+    }
+    mock_s3 = MagicMock()
+    mock_s3.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(objects[Key])}
+    mock_client.return_value = mock_s3
+
+    df = download_archive_from_s3_to_dataframe("test-bucket", "test-folder")
+
+    assert df["keyword_recordings_id"].tolist() == [7]
+    assert df["total_mentions"].tolist() == [6]
 
 
-@patch('combined_data.os.remove')
-@patch('combined_data.pd.read_csv')
-@patch('os.getcwd', return_value='/mock/directory')
 @patch('combined_data.boto3.client')
-def test_download_csv_exception(mock_client, mock_getcwd, mock_readcsv, mock_remove, caplog):
-    """Test case when something goes wrong in the downloading of csv from the S3 or the conversion to dataframe, an error is raised."""
+def test_download_archive_without_manifest_reads_legacy_csv(mock_client):
+    """Test a folder archived before the manifest existed has its CSV files read oldest first."""
+    mock_s3 = MagicMock()
+    mock_client.return_value = mock_s3
+    csv = {
+        "test-folder/keyword_recording.csv": b"keyword_recordings_id,keywords_id,total_mentions,avg_sentiment,date_and_hour\n"
+                                             b"1,10,5,0.5,2024-12-12 10:00:00\n",
+        "test-folder/keyword_recording_2.csv": b"keyword_recordings_id,keywords_id,total_mentions,avg_sentiment,date_and_hour\n"
+                                               b"2,10,9,0.5,2024-12-12 10:00:00\n"
+    }
+
+    def get_object(Bucket, Key):
+        if Key not in csv:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(csv[Key])}
+
+    mock_s3.get_object.side_effect = get_object
+    mock_s3.get_paginator.return_value.paginate.return_value = [{"Contents": [
+        {"Key": "test-folder/keyword_recording_2.csv", "LastModified": datetime(2024, 12, 13)},
+        {"Key": "test-folder/notes.txt", "LastModified": datetime(2024, 12, 11)},
+        {"Key": "test-folder/keyword_recording.csv", "LastModified": datetime(2024, 12, 12)}]}]
 
+    df = download_archive_from_s3_to_dataframe("test-bucket", "test-folder")
+
+    mock_s3.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket="test-bucket", Prefix="test-folder/")
+    assert df["keyword_recordings_id"].tolist() == [2]
+    assert df["sentiment_sum"].tolist() == [4.5]
+
+
+@patch('combined_data.boto3.client')
+def test_download_archive_exception(mock_client, caplog):
+    """Test case when something goes wrong reading the archive from S3, None is returned and the error logged."""
     mock_s3 = MagicMock()
     mock_client.return_value = mock_s3
-    mock_client.download_file.side_effect = Exception()
+    mock_s3.get_object.side_effect = Exception()
 
-    bucket_name = "test-bucket"
-    folder_name = "test-folder"
-    file_name = "temp_file.csv"
     with caplog.at_level(logging.INFO):
-        df = download_csv_from_s3_to_dataframe(
-            bucket_name, folder_name, file_name)
+        df = download_archive_from_s3_to_dataframe("test-bucket", "test-folder")
 
     assert df is None
     assert "An error occurred:" in caplog.text
@@ -156,10 +208,10 @@ def test_fetch_keyword_recordings_error(mock_conn, mock_read_sql, aws_env_vars):
 
 
 @patch("combined_data.fetch_keyword_recordings_as_dataframe")
-@patch("combined_data.download_csv_from_s3_to_dataframe")
+@patch("combined_data.download_archive_from_s3_to_dataframe")
 @patch('combined_data.get_connection')
 def test_main_combine_success(mock_conn, mock_download, mock_fetch_df, aws_env_vars, caplog):
-    """Test the main combine function successful downloads a csv file and returns a dataframe."""
+    """Test the main combine function successfully downloads the archive and returns a dataframe."""
     mock_download.return_value = pd.DataFrame({
         'keyword_recordings_id': [1],
         'keywords_id': [10],
@@ -181,13 +233,14 @@ def test_main_combine_success(mock_conn, mock_download, mock_fetch_df, aws_env_v
     assert isinstance(result, pd.DataFrame)
     assert not result.empty
     assert len(result) == 2
+    assert list(result.columns) == ARCHIVE_COLUMNS
     mock_download.assert_called_once()
     mock_fetch_df.assert_called_once()
     assert 'Combined DataFrame from S3 created successfully.' in caplog.text
 
 
 @patch("combined_data.fetch_keyword_recordings_as_dataframe")
-@patch("combined_data.download_csv_from_s3_to_dataframe")
+@patch("combined_data.download_archive_from_s3_to_dataframe")
 @patch('combined_data.get_connection')
 def test_main_combine_one_df_none_error(mock_conn, mock_download, mock_fetch_df, aws_env_vars, caplog):
     """Test error is logged if one of the dfs are returned as none."""
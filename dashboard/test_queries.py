@@ -0,0 +1,39 @@
+"""Test script for queries.py"""
+
+from unittest.mock import MagicMock
+import datetime
+import pandas as pd
+from queries import choose_rollup, get_first_rollup_period, get_rollups
+
+
+def test_choose_rollup_coarsest_that_fits():
+    """Test the coarsest rollup with enough periods to chart is chosen."""
+    now = pd.Timestamp('2024-12-31 12:00')
+
+    assert choose_rollup(now - pd.Timedelta(days=90), now) == 'keyword_rollups_1d'
+    assert choose_rollup(now - pd.Timedelta(days=7), now) == 'keyword_rollups_6h'
+    assert choose_rollup(now - pd.Timedelta(days=2), now) == 'keyword_rollups_1h'
+    assert choose_rollup(now - pd.Timedelta(hours=3), now) == 'keyword_rollups_1h'
+
+
+def test_get_first_rollup_period_no_recordings():
+    """Test keywords without any recordings have no first period."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = {'first_period': None}
+
+    assert get_first_rollup_period([1, 2], mock_cursor) is None
+
+
+def test_get_rollups_reads_one_table():
+    """Test rollups are read from the chosen table and keep their columns when empty."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+
+    result = get_rollups([1], 'keyword_rollups_6h',
+                         pd.Timestamp('2024-12-01'), mock_cursor)
+
+    query, params = mock_cursor.execute.call_args.args
+    assert 'FROM keyword_rollups_6h' in query
+    assert params == ([1], datetime.datetime(2024, 12, 1))
+    assert list(result.columns) == ['keywords_id', 'date_and_hour', 'total_mentions',
+                                    'mentions_per_hour', 'avg_sentiment']
@@ -3,16 +3,55 @@
 # pylint: disable=E0401
 
 from os import environ as ENV
+import asyncio
 import logging
-import requests
+import math
+import random
+import time
+from urllib.parse import urljoin
+import aiohttp
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import RealDictCursor, RealDictRow
-from psycopg2.extensions import cursor as Cursor
+from psycopg2.extensions import cursor as Cursor, connection as Connection
 
 load_dotenv()
 
-API_ENDPOINT = ENV["API_ENDPOINT"]
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+API_ENDPOINT = ENV.get("API_ENDPOINT")
+REFRESH_MODE = ENV.get("REFRESH_MODE", "api")
+
+DEFAULT_CHUNK_SIZE = 25
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 30
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 10
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_JOB_POLL_SECONDS = 10
+DEFAULT_JOB_WAIT_SECONDS = 900
+# A job the API no longer knows, e.g. after a restart, counts as finished without success
+FINISHED_JOB_STATUSES = ("succeeded", "failed", "missing")
+
+DUE_KEYWORDS = """
+    WITH due AS (
+        SELECT DISTINCT s.keywords_id
+        FROM subscription AS s
+        LEFT JOIN keyword_refresh_schedule AS rs ON rs.keywords_id = s.keywords_id
+        WHERE rs.next_refresh_at IS NULL
+        OR rs.next_refresh_at <= date_trunc('hour', NOW())
+    )"""
+
+MARK_REFRESHED = """
+    UPDATE keyword_refresh_schedule AS rs
+    SET last_refreshed_at = date_trunc('hour', NOW()),
+        next_refresh_at = date_trunc('hour', NOW())
+            + make_interval(hours => rs.refresh_interval_hours)"""
 
 
 def get_connection() -> tuple:
@@ -30,46 +69,204 @@ def get_connection() -> tuple:
     return conn, cursor
 
 
-def submit_topic(data: dict) -> None:
-    """Submit topic details to the API"""
+def backoff_delay(attempt: int) -> float:
+    """Returns a randomised wait before a retry that grows with each attempt"""
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+async def submit_chunk(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                       topic_names: list[str], retries: int) -> dict:
+    """Submit a chunk of topics to the API's batch endpoint, retrying failed
+    connections and server errors with jittered backoff. Keeps the status URL of every
+    job the chunk's topics were queued on or attached to."""
+    result = {"topics": topic_names, "ok": False, "attempts": 0, "job_id": None,
+              "status_urls": []}
+    async with semaphore:
+        started = time.monotonic()
+        for attempt in range(retries + 1):
+            result["attempts"] += 1
+            try:
+                async with session.post(f"{API_ENDPOINT}/batch",
+                                        json={"topic_names": topic_names}) as response:
+                    body = await response.json(content_type=None)
+                    if response.status in (200, 202):
+                        status_urls = {body.get("status_url")} | {
+                            topic.get("status_url") for topic in body.get("topics", [])}
+                        result.update(ok=True, job_id=body.get("job_id"),
+                                      status_urls=sorted(url for url in status_urls if url))
+                        break
+                    logging.warning("Error: %s", body.get("message", "Unknown error"))
+                    if response.status not in RETRY_STATUSES:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.warning("Failed to connect to the API. Error: %s", e)
+            if attempt < retries:
+                await asyncio.sleep(backoff_delay(attempt))
+        result["latency"] = time.monotonic() - started
+
+    if result["ok"]:
+        logging.info("✅ %s topics submitted successfully! Job: %s",
+                     len(topic_names), result["job_id"])
+    else:
+        logging.error("Failed to submit %s after %s attempts.",
+                      topic_names, result["attempts"])
+    return result
+
+
+async def submit_topics(topic_names: list[str]) -> list[dict]:
+    """Submit topics in chunks over one pooled HTTP session, with a bounded number
+    of requests in flight so one slow chunk does not hold up the rest"""
+    chunk_size = int(ENV.get("SUBMIT_CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+    concurrency = int(ENV.get("SUBMIT_CONCURRENCY", DEFAULT_CONCURRENCY))
+    retries = int(ENV.get("SUBMIT_RETRIES", DEFAULT_RETRIES))
+    timeout = aiohttp.ClientTimeout(total=float(ENV.get("SUBMIT_TIMEOUT", DEFAULT_TIMEOUT)))
+    chunks = [topic_names[i:i + chunk_size]
+              for i in range(0, len(topic_names), chunk_size)]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*(submit_chunk(session, semaphore, chunk, retries)
+                                      for chunk in chunks))
+
+
+async def job_status(session: aiohttp.ClientSession, status_url: str) -> str:
+    """Returns the status of a job, or None if the API could not be reached"""
     try:
-        response = requests.post(API_ENDPOINT, json=data, timeout=1000)
-        if response.status_code == 200:
-            logging.info("✅ Topic submitted successfully!")
-        else:
-            logging.error("Error: %s", response.json().get(
-                'message', 'Unknown error'))
-    except requests.exceptions.RequestException as e:
-        logging.error("Failed to connect to the API. Error: %s", e)
-
-
-def find_unique_keywords(cursor: Cursor) -> RealDictRow:
-    """Finds the keywords that users have subscribed to"""
+        async with session.get(urljoin(API_ENDPOINT, status_url)) as response:
+            if response.status == 404:
+                return "missing"
+            body = await response.json(content_type=None)
+            return body.get("status")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.warning("Failed to check job %s. Error: %s", status_url, e)
+        return None
+
+
+async def poll_jobs(session: aiohttp.ClientSession, status_urls: list[str],
+                    poll_seconds: float, wait_seconds: float) -> dict:
+    """Checks the submitted jobs every poll_seconds until they have all finished or
+    wait_seconds have passed. Returns the status of each finished job."""
+    deadline = time.monotonic() + wait_seconds
+    statuses, pending = {}, list(status_urls)
+    while pending:
+        checked = await asyncio.gather(*(job_status(session, url) for url in pending))
+        statuses.update((url, status) for url, status in zip(pending, checked)
+                        if status in FINISHED_JOB_STATUSES)
+        pending = [url for url in pending if url not in statuses]
+        if not pending or time.monotonic() + poll_seconds > deadline:
+            break
+        await asyncio.sleep(poll_seconds)
+
+    if pending:
+        logging.warning("%s jobs had not finished after %ss, so their keywords stay due.",
+                        len(pending), wait_seconds)
+    return statuses
+
+
+async def wait_for_jobs(status_urls: list[str]) -> dict:
+    """Waits for the jobs the topics were submitted to over one HTTP session"""
+    poll_seconds = float(ENV.get("JOB_POLL_SECONDS", DEFAULT_JOB_POLL_SECONDS))
+    wait_seconds = float(ENV.get("JOB_WAIT_SECONDS", DEFAULT_JOB_WAIT_SECONDS))
+    timeout = aiohttp.ClientTimeout(total=float(ENV.get("SUBMIT_TIMEOUT", DEFAULT_TIMEOUT)))
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        return await poll_jobs(session, status_urls, poll_seconds, wait_seconds)
+
+
+def refreshed_topics(results: list[dict], statuses: dict) -> list[str]:
+    """Returns the topics of the chunks whose jobs all succeeded. A chunk the API
+    reported as already up to date has no jobs to wait for."""
+    return [topic for result in results
+            if result["ok"] and all(statuses.get(url) == "succeeded"
+                                    for url in result["status_urls"])
+            for topic in result["topics"]]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Returns the nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def summarise(results: list[dict]) -> dict:
+    """Logs and returns how many topics were submitted and the latency of the requests"""
+    latencies = [result["latency"] for result in results]
+    summary = {
+        "requests": len(results),
+        "succeeded": sum(len(r["topics"]) for r in results if r["ok"]),
+        "failed": sum(len(r["topics"]) for r in results if not r["ok"]),
+        "retries": sum(r["attempts"] - 1 for r in results),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+    logging.info("Submitted %s topics, %s failed, in %s requests with %s retries. "
+                 "Latency p50 %.2fs, p95 %.2fs, p99 %.2fs.",
+                 summary["succeeded"], summary["failed"], summary["requests"],
+                 summary["retries"], summary["p50"], summary["p95"], summary["p99"])
+    return summary
+
+
+def enqueue_refresh_tasks(conn: Connection, cursor: Cursor) -> int:
+    """Adds this hour's refresh task for every subscribed keyword that is due a
+    refresh to the work queue that the pipeline's refresh workers claim from, with the
+    same database function as `refresh_worker.py enqueue`. The workers move the
+    schedule on when they complete a task, so failures are retried."""
     cursor.execute(
-        """SELECT DISTINCT keywords_id
-         FROM subscription""")
-    keywords = cursor.fetchall()
-    return keywords
+        "SELECT enqueue_keyword_refresh_tasks(date_trunc('hour', NOW())::TIMESTAMP) AS added")
+    added = cursor.fetchone()["added"]
+    conn.commit()
+    return added
 
 
-def fetch_keyword(cursor: Cursor, keyword_id: int) -> RealDictRow:
-    """Find keyword name from ID"""
+def find_due_keywords(cursor: Cursor) -> list[RealDictRow]:
+    """Finds the ID and name of every subscribed keyword due a refresh this hour"""
     cursor.execute(
-        """SELECT keyword
-         FROM keywords
-         WHERE keywords_id = %s""", (keyword_id,))
-    keywords = cursor.fetchone()
+        f"""{DUE_KEYWORDS}
+         SELECT k.keywords_id, k.keyword
+         FROM due
+         JOIN keywords AS k ON k.keywords_id = due.keywords_id""")
+    keywords = cursor.fetchall()
     return keywords
 
 
+def mark_refreshed(conn: Connection, cursor: Cursor, keyword_ids: list[int]) -> None:
+    """Moves the next refresh of keywords whose jobs succeeded on by their refresh interval"""
+    cursor.execute(f"""{MARK_REFRESHED}
+         WHERE rs.keywords_id = ANY(%s)""", (keyword_ids,))
+    conn.commit()
+
+
 def main() -> None:
-    """Run ETL through API for each keyword"""
-    _, cursor = get_connection()
-    keywords = find_unique_keywords(cursor)
-    for keyword_id in keywords:
-        keyword = fetch_keyword(cursor, keyword_id["keywords_id"])["keyword"]
-        topic_data = {"topic_name": keyword}
-        submit_topic(topic_data)
+    """Refresh all subscribed keywords that are due, either through the API, moving on
+    the schedule of those whose jobs succeed, or by queueing them for the refresh workers"""
+    conn, cursor = get_connection()
+    try:
+        if REFRESH_MODE == "queue":
+            logging.info("Queued %s keyword refresh tasks.",
+                         enqueue_refresh_tasks(conn, cursor))
+            return
+
+        keywords = find_due_keywords(cursor)
+        if not keywords:
+            logging.info("No keywords are due a refresh.")
+            return
+
+        keyword_ids = {row["keyword"]: row["keywords_id"] for row in keywords}
+        results = asyncio.run(submit_topics(list(keyword_ids)))
+        summarise(results)
+        status_urls = sorted({url for result in results if result["ok"]
+                              for url in result["status_urls"]})
+        statuses = asyncio.run(wait_for_jobs(status_urls)) if status_urls else {}
+        refreshed = [keyword_ids[topic] for topic in refreshed_topics(results, statuses)]
+        logging.info("Refreshed %s of %s due keywords.", len(refreshed), len(keyword_ids))
+        if refreshed:
+            mark_refreshed(conn, cursor, refreshed)
+    finally:
+        cursor.close()
+        conn.close()
 
 
 if __name__ == "__main__":
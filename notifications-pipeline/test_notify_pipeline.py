@@ -0,0 +1,223 @@
+"""Test script for notify_pipeline.py"""
+# pylint: skip-file
+
+import asyncio
+import logging
+from unittest.mock import AsyncMock, MagicMock, patch
+import aiohttp
+import pytest
+from notify_pipeline import (backoff_delay, submit_chunk, poll_jobs, refreshed_topics,
+                             percentile, summarise, enqueue_refresh_tasks, main)
+
+
+class FakeResponse:
+    """Response of the batch endpoint with a status and JSON body."""
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def json(self, content_type=None):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+def make_session(*outcomes):
+    """Session whose posts answer with each outcome in turn, raising exceptions."""
+    session = MagicMock()
+    session.post.side_effect = list(outcomes)
+    return session
+
+
+def run_chunk(session, retries=3):
+    """Submits one chunk of topics with the backoff waits patched out."""
+    with patch('notify_pipeline.asyncio.sleep', new=AsyncMock()) as mock_sleep, \
+            patch('notify_pipeline.backoff_delay', return_value=0.25) as mock_delay:
+        result = asyncio.run(submit_chunk(session, asyncio.Semaphore(1),
+                                          ['python', 'rust'], retries))
+    return result, mock_sleep, mock_delay
+
+
+def test_submit_chunk_succeeds_first_time():
+    """Test an accepted chunk is submitted once without waiting."""
+    session = make_session(FakeResponse(202, {
+        'job_id': 'abc', 'status_url': '/jobs/abc',
+        'topics': [{'topic': 'python', 'status_url': '/jobs/abc'},
+                   {'topic': 'rust', 'status_url': '/jobs/def'}]}))
+    result, mock_sleep, _ = run_chunk(session)
+
+    assert result['ok'] and result['job_id'] == 'abc'
+    assert result['status_urls'] == ['/jobs/abc', '/jobs/def']
+    assert result['attempts'] == 1
+    assert session.post.call_args.kwargs['json'] == {'topic_names': ['python', 'rust']}
+    mock_sleep.assert_not_called()
+
+
+def test_submit_chunk_retries_server_errors_and_connection_failures():
+    """Test 5xx responses and connection errors are retried after a backoff wait."""
+    session = make_session(FakeResponse(503, {'message': 'busy'}),
+                           aiohttp.ClientConnectionError('reset'),
+                           FakeResponse(200, {'job_id': None}))
+    result, mock_sleep, mock_delay = run_chunk(session)
+
+    assert result['ok']
+    assert result['attempts'] == 3
+    assert [c.args for c in mock_delay.call_args_list] == [(0,), (1,)]
+    assert [c.args for c in mock_sleep.call_args_list] == [(0.25,), (0.25,)]
+
+
+def test_submit_chunk_gives_up_after_retries(caplog):
+    """Test a chunk that keeps failing is reported after the last retry without a final wait."""
+    session = make_session(*[FakeResponse(429, {'message': 'slow down'})] * 3)
+    with caplog.at_level(logging.ERROR):
+        result, mock_sleep, _ = run_chunk(session, retries=2)
+
+    assert not result['ok']
+    assert result['attempts'] == 3
+    assert mock_sleep.call_count == 2
+    assert 'after 3 attempts' in caplog.text
+
+
+def test_submit_chunk_does_not_retry_client_errors():
+    """Test a rejected chunk is not sent again."""
+    session = make_session(FakeResponse(400, {'message': 'bad request'}))
+    result, mock_sleep, _ = run_chunk(session)
+
+    assert not result['ok']
+    assert result['attempts'] == 1
+    mock_sleep.assert_not_called()
+
+
+def test_poll_jobs_waits_until_jobs_finish():
+    """Test jobs are checked again after a wait until they finish, and unknown jobs count as finished."""
+    session = MagicMock()
+    session.get.side_effect = [FakeResponse(200, {'status': 'running'}),
+                               FakeResponse(404, {'message': 'Job not found'}),
+                               FakeResponse(200, {'status': 'succeeded'})]
+    with patch('notify_pipeline.asyncio.sleep', new=AsyncMock()) as mock_sleep, \
+            patch('notify_pipeline.API_ENDPOINT', 'http://api:5000/topics'):
+        statuses = asyncio.run(poll_jobs(session, ['/jobs/a', '/jobs/b'], 5, 60))
+
+    assert statuses == {'/jobs/a': 'succeeded', '/jobs/b': 'missing'}
+    assert session.get.call_args.args == ('http://api:5000/jobs/a',)
+    mock_sleep.assert_called_once_with(5)
+
+
+def test_poll_jobs_stops_at_the_deadline(caplog):
+    """Test jobs still running when the wait is over are left out."""
+    session = MagicMock()
+    session.get.side_effect = lambda url: FakeResponse(200, {'status': 'running'})
+    with patch('notify_pipeline.asyncio.sleep', new=AsyncMock()) as mock_sleep:
+        with caplog.at_level(logging.WARNING):
+            statuses = asyncio.run(poll_jobs(session, ['/jobs/a'], 5, 4))
+
+    assert statuses == {}
+    mock_sleep.assert_not_called()
+    assert 'stay due' in caplog.text
+
+
+def test_refreshed_topics_only_counts_succeeded_jobs():
+    """Test a chunk's topics are refreshed only when every one of its jobs succeeded."""
+    results = [{'topics': ['a', 'b'], 'ok': True, 'status_urls': ['/jobs/1']},
+               {'topics': ['c'], 'ok': True, 'status_urls': ['/jobs/1', '/jobs/2']},
+               {'topics': ['d'], 'ok': True, 'status_urls': ['/jobs/3']},
+               {'topics': ['e'], 'ok': True, 'status_urls': []},
+               {'topics': ['f'], 'ok': False, 'status_urls': []}]
+    statuses = {'/jobs/1': 'succeeded', '/jobs/2': 'failed'}
+
+    assert refreshed_topics(results, statuses) == ['a', 'b', 'e']
+
+
+@patch('notify_pipeline.mark_refreshed')
+@patch('notify_pipeline.find_due_keywords')
+@patch('notify_pipeline.get_connection')
+def test_main_marks_only_keywords_whose_jobs_succeeded(mock_connection, mock_find, mock_mark):
+    """Test an accepted submission does not move the schedule on until its job succeeds."""
+    conn, cursor = MagicMock(), MagicMock()
+    mock_connection.return_value = (conn, cursor)
+    mock_find.return_value = [{'keywords_id': 1, 'keyword': 'python'},
+                              {'keywords_id': 2, 'keyword': 'rust'}]
+    results = [{'topics': ['python'], 'ok': True, 'attempts': 1, 'latency': 0.1,
+                'status_urls': ['/jobs/1']},
+               {'topics': ['rust'], 'ok': True, 'attempts': 1, 'latency': 0.1,
+                'status_urls': ['/jobs/2']}]
+    with patch('notify_pipeline.submit_topics', new=AsyncMock(return_value=results)), \
+            patch('notify_pipeline.wait_for_jobs', new=AsyncMock(
+                return_value={'/jobs/1': 'succeeded', '/jobs/2': 'failed'})) as mock_wait:
+        main()
+
+    mock_wait.assert_awaited_once_with(['/jobs/1', '/jobs/2'])
+    mock_mark.assert_called_once_with(conn, cursor, [1])
+
+
+@pytest.mark.parametrize('attempt, ceiling', [(0, 0.5), (1, 1), (3, 4), (10, 10)])
+def test_backoff_delay_is_full_jitter_up_to_the_cap(attempt, ceiling):
+    """Test each wait is drawn between zero and the capped exponential ceiling."""
+    with patch('notify_pipeline.random.uniform', side_effect=lambda low, high: high) as mock_uniform:
+        assert backoff_delay(attempt) == ceiling
+    assert mock_uniform.call_args.args == (0, ceiling)
+    assert 0 <= backoff_delay(attempt) <= ceiling
+
+
+def test_percentile_nearest_rank():
+    """Test percentiles pick the nearest-rank value and an empty list gives zero."""
+    values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+    assert percentile(values, 50) == 5
+    assert percentile(values, 95) == 10
+    assert percentile(values, 10) == 1
+    assert percentile(values, 0) == 1
+    assert percentile([2.5], 99) == 2.5
+    assert percentile([], 50) == 0.0
+
+
+def test_summarise(caplog):
+    """Test the summary counts topics by outcome, retries and latency percentiles."""
+    results = [{'topics': ['a', 'b'], 'ok': True, 'attempts': 1, 'latency': 0.5},
+               {'topics': ['c'], 'ok': False, 'attempts': 4, 'latency': 3.0},
+               {'topics': ['d'], 'ok': True, 'attempts': 2, 'latency': 1.0}]
+    with caplog.at_level(logging.INFO):
+        summary = summarise(results)
+
+    assert summary == {'requests': 3, 'succeeded': 3, 'failed': 1, 'retries': 4,
+                       'p50': 1.0, 'p95': 3.0, 'p99': 3.0}
+    assert 'Submitted 3 topics, 1 failed, in 3 requests with 4 retries' in caplog.text
+    assert 'p50 1.00s, p95 3.00s, p99 3.00s' in caplog.text
+
+
+def test_enqueue_refresh_tasks_uses_the_shared_function():
+    """Test queue mode adds tasks with the database function the refresh workers use."""
+    conn, cursor = MagicMock(), MagicMock()
+    cursor.fetchone.return_value = {'added': 4}
+    assert enqueue_refresh_tasks(conn, cursor) == 4
+    assert 'enqueue_keyword_refresh_tasks(' in cursor.execute.call_args.args[0]
+    conn.commit.assert_called_once()
+
+
+@pytest.mark.parametrize('mode', ['queue', 'api'])
+@patch('notify_pipeline.find_due_keywords', return_value=[])
+@patch('notify_pipeline.enqueue_refresh_tasks', return_value=0)
+@patch('notify_pipeline.get_connection')
+def test_main_closes_the_connection(mock_connection, mock_enqueue, mock_find, mode):
+    """Test the database connection is closed whichever way the run ends."""
+    conn, cursor = MagicMock(), MagicMock()
+    mock_connection.return_value = (conn, cursor)
+    with patch('notify_pipeline.REFRESH_MODE', mode):
+        main()
+    cursor.close.assert_called_once()
+    conn.close.assert_called_once()
+
+
+@patch('notify_pipeline.find_due_keywords', side_effect=RuntimeError('boom'))
+@patch('notify_pipeline.get_connection')
+def test_main_closes_the_connection_on_error(mock_connection, mock_find):
+    """Test the database connection is closed when the run fails."""
+    conn, cursor = MagicMock(), MagicMock()
+    mock_connection.return_value = (conn, cursor)
+    with pytest.raises(RuntimeError):
+        main()
+    conn.close.assert_called_once()
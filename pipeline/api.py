@@ -1,27 +1,87 @@
 """Api.py: script setting up api to post new topics to."""
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, url_for
 from etl import main
+from jobs import JobQueue, normalize_topic
+from run_history import refreshed_since
+import metrics
 
 app = Flask(__name__)
+queue = JobQueue(refreshed_since=refreshed_since)
+
+
+SUBMISSION_RESPONSES = {
+    "queued": ("Topic queued successfully", 202),
+    "attached": ("Topic is already being collected", 202),
+    "fresh": ("Topic data is already up to date", 200)
+}
 
 
 @app.route("/topics", methods=["POST"])
 def add_topic() -> None:
-    """API endpoint to add new topics to RDS."""
+    """API endpoint to queue an ETL job adding new topics to RDS.
+    Requests for a topic already in flight share its job."""
     data = request.get_json()
     topic_name = data.get("topic_name")
 
-    if not topic_name:
+    if not topic_name or not topic_name.strip():
         return jsonify({"message": "Topic name is required"}), 400
 
-    main([topic_name])
+    topic = normalize_topic(topic_name)
+    job, outcome = queue.submit_topic(main, topic)
+    message, status_code = SUBMISSION_RESPONSES[outcome]
+    if job is None:
+        return jsonify({"message": message, "topic": topic,
+                        "job_id": None, "status_url": None}), status_code
+    location = url_for("get_job", job_id=job["job_id"])
+
+    return jsonify({"message": message, "topic": topic, "job_id": job["job_id"],
+                    "status_url": location}), status_code, {"Location": location}
+
+
+@app.route("/topics/batch", methods=["POST"])
+def add_topics() -> None:
+    """API endpoint to queue one ETL job for many topics, so they share one scan of S3.
+    Topics already in flight or fresh are reported against their existing job."""
+    data = request.get_json()
+    topic_names = data.get("topic_names")
+
+    if not isinstance(topic_names, list) or not topic_names or \
+            not all(isinstance(name, str) and name.strip() for name in topic_names):
+        return jsonify({"message": "A list of topic names is required"}), 400
+
+    job, covered = queue.submit_topics(main, topic_names)
+    topics = [{"topic": topic, "job_id": job_id, "outcome": outcome,
+               "status_url": url_for("get_job", job_id=job_id) if job_id else None}
+              for topic, (job_id, outcome) in covered.items()]
 
-    return jsonify({"message": "Topic added successfully", "topic": topic_name}), 200
+    if job is None:
+        return jsonify({"message": "Topics are already up to date or being collected",
+                        "job_id": None, "topics": topics}), 200
+
+    location = url_for("get_job", job_id=job["job_id"])
+    return jsonify({"message": "Topics queued successfully", "job_id": job["job_id"],
+                    "status_url": location, "topics": topics}), 202, {"Location": location}
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str) -> None:
+    """API endpoint to report the status and timings of a queued job."""
+    job = queue.get(job_id)
+
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+
+    return jsonify(job), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics() -> Response:
+    """API endpoint exposing ETL stage timings and counters for Prometheus to scrape."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
 
     # app.run(debug=True)
-
@@ -0,0 +1,138 @@
+"""Runs the ETL pipeline on an asyncio event loop, reading S3 concurrently with aioboto3
+while the Google Trends suggestions and keyword ids are looked up on threads"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections.abc import Awaitable
+from os import environ as ENV
+import aioboto3
+import pandas as pd
+from extract import recent_dates, hourly_keys, hour_sentiment, related_terms
+from transform import get_keyword_map, transform_batch
+from load import main as load_main
+from metrics import timer, inc
+from etl import run_pipeline
+from profiling import profiled_call
+
+DEFAULT_S3_CONCURRENCY = 16
+
+# The tasks each task waits on before it can start
+DEPENDENCIES = {
+    "transform": ("extract", "suggestions", "keyword_ids"),
+    "load": ("transform",)
+}
+
+
+def s3_client():
+    """Returns an aioboto3 S3 client to use in an async with block"""
+    return aioboto3.Session().client("s3")
+
+
+async def read_hour(s3, bucket: str, date: str, key: str, hour: str, topic: list[str],
+                    semaphore: asyncio.Semaphore) -> list[dict]:
+    """Reads one hourly file and scores it on a thread"""
+    async with semaphore:
+        with timer("s3_get"):
+            response = await s3.get_object(Bucket=bucket, Key=key)
+            body = await response['Body'].read()
+    inc("etl_s3_requests_total", operation="get_object")
+    inc("etl_s3_bytes_total", len(body))
+    return await asyncio.to_thread(profiled_call, hour_sentiment, date, hour, body, topic)
+
+
+async def list_date(s3, bucket: str, date: str, semaphore: asyncio.Semaphore) -> list:
+    """Returns the date, key and hour of each hourly file for a date"""
+    prefix = f"bluesky/{date}/"
+    async with semaphore:
+        with timer("s3_list"):
+            response = await s3.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    inc("etl_s3_requests_total", operation="list_objects_v2")
+    if 'Contents' not in response:
+        logging.info("No files found in the folder for date %s.", date)
+    return [(date, key, hour) for key, hour in hourly_keys(response, prefix)]
+
+
+async def scan_s3(topic: list[str]) -> list[dict]:
+    """Returns the sentiment and mentions of each keyword for every hour of the past
+    7 days, with up to S3_CONCURRENCY requests to S3 at once"""
+    bucket = os.environ.get("S3_BUCKET_NAME")
+    semaphore = asyncio.Semaphore(int(ENV.get("S3_CONCURRENCY", DEFAULT_S3_CONCURRENCY)))
+    async with s3_client() as s3:
+        listings = await asyncio.gather(*(list_date(s3, bucket, date, semaphore)
+                                          for date in recent_dates()))
+        hours = await asyncio.gather(*(read_hour(s3, bucket, date, key, hour, topic, semaphore)
+                                       for listing in listings
+                                       for date, key, hour in listing))
+
+    rows = [row for hour_data in hours for row in hour_data]
+    if not rows:
+        logging.info("No files found in the past 7 days.")
+        raise ValueError("No files found in the past 7 days.")
+    inc("etl_rows_total", len(rows), stage="extract")
+    return rows
+
+
+def critical_path(spans: dict, dependencies: dict) -> list[tuple[str, float]]:
+    """Walks back from the last task to finish, through the dependency that finished
+    last at each step. Returns the tasks that set the length of the run and how long
+    each took."""
+    task = max(spans, key=lambda name: spans[name][1])
+    path = []
+    while task:
+        start, end = spans[task]
+        path.append((task, end - start))
+        task = max((name for name in dependencies.get(task, ()) if name in spans),
+                   key=lambda name: spans[name][1], default=None)
+    return path[::-1]
+
+
+async def collect(topic: list[str]) -> tuple[int, list[tuple[str, float]]]:
+    """Runs the independent I/O of a run concurrently then transforms and loads it.
+    Returns the hours processed and the critical path of the run."""
+    started = time.perf_counter()
+    spans = {}
+
+    async def span(name: str, awaitable: Awaitable):
+        start = time.perf_counter() - started
+        with timer(name):
+            result = await awaitable
+        spans[name] = (start, time.perf_counter() - started)
+        return result
+
+    rows, terms, keyword_map = await asyncio.gather(
+        span("extract", scan_s3(topic)),
+        span("suggestions", asyncio.to_thread(profiled_call, related_terms, topic)),
+        span("keyword_ids", asyncio.to_thread(profiled_call, get_keyword_map, topic)))
+
+    dataframe = pd.DataFrame(rows)
+    dataframe['Related Terms'] = dataframe['Keyword'].map(terms)
+    transform_df = await span("transform", asyncio.to_thread(profiled_call, transform_batch,
+                                                             dataframe, keyword_map))
+    await span("load", asyncio.to_thread(profiled_call, load_main, topic, transform_df))
+    return int(dataframe['Date and Hour'].nunique()), critical_path(spans, DEPENDENCIES)
+
+
+def run_async(topic: list[str], run: dict) -> None:
+    """Runs the pipeline on an event loop and logs its critical path"""
+    run["hours_processed"], run["critical_path"] = asyncio.run(collect(topic))
+    logging.info("Critical path: %s", " -> ".join(
+        f"{task} {seconds:.2f}s" for task, seconds in run["critical_path"]))
+
+
+def main(topic: list[str], profile_dir: str = None) -> None:
+    """Runs the asyncio pipeline for some topics, recording the run in pipeline_runs"""
+    run_pipeline(topic, run_async, profile_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the ETL pipeline for some topics on an asyncio event loop.")
+    parser.add_argument("topics", nargs="*", default=["vegan protein"],
+                        help="Topics to collect.")
+    parser.add_argument("--profile-dir",
+                        help="Profile the run with cProfile and tracemalloc into this directory.")
+    args = parser.parse_args()
+    main(args.topics, profile_dir=args.profile_dir)
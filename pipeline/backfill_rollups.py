@@ -0,0 +1,109 @@
+"""One-off script that fills the keyword rollups with the hours recorded before the load
+step maintained them, from keyword_recordings and optionally the archive in S3"""
+
+import argparse
+import logging
+import os
+import pandas as pd
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+from load import create_staging_tables, copy_rows, update_rollups
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+LEGACY_ARCHIVE_FILE = "keyword_recording.csv"
+
+# Archived hours of deleted keywords are dropped and hours still in keyword_recordings
+# replace their archived copy
+STAGE_RECORDINGS_QUERIES = (
+    """DELETE FROM stage_keyword_recordings AS staged
+       WHERE NOT EXISTS (SELECT 1 FROM keywords
+                         WHERE keywords.keywords_id = staged.keywords_id)""",
+    """DELETE FROM stage_keyword_recordings AS staged
+       USING keyword_recordings AS recording
+       WHERE recording.keywords_id = staged.keywords_id
+       AND recording.date_and_hour = staged.date_and_hour""",
+    """INSERT INTO stage_keyword_recordings
+       (keywords_id, date_and_hour, total_mentions, sentiment_sum, sentiment_sum_squares)
+       SELECT keywords_id, date_and_hour, total_mentions, sentiment_sum, sentiment_sum_squares
+       FROM keyword_recordings"""
+)
+
+
+def read_archive(path: str) -> pd.DataFrame:
+    """Reads a downloaded copy of the archive, either the legacy CSV on its own or the
+    whole archive folder with the legacy CSV and the Parquet files under recordings/"""
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    frames = []
+    if os.path.exists(os.path.join(path, LEGACY_ARCHIVE_FILE)):
+        frames.append(pd.read_csv(os.path.join(path, LEGACY_ARCHIVE_FILE)))
+    if os.path.isdir(os.path.join(path, "recordings")):
+        frames.append(pd.read_parquet(os.path.join(path, "recordings")))
+    return pd.concat(frames, ignore_index=True)
+
+
+def archive_rows(archive: pd.DataFrame) -> list[tuple]:
+    """Returns one staging row per keyword and hour of the archived recordings, keeping
+    the latest. Hours archived before the sums were stored get theirs from the average."""
+    archive = archive.dropna(subset=['keywords_id', 'date_and_hour'])
+    sentiment_sum = archive.get('sentiment_sum', pd.Series(float('nan'), index=archive.index))
+    archive = archive.assign(
+        date_and_hour=pd.to_datetime(archive['date_and_hour']).dt.floor('h'),
+        sentiment_sum=sentiment_sum.fillna(archive['avg_sentiment'] * archive['total_mentions']))
+    if 'sentiment_sum_squares' not in archive:
+        archive['sentiment_sum_squares'] = None
+    archive = archive.drop_duplicates(['keywords_id', 'date_and_hour'], keep='last')
+
+    return [(int(row['keywords_id']), row['date_and_hour'].to_pydatetime(),
+             int(row['total_mentions']), row['sentiment_sum'],
+             None if pd.isna(row['sentiment_sum_squares']) else row['sentiment_sum_squares'])
+            for row in archive.to_dict(orient='records')]
+
+
+def stage_recordings(cursor: curs, archive: pd.DataFrame = None) -> int:
+    """Stages the archived hours and those in keyword_recordings. Returns the number of
+    hours staged."""
+    create_staging_tables(cursor)
+    if archive is not None:
+        copy_rows(cursor, "stage_keyword_recordings", archive_rows(archive))
+    for query in STAGE_RECORDINGS_QUERIES:
+        cursor.execute(query)
+    cursor.execute("SELECT COUNT(*) AS hours FROM stage_keyword_recordings")
+    return cursor.fetchone()['hours']
+
+
+def main(archive_file: str = None) -> None:
+    """Rolls up every recorded hour in a single transaction. Hours already in the
+    rollups are only changed if their recording differs, so it is safe to rerun."""
+    load_dotenv()
+    archive = read_archive(archive_file) if archive_file else None
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            hours = stage_recordings(cursor, archive)
+            written = update_rollups(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    logging.info("Rolled up %s hours: %s", hours, ", ".join(
+        f"{count} rows into {table}" for table, count in written.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fill the keyword rollups with the hours recorded so far.")
+    parser.add_argument("--archive",
+                        help="A copy of the long_term_keyword_data folder in S3, "
+                             "or of its keyword_recording.csv.")
+    args = parser.parse_args()
+    main(args.archive)
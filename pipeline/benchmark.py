@@ -0,0 +1,209 @@
+"""Benchmarks a full ETL run offline, reading synthetic Bluesky files from a local S3
+stand-in and loading them into a local Postgres"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import environ as ENV
+from unittest.mock import patch
+from dotenv import load_dotenv
+import async_etl
+import extract
+import etl
+import metrics
+from db import borrow_connection
+from local_s3 import LocalS3, AsyncLocalS3
+
+BENCHMARK_BUCKET = "benchmark"
+DEFAULT_POSTS_PER_HOUR = 1000
+DEFAULT_DAYS = 7
+DEFAULT_KEYWORDS = 10
+DEFAULT_MENTION_RATE = 0.05
+MAX_DAYS = 7
+MODES = ("batch", "streaming", "async")
+
+STAGE_ROWS = {
+    "extract": ("etl_rows_total", (("stage", "extract"),)),
+    "transform": ("etl_rows_total", (("stage", "transform"),)),
+    "load": ("etl_rows_loaded_total", (("table", "keyword_recordings"),))
+}
+
+WORDS = ("the", "a", "today", "really", "new", "just", "love", "think", "about", "my",
+         "going", "with", "this", "people", "day", "good", "more", "out", "time", "why")
+
+
+class OfflineTrends:
+    """Stands in for pytrends so a benchmark makes no network requests"""
+
+    def suggestions(self, keyword: str) -> list[dict]:
+        """Returns made up suggestions for a keyword"""
+        return [{"title": f"{keyword} {suffix}"} for suffix in ("news", "review", "price")]
+
+
+def benchmark_keywords(count: int) -> list[str]:
+    """Returns keywords that never contain one another, so mentions are not double counted"""
+    return [f"benchtopic{i:04d}x" for i in range(count)]
+
+
+def synthetic_posts(rng: random.Random, keywords: list[str], posts: int,
+                    mention_rate: float) -> dict:
+    """Returns an hour of posts and their sentiment in the format written by the
+    Bluesky firehose script"""
+    hour = {}
+    for i in range(posts):
+        words = rng.choices(WORDS, k=12)
+        for keyword in keywords:
+            if rng.random() < mention_rate:
+                words.insert(rng.randrange(len(words)), keyword)
+        hour[f"{i} {' '.join(words)}"] = {
+            "Sentiment Score": {"compound": round(rng.uniform(-1, 1), 4)}}
+    return hour
+
+
+def generate_files(root: str, keywords: list[str], posts_per_hour: int, days: int,
+                   mention_rate: float = DEFAULT_MENTION_RATE, seed: int = 0) -> int:
+    """Writes an hourly file for every hour of the past days into the local S3 root.
+    Returns the number of bytes written."""
+    rng = random.Random(seed)
+    s3 = LocalS3(root)
+    today = datetime.datetime.now()
+    written = 0
+    for day in range(min(days, MAX_DAYS)):
+        date = (today - datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+        for hour in range(24):
+            body = json.dumps(synthetic_posts(rng, keywords, posts_per_hour,
+                                              mention_rate)).encode("utf-8")
+            s3.put_object(Bucket=BENCHMARK_BUCKET, Key=f"bluesky/{date}/{hour:02d}.json",
+                          Body=body)
+            written += len(body)
+    return written
+
+
+def load_schema(schema_file: str = "schema.sql") -> None:
+    """Recreates the tables in SCHEMA_NAME from schema.sql. This drops every table."""
+    with open(schema_file, encoding="utf-8") as file:
+        sql = file.read().replace(":schema_name", ENV["SCHEMA_NAME"])
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+        conn.commit()
+
+
+def peak_rss_mib() -> float:
+    """Returns the peak resident memory of this process in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def summarise(stats: dict, wall_seconds: float, input_bytes: int,
+              baseline_rss_mib: float = 0) -> dict:
+    """Returns the wall time, peak memory and throughput of each stage of a run. The
+    memory the run added is the peak less the baseline taken before it started."""
+    stages = {}
+    for stage, seconds in sorted(stats["stage_seconds"].items()):
+        stages[stage] = {"seconds": round(seconds, 4)}
+        if stage in STAGE_ROWS:
+            rows = stats["counters"].get(STAGE_ROWS[stage], 0)
+            stages[stage]["rows"] = rows
+            stages[stage]["rows_per_second"] = round(rows / seconds, 1) if seconds else None
+    scan_seconds = stats["stage_seconds"].get("s3_scan")
+    bytes_read = stats["counters"].get(("etl_s3_bytes_total", ()), 0)
+    if scan_seconds:
+        stages["s3_scan"]["mib_per_second"] = round(bytes_read / 2 ** 20 / scan_seconds, 2)
+    peak = peak_rss_mib()
+    return {
+        "wall_seconds": round(wall_seconds, 4),
+        "peak_rss_mib": round(peak, 1),
+        "baseline_rss_mib": round(baseline_rss_mib, 1),
+        "run_rss_mib": round(peak - baseline_rss_mib, 1),
+        "input_mib": round(input_bytes / 2 ** 20, 2),
+        "bytes_read": bytes_read,
+        "stages": stages
+    }
+
+
+def run_benchmark(root: str, keywords: list[str], input_bytes: int, mode: str = "batch",
+                  s3_latency: float = 0) -> dict:
+    """Runs the pipeline in a mode against the files in the local S3 root and returns
+    its summary"""
+    metrics.reset()
+    baseline_rss_mib = peak_rss_mib()
+    with patch.dict(os.environ, {"S3_BUCKET_NAME": BENCHMARK_BUCKET}), \
+            patch.object(extract, "s3_connection", return_value=LocalS3(root, s3_latency)), \
+            patch.object(async_etl, "s3_client", return_value=AsyncLocalS3(root, s3_latency)), \
+            patch.object(extract, "initialize_trend_request", return_value=OfflineTrends()):
+        started = time.perf_counter()
+        if mode == "async":
+            async_etl.main(keywords)
+        else:
+            etl.main(keywords, streaming=mode == "streaming")
+        wall_seconds = time.perf_counter() - started
+    return summarise(metrics.snapshot(), wall_seconds, input_bytes, baseline_rss_mib)
+
+
+def run_in_subprocess(*args) -> dict:
+    """Runs the benchmark in a fresh process, so its peak memory is not that of
+    generating the files"""
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, *args).result()
+
+
+def main(posts_per_hour: int, days: int, keyword_count: int, root: str = None,
+         seed: int = 0, reload_schema: bool = False, mode: str = "batch",
+         s3_latency: float = 0) -> dict:
+    """Generates the synthetic files, runs the benchmark in its own process and logs
+    its summary"""
+    load_dotenv()
+    if reload_schema:
+        load_schema()
+    keywords = benchmark_keywords(keyword_count)
+    with tempfile.TemporaryDirectory() as temporary_root:
+        root = root or temporary_root
+        input_bytes = generate_files(root, keywords, posts_per_hour, days, seed=seed)
+        logging.info("Generated %.1f MiB of posts for %s keywords over %s days.",
+                     input_bytes / 2 ** 20, len(keywords), min(days, MAX_DAYS))
+        summary = run_in_subprocess(root, keywords, input_bytes, mode, s3_latency)
+
+    for stage, stage_summary in summary["stages"].items():
+        logging.info("%s: %s", stage, ", ".join(
+            f"{name}={value}" for name, value in stage_summary.items()))
+    logging.info("Run took %.2fs with a peak RSS of %.1f MiB, %.1f MiB above its baseline.",
+                 summary["wall_seconds"], summary["peak_rss_mib"], summary["run_rss_mib"])
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark an ETL run against synthetic files and a local Postgres.")
+    parser.add_argument("--posts-per-hour", type=int, default=DEFAULT_POSTS_PER_HOUR,
+                        help="Posts in each hourly file.")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS,
+                        help=f"Days of hourly files to generate, at most {MAX_DAYS}.")
+    parser.add_argument("--keywords", type=int, default=DEFAULT_KEYWORDS,
+                        help="Number of keywords to collect.")
+    parser.add_argument("--root",
+                        help="Directory to write the files to, a temporary one by default.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic posts.")
+    parser.add_argument("--load-schema", action="store_true",
+                        help="Recreate the tables from schema.sql first. This drops every table.")
+    parser.add_argument("--mode", choices=MODES, default="batch",
+                        help="Pipeline to run.")
+    parser.add_argument("--s3-latency-ms", type=float, default=0,
+                        help="Milliseconds to wait on each S3 request, to mimic the real S3.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    args = parser.parse_args()
+    result = main(args.posts_per_hour, args.days, args.keywords, args.root, args.seed,
+                  args.load_schema, args.mode, args.s3_latency_ms / 1000)
+    if args.json:
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,134 @@
+"""Shared pool of database connections used by every stage of the pipeline"""
+
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from os import environ as ENV
+import psycopg2
+import psycopg2.extras
+from psycopg2.extensions import connection as connect, TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_MAX_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+_pool = None
+_slots = None
+_last_used = {}
+_pool_lock = threading.Lock()
+
+
+def create_pool() -> ThreadedConnectionPool:
+    """Creates a connection pool whose connections start in the configured schema"""
+    try:
+        pool = ThreadedConnectionPool(
+            int(ENV.get("DB_POOL_MIN_SIZE", DEFAULT_POOL_MIN_SIZE)),
+            int(ENV.get("DB_POOL_MAX_SIZE", DEFAULT_POOL_MAX_SIZE)),
+            user=ENV["DB_USERNAME"],
+            password=ENV["DB_PASSWORD"],
+            host=ENV["DB_HOST"],
+            port=ENV["DB_PORT"],
+            database=ENV["DB_NAME"],
+            options=f"-c search_path={ENV['SCHEMA_NAME']}",
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+    except psycopg2.OperationalError as e:
+        logging.error(
+            "Operational error while connecting to the database: %s", e)
+        raise
+    logging.info("Connection pool established to database.")
+    return pool
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """Returns the process wide connection pool, creating it on first use"""
+    global _pool, _slots  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_pool()
+            _slots = threading.BoundedSemaphore(_pool.maxconn)
+    return _pool
+
+
+def close_pool() -> None:
+    """Closes every pooled connection"""
+    global _pool, _slots  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            logging.info("Connection pool closed.")
+        _pool = None
+        _slots = None
+        _last_used.clear()
+
+
+atexit.register(close_pool)
+
+
+def is_healthy(conn: connect) -> bool:
+    """Checks a pooled connection is still usable, skipping recently used connections"""
+    if conn.closed:
+        return False
+    interval = float(ENV.get("DB_HEALTH_CHECK_INTERVAL",
+                             DEFAULT_HEALTH_CHECK_INTERVAL))
+    if time.monotonic() - _last_used.get(id(conn), 0) < interval:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        logging.warning("Discarding broken database connection: %s", e)
+        return False
+    return True
+
+
+def acquire_connection() -> connect:
+    """Takes a healthy connection from the pool, waiting while all connections are in use"""
+    pool = get_pool()
+    timeout = float(ENV.get("DB_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT))
+    if not _slots.acquire(timeout=timeout):
+        raise PoolError(
+            f"No database connection became free within {timeout} seconds")
+    try:
+        conn = pool.getconn()
+        if not is_healthy(conn):
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+    return conn
+
+
+def release_connection(conn: connect) -> None:
+    """Returns a connection to the pool, discarding it if it can not be reused"""
+    broken = bool(conn.closed)
+    if not broken and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+    try:
+        get_pool().putconn(conn, close=broken)
+    finally:
+        _slots.release()
+
+
+@contextmanager
+def borrow_connection():
+    """Lends a pooled connection for the duration of a with block"""
+    conn = acquire_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
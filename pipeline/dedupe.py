@@ -0,0 +1,203 @@
+"""One-off tool to remove duplicate rows that predate the load step's unique keys
+and compact the affected tables"""
+
+import argparse
+import logging
+from psycopg2.extensions import connection as connect, cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+UNIQUE_KEYS = {
+    "keywords": ("keywords_keyword_key", "keyword"),
+    "keyword_recordings": ("keyword_recordings_keyword_hour_key",
+                           "keywords_id, date_and_hour"),
+    "related_terms": ("related_terms_related_term_key", "related_term"),
+    "related_term_assignment": ("related_term_assignment_keyword_term_key",
+                                "keywords_id, related_term_id")
+}
+
+# Tables pointing at a keyword, with the row id, what else identifies the row for a
+# keyword and which copy to keep when two merged keywords both have one
+KEYWORD_REFERENCES = {
+    "keyword_recordings": ("keyword_recordings_id", "date_and_hour",
+                           "keyword_recordings_id DESC"),
+    "related_term_assignment": ("related_term_assignment", "related_term_id",
+                                "related_term_assignment"),
+    "subscription": ("subscription_id", "user_id", "subscription_id"),
+    "keyword_refresh_tasks": ("refresh_task_id", "run_hour", "refresh_task_id")
+}
+# Rows derived per keyword that are dropped for the merged copies. The scheduler and
+# backfill_rollups.py rebuild them for the kept keyword.
+KEYWORD_DERIVED_TABLES = ("keyword_refresh_schedule", "keyword_rollups_1h",
+                          "keyword_rollups_6h", "keyword_rollups_1d")
+
+
+def count_duplicate_recordings(cursor: curs) -> int:
+    """Returns the number of surplus recordings for keywords and hours recorded more than once"""
+    cursor.execute("""SELECT COUNT(*) - COUNT(DISTINCT (keywords_id, date_and_hour)) AS duplicates
+                   FROM keyword_recordings""")
+    return cursor.fetchone()['duplicates']
+
+
+def delete_duplicate_recordings(cursor: curs) -> int:
+    """Deletes all but the most recently inserted recording for each keyword and hour"""
+    cursor.execute("""DELETE FROM keyword_recordings
+                   WHERE keyword_recordings_id IN (
+                       SELECT keyword_recordings_id FROM (
+                           SELECT keyword_recordings_id,
+                                  ROW_NUMBER() OVER (
+                                      PARTITION BY keywords_id, date_and_hour
+                                      ORDER BY keyword_recordings_id DESC) AS row_number
+                           FROM keyword_recordings) AS ranked
+                       WHERE ranked.row_number > 1)""")
+    return cursor.rowcount
+
+
+def delete_duplicate_related_terms(cursor: curs) -> int:
+    """Points assignments at the oldest copy of each related term and deletes the other copies"""
+    cursor.execute("""UPDATE related_term_assignment AS rta
+                   SET related_term_id = copies.keep_id
+                   FROM (SELECT related_term_id,
+                                MIN(related_term_id) OVER (PARTITION BY related_term) AS keep_id
+                         FROM related_terms) AS copies
+                   WHERE rta.related_term_id = copies.related_term_id
+                   AND copies.keep_id <> copies.related_term_id""")
+    cursor.execute("""DELETE FROM related_terms AS duplicate
+                   USING related_terms AS original
+                   WHERE duplicate.related_term = original.related_term
+                   AND duplicate.related_term_id > original.related_term_id""")
+    return cursor.rowcount
+
+
+def delete_duplicate_assignments(cursor: curs) -> int:
+    """Deletes repeated keyword to related term assignments, keeping the oldest"""
+    cursor.execute("""DELETE FROM related_term_assignment
+                   WHERE related_term_assignment IN (
+                       SELECT related_term_assignment FROM (
+                           SELECT related_term_assignment,
+                                  ROW_NUMBER() OVER (
+                                      PARTITION BY keywords_id, related_term_id
+                                      ORDER BY related_term_assignment) AS row_number
+                           FROM related_term_assignment) AS ranked
+                       WHERE ranked.row_number > 1)""")
+    return cursor.rowcount
+
+
+def merge_duplicate_keywords(cursor: curs) -> int:
+    """Points every table referencing a keyword at the oldest copy of it, ignoring case,
+    drops the rows that then repeat and deletes the other copies. The kept copy is
+    lowercased like the keywords the load step adds. Returns the number of copies deleted."""
+    cursor.execute("""CREATE TEMPORARY TABLE keyword_merges ON COMMIT DROP AS
+                   SELECT keywords_id AS duplicate_id, keep_id FROM (
+                       SELECT keywords_id,
+                              MIN(keywords_id) OVER (PARTITION BY LOWER(keyword)) AS keep_id
+                       FROM keywords) AS copies
+                   WHERE keywords_id <> keep_id""")
+    for table, (row_id, columns, keep_order) in KEYWORD_REFERENCES.items():
+        cursor.execute(f"""DELETE FROM {table}
+                       WHERE {row_id} IN (
+                           SELECT {row_id} FROM (
+                               SELECT {row_id},
+                                      ROW_NUMBER() OVER (
+                                          PARTITION BY COALESCE(merge.keep_id, ref.keywords_id), {columns}
+                                          ORDER BY {keep_order}) AS row_number
+                               FROM {table} AS ref
+                               LEFT JOIN keyword_merges AS merge
+                                   ON merge.duplicate_id = ref.keywords_id
+                               WHERE COALESCE(merge.keep_id, ref.keywords_id) IN (
+                                   SELECT keep_id FROM keyword_merges)) AS ranked
+                           WHERE ranked.row_number > 1)""")
+        cursor.execute(f"""UPDATE {table} AS ref
+                       SET keywords_id = merge.keep_id
+                       FROM keyword_merges AS merge
+                       WHERE ref.keywords_id = merge.duplicate_id""")
+    for table in KEYWORD_DERIVED_TABLES:
+        cursor.execute(f"""DELETE FROM {table} AS ref
+                       USING keyword_merges AS merge
+                       WHERE ref.keywords_id = merge.duplicate_id""")
+    cursor.execute("""DELETE FROM keywords
+                   USING keyword_merges AS merge
+                   WHERE keywords.keywords_id = merge.duplicate_id""")
+    merged = cursor.rowcount
+    cursor.execute("""UPDATE keywords SET keyword = LOWER(keyword)
+                   WHERE keywords_id IN (SELECT keep_id FROM keyword_merges)""")
+    return merged
+
+
+def add_unique_constraint(cursor: curs, table: str) -> bool:
+    """Adds the table's unique key from UNIQUE_KEYS if it does not have it yet"""
+    name, columns = UNIQUE_KEYS[table]
+    cursor.execute("""SELECT 1 FROM pg_constraint
+                   WHERE conname = %s
+                   AND conrelid = %s::regclass""", (name, table))
+    if cursor.fetchone() is not None:
+        return False
+    cursor.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({columns})")
+    return True
+
+
+def compact_tables(conn: connect, cursor: curs, full: bool = False) -> None:
+    """Reclaims the space left by deleted rows and refreshes planner statistics"""
+    conn.autocommit = True
+    try:
+        for table in UNIQUE_KEYS:
+            cursor.execute(
+                f"VACUUM {'FULL ' if full else ''}ANALYZE {table}")
+    finally:
+        conn.autocommit = False
+
+
+def main(full: bool = False, dry_run: bool = False) -> None:
+    """Deduplicates the loaded tables, enforces their unique keys and compacts them"""
+    load_dotenv()
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            duplicates = count_duplicate_recordings(cursor)
+            logging.info("Found %s duplicate keyword recordings.", duplicates)
+            if dry_run:
+                return
+
+            deleted = {
+                "keywords": merge_duplicate_keywords(cursor),
+                "keyword_recordings": delete_duplicate_recordings(cursor),
+                "related_terms": delete_duplicate_related_terms(cursor),
+                "related_term_assignment": delete_duplicate_assignments(cursor)
+            }
+            added = [table for table in UNIQUE_KEYS
+                     if add_unique_constraint(cursor, table)]
+            conn.commit()
+            for table, count in deleted.items():
+                logging.info("Deleted %s duplicate rows from %s.", count, table)
+            for table in added:
+                logging.info("Added unique key %s.", UNIQUE_KEYS[table][0])
+            if deleted["keywords"]:
+                logging.info("Run backfill_rollups.py to roll the merged keywords' hours "
+                             "into the kept keywords.")
+
+            compact_tables(conn, cursor, full)
+            logging.info("Compacted tables%s.",
+                         " with VACUUM FULL" if full else "")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove duplicate rows from the loaded tables and compact them.")
+    parser.add_argument("--full", action="store_true",
+                        help="Run VACUUM FULL to return space to the OS (locks the tables).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only report how many duplicate recordings exist.")
+    args = parser.parse_args()
+    main(full=args.full, dry_run=args.dry_run)
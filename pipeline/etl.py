@@ -1,17 +1,150 @@
 """A script to run an ETL pipeline"""
 
-from extract import main as extract_main
-from transform import main as transform_main
+import argparse
+import contextvars
+import queue
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import nullcontext
+from datetime import datetime
+from os import environ as ENV
+import pandas as pd
+from extract import main as extract_main, stream as extract_stream
+from transform import main as transform_main, get_keyword_map, transform_batch
 from load import main as load_main
+from metrics import timer, timed, track_run
+from profiling import profile, profile_dir_for, profiled_call
+from run_history import run_row, record_run
 
+DEFAULT_PREFETCH_HOURS = 4
+DEFAULT_LOAD_CHUNK_HOURS = 24
 
-def main(topic: list[str]) -> None:
-    """Runs pipeline through extract, transform and load"""
-    mentions_per_hour = extract_main(topic)
-    transform_df = transform_main(mentions_per_hour)
-    load_main(topic, transform_df)
+_DONE = object()
+
+
+def streaming_enabled() -> bool:
+    """Returns whether ETL_STREAMING turns on the streaming pipeline"""
+    return ENV.get("ETL_STREAMING", "").lower() in ("1", "true", "yes")
+
+
+def prefetch(iterable: Iterable, size: int) -> Iterator:
+    """Yields from an iterable that is read on a background thread, which keeps up to
+    size items ready so the producer works while the consumer is busy"""
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            put((_DONE, e))
+            return
+        put((_DONE, None))
+
+    # The producer runs in a copy of this context so its metrics and profile count
+    # towards the run
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(profiled_call, produce),
+                              name="etl-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_batch(topic: list[str], run: dict) -> None:
+    """Extracts the whole week, then transforms and loads it in one transaction"""
+    with timer("extract"):
+        mentions_per_hour = extract_main(topic)
+    run["hours_processed"] = int(mentions_per_hour['Date and Hour'].nunique())
+    with timer("transform"):
+        transform_df = transform_main(mentions_per_hour)
+    with timer("load"):
+        load_main(topic, transform_df)
+
+
+def load_chunk(topic: list[str], rows: list[dict], keyword_map: dict) -> None:
+    """Transforms and loads a chunk of streamed rows in one transaction"""
+    with timer("transform"):
+        transform_df = transform_batch(pd.DataFrame(rows), keyword_map)
+    with timer("load"):
+        load_main(topic, transform_df)
+
+
+def run_streaming(topic: list[str], run: dict) -> None:
+    """Extracts one hour at a time on a background thread while earlier hours are
+    transformed and loaded. Every LOAD_CHUNK_HOURS hours are committed together, so
+    memory stays bounded but a failed run may leave its earlier chunks loaded."""
+    prefetch_hours = int(ENV.get("ETL_PREFETCH_HOURS", DEFAULT_PREFETCH_HOURS))
+    chunk_hours = int(ENV.get("LOAD_CHUNK_HOURS", DEFAULT_LOAD_CHUNK_HOURS))
+    with timer("transform"):
+        keyword_map = get_keyword_map(topic)
+
+    hours, chunk, chunk_size = set(), [], 0
+    for hour_data in prefetch(timed("extract", extract_stream(topic)), prefetch_hours):
+        hours.update(row['Date and Hour'] for row in hour_data)
+        chunk.extend(hour_data)
+        chunk_size += 1
+        if chunk_size >= chunk_hours:
+            load_chunk(topic, chunk, keyword_map)
+            chunk, chunk_size = [], 0
+    if chunk:
+        load_chunk(topic, chunk, keyword_map)
+    run["hours_processed"] = len(hours)
+
+
+def run_pipeline(topic: list[str], runner: Callable[[list[str], dict], None],
+                 profile_dir: str = None) -> None:
+    """Runs a pipeline runner for some topics, recording the run in pipeline_runs.
+    The run is profiled into profile_dir, or ETL_PROFILE_DIR if set."""
+    profile_dir = profile_dir or profile_dir_for(topic)
+    started_at = datetime.now()
+    status, error = "failed", None
+    with track_run() as run, profile(profile_dir, topic) if profile_dir else nullcontext():
+        try:
+            with timer("etl"):
+                runner(topic, run)
+            status = "succeeded"
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            record_run(run_row(topic, run, started_at, datetime.now(), status, error))
+
+
+def main(topic: list[str], profile_dir: str = None, streaming: bool = None) -> None:
+    """Runs pipeline through extract, transform and load, streamed if streaming, or
+    ETL_STREAMING if not given"""
+    streaming = streaming_enabled() if streaming is None else streaming
+    run_pipeline(topic, run_streaming if streaming else run_batch, profile_dir)
 
 
 if __name__ == "__main__":
-    topic = ['vegan protein']
-    main(topic)
+    parser = argparse.ArgumentParser(description="Run the ETL pipeline for some topics.")
+    parser.add_argument("topics", nargs="*", default=["vegan protein"],
+                        help="Topics to collect.")
+    parser.add_argument("--profile-dir",
+                        help="Profile the run with cProfile and tracemalloc into this directory.")
+    parser.add_argument("--stream", action="store_true", default=None,
+                        help="Extract, transform and load one hour at a time.")
+    args = parser.parse_args()
+    main(args.topics, profile_dir=args.profile_dir, streaming=args.stream)
@@ -4,11 +4,13 @@ import os
 import logging
 import json
 import datetime
+from collections.abc import Iterator
 from httpx import Client
 import pandas as pd
 from boto3 import client
 from dotenv import load_dotenv
 from pytrends.request import TrendReq
+from metrics import timer, inc
 
 load_dotenv(".env")
 
@@ -34,56 +36,93 @@ def s3_connection() -> client:
     return s3
 
 
-def average_sentiment_analysis(keyword: str, file_data: dict) -> tuple:
-    """Calculates the average sentiment for a keyword in a .json file"""
-    total_sentiment = 0
+def sentiment_totals(keyword: str, file_data: dict) -> tuple[int, float, float]:
+    """Returns the mentions of a keyword in a .json file with the sum and sum of squares
+    of their sentiment, which add up exactly across files"""
     mentions = 0
+    total_sentiment = 0
+    total_squares = 0
     for text, sentiment in file_data.items():
         if keyword in text:
-            total_sentiment += sentiment['Sentiment Score']['compound']
+            score = sentiment['Sentiment Score']['compound']
+            total_sentiment += score
+            total_squares += score * score
             mentions += 1
+    return mentions, total_sentiment, total_squares
+
+
+def average_sentiment_analysis(keyword: str, file_data: dict) -> tuple:
+    """Calculates the average sentiment for a keyword in a .json file"""
+    mentions, total_sentiment, _ = sentiment_totals(keyword, file_data)
     if mentions == 0:
         return (total_sentiment, mentions)
     return total_sentiment/mentions, mentions
 
 
-def extract_s3_data(s3: Client, bucket: str, topic: list[str]) -> pd.DataFrame:
-    """Extracts relevant data from an S3 Bucket for the past 7 days."""
+def recent_dates(days: int = 7) -> list[str]:
+    """Returns the dates of the past days, most recent first"""
     today = datetime.datetime.now()
-    date_list = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
-                 for i in range(7)]
+    return [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+            for i in range(days)]
+
+
+def hourly_keys(response: dict, prefix: str) -> list[tuple[str, str]]:
+    """Returns the key and hour of each hourly file directly under a listed prefix"""
+    return [(obj['Key'], obj['Key'].split("/")[-1].split(".")[0])
+            for obj in response.get('Contents', [])
+            if obj['Key'].endswith('.json') and obj['Key'].count('/') == prefix.count('/')]
 
-    sentiment_and_mention_data = []
 
-    for date in date_list:
+def hour_sentiment(date: str, hour: str, body: bytes, topic: list[str]) -> list[dict]:
+    """Returns the sentiment and mentions of each keyword in one hourly file"""
+    with timer("json_decode"):
+        file_content = json.loads(body.decode('utf-8'))
+
+    hour_data = []
+    for keyword in topic:
+        with timer("sentiment"):
+            mentions, total_sentiment, total_squares = sentiment_totals(
+                keyword, file_content)
+
+        hour_data.append({
+            'Date and Hour': f"{date} {hour}",
+            'Keyword': keyword,
+            'Total Mentions': mentions,
+            'Sentiment Sum': total_sentiment,
+            'Sentiment Sum of Squares': total_squares
+        })
+    return hour_data
+
+
+def hourly_sentiment(s3: Client, bucket: str, topic: list[str]) -> Iterator[list[dict]]:
+    """Yields the sentiment and mentions of each keyword for one hourly file at a time,
+    for the past 7 days"""
+    for date in recent_dates():
         prefix = f"bluesky/{date}/"
-        response = s3.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, Delimiter='/')
+        with timer("s3_list"):
+            response = s3.list_objects_v2(
+                Bucket=bucket, Prefix=prefix, Delimiter='/')
+        inc("etl_s3_requests_total", operation="list_objects_v2")
 
         if 'Contents' in response:
-            for obj in response['Contents']:
-                key = obj['Key']
-                hour = key.split("/")[-1].split(".")[0]
-
-                if key.endswith('.json') and key.count('/') == prefix.count('/'):
+            for key, hour in hourly_keys(response, prefix):
+                with timer("s3_get"):
                     file_obj = s3.get_object(Bucket=bucket, Key=key)
-                    file_content = json.loads(
-                        file_obj['Body'].read().decode('utf-8'))
-
-                    for keyword in topic:
-                        sentiment_and_mentions = average_sentiment_analysis(
-                            keyword, file_content)
-
-                        sentiment_and_mention_data.append({
-                            'Date and Hour': f"{date} {hour}",
-                            'Keyword': keyword,
-                            'Average Sentiment': sentiment_and_mentions[0],
-                            'Total Mentions': sentiment_and_mentions[1]
-                        })
+                    body = file_obj['Body'].read()
+                inc("etl_s3_requests_total", operation="get_object")
+                inc("etl_s3_bytes_total", len(body))
+                yield hour_sentiment(date, hour, body, topic)
         else:
             logging.info(f"No files found in the folder for date {date}.")
 
+
+def extract_s3_data(s3: Client, bucket: str, topic: list[str]) -> pd.DataFrame:
+    """Extracts relevant data from an S3 Bucket for the past 7 days."""
+    sentiment_and_mention_data = [row for hour_data in hourly_sentiment(s3, bucket, topic)
+                                  for row in hour_data]
+
     if sentiment_and_mention_data:
+        inc("etl_rows_total", len(sentiment_and_mention_data), stage="extract")
         return pd.DataFrame(sentiment_and_mention_data)
 
     logging.info("No files found in the past 7 days.")
@@ -100,18 +139,49 @@ def fetch_suggestions(pytrend: TrendReq, keyword: str) -> list[dict]:
     return pytrend.suggestions(keyword=keyword)
 
 
+def related_terms(topic: list[str]) -> dict:
+    """Returns each keyword's Google Trends suggestions joined by commas"""
+    pytrend = initialize_trend_request()
+    terms = {}
+    for keyword in topic:
+        with timer("pytrends"):
+            suggestions = fetch_suggestions(pytrend, keyword)
+        inc("etl_pytrends_requests_total")
+        terms[keyword] = ",".join([suggestion['title'] for suggestion in suggestions])
+    return terms
+
+
 def main(topic: list[str]) -> pd.DataFrame:
     """Main function to run extract script"""
     s3 = s3_connection()
 
     bucket = os.environ.get("S3_BUCKET_NAME")
 
-    extracted_dataframe = extract_s3_data(s3, bucket, topic)
+    with timer("s3_scan"):
+        extracted_dataframe = extract_s3_data(s3, bucket, topic)
 
-    pytrend = initialize_trend_request()
-    for keyword in topic:
+    for keyword, terms in related_terms(topic).items():
         extracted_dataframe.loc[extracted_dataframe['Keyword'] == keyword,
-                                'Related Terms'] = ",".join([suggestion['title']
-                                                             for suggestion in fetch_suggestions(pytrend, keyword)])
+                                'Related Terms'] = terms
     return extracted_dataframe
 
+
+def stream(topic: list[str]) -> Iterator[list[dict]]:
+    """Yields the extracted rows one hour at a time so later stages can start on them
+    before the whole week has been read. Related terms are fetched first so every
+    hour is complete."""
+    terms = related_terms(topic)
+    s3 = s3_connection()
+    bucket = os.environ.get("S3_BUCKET_NAME")
+
+    found = False
+    for hour_data in hourly_sentiment(s3, bucket, topic):
+        found = True
+        inc("etl_rows_total", len(hour_data), stage="extract")
+        for row in hour_data:
+            row['Related Terms'] = terms[row['Keyword']]
+        yield hour_data
+
+    if not found:
+        logging.info("No files found in the past 7 days.")
+        raise ValueError("No files found in the past 7 days.")
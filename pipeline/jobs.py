@@ -0,0 +1,200 @@
+"""Background job queue that runs ETL jobs for the API"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timedelta, timezone
+from os import environ as ENV
+from typing import Callable
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_HISTORY = 1000
+DEFAULT_FRESHNESS_SECONDS = 300
+FINISHED_STATUSES = ("succeeded", "failed")
+
+
+def utc_now() -> str:
+    """Returns the current UTC time as an ISO 8601 string"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def normalize_topic(topic: str) -> str:
+    """Lower cases a topic and collapses its whitespace so equivalent topics match"""
+    return " ".join(topic.split()).lower()
+
+
+class JobQueue:
+    """Runs submitted jobs on a pool of worker threads and keeps track of their status"""
+
+    def __init__(self, workers: int = None, max_history: int = DEFAULT_MAX_HISTORY,
+                 freshness_seconds: float = None,
+                 refreshed_since: Callable[[list[str], datetime], set] = None):
+        workers = workers or int(ENV.get("API_WORKERS", DEFAULT_WORKERS))
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="etl-worker")
+        self._max_history = max_history
+        self._freshness_seconds = freshness_seconds if freshness_seconds is not None \
+            else float(ENV.get("TOPIC_FRESHNESS_SECONDS", DEFAULT_FRESHNESS_SECONDS))
+        self._jobs = OrderedDict()
+        self._futures = {}
+        self._in_flight = {}
+        self._refreshed = {}
+        self._refreshed_since = refreshed_since
+        self._lock = threading.RLock()
+
+    def submit(self, func: Callable, topics: list[str]) -> dict:
+        """Queues func(topics) and returns the new job without waiting for it to run"""
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "topics": topics,
+            "status": "queued",
+            "submitted_at": utc_now(),
+            "started_at": None,
+            "finished_at": None,
+            "queued_seconds": None,
+            "run_seconds": None,
+            "error": None,
+            "_submitted": time.monotonic()
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._prune()
+            for topic in topics:
+                self._in_flight[topic] = job_id
+            self._futures[job_id] = self._executor.submit(
+                self._run, job_id, func, topics)
+        logging.info("Queued job %s for %s.", job_id, topics)
+        return self.get(job_id)
+
+    def submit_topic(self, func: Callable, topic: str) -> tuple[dict, str]:
+        """Queues func([topic]) for a normalized topic unless a job for it is already
+        queued or running, or its data was refreshed within the freshness window.
+        Returns the job that covers the topic and whether it was "queued", "attached"
+        to a job in flight or is "fresh"."""
+        _, covered = self.submit_topics(func, [topic])
+        job_id, outcome = next(iter(covered.values()))
+        return self.get(job_id), outcome
+
+    def submit_topics(self, func: Callable, topics: list[str]) -> tuple[dict, dict]:
+        """Queues one func(topics) job for every normalized topic that is not already
+        in flight or fresh. Returns the new job, or None if every topic was covered,
+        and a mapping of each topic to the job covering it and its outcome. A topic
+        refreshed by another process has no job here, so it is covered by None."""
+        covered = {}
+        topics = list(dict.fromkeys(map(normalize_topic, topics)))
+        refreshed_elsewhere = self._refreshed_elsewhere(topics)
+        with self._lock:
+            for topic in topics:
+                if topic in covered:
+                    continue
+                job_id = self._in_flight.get(topic)
+                if job_id is not None:
+                    logging.info("Attached %s to job %s already in flight.", topic, job_id)
+                    covered[topic] = (job_id, "attached")
+                    continue
+                job_id = self._fresh_job_id(topic)
+                if job_id is not None or topic in refreshed_elsewhere:
+                    logging.info("Skipped %s, refreshed by %s.", topic,
+                                 f"job {job_id}" if job_id else "another process")
+                    covered[topic] = (job_id, "fresh")
+                    continue
+                covered[topic] = (None, "queued")
+
+            queued = [topic for topic, (_, outcome) in covered.items() if outcome == "queued"]
+            if not queued:
+                return None, covered
+            job = self.submit(func, queued)
+            for topic in queued:
+                covered[topic] = (job["job_id"], "queued")
+        return job, covered
+
+    def _fresh_job_id(self, topic: str) -> str:
+        """Returns the job that refreshed a topic within the freshness window, if any"""
+        refreshed = self._refreshed.get(topic)
+        if refreshed is None:
+            return None
+        finished, job_id = refreshed
+        if time.monotonic() - finished > self._freshness_seconds or job_id not in self._jobs:
+            del self._refreshed[topic]
+            return None
+        return job_id
+
+    def _refreshed_elsewhere(self, topics: list[str]) -> set:
+        """Returns the topics that runs of other API processes or refresh workers
+        refreshed within the freshness window. A failed lookup counts none as fresh."""
+        if self._refreshed_since is None or not topics:
+            return set()
+        since = datetime.now() - timedelta(seconds=self._freshness_seconds)
+        try:
+            return self._refreshed_since(topics, since)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.warning("Could not look up recently refreshed topics: %s", e)
+            return set()
+
+    def _run(self, job_id: str, func: Callable, topics: list[str]) -> None:
+        """Runs a job on a worker thread, recording its status and timings"""
+        started = time.monotonic()
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(status="running", started_at=utc_now(),
+                       queued_seconds=round(started - job["_submitted"], 3))
+        status, error = "succeeded", None
+        try:
+            func(topics)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Job %s for %s failed: %s", job_id, topics, e)
+            status, error = "failed", str(e)
+        finished = time.monotonic()
+        with self._lock:
+            self._update(job_id, status=status, error=error, finished_at=utc_now(),
+                         run_seconds=round(finished - started, 3))
+            for topic in topics:
+                if self._in_flight.get(topic) == job_id:
+                    del self._in_flight[topic]
+                if status == "succeeded":
+                    self._refreshed[topic] = (finished, job_id)
+        logging.info("Job %s finished with status %s.", job_id, status)
+
+    def _update(self, job_id: str, **fields) -> None:
+        """Updates fields of a job record"""
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _prune(self) -> None:
+        """Forgets the oldest finished jobs once more than max_history are held, and
+        topics refreshed longer ago than the freshness window"""
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self._max_history:
+                break
+            if self._jobs[job_id]["status"] in FINISHED_STATUSES:
+                del self._jobs[job_id]
+                self._futures.pop(job_id, None)
+        now = time.monotonic()
+        for topic, (finished, _) in list(self._refreshed.items()):
+            if now - finished > self._freshness_seconds:
+                del self._refreshed[topic]
+
+    def get(self, job_id: str) -> dict:
+        """Returns a copy of a job's public fields, or None for an unknown job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items()
+                    if not key.startswith("_")}
+
+    def wait(self, job_id: str, timeout: float = None) -> dict:
+        """Blocks until a job has finished and returns it"""
+        future: Future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout=timeout)
+        return self.get(job_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops accepting jobs and optionally waits for running jobs to finish"""
+        self._executor.shutdown(wait=wait)
@@ -1,129 +1,270 @@
 """Script to load data into RDS"""
 
-import datetime
+import csv
+import io
+import time
 from os import environ as ENV
 import logging
 import pandas as pd
 from datetime import datetime
 import psycopg2
 import psycopg2.extras
-from psycopg2.extensions import connection as connect, cursor as curs
+from psycopg2.extensions import cursor as curs
 from dotenv import load_dotenv
+from db import borrow_connection
+from metrics import timer, inc
 
+DEFAULT_BATCH_SIZE = 1000
 
-def setup_connection() -> tuple:
-    """Retrieve database connection and cursor"""
-    try:
-        conn = psycopg2.connect(
-            user=ENV["DB_USERNAME"],
-            password=ENV["DB_PASSWORD"],
-            host=ENV["DB_HOST"],
-            port=ENV["DB_PORT"],
-            database=ENV["DB_NAME"]
-        )
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(f"SET SEARCH_PATH TO {ENV['SCHEMA_NAME']};")
-    except psycopg2.OperationalError as e:
-        logging.error(
-            "Operational error while connecting to the database: %s", e)
-        raise
-    except Exception as e:
-        logging.error("Error connecting to database: %s", e)
-        raise
-    logging.info("Connection successfully established to database.")
-
-    return conn, cursor
-
-
-def insert_keywords(conn: connect, cursor: curs,
-                    topic: list[str]) -> None:
-    """Insert keywords into keywords table from topic"""
-    for keyword in topic:
-        cursor.execute(
-            "SELECT keywords_id FROM keywords WHERE keyword = %s", (keyword,))
-        existing_id = cursor.fetchone()
+STAGING_TABLES = {
+    "stage_keywords": "keyword VARCHAR(50) NOT NULL",
+    "stage_keyword_recordings": """keywords_id BIGINT NOT NULL,
+                                   date_and_hour TIMESTAMP NOT NULL,
+                                   total_mentions BIGINT,
+                                   sentiment_sum FLOAT,
+                                   sentiment_sum_squares FLOAT""",
+    "stage_related_terms": """keyword VARCHAR(50) NOT NULL,
+                              related_term VARCHAR(255) NOT NULL"""
+}
+
+# New keywords are added in the load transaction, so a failed load leaves none behind,
+# and the unique key stops concurrent loads adding the same keyword twice
+KEYWORDS_QUERY = """INSERT INTO keywords (keyword)
+                    SELECT DISTINCT keyword FROM stage_keywords
+                    ON CONFLICT (keyword) DO NOTHING
+                    RETURNING keyword, keywords_id"""
+# Run as a separate statement so it sees keywords a concurrent load committed while
+# this one waited on the unique key
+KEYWORD_IDS_QUERY = """SELECT DISTINCT keywords.keyword, keywords.keywords_id
+                       FROM keywords
+                       JOIN stage_keywords ON stage_keywords.keyword = keywords.keyword"""
+
+MERGE_QUERIES = {
+    "keyword_recordings": """INSERT INTO keyword_recordings
+                             (keywords_id, total_mentions, sentiment_sum,
+                              sentiment_sum_squares, date_and_hour)
+                             SELECT keywords_id, total_mentions, sentiment_sum,
+                                    sentiment_sum_squares, date_and_hour
+                             FROM stage_keyword_recordings
+                             ON CONFLICT (keywords_id, date_and_hour) DO UPDATE
+                             SET total_mentions = EXCLUDED.total_mentions,
+                                 sentiment_sum = EXCLUDED.sentiment_sum,
+                                 sentiment_sum_squares = EXCLUDED.sentiment_sum_squares""",
+    "related_terms": """INSERT INTO related_terms (related_term)
+                        SELECT DISTINCT related_term FROM stage_related_terms
+                        ON CONFLICT (related_term) DO NOTHING""",
+    "related_term_assignment": """INSERT INTO related_term_assignment
+                                  (keywords_id, related_term_id)
+                                  SELECT DISTINCT keywords.keywords_id,
+                                         related_terms.related_term_id
+                                  FROM stage_related_terms AS staged
+                                  JOIN keywords ON keywords.keyword = staged.keyword
+                                  JOIN related_terms
+                                      ON related_terms.related_term = staged.related_term
+                                  ON CONFLICT (keywords_id, related_term_id) DO NOTHING"""
+}
+
+# Coarser rollups are bucketed from the same origin as pandas' floor, e.g. 00:00, 06:00...
+ROLLUP_PERIODS = {
+    "keyword_rollups_6h": "6 hours",
+    "keyword_rollups_1d": "1 day"
+}
+
+ROLLUP_LOCK_QUERY = """SELECT pg_advisory_xact_lock(hashtext('keyword_rollups'), keywords_id::INT)
+                       FROM (SELECT DISTINCT keywords_id FROM stage_keyword_recordings
+                             ORDER BY keywords_id) AS staged"""
 
-        if existing_id is None:
-            cursor.execute(
-                """INSERT INTO keywords (keyword) VALUES (%s)""", (keyword,))
-            conn.commit()
+# What each staged hour adds to the rollups: all of a new hour, or the change to a
+# reloaded one. Hours that are unchanged add nothing and are left out.
+ROLLUP_DELTA_QUERY = """CREATE TEMPORARY TABLE stage_rollup_deltas ON COMMIT DROP AS
+                        SELECT staged.keywords_id, staged.date_and_hour,
+                               CASE WHEN hourly.keywords_id IS NULL THEN 1 ELSE 0 END
+                                   AS hours_recorded,
+                               staged.total_mentions - COALESCE(hourly.total_mentions, 0)
+                                   AS total_mentions,
+                               staged.sentiment_sum - COALESCE(hourly.sentiment_sum, 0)
+                                   AS sentiment_sum,
+                               staged.sentiment_sum_squares
+                                   - COALESCE(hourly.sentiment_sum_squares, 0)
+                                   AS sentiment_sum_squares
+                        FROM stage_keyword_recordings AS staged
+                        LEFT JOIN keyword_rollups_1h AS hourly
+                            ON hourly.keywords_id = staged.keywords_id
+                            AND hourly.period_start = staged.date_and_hour
+                        WHERE hourly.keywords_id IS NULL
+                        OR (staged.total_mentions, staged.sentiment_sum,
+                            staged.sentiment_sum_squares)
+                           IS DISTINCT FROM (hourly.total_mentions, hourly.sentiment_sum,
+                                             hourly.sentiment_sum_squares)"""
 
+HOURLY_ROLLUP_QUERY = """INSERT INTO keyword_rollups_1h
+                         (keywords_id, period_start, hours_recorded, total_mentions,
+                          sentiment_sum, sentiment_sum_squares)
+                         SELECT staged.keywords_id, staged.date_and_hour, 1,
+                                staged.total_mentions, staged.sentiment_sum,
+                                staged.sentiment_sum_squares
+                         FROM stage_keyword_recordings AS staged
+                         JOIN stage_rollup_deltas AS delta
+                             ON delta.keywords_id = staged.keywords_id
+                             AND delta.date_and_hour = staged.date_and_hour
+                         ON CONFLICT (keywords_id, period_start) DO UPDATE
+                         SET total_mentions = EXCLUDED.total_mentions,
+                             sentiment_sum = EXCLUDED.sentiment_sum,
+                             sentiment_sum_squares = EXCLUDED.sentiment_sum_squares"""
 
-def insert_keyword_recordings(conn: connect,
-                              cursor: curs, dataframe: pd.DataFrame) -> None:
-    """Inserts data into the keyword_recordings table"""
+ROLLUP_QUERY = """INSERT INTO {table} AS rollup
+                  (keywords_id, period_start, hours_recorded, total_mentions,
+                   sentiment_sum, sentiment_sum_squares)
+                  SELECT keywords_id,
+                         DATE_BIN(INTERVAL '{period}', date_and_hour, TIMESTAMP '2000-01-01'),
+                         SUM(hours_recorded), SUM(total_mentions), SUM(sentiment_sum),
+                         SUM(sentiment_sum_squares)
+                  FROM stage_rollup_deltas
+                  GROUP BY 1, 2
+                  ON CONFLICT (keywords_id, period_start) DO UPDATE
+                  SET hours_recorded = rollup.hours_recorded + EXCLUDED.hours_recorded,
+                      total_mentions = rollup.total_mentions + EXCLUDED.total_mentions,
+                      sentiment_sum = rollup.sentiment_sum + EXCLUDED.sentiment_sum,
+                      sentiment_sum_squares = rollup.sentiment_sum_squares
+                                              + EXCLUDED.sentiment_sum_squares"""
 
+PARTITION_QUERY = """SELECT create_keyword_recordings_partitions(MIN(date_and_hour),
+                                                                  MAX(date_and_hour)) AS created
+                     FROM stage_keyword_recordings"""
+
+
+def get_batch_size() -> int:
+    """Returns the number of rows to send to the database per COPY"""
+    return int(ENV.get("LOAD_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+
+
+def keyword_recording_rows(dataframe: pd.DataFrame, keyword_ids: dict = None) -> list[tuple]:
+    """Returns one keyword recording row per keyword and hour, keeping the latest.
+    Rows of keywords added by this load take their id from keyword_ids."""
+    rows = {}
     for row in dataframe.to_dict(orient='records'):
+        if pd.isna(row['keyword_id']) and keyword_ids:
+            row['keyword_id'] = keyword_ids.get(str(row.get('Keyword')).lower())
+        if pd.isna(row['keyword_id']):
+            logging.warning("Skipping recording for unknown keyword '%s'.",
+                            row.get('Keyword'))
+            continue
         date_and_hour = datetime.strptime(row['Date and Hour'], "%Y-%m-%d %H")
-        total_mentions = row['Total Mentions']
-        average_sentiment = row['Average Sentiment']
-        keyword_id = row['keyword_id']
-        cursor.execute("""INSERT INTO keyword_recordings
-                       (keywords_id, total_mentions, avg_sentiment, date_and_hour)
-                       VALUES (%s, %s, %s, %s)""",
-                       (keyword_id, total_mentions, average_sentiment, date_and_hour))
-        conn.commit()
-
-
-def insert_related_terms(conn: connect, cursor: curs, extracted_dataframe: pd.DataFrame) -> dict:
-    """Inserts unique related terms into the related terms table"""
-    keyword_and_ids = {}
-    processed_terms = set()
-
-    for row in extracted_dataframe.to_dict(orient='records'):
-        related_terms = row['Related Terms'].split(",")
-        keyword = row['Keyword']
-
-        for term in related_terms:
-            term = term.strip()
-            if term not in processed_terms:
-                cursor.execute("""SELECT related_term_id FROM related_terms
-                               WHERE related_term = %s""", (term, ))
-                existing_term = cursor.fetchone()
-
-                if existing_term is None:
-                    cursor.execute("""INSERT INTO related_terms (related_term)
-                                VALUES (%s) RETURNING related_term_id""", (term, ))
-                    related_term_id = cursor.fetchone()['related_term_id']
-                else:
-                    related_term_id = existing_term['related_term_id']
-
-                keyword_and_ids[related_term_id] = keyword
-                processed_terms.add(term)
-                conn.commit()
+        rows[(row['keyword_id'], date_and_hour)] = (
+            row['keyword_id'], date_and_hour, row['Total Mentions'], row['Sentiment Sum'],
+            row['Sentiment Sum of Squares'])
+    return list(rows.values())
+
 
-    return keyword_and_ids
+def related_term_rows(dataframe: pd.DataFrame) -> list[tuple]:
+    """Returns the unique keyword and related term pairs.
+    The related terms repeat on every row of a keyword so each pair is only kept once."""
+    pairs = set()
+    for row in dataframe[['Keyword', 'Related Terms']].drop_duplicates().to_dict(
+            orient='records'):
+        pairs.update((row['Keyword'].lower(), term.strip())
+                     for term in str(row['Related Terms']).split(",") if term.strip())
+    return sorted(pairs)
 
 
-def get_keyword_id(cursor: curs, keyword: str) -> int:
-    """Returns the keyword id for a given keyword"""
+def create_staging_tables(cursor: curs) -> None:
+    """Creates temporary staging tables that are dropped when the transaction ends"""
+    for table, columns in STAGING_TABLES.items():
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {table} ({columns}) ON COMMIT DROP")
+
+
+def copy_rows(cursor: curs, table: str, rows: list[tuple], batch_size: int = None) -> None:
+    """Bulk copies rows into a staging table in batches of CSV"""
+    batch_size = batch_size or get_batch_size()
+    start = time.perf_counter()
+    for offset in range(0, len(rows), batch_size):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows[offset:offset + batch_size])
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv)", buffer)
+    elapsed = time.perf_counter() - start
+
+    logging.info("Copied %s rows into %s in %.2fs (%.0f rows/s).",
+                 len(rows), table, elapsed, len(rows) / elapsed if elapsed else len(rows))
+
+
+def create_partitions(cursor: curs) -> int:
+    """Creates the keyword_recordings partitions for the days being loaded that do not
+    exist yet. Returns the number of partitions created."""
+    cursor.execute(PARTITION_QUERY)
+    created = cursor.fetchone()['created']
+    if created:
+        logging.info("Created %s keyword_recordings partitions.", created)
+    return created
 
-    cursor.execute(
-        """SELECT keywords.keywords_id FROM keywords WHERE keyword = %s""", (keyword, ))
-    result = cursor.fetchone()
-    if result is None:
-        logging.error("Keyword '%s' not found in the database.", keyword)
-        raise ValueError(f"Keyword '{keyword}' not found.")
-    return result['keywords_id']
 
+def add_keywords(cursor: curs) -> tuple[dict, int]:
+    """Adds the staged keywords that are not in the database yet. Returns the id of every
+    staged keyword and the number added."""
+    cursor.execute(KEYWORDS_QUERY)
+    added = cursor.rowcount
+    cursor.execute(KEYWORD_IDS_QUERY)
+    return {row['keyword']: row['keywords_id'] for row in cursor.fetchall()}, added
 
-def insert_related_term_assignment(conn: connect, cursor: curs, keyword_and_ids: dict) -> None:
-    """Inserts data into the related_term_assignment table"""
-    for key, value in keyword_and_ids.items():
-        keyword_id = get_keyword_id(cursor, value)
-        cursor.execute("""INSERT INTO related_term_assignment (keywords_id, related_term_id)
-                       VALUES (%s, %s)""", (keyword_id, key))
-        conn.commit()
+
+def merge_staged_rows(cursor: curs) -> dict:
+    """Merges the staging tables into the real tables with one statement per table.
+    Returns the number of rows written to each table."""
+    written = {}
+    for table, query in MERGE_QUERIES.items():
+        cursor.execute(query)
+        written[table] = cursor.rowcount
+    return written
+
+
+def update_rollups(cursor: curs) -> dict:
+    """Adds the staged recordings to the hourly, 6-hourly and daily rollups.
+    Keywords are locked so concurrent loads of the same keyword apply their changes one
+    after the other. Returns the number of rows written to each rollup."""
+    cursor.execute(ROLLUP_LOCK_QUERY)
+    cursor.execute(ROLLUP_DELTA_QUERY)
+    cursor.execute(HOURLY_ROLLUP_QUERY)
+    written = {"keyword_rollups_1h": cursor.rowcount}
+    for table, period in ROLLUP_PERIODS.items():
+        cursor.execute(ROLLUP_QUERY.format(table=table, period=period))
+        written[table] = cursor.rowcount
+    return written
 
 
 def main(topic: list[str], extracted_dataframe: pd.DataFrame) -> None:
-    """Main function to load environment variables to import data into the database."""
-    conn, cursor = setup_connection()
+    """Main function to load environment variables to import data into the database.
+    The whole run is staged, merged and rolled up in a single transaction."""
     load_dotenv()
-    insert_keywords(conn, cursor, topic)
-    insert_keyword_recordings(conn, cursor, extracted_dataframe)
-    related_term_ids = insert_related_terms(conn, cursor, extracted_dataframe)
-    insert_related_term_assignment(conn, cursor, related_term_ids)
+    with borrow_connection() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            with timer("load_copy"):
+                create_staging_tables(cursor)
+                copy_rows(cursor, "stage_keywords",
+                          [(keyword.lower(),) for keyword in topic])
+                keyword_ids, added = add_keywords(cursor)
+                copy_rows(cursor, "stage_keyword_recordings",
+                          keyword_recording_rows(extracted_dataframe, keyword_ids))
+                copy_rows(cursor, "stage_related_terms",
+                          related_term_rows(extracted_dataframe))
+            with timer("load_merge"):
+                create_partitions(cursor)
+                written = {"keywords": added, **merge_staged_rows(cursor)}
+            with timer("load_rollup"):
+                written.update(update_rollups(cursor))
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error("Load failed, no data was written: %s", e)
+            raise
+        finally:
+            cursor.close()
+
+    for table, count in written.items():
+        inc("etl_rows_loaded_total", count, table=table)
+    logging.info("Loaded %s", ", ".join(
+        f"{count} rows into {table}" for table, count in written.items()))
 
 
 if __name__ == "__main__":
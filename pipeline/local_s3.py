@@ -0,0 +1,99 @@
+"""Filesystem stand-in for the parts of the S3 client the pipeline uses, so the
+pipeline can run offline against files on disk"""
+
+import asyncio
+import io
+import os
+import time
+
+
+class LocalS3:
+    """Serves list_objects_v2 and get_object from <root>/<bucket>/<key>, optionally
+    sleeping for latency seconds per request to mimic the round trip to S3"""
+
+    def __init__(self, root: str, latency: float = 0):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, bucket: str, key: str = "") -> str:
+        """Returns the file path of a key"""
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "",
+                        Delimiter: str = None, **_) -> dict:  # pylint: disable=invalid-name
+        """Lists the keys under a prefix. With a '/' delimiter only the keys directly
+        under the prefix are listed and deeper keys are grouped into CommonPrefixes."""
+        time.sleep(self.latency)
+        bucket_root = self._path(Bucket)
+        contents, common_prefixes = [], set()
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, "/")
+                if not key.startswith(Prefix):
+                    continue
+                rest = key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    common_prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    continue
+                contents.append({"Key": key, "Size": os.path.getsize(path)})
+
+        response = {"KeyCount": len(contents), "IsTruncated": False}
+        if contents:
+            response["Contents"] = sorted(contents, key=lambda obj: obj["Key"])
+        if common_prefixes:
+            response["CommonPrefixes"] = [{"Prefix": prefix}
+                                          for prefix in sorted(common_prefixes)]
+        return response
+
+    def get_object(self, Bucket: str, Key: str, **_) -> dict:  # pylint: disable=invalid-name
+        """Returns an object's body"""
+        time.sleep(self.latency)
+        with open(self._path(Bucket, Key), "rb") as file:
+            body = file.read()
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **_) -> dict:  # pylint: disable=invalid-name
+        """Writes an object"""
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(Body if isinstance(Body, bytes) else Body.encode("utf-8"))
+        return {}
+
+
+class AsyncBody:
+    """Object body whose read is awaited, like aiobotocore's StreamingBody"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def read(self) -> bytes:
+        """Returns the body"""
+        return self.body
+
+
+class AsyncLocalS3:
+    """Async version of LocalS3 in the shape of an aioboto3 client. Latency is waited
+    on without blocking the event loop, so concurrent requests overlap."""
+
+    def __init__(self, root: str, latency: float = 0):
+        self.s3 = LocalS3(root)
+        self.latency = latency
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        return False
+
+    async def list_objects_v2(self, **kwargs) -> dict:
+        """Lists the keys under a prefix"""
+        await asyncio.sleep(self.latency)
+        return self.s3.list_objects_v2(**kwargs)
+
+    async def get_object(self, **kwargs) -> dict:
+        """Returns an object's body"""
+        await asyncio.sleep(self.latency)
+        response = self.s3.get_object(**kwargs)
+        return {**response, "Body": AsyncBody(response["Body"].read())}
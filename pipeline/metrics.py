@@ -0,0 +1,155 @@
+"""In-process counters and latency histograms for the ETL stages, rendered in the
+Prometheus text format for the API's /metrics endpoint"""
+
+import contextvars
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = {
+    "etl_stage_duration_seconds": ("histogram", "Time spent in each ETL stage."),
+    "etl_stage_errors_total": ("counter", "ETL stages that raised an exception."),
+    "etl_rows_total": ("counter", "Rows produced by each ETL stage."),
+    "etl_rows_loaded_total": ("counter", "Rows inserted or updated by the load stage by table."),
+    "etl_s3_requests_total": ("counter", "Requests made to S3 by operation."),
+    "etl_s3_bytes_total": ("counter", "Bytes of post data read from S3."),
+    "etl_pytrends_requests_total": ("counter", "Requests made to Google Trends for suggestions.")
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_current_run = contextvars.ContextVar("current_run", default=None)
+_DONE = object()
+
+
+def label_key(labels: dict) -> tuple:
+    """Returns labels as a sorted tuple so they can key a series"""
+    return tuple(sorted(labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """Adds an amount to a counter"""
+    key = (name, label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    run = _current_run.get()
+    if run is not None:
+        run["counters"][key] = run["counters"].get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Records a value in a histogram"""
+    key = (name, label_key(labels))
+    with _lock:
+        histogram = _histograms.setdefault(
+            key, {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def timer(stage: str):
+    """Times a block as an ETL stage, counting the stage as an error if it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("etl_stage_errors_total", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("etl_stage_duration_seconds", elapsed, stage=stage)
+        run = _current_run.get()
+        if run is not None:
+            run["stage_seconds"][stage] = run["stage_seconds"].get(stage, 0) + elapsed
+
+
+def timed(stage: str, iterable: Iterable) -> Iterator:
+    """Yields from an iterable, timing the work done to produce each item as the stage"""
+    iterator = iter(iterable)
+    while True:
+        with timer(stage):
+            item = next(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+@contextmanager
+def track_run():
+    """Collects the stage durations and counters recorded by one ETL run, as well as
+    adding them to the process wide metrics"""
+    run = {"stage_seconds": {}, "counters": {}}
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+
+def run_counter(run: dict, name: str, **labels) -> float:
+    """Returns a counter's total within one tracked run"""
+    return run["counters"].get((name, label_key(labels)), 0)
+
+
+def snapshot() -> dict:
+    """Returns the total seconds spent in each stage and every counter's value"""
+    with _lock:
+        stage_seconds = {dict(labels)["stage"]: histogram["sum"]
+                         for (name, labels), histogram in _histograms.items()
+                         if name == "etl_stage_duration_seconds"}
+        return {"stage_seconds": stage_seconds, "counters": dict(_counters)}
+
+
+def format_labels(labels: tuple, **extra) -> str:
+    """Formats labels as a Prometheus label set"""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"],
+                            "count": value["count"]}
+                      for key, value in _histograms.items()}
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            continue
+        for (series, labels), histogram in sorted(histograms.items()):
+            if series != name:
+                continue
+            for bound, count in zip(DEFAULT_BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} "
+                         f"{histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """Forgets every recorded value"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
@@ -0,0 +1,189 @@
+"""One-off migration that turns keyword_recordings into a table partitioned by day, so
+queries over recent hours only read the days they need and old days are dropped whole"""
+
+import argparse
+import logging
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+from dedupe import count_duplicate_recordings
+from widen_recordings import is_widened, widen_recordings
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+OLD_TABLE = "keyword_recordings_unpartitioned"
+
+# These match schema.sql, which creates them for new databases
+PARTITIONED_TABLE = """CREATE TABLE IF NOT EXISTS keyword_recordings (
+    keyword_recordings_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    keywords_id BIGINT,
+    total_mentions BIGINT,
+    sentiment_sum FLOAT,
+    sentiment_sum_squares FLOAT,
+    date_and_hour TIMESTAMP NOT NULL,
+    avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED,
+    PRIMARY KEY (keyword_recordings_id, date_and_hour),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id),
+    CONSTRAINT keyword_recordings_keyword_hour_key UNIQUE (keywords_id, date_and_hour)
+) PARTITION BY RANGE (date_and_hour);"""
+
+TIME_INDEX = """CREATE INDEX IF NOT EXISTS keyword_recordings_date_and_hour_idx
+    ON keyword_recordings USING BRIN (date_and_hour);"""
+
+CREATE_PARTITIONS_FUNCTION = """CREATE OR REPLACE FUNCTION create_keyword_recordings_partitions(first_hour TIMESTAMP,
+                                                                last_hour TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    day DATE := first_hour::DATE;
+    created INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('keyword_recordings_partitions'));
+    WHILE day <= last_hour::DATE LOOP
+        IF to_regclass('keyword_recordings_p' || TO_CHAR(day, 'YYYYMMDD')) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF keyword_recordings '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'keyword_recordings_p' || TO_CHAR(day, 'YYYYMMDD'), day, day + 1);
+            created := created + 1;
+        END IF;
+        day := day + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;"""
+
+DROP_PARTITIONS_FUNCTION = """CREATE OR REPLACE FUNCTION drop_keyword_recordings_partitions(cutoff TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    partition_name TEXT;
+    dropped INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('keyword_recordings_partitions'));
+    FOR partition_name IN
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'keyword_recordings'::REGCLASS
+        AND child.relname ~ '^keyword_recordings_p[0-9]{8}$'
+        AND TO_DATE(RIGHT(child.relname, 8), 'YYYYMMDD') + 1 <= cutoff
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;"""
+
+PARTITION_DDL = (PARTITIONED_TABLE, TIME_INDEX, CREATE_PARTITIONS_FUNCTION,
+                 DROP_PARTITIONS_FUNCTION)
+
+
+def is_partitioned(cursor: curs) -> bool:
+    """Returns whether keyword_recordings is already partitioned"""
+    cursor.execute("""SELECT 1 FROM pg_partitioned_table
+                   WHERE partrelid = 'keyword_recordings'::regclass""")
+    return cursor.fetchone() is not None
+
+
+def rename_old_table(cursor: curs) -> None:
+    """Moves the unpartitioned table and its indexes out of the way of the new ones"""
+    cursor.execute(f"ALTER TABLE keyword_recordings RENAME TO {OLD_TABLE}")
+    cursor.execute("""SELECT index.relname AS name
+                   FROM pg_index
+                   JOIN pg_class AS index ON index.oid = pg_index.indexrelid
+                   WHERE pg_index.indrelid = %s::regclass""", (OLD_TABLE,))
+    for row in cursor.fetchall():
+        cursor.execute(f"ALTER INDEX {row['name']} RENAME TO {row['name']}_unpartitioned")
+    cursor.execute("""SELECT conname AS name FROM pg_constraint
+                   WHERE conrelid = %s::regclass AND contype = 'f'""", (OLD_TABLE,))
+    for row in cursor.fetchall():
+        cursor.execute(
+            f"ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT {row['name']} TO {row['name']}_unpartitioned")
+
+
+def create_partitioned_table(cursor: curs) -> None:
+    """Creates the partitioned table, its time index and the partition functions"""
+    for statement in PARTITION_DDL:
+        cursor.execute(statement)
+
+
+def copy_recordings(cursor: curs) -> int:
+    """Creates a partition for every day with recordings and copies the recordings
+    into them, keeping their ids. Returns the number of rows copied."""
+    cursor.execute(f"""SELECT create_keyword_recordings_partitions(MIN(date_and_hour),
+                                                                   MAX(date_and_hour))
+                   FROM {OLD_TABLE}""")
+    cursor.execute(f"""INSERT INTO keyword_recordings
+                   (keyword_recordings_id, keywords_id, total_mentions, sentiment_sum,
+                    sentiment_sum_squares, date_and_hour)
+                   OVERRIDING SYSTEM VALUE
+                   SELECT keyword_recordings_id, keywords_id, total_mentions, sentiment_sum,
+                          sentiment_sum_squares, date_and_hour
+                   FROM {OLD_TABLE}
+                   WHERE date_and_hour IS NOT NULL""")
+    copied = cursor.rowcount
+    cursor.execute("""SELECT setval(pg_get_serial_sequence('keyword_recordings',
+                                                          'keyword_recordings_id'),
+                                    COALESCE(MAX(keyword_recordings_id), 0) + 1, false)
+                   FROM keyword_recordings""")
+    return copied
+
+
+def count_undated_recordings(cursor: curs) -> int:
+    """Returns the number of recordings without an hour, which no partition can hold"""
+    cursor.execute(f"SELECT COUNT(*) AS undated FROM {OLD_TABLE} WHERE date_and_hour IS NULL")
+    return cursor.fetchone()['undated']
+
+
+def main(keep_old: bool = False) -> None:
+    """Partitions keyword_recordings by day in a single transaction, first widening it
+    if it still stores the average sentiment"""
+    load_dotenv()
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if is_partitioned(cursor):
+                logging.info("keyword_recordings is already partitioned.")
+                return
+
+            # The partitioned table's unique key would reject them part way through the copy
+            duplicates = count_duplicate_recordings(cursor)
+            if duplicates:
+                raise ValueError(f"keyword_recordings has {duplicates} duplicate recordings "
+                                 "of a keyword and hour. Run dedupe.py first.")
+
+            if not is_widened(cursor):
+                widen_recordings(cursor)
+            rename_old_table(cursor)
+            create_partitioned_table(cursor)
+            copied = copy_recordings(cursor)
+            undated = count_undated_recordings(cursor)
+            if not keep_old:
+                cursor.execute(f"DROP TABLE {OLD_TABLE}")
+            conn.commit()
+            logging.info("Copied %s recordings into daily partitions.", copied)
+            if undated:
+                logging.warning("Skipped %s recordings without an hour.", undated)
+            if keep_old:
+                logging.info("The old table was kept as %s.", OLD_TABLE)
+
+            cursor.execute("ANALYZE keyword_recordings")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Partition keyword_recordings by day.")
+    parser.add_argument("--keep-old", action="store_true",
+                        help=f"Keep the unpartitioned table as {OLD_TABLE}.")
+    args = parser.parse_args()
+    main(args.keep_old)
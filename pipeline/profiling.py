@@ -0,0 +1,171 @@
+"""Profiles an ETL run with cProfile and tracemalloc, writing pstats, collapsed stacks
+for flamegraph tools and the top allocation sites"""
+
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from os import environ as ENV
+from typing import Callable
+
+TRACEBACK_FRAMES = 25
+TOP_ALLOCATIONS = 25
+ALLOCATION_FRAMES = 5
+MAX_STACK_DEPTH = 64
+MIN_STACK_SECONDS = 1e-6
+
+_profile_lock = threading.Lock()
+# The profilers of the worker threads of the run being profiled in this context
+_thread_profilers = contextvars.ContextVar("thread_profilers", default=None)
+
+
+def profile_dir_for(topics: list[str]) -> str:
+    """Returns the directory to profile a run into from ETL_PROFILE_DIR, or None.
+    If ETL_PROFILE_TOPICS is set only runs including one of those topics are profiled."""
+    output_dir = ENV.get("ETL_PROFILE_DIR")
+    wanted = {topic.strip().lower() for topic in ENV.get("ETL_PROFILE_TOPICS", "").split(",")
+              if topic.strip()}
+    if not output_dir or (wanted and not wanted & {topic.lower() for topic in topics}):
+        return None
+    return output_dir
+
+
+def frame_name(func: tuple) -> str:
+    """Formats a pstats function key as a flamegraph frame"""
+    filename, line, name = func
+    if filename == "~":
+        frame = name
+    else:
+        frame = f"{name} ({os.path.basename(filename)}:{line})"
+    return frame.replace(";", ":")
+
+
+def collapsed_stacks(stats: pstats.Stats) -> Counter:
+    """Rebuilds call stacks from the caller graph recorded by cProfile and returns the
+    microseconds of self time spent in each. Time is split between a function's
+    callers in proportion to the calls they made, so deep stacks are estimates."""
+    children = defaultdict(list)
+    roots = []
+    for func, (_, _, tottime, cumtime, callers) in stats.stats.items():
+        if not callers:
+            roots.append((func, tottime, cumtime))
+        for caller, (_, _, caller_tottime, caller_cumtime) in callers.items():
+            children[caller].append((func, caller_tottime, caller_cumtime))
+
+    totals = {func: cumtime for func, (_, _, _, cumtime, _) in stats.stats.items()}
+    stacks = Counter()
+
+    def walk(func, path, tottime, cumtime):
+        path = path + (frame_name(func),)
+        if tottime > 0:
+            stacks[";".join(path)] += round(tottime * 1e6)
+        if len(path) >= MAX_STACK_DEPTH or not totals.get(func):
+            return
+        share = cumtime / totals[func]
+        for child, child_tottime, child_cumtime in children[func]:
+            if frame_name(child) in path or child_cumtime * share < MIN_STACK_SECONDS:
+                continue
+            walk(child, path, child_tottime * share, child_cumtime * share)
+
+    for func, tottime, cumtime in roots:
+        walk(func, (), tottime, cumtime)
+    return stacks
+
+
+def write_collapsed(stats: pstats.Stats, path: str) -> None:
+    """Writes collapsed stacks in the format read by flamegraph.pl and speedscope"""
+    with open(path, "w", encoding="utf-8") as file:
+        for stack, microseconds in sorted(collapsed_stacks(stats).items()):
+            if microseconds > 0:
+                file.write(f"{stack} {microseconds}\n")
+
+
+def write_allocations(snapshot: tracemalloc.Snapshot, peak: int, path: str) -> None:
+    """Writes the peak traced memory and the lines that allocated the most memory"""
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(f"Peak traced memory: {peak / 2 ** 20:.1f} MiB\n\n")
+        for stat in snapshot.statistics("traceback")[:TOP_ALLOCATIONS]:
+            file.write(f"{stat.size / 2 ** 10:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format(limit=ALLOCATION_FRAMES, most_recent_first=True):
+                file.write(f"{line}\n")
+            file.write("\n")
+
+
+def profiled_call(func: Callable, *args):
+    """Calls func on a worker thread of a run, with its own profiler if the run is being
+    profiled, so the work shows up in the run's profile. The thread must run in a copy
+    of the run's context, as asyncio.to_thread and etl.prefetch threads do."""
+    profilers = _thread_profilers.get()
+    if profilers is None:
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # From Python 3.12 the run's profiler already sees every thread
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        profilers.append(profiler)
+
+
+def merge_stats(profiler: cProfile.Profile, thread_profilers: list) -> pstats.Stats:
+    """Adds the profiles of the run's worker threads to that of the thread it ran on"""
+    stats = pstats.Stats(profiler)
+    for thread_profiler in list(thread_profilers):
+        stats.add(thread_profiler)
+    return stats
+
+
+@contextmanager
+def profile(output_dir: str, topics: list[str]):
+    """Profiles the block with cProfile and tracemalloc and writes the results to
+    output_dir. Work the block hands to other threads is only profiled when it is
+    called through profiled_call. Only one run is profiled at a time; others run
+    unprofiled."""
+    if not _profile_lock.acquire(blocking=False):
+        logging.warning("Another run is being profiled, running %s without profiling.",
+                        topics)
+        yield
+        return
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        slug = re.sub(r"[^a-z0-9]+", "-", "_".join(topics).lower()).strip("-")[:50]
+        prefix = os.path.join(output_dir,
+                              f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{slug or 'run'}")
+
+        tracemalloc.start(TRACEBACK_FRAMES)
+        thread_profilers = []
+        token = _thread_profilers.set(thread_profilers)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            _thread_profilers.reset(token)
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            stats = merge_stats(profiler, thread_profilers)
+            stats.dump_stats(f"{prefix}.pstats")
+            write_collapsed(stats, f"{prefix}.collapsed")
+            write_allocations(snapshot, peak, f"{prefix}.allocations.txt")
+            logging.info("Wrote profile of %s, with %s worker thread calls, to %s.*",
+                         topics, len(thread_profilers), prefix)
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,224 @@
+"""Benchmarks the dashboard, notification and retention queries against keyword_recordings
+laid out as one plain table and as daily partitions, filled with the same synthetic rows"""
+
+import argparse
+import json
+import logging
+import statistics
+import time
+from os import environ as ENV
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+from partition_recordings import PARTITION_DDL
+from widen_recordings import AVERAGE_COLUMN
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+DEFAULT_ROWS = 10_000_000
+DEFAULT_KEYWORDS = 1000
+DEFAULT_REPEATS = 5
+LAYOUTS = ("plain", "partitioned")
+
+KEYWORDS_TABLE = """CREATE TABLE keywords (
+    keywords_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    keyword VARCHAR(50) NOT NULL,
+    PRIMARY KEY (keywords_id)
+)"""
+
+# keyword_recordings as one table, as it was before it was partitioned
+PLAIN_TABLE = f"""CREATE TABLE keyword_recordings (
+    keyword_recordings_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    keywords_id BIGINT,
+    total_mentions BIGINT,
+    sentiment_sum FLOAT,
+    sentiment_sum_squares FLOAT,
+    date_and_hour TIMESTAMP,
+    {AVERAGE_COLUMN},
+    PRIMARY KEY (keyword_recordings_id),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id),
+    CONSTRAINT keyword_recordings_keyword_hour_key UNIQUE (keywords_id, date_and_hour)
+)"""
+
+FILL_QUERY = """INSERT INTO keyword_recordings (keywords_id, total_mentions, sentiment_sum,
+                                                sentiment_sum_squares, date_and_hour)
+                SELECT keywords_id, mentions, mentions * mean, mentions * mean * mean, hour
+                FROM (SELECT keywords_id, (random() * 500)::BIGINT AS mentions,
+                             random() * 2 - 1 AS mean,
+                             DATE_TRUNC('hour', NOW()) - n * INTERVAL '1 hour' AS hour
+                      FROM keywords, generate_series(0, %(hours)s - 1) AS n) AS recordings"""
+
+# The queries in dashboard/queries.py, notifications/notify.py and rds_to_s3/etl_lambda.py
+QUERIES = {
+    "keyword_history": """
+        SELECT k.keyword, kr.total_mentions, kr.avg_sentiment, kr.date_and_hour
+        FROM keyword_recordings as kr
+        JOIN keywords as k ON k.keywords_id = kr.keywords_id
+        WHERE keyword = %(keyword)s""",
+    "change_over_24_hours": """
+        WITH avg_sentiment_24_ago AS (
+            SELECT DISTINCT ON (k.keyword) kr.avg_sentiment, kr.total_mentions, k.keyword
+            FROM keyword_recordings AS kr
+            JOIN keywords AS k ON kr.keywords_id = k.keywords_id
+            WHERE k.keyword = ANY (%(keywords)s)
+            AND date_and_hour <= NOW() - INTERVAL '24 HOURS'
+            ORDER BY k.keyword, date_and_hour DESC
+        ),
+        avg_sentiment_now AS (
+            SELECT DISTINCT ON (k.keyword) kr.avg_sentiment, kr.total_mentions, k.keyword
+            FROM keyword_recordings AS kr
+            JOIN keywords AS k ON kr.keywords_id = k.keywords_id
+            WHERE k.keyword = ANY (%(keywords)s) AND date_and_hour <= NOW()
+            ORDER BY k.keyword, date_and_hour DESC
+        )
+        SELECT * FROM avg_sentiment_24_ago AS a
+        JOIN avg_sentiment_now AS n ON n.keyword = a.keyword""",
+    "most_mentioned_24_hours": """
+        SELECT k.keyword, SUM(kr.total_mentions) AS total_mentions,
+               SUM(kr.sentiment_sum) / NULLIF(SUM(kr.total_mentions), 0) AS avg_sentiment
+        FROM keyword_recordings AS kr
+        JOIN keywords AS k ON k.keywords_id = kr.keywords_id
+        WHERE kr.date_and_hour >= NOW() - INTERVAL '24 HOURS'
+        GROUP BY k.keyword
+        ORDER BY total_mentions DESC
+        LIMIT 1""",
+    "most_positive_24_hours": """
+        SELECT k.keyword, MAX(kr.avg_sentiment) AS max_sentiment, kr.date_and_hour
+        FROM keyword_recordings AS kr
+        JOIN keywords AS k ON k.keywords_id = kr.keywords_id
+        WHERE kr.date_and_hour >= NOW() - INTERVAL '24 HOURS'
+        GROUP BY k.keyword, kr.date_and_hour
+        ORDER BY max_sentiment DESC
+        LIMIT 1""",
+    "latest_mentions": """
+        SELECT kr.keywords_id,
+               ARRAY_AGG(kr.total_mentions ORDER BY kr.date_and_hour DESC) AS mentions
+        FROM keyword_recordings kr
+        GROUP BY kr.keywords_id""",
+    "archive_older_than_24_hours": """
+        SELECT * FROM keyword_recordings kr
+        WHERE date_and_hour < NOW() - INTERVAL '24 HOURS'"""
+}
+
+RETENTION_QUERIES = {
+    "plain": ["""DELETE FROM keyword_recordings
+                 WHERE date_and_hour < NOW() - INTERVAL '24 HOURS'"""],
+    "partitioned": ["""SELECT drop_keyword_recordings_partitions(
+                           (NOW() - INTERVAL '24 HOURS')::TIMESTAMP)""",
+                    """DELETE FROM keyword_recordings
+                       WHERE date_and_hour < NOW() - INTERVAL '24 HOURS'"""]
+}
+
+
+def schema_for(layout: str) -> str:
+    """Returns the scratch schema a layout is built in"""
+    return f"{ENV['SCHEMA_NAME']}_bench_{layout}"
+
+
+def build_layout(cursor: curs, layout: str, keywords: int, hours: int) -> None:
+    """Creates a scratch schema holding keywords and keyword_recordings in a layout and
+    fills it with a recording for every keyword and hour"""
+    schema = schema_for(layout)
+    cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {schema}")
+    cursor.execute(f"SET search_path TO {schema}")
+    cursor.execute(KEYWORDS_TABLE)
+    cursor.execute("""INSERT INTO keywords (keyword)
+                   SELECT 'keyword' || n FROM generate_series(1, %s) AS n""", (keywords,))
+    if layout == "plain":
+        cursor.execute(PLAIN_TABLE)
+    else:
+        for statement in PARTITION_DDL:
+            cursor.execute(statement)
+        cursor.execute("""SELECT create_keyword_recordings_partitions(
+                              (DATE_TRUNC('hour', NOW()) - %s * INTERVAL '1 hour')::TIMESTAMP,
+                              NOW()::TIMESTAMP)""", (hours,))
+    cursor.execute(FILL_QUERY, {"hours": hours})
+    cursor.execute("ANALYZE keywords")
+    cursor.execute("ANALYZE keyword_recordings")
+
+
+def execution_ms(cursor: curs, query: str, params: dict) -> float:
+    """Returns the server side execution time of a query in milliseconds"""
+    cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", params)
+    plan = cursor.fetchone()["QUERY PLAN"]
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]["Execution Time"]
+
+
+def time_queries(cursor: curs, layout: str, keywords: int, repeats: int) -> dict:
+    """Returns the median execution time of each query in a layout"""
+    cursor.execute(f"SET search_path TO {schema_for(layout)}")
+    params = {"keyword": f"keyword{keywords // 2}",
+              "keywords": [f"keyword{n}" for n in range(1, min(keywords, 5) + 1)]}
+    timings = {}
+    for name, query in QUERIES.items():
+        execution_ms(cursor, query, params)
+        timings[name] = statistics.median(execution_ms(cursor, query, params)
+                                          for _ in range(repeats))
+    return timings
+
+
+def time_retention(conn, cursor: curs, layout: str) -> float:
+    """Returns how long removing the recordings older than 24 hours takes in a layout,
+    in milliseconds. The removal is rolled back."""
+    cursor.execute(f"SET search_path TO {schema_for(layout)}")
+    started = time.perf_counter()
+    for query in RETENTION_QUERIES[layout]:
+        cursor.execute(query)
+    elapsed = (time.perf_counter() - started) * 1000
+    conn.rollback()
+    return elapsed
+
+
+def main(rows: int, keywords: int, repeats: int, keep: bool = False) -> dict:
+    """Builds both layouts with the same rows and compares their query times"""
+    load_dotenv()
+    hours = max(rows // keywords, 1)
+    results = {}
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for layout in LAYOUTS:
+                started = time.perf_counter()
+                build_layout(cursor, layout, keywords, hours)
+                conn.commit()
+                logging.info("Built the %s layout with %s rows in %.1fs.", layout,
+                             keywords * hours, time.perf_counter() - started)
+
+            for layout in LAYOUTS:
+                results[layout] = time_queries(cursor, layout, keywords, repeats)
+                conn.rollback()
+                results[layout]["retention"] = time_retention(conn, cursor, layout)
+
+            for name in results["plain"]:
+                plain, partitioned = results["plain"][name], results["partitioned"][name]
+                logging.info("%-28s plain %10.2fms  partitioned %10.2fms  %6.1fx", name,
+                             plain, partitioned, plain / partitioned if partitioned else 0)
+        finally:
+            conn.rollback()
+            if not keep:
+                for layout in LAYOUTS:
+                    cursor.execute(f"DROP SCHEMA IF EXISTS {schema_for(layout)} CASCADE")
+                conn.commit()
+            cursor.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare keyword_recordings queries on a plain and a partitioned table.")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS,
+                        help="Recordings to generate in each layout.")
+    parser.add_argument("--keywords", type=int, default=DEFAULT_KEYWORDS,
+                        help="Keywords to spread the recordings over.")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="Times to run each query; the median is reported.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the scratch schemas afterwards.")
+    args = parser.parse_args()
+    main(args.rows, args.keywords, args.repeats, args.keep)
@@ -0,0 +1,251 @@
+"""Postgres backed work queue that lets any number of workers split the hourly
+refresh of subscribed keywords"""
+
+import argparse
+import logging
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from os import environ as ENV
+from typing import Callable
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+from etl import main as etl_main
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+DEFAULT_CLAIM_SIZE = 10
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+# The due keywords are queued by a function in schema.sql, which the notifications
+# pipeline calls too
+ENQUEUE_QUERY = "SELECT enqueue_keyword_refresh_tasks(%(run_hour)s) AS added"
+
+EXPIRE_QUERY = """
+    UPDATE keyword_refresh_tasks
+    SET status = 'failed', worker_id = NULL, lease_expires_at = NULL,
+        finished_at = NOW(), error = 'Lease expired on the final attempt'
+    WHERE status = 'running' AND lease_expires_at < NOW() AND attempts >= %s"""
+
+CLAIM_QUERY = """
+    UPDATE keyword_refresh_tasks AS t
+    SET status = 'running', worker_id = %(worker_id)s, attempts = t.attempts + 1,
+        started_at = NOW(), heartbeat_at = NOW(),
+        lease_expires_at = NOW() + make_interval(secs => %(lease_seconds)s)
+    FROM keywords AS k
+    WHERE k.keywords_id = t.keywords_id
+    AND t.refresh_task_id IN (
+        SELECT refresh_task_id
+        FROM keyword_refresh_tasks
+        WHERE (status = 'pending'
+               OR (status = 'running' AND lease_expires_at < NOW()))
+        AND attempts < %(max_attempts)s
+        ORDER BY run_hour, refresh_task_id
+        LIMIT %(claim_size)s
+        FOR UPDATE SKIP LOCKED)
+    RETURNING t.refresh_task_id, k.keyword"""
+
+HEARTBEAT_QUERY = """
+    UPDATE keyword_refresh_tasks
+    SET heartbeat_at = NOW(),
+        lease_expires_at = NOW() + make_interval(secs => %s)
+    WHERE refresh_task_id = ANY(%s) AND worker_id = %s AND status = 'running'"""
+
+COMPLETE_QUERY = """
+    WITH done AS (
+        UPDATE keyword_refresh_tasks
+        SET status = 'done', finished_at = NOW(), lease_expires_at = NULL, error = NULL
+        WHERE refresh_task_id = ANY(%s) AND worker_id = %s AND status = 'running'
+        RETURNING keywords_id, run_hour
+    ), scheduled AS (
+        UPDATE keyword_refresh_schedule AS rs
+        SET last_refreshed_at = done.run_hour,
+            next_refresh_at = done.run_hour + make_interval(hours => rs.refresh_interval_hours)
+        FROM done
+        WHERE rs.keywords_id = done.keywords_id
+        AND (rs.last_refreshed_at IS NULL OR rs.last_refreshed_at < done.run_hour)
+    )
+    SELECT COUNT(*) AS completed FROM done"""
+
+FAIL_QUERY = """
+    UPDATE keyword_refresh_tasks
+    SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+        finished_at = CASE WHEN attempts >= %s THEN NOW() END,
+        worker_id = NULL, lease_expires_at = NULL, error = %s
+    WHERE refresh_task_id = ANY(%s) AND worker_id = %s AND status = 'running'"""
+
+PROGRESS_QUERY = """
+    SELECT run_hour, tasks, pending, running, done, failed,
+           first_started_at, last_finished_at
+    FROM keyword_refresh_progress
+    ORDER BY run_hour DESC
+    LIMIT %s"""
+
+
+def get_lease_seconds() -> int:
+    """Returns how long a claimed task is leased to a worker before others may take it"""
+    return int(ENV.get("REFRESH_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+
+
+def get_max_attempts() -> int:
+    """Returns how many times a task is tried before it is marked as failed"""
+    return int(ENV.get("REFRESH_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+
+
+def enqueue_tasks(cursor: curs, run_hour: datetime = None) -> int:
+    """Adds a refresh task for every subscribed keyword due a refresh in the run hour,
+    which defaults to the current hour, unless one is already waiting or running. The
+    schedule only moves on when a task completes, so failed refreshes are queued again.
+    Returns the number of tasks added."""
+    if run_hour is None:
+        cursor.execute("SELECT date_trunc('hour', NOW())::timestamp AS run_hour")
+        run_hour = cursor.fetchone()["run_hour"]
+    cursor.execute(ENQUEUE_QUERY, {"run_hour": run_hour})
+    return cursor.fetchone()["added"]
+
+
+def claim_tasks(cursor: curs, worker_id: str, claim_size: int,
+                lease_seconds: int, max_attempts: int) -> list[dict]:
+    """Leases up to claim_size pending or expired tasks to a worker, skipping tasks
+    other workers are claiming at the same time"""
+    cursor.execute(EXPIRE_QUERY, (max_attempts,))
+    cursor.execute(CLAIM_QUERY, {"worker_id": worker_id, "lease_seconds": lease_seconds,
+                                 "max_attempts": max_attempts, "claim_size": claim_size})
+    return cursor.fetchall()
+
+
+def extend_leases(cursor: curs, task_ids: list[int], worker_id: str,
+                  lease_seconds: int) -> int:
+    """Records a heartbeat for tasks still held by a worker. Returns how many it holds."""
+    cursor.execute(HEARTBEAT_QUERY, (lease_seconds, task_ids, worker_id))
+    return cursor.rowcount
+
+
+def complete_tasks(cursor: curs, task_ids: list[int], worker_id: str) -> int:
+    """Marks tasks still held by a worker as done and moves the next refresh of their
+    keywords on by their refresh interval. Returns how many it completed."""
+    cursor.execute(COMPLETE_QUERY, (task_ids, worker_id))
+    return cursor.fetchone()["completed"]
+
+
+def fail_tasks(cursor: curs, task_ids: list[int], worker_id: str,
+               error: str, max_attempts: int) -> int:
+    """Returns tasks to the queue, or marks them failed once out of attempts"""
+    cursor.execute(FAIL_QUERY, (max_attempts, max_attempts, error, task_ids, worker_id))
+    return cursor.rowcount
+
+
+def get_progress(cursor: curs, limit: int = 24) -> list[dict]:
+    """Returns task counts by status for the most recent run hours"""
+    cursor.execute(PROGRESS_QUERY, (limit,))
+    return cursor.fetchall()
+
+
+def run_in_transaction(func: Callable, *args):
+    """Runs func(cursor, *args) on a pooled connection and commits the result"""
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            result = func(cursor, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+@contextmanager
+def heartbeat(task_ids: list[int], worker_id: str, lease_seconds: int):
+    """Keeps extending the lease on tasks from a background thread while they are worked on"""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(lease_seconds / 3):
+            try:
+                held = run_in_transaction(extend_leases, task_ids, worker_id, lease_seconds)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logging.warning("Heartbeat for tasks %s failed: %s", task_ids, e)
+                continue
+            if held < len(task_ids):
+                logging.warning("Worker %s lost the lease on %s of its tasks.",
+                                worker_id, len(task_ids) - held)
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{worker_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(refresh: Callable, worker_id: str = None, claim_size: int = None) -> dict:
+    """Claims and refreshes batches of keywords until the queue is empty.
+    Returns the number of tasks this worker completed and failed."""
+    worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+    claim_size = claim_size or int(ENV.get("REFRESH_CLAIM_SIZE", DEFAULT_CLAIM_SIZE))
+    lease_seconds = get_lease_seconds()
+    max_attempts = get_max_attempts()
+    counts = {"done": 0, "failed": 0}
+
+    while True:
+        tasks = run_in_transaction(claim_tasks, worker_id, claim_size,
+                                   lease_seconds, max_attempts)
+        if not tasks:
+            break
+        task_ids = [task["refresh_task_id"] for task in tasks]
+        keywords = [task["keyword"] for task in tasks]
+        logging.info("Worker %s claimed %s.", worker_id, keywords)
+
+        try:
+            with heartbeat(task_ids, worker_id, lease_seconds):
+                refresh(keywords)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Refresh of %s failed: %s", keywords, e)
+            run_in_transaction(fail_tasks, task_ids, worker_id, str(e), max_attempts)
+            counts["failed"] += len(task_ids)
+            continue
+
+        completed = run_in_transaction(complete_tasks, task_ids, worker_id)
+        if completed < len(task_ids):
+            logging.warning("Worker %s finished %s tasks after their lease expired.",
+                            worker_id, len(task_ids) - completed)
+        counts["done"] += completed
+
+    logging.info("Worker %s finished: %s done, %s failed.",
+                 worker_id, counts["done"], counts["failed"])
+    return counts
+
+
+def main(command: str) -> None:
+    """Enqueues this hour's refresh, works through the queue or reports progress"""
+    load_dotenv()
+    if command == "enqueue":
+        added = run_in_transaction(enqueue_tasks)
+        logging.info("Queued %s keyword refresh tasks.", added)
+    elif command == "work":
+        run_worker(etl_main)
+    else:
+        for row in run_in_transaction(get_progress):
+            logging.info("%s: %s tasks, %s pending, %s running, %s done, %s failed.",
+                         row["run_hour"], row["tasks"], row["pending"], row["running"],
+                         row["done"], row["failed"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split the hourly keyword refresh across any number of workers.")
+    parser.add_argument("command", choices=["enqueue", "work", "progress"],
+                        help="Queue this hour's tasks, work through the queue or show progress.")
+    args = parser.parse_args()
+    main(args.command)
@@ -0,0 +1,148 @@
+"""Records every ETL run in the pipeline_runs table and reports runs whose cost per
+row drifts from the recent baseline"""
+
+import argparse
+import json
+import logging
+import statistics
+from datetime import datetime
+from os import environ as ENV
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+from jobs import normalize_topic
+from metrics import run_counter
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+DEFAULT_BASELINE_RUNS = 20
+DEFAULT_THRESHOLD = 1.5
+
+RECORD_QUERY = """
+    INSERT INTO pipeline_runs (started_at, finished_at, status, error, keyword_count, topics,
+                               hours_processed, rows_loaded, bytes_read, duration_seconds,
+                               stage_seconds, code_version)
+    VALUES (%(started_at)s, %(finished_at)s, %(status)s, %(error)s, %(keyword_count)s,
+            %(topics)s, %(hours_processed)s, %(rows_loaded)s, %(bytes_read)s, %(duration_seconds)s,
+            %(stage_seconds)s, %(code_version)s)"""
+
+RECENT_RUNS_QUERY = """
+    SELECT pipeline_run_id, started_at, keyword_count, hours_processed, rows_loaded,
+           duration_seconds, code_version
+    FROM (
+        SELECT *
+        FROM pipeline_runs
+        WHERE status = 'succeeded' AND rows_loaded > 0
+        ORDER BY started_at DESC
+        LIMIT %s
+    ) AS recent
+    ORDER BY started_at"""
+
+# The topics whose data a successful run, from any process, refreshed since a time
+REFRESHED_SINCE_QUERY = """
+    SELECT DISTINCT topic
+    FROM pipeline_runs, unnest(topics) AS topic
+    WHERE status = 'succeeded' AND finished_at >= %s AND topics && %s::TEXT[]
+    AND topic = ANY(%s)"""
+
+
+def run_row(topics: list[str], run: dict, started_at: datetime, finished_at: datetime,
+            status: str, error: str = None) -> dict:
+    """Builds the pipeline_runs row for a run tracked by metrics.track_run"""
+    return {
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "status": status,
+        "error": error,
+        "keyword_count": len(topics),
+        "topics": [normalize_topic(topic) for topic in topics],
+        "hours_processed": run.get("hours_processed", 0),
+        "rows_loaded": int(run_counter(run, "etl_rows_loaded_total",
+                                       table="keyword_recordings")),
+        "bytes_read": int(run_counter(run, "etl_s3_bytes_total")),
+        "duration_seconds": (finished_at - started_at).total_seconds(),
+        "stage_seconds": json.dumps({stage: round(seconds, 4) for stage, seconds
+                                     in sorted(run["stage_seconds"].items())}),
+        "code_version": ENV.get("CODE_VERSION", "unknown")
+    }
+
+
+def record_run(row: dict) -> None:
+    """Writes a run to pipeline_runs. A failure to record is logged rather than raised
+    so it never fails the run itself."""
+    try:
+        with borrow_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(RECORD_QUERY, row)
+            conn.commit()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.warning("Could not record pipeline run: %s", e)
+
+
+def refreshed_since(topics: list[str], since: datetime) -> set[str]:
+    """Returns the topics a successful run refreshed since a time, whichever process ran it"""
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(REFRESHED_SINCE_QUERY, (since, topics, topics))
+            return {row['topic'] for row in cursor.fetchall()}
+
+
+def get_recent_runs(cursor: curs, limit: int) -> list[dict]:
+    """Returns the most recent successful runs that loaded rows, oldest first"""
+    cursor.execute(RECENT_RUNS_QUERY, (limit,))
+    return cursor.fetchall()
+
+
+def flag_deviations(runs: list[dict], baseline_runs: int, threshold: float) -> list[dict]:
+    """Compares each run's seconds per row loaded with the median of the runs before it
+    and returns the runs that are more than threshold times slower or faster"""
+    flagged = []
+    costs = [run["duration_seconds"] / run["rows_loaded"] for run in runs]
+    for i, run in enumerate(runs):
+        trailing = costs[max(0, i - baseline_runs):i]
+        if len(trailing) < min(baseline_runs, 5):
+            continue
+        baseline = statistics.median(trailing)
+        ratio = costs[i] / baseline if baseline else 0
+        if ratio >= threshold or (ratio and ratio <= 1 / threshold):
+            flagged.append({**run, "cost_per_row": costs[i], "baseline_cost_per_row": baseline,
+                            "ratio": ratio})
+    return flagged
+
+
+def main(runs: int, baseline_runs: int, threshold: float) -> list[dict]:
+    """Reports recent runs whose cost per row deviates from the trailing baseline"""
+    load_dotenv()
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            recent = get_recent_runs(cursor, runs + baseline_runs)
+
+    checked = {run["pipeline_run_id"] for run in recent[-runs:]}
+    flagged = [run for run in flag_deviations(recent, baseline_runs, threshold)
+               if run["pipeline_run_id"] in checked]
+    for run in flagged:
+        logging.warning("Run %s at %s (%s) took %.4fs per row, %.1fx the baseline of %.4fs "
+                        "(%s keywords, %s hours, %s rows).",
+                        run["pipeline_run_id"], run["started_at"], run["code_version"],
+                        run["cost_per_row"], run["ratio"], run["baseline_cost_per_row"],
+                        run["keyword_count"], run["hours_processed"], run["rows_loaded"])
+    logging.info("Checked %s runs, %s deviated from the baseline.",
+                 len(checked), len(flagged))
+    return flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Flag ETL runs whose cost per row deviates from the trailing baseline.")
+    parser.add_argument("--runs", type=int, default=50,
+                        help="Number of recent runs to check.")
+    parser.add_argument("--baseline-runs", type=int, default=DEFAULT_BASELINE_RUNS,
+                        help="Number of earlier runs whose median cost per row is the baseline.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Flag runs this many times slower or faster than the baseline.")
+    args = parser.parse_args()
+    main(args.runs, args.baseline_runs, args.threshold)
@@ -0,0 +1,137 @@
+"""Sets how often each subscribed keyword is refreshed from its recent activity,
+so quiet keywords are not collected every hour"""
+
+import logging
+import math
+from os import environ as ENV
+from psycopg2.extensions import cursor as curs
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from db import borrow_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+DEFAULT_MIN_HOURS = 1
+DEFAULT_MAX_HOURS = 24
+DEFAULT_LOOKBACK_HOURS = 168
+DEFAULT_HOT_MENTIONS_PER_HOUR = 10
+
+ACTIVITY_QUERY = """
+    SELECT s.keywords_id,
+           BOOL_OR(s.subscription_status) AS notifications_enabled,
+           COALESCE(MAX(r.mentions_per_hour), 0) AS mentions_per_hour,
+           COALESCE(MAX(r.volatility), 0) AS volatility
+    FROM subscription AS s
+    LEFT JOIN (
+        SELECT keywords_id,
+               SUM(total_mentions)::FLOAT / NULLIF(SUM(hours_recorded), 0) AS mentions_per_hour,
+               STDDEV_POP(total_mentions)::FLOAT AS volatility
+        FROM keyword_rollups_1h
+        WHERE period_start >= NOW() - make_interval(hours => %(lookback_hours)s)
+        GROUP BY keywords_id
+    ) AS r ON r.keywords_id = s.keywords_id
+    GROUP BY s.keywords_id"""
+
+SCHEDULE_QUERY = """
+    INSERT INTO keyword_refresh_schedule AS rs
+        (keywords_id, refresh_interval_hours, mentions_per_hour, volatility,
+         notifications_enabled, next_refresh_at)
+    VALUES %s
+    ON CONFLICT (keywords_id) DO UPDATE
+    SET refresh_interval_hours = EXCLUDED.refresh_interval_hours,
+        mentions_per_hour = EXCLUDED.mentions_per_hour,
+        volatility = EXCLUDED.volatility,
+        notifications_enabled = EXCLUDED.notifications_enabled,
+        next_refresh_at = COALESCE(
+            rs.last_refreshed_at + make_interval(hours => EXCLUDED.refresh_interval_hours),
+            EXCLUDED.next_refresh_at),
+        updated_at = NOW()"""
+
+SCHEDULE_TEMPLATE = "(%s, %s, %s, %s, %s, date_trunc('hour', NOW()))"
+
+
+def get_bounds() -> tuple[int, int]:
+    """Returns the shortest and longest refresh intervals in hours"""
+    min_hours = int(ENV.get("REFRESH_MIN_HOURS", DEFAULT_MIN_HOURS))
+    max_hours = int(ENV.get("REFRESH_MAX_HOURS", DEFAULT_MAX_HOURS))
+    return min_hours, max(min_hours, max_hours)
+
+
+def refresh_interval(mentions_per_hour: float, volatility: float, notifications_enabled: bool,
+                     min_hours: int, max_hours: int, hot_mentions_per_hour: float) -> int:
+    """Returns the hours between refreshes of a keyword. Keywords at least as busy or
+    volatile as hot_mentions_per_hour refresh as often as allowed, quieter keywords
+    proportionally less often and keywords watched for notifications twice as often."""
+    activity = mentions_per_hour + volatility
+    if activity <= 0:
+        hours = max_hours
+    else:
+        hours = math.ceil(hot_mentions_per_hour / activity)
+    hours = min(max(hours, min_hours), max_hours)
+    if notifications_enabled:
+        hours = max(math.ceil(hours / 2), min_hours)
+    return hours
+
+
+def get_keyword_activity(cursor: curs, lookback_hours: int) -> list[dict]:
+    """Returns the recent mention volume and volatility of every subscribed keyword"""
+    cursor.execute(ACTIVITY_QUERY, {"lookback_hours": lookback_hours})
+    return cursor.fetchall()
+
+
+def save_schedule(cursor: curs, schedule: list[tuple]) -> None:
+    """Stores each keyword's refresh interval, moving its next refresh to match"""
+    if schedule:
+        execute_values(cursor, SCHEDULE_QUERY, schedule, template=SCHEDULE_TEMPLATE)
+
+
+def compute_savings(intervals: list[int], min_hours: int) -> dict:
+    """Compares the refreshes a day under the schedule with refreshing every keyword
+    at the shortest interval"""
+    baseline = len(intervals) * 24 / min_hours
+    scheduled = sum(24 / hours for hours in intervals)
+    return {
+        "keywords": len(intervals),
+        "baseline_refreshes_per_day": round(baseline, 1),
+        "scheduled_refreshes_per_day": round(scheduled, 1),
+        "saved_percent": round(100 * (1 - scheduled / baseline), 1) if baseline else 0.0
+    }
+
+
+def main() -> dict:
+    """Recalculates every subscribed keyword's refresh interval and reports the savings"""
+    load_dotenv()
+    min_hours, max_hours = get_bounds()
+    lookback_hours = int(ENV.get("SCHEDULE_LOOKBACK_HOURS", DEFAULT_LOOKBACK_HOURS))
+    hot = float(ENV.get("HOT_MENTIONS_PER_HOUR", DEFAULT_HOT_MENTIONS_PER_HOUR))
+
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            schedule = []
+            for row in get_keyword_activity(cursor, lookback_hours):
+                hours = refresh_interval(row["mentions_per_hour"], row["volatility"],
+                                         row["notifications_enabled"], min_hours, max_hours, hot)
+                schedule.append((row["keywords_id"], hours, row["mentions_per_hour"],
+                                 row["volatility"], row["notifications_enabled"]))
+            save_schedule(cursor, schedule)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    savings = compute_savings([row[1] for row in schedule], min_hours)
+    logging.info("Scheduled %s keywords: %s refreshes a day instead of %s (%s%% saved).",
+                 savings["keywords"], savings["scheduled_refreshes_per_day"],
+                 savings["baseline_refreshes_per_day"], savings["saved_percent"])
+    return savings
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 CREATE SCHEMA IF NOT EXISTS :schema_name;
 SET search_path TO :schema_name;
 
+DROP VIEW IF EXISTS keyword_refresh_progress;
+DROP TABLE IF EXISTS pipeline_runs;
+DROP TABLE IF EXISTS keyword_refresh_tasks;
+DROP TABLE IF EXISTS keyword_refresh_schedule;
 DROP TABLE IF EXISTS subscription;
 DROP TABLE IF EXISTS related_term_assignment;
 DROP TABLE IF EXISTS related_terms;
+DROP TABLE IF EXISTS keyword_rollups_1d;
+DROP TABLE IF EXISTS keyword_rollups_6h;
+DROP TABLE IF EXISTS keyword_rollups_1h;
 DROP TABLE IF EXISTS keyword_recordings;
 DROP TABLE IF EXISTS keywords;
 DROP TABLE IF EXISTS "user";
@@ -22,17 +29,108 @@ CREATE TABLE IF NOT EXISTS "user" (
 CREATE TABLE IF NOT EXISTS keywords (
     keywords_id BIGINT GENERATED ALWAYS AS IDENTITY,
     keyword VARCHAR(50) NOT NULL,
-    PRIMARY KEY (keywords_id)
+    PRIMARY KEY (keywords_id),
+    CONSTRAINT keywords_keyword_key UNIQUE (keyword)
 ); 
 
 
 CREATE TABLE IF NOT EXISTS keyword_recordings (
     keyword_recordings_id BIGINT GENERATED ALWAYS AS IDENTITY,
     keywords_id BIGINT,
-    total_mentions SMALLINT,
-    avg_sentiment FLOAT,
-    date_and_hour TIMESTAMP,
-    PRIMARY KEY (keyword_recordings_id),
+    total_mentions BIGINT,
+    sentiment_sum FLOAT,
+    sentiment_sum_squares FLOAT,
+    date_and_hour TIMESTAMP NOT NULL,
+    avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED,
+    PRIMARY KEY (keyword_recordings_id, date_and_hour),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id),
+    CONSTRAINT keyword_recordings_keyword_hour_key UNIQUE (keywords_id, date_and_hour)
+) PARTITION BY RANGE (date_and_hour);
+
+CREATE INDEX IF NOT EXISTS keyword_recordings_date_and_hour_idx
+    ON keyword_recordings USING BRIN (date_and_hour);
+
+CREATE OR REPLACE FUNCTION create_keyword_recordings_partitions(first_hour TIMESTAMP,
+                                                                last_hour TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    day DATE := first_hour::DATE;
+    created INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('keyword_recordings_partitions'));
+    WHILE day <= last_hour::DATE LOOP
+        IF to_regclass('keyword_recordings_p' || TO_CHAR(day, 'YYYYMMDD')) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF keyword_recordings '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'keyword_recordings_p' || TO_CHAR(day, 'YYYYMMDD'), day, day + 1);
+            created := created + 1;
+        END IF;
+        day := day + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION drop_keyword_recordings_partitions(cutoff TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    partition_name TEXT;
+    dropped INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('keyword_recordings_partitions'));
+    FOR partition_name IN
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'keyword_recordings'::REGCLASS
+        AND child.relname ~ '^keyword_recordings_p[0-9]{8}$'
+        AND TO_DATE(RIGHT(child.relname, 8), 'YYYYMMDD') + 1 <= cutoff
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TABLE IF NOT EXISTS keyword_rollups_1h (
+    keywords_id BIGINT NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    hours_recorded INT NOT NULL,
+    total_mentions BIGINT NOT NULL,
+    sentiment_sum FLOAT NOT NULL,
+    sentiment_sum_squares FLOAT,
+    avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED,
+    PRIMARY KEY (keywords_id, period_start),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id)
+);
+
+CREATE TABLE IF NOT EXISTS keyword_rollups_6h (
+    keywords_id BIGINT NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    hours_recorded INT NOT NULL,
+    total_mentions BIGINT NOT NULL,
+    sentiment_sum FLOAT NOT NULL,
+    sentiment_sum_squares FLOAT,
+    avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED,
+    PRIMARY KEY (keywords_id, period_start),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id)
+);
+
+CREATE TABLE IF NOT EXISTS keyword_rollups_1d (
+    keywords_id BIGINT NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    hours_recorded INT NOT NULL,
+    total_mentions BIGINT NOT NULL,
+    sentiment_sum FLOAT NOT NULL,
+    sentiment_sum_squares FLOAT,
+    avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED,
+    PRIMARY KEY (keywords_id, period_start),
     FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id)
 );
 
@@ -41,7 +139,8 @@ CREATE TABLE IF NOT EXISTS related_terms (
     related_term_id BIGINT GENERATED ALWAYS AS IDENTITY,
     related_term VARCHAR(255) NOT NULL,
     PRIMARY KEY (related_term_id),
-    FOREIGN KEY (related_term_id) REFERENCES related_terms(related_term_id)
+    FOREIGN KEY (related_term_id) REFERENCES related_terms(related_term_id),
+    CONSTRAINT related_terms_related_term_key UNIQUE (related_term)
 );
 
 
@@ -51,7 +150,8 @@ CREATE TABLE IF NOT EXISTS related_term_assignment (
     related_term_id BIGINT,
     PRIMARY KEY (related_term_assignment),
     FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id),
-    FOREIGN KEY (related_term_id) REFERENCES related_terms(related_term_id)
+    FOREIGN KEY (related_term_id) REFERENCES related_terms(related_term_id),
+    CONSTRAINT related_term_assignment_keyword_term_key UNIQUE (keywords_id, related_term_id)
 );
 
 
@@ -64,4 +164,101 @@ CREATE TABLE IF NOT EXISTS subscription (
     PRIMARY KEY (subscription_id),
     FOREIGN KEY (user_id) REFERENCES "user"(user_id),
     FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id)
-);
\ No newline at end of file
+);
+
+
+CREATE TABLE IF NOT EXISTS keyword_refresh_tasks (
+    refresh_task_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    run_hour TIMESTAMP NOT NULL,
+    keywords_id BIGINT NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    worker_id VARCHAR(100),
+    lease_expires_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    error TEXT,
+    PRIMARY KEY (refresh_task_id),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id),
+    CONSTRAINT keyword_refresh_tasks_run_keyword_key UNIQUE (run_hour, keywords_id),
+    CONSTRAINT keyword_refresh_tasks_status_check
+        CHECK (status IN ('pending', 'running', 'done', 'failed'))
+);
+
+CREATE INDEX IF NOT EXISTS keyword_refresh_tasks_status_idx
+    ON keyword_refresh_tasks (status, refresh_task_id);
+
+
+CREATE TABLE IF NOT EXISTS keyword_refresh_schedule (
+    keywords_id BIGINT NOT NULL,
+    refresh_interval_hours SMALLINT NOT NULL,
+    mentions_per_hour FLOAT NOT NULL,
+    volatility FLOAT NOT NULL,
+    notifications_enabled BOOLEAN NOT NULL,
+    last_refreshed_at TIMESTAMP,
+    next_refresh_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (keywords_id),
+    FOREIGN KEY (keywords_id) REFERENCES keywords(keywords_id)
+);
+
+-- Shared by refresh_worker.py enqueue and the notifications pipeline's queue mode
+CREATE OR REPLACE FUNCTION enqueue_keyword_refresh_tasks(run_hour TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    added INT;
+BEGIN
+    WITH due AS (
+        SELECT DISTINCT s.keywords_id
+        FROM subscription AS s
+        LEFT JOIN keyword_refresh_schedule AS rs ON rs.keywords_id = s.keywords_id
+        WHERE (rs.next_refresh_at IS NULL OR rs.next_refresh_at <= enqueue_keyword_refresh_tasks.run_hour)
+        AND NOT EXISTS (
+            SELECT 1 FROM keyword_refresh_tasks AS t
+            WHERE t.keywords_id = s.keywords_id AND t.status IN ('pending', 'running'))
+    )
+    INSERT INTO keyword_refresh_tasks (run_hour, keywords_id)
+    SELECT enqueue_keyword_refresh_tasks.run_hour, keywords_id
+    FROM due
+    ON CONFLICT ON CONSTRAINT keyword_refresh_tasks_run_keyword_key DO NOTHING;
+    GET DIAGNOSTICS added = ROW_COUNT;
+    RETURN added;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE VIEW keyword_refresh_progress AS
+    SELECT run_hour,
+           COUNT(*) AS tasks,
+           COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+           COUNT(*) FILTER (WHERE status = 'running') AS running,
+           COUNT(*) FILTER (WHERE status = 'done') AS done,
+           COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+           MIN(started_at) AS first_started_at,
+           MAX(finished_at) AS last_finished_at
+    FROM keyword_refresh_tasks
+    GROUP BY run_hour;
+
+
+CREATE TABLE IF NOT EXISTS pipeline_runs (
+    pipeline_run_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    error TEXT,
+    keyword_count INT NOT NULL,
+    topics TEXT[] NOT NULL DEFAULT '{}',
+    hours_processed INT NOT NULL,
+    rows_loaded BIGINT NOT NULL,
+    bytes_read BIGINT NOT NULL,
+    duration_seconds FLOAT NOT NULL,
+    stage_seconds JSONB NOT NULL,
+    code_version VARCHAR(64) NOT NULL,
+    PRIMARY KEY (pipeline_run_id)
+);
+
+CREATE INDEX IF NOT EXISTS pipeline_runs_topics_idx
+    ON pipeline_runs USING GIN (topics);
+
+CREATE INDEX IF NOT EXISTS pipeline_runs_started_at_idx ON pipeline_runs (started_at);
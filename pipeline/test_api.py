@@ -1,10 +1,13 @@
 """Test file for api.py"""
 # pylint: skip-file
 
+import threading
 import pytest
 from unittest.mock import patch
 
+import api
 from api import app
+from jobs import JobQueue
 
 
 @pytest.fixture
@@ -13,18 +16,32 @@ def test_api():
     return app.test_client()
 
 
-def test_successful_post_request(test_api):
-    """Test successful post request yields expected results."""
+@pytest.fixture(autouse=True)
+def job_queue():
+    """Fresh job queue for each test."""
+    queue = JobQueue(workers=1)
+    with patch.object(api, 'queue', queue):
+        yield queue
+    queue.shutdown()
+
+
+def test_successful_post_request(test_api, job_queue):
+    """Test successful post request queues the topic and returns straight away."""
     with patch('api.main') as mock_main:
         fake_data = {
             "topic_name": "test"
         }
 
         response = test_api.post('/topics', json=fake_data)
-        mock_main.assert_called_once_with(['test'])
-        assert response.status_code == 200
-        assert response.json['message'] == 'Topic added successfully'
+        assert response.status_code == 202
+        assert response.json['message'] == 'Topic queued successfully'
         assert response.json['topic'] == 'test'
+        job_id = response.json['job_id']
+        assert response.headers['Location'] == f'/jobs/{job_id}'
+        assert response.json['status_url'] == f'/jobs/{job_id}'
+
+        job_queue.wait(job_id, timeout=5)
+        mock_main.assert_called_once_with(['test'])
 
 
 def test_unsuccessful_post_missing_topic(test_api):
@@ -35,7 +52,7 @@ def test_unsuccessful_post_missing_topic(test_api):
     assert response.json['message'] == 'Topic name is required'
 
 
-def test_more_than_one_word_topic(test_api):
+def test_more_than_one_word_topic(test_api, job_queue):
     """Test scenario when user-submitted topic contains more than one word."""
 
     with patch('api.main') as mock_main:
@@ -43,7 +60,180 @@ def test_more_than_one_word_topic(test_api):
             "topic_name": "testing this"
         }
         response = test_api.post('/topics', json=fake_data)
+        assert response.status_code == 202
+        assert response.json['topic'] == 'testing this'
+        job_queue.wait(response.json['job_id'], timeout=5)
         mock_main.assert_called_once_with(['testing this'])
-        assert response.status_code == 200
-        assert response.json['message'] == 'Topic added successfully'
+
+
+def test_topic_is_normalized(test_api, job_queue):
+    """Test the submitted topic is trimmed and lower cased before it is collected."""
+    with patch('api.main') as mock_main:
+        response = test_api.post('/topics', json={"topic_name": "  Testing   This "})
         assert response.json['topic'] == 'testing this'
+        job_queue.wait(response.json['job_id'], timeout=5)
+        mock_main.assert_called_once_with(['testing this'])
+
+
+def test_blank_topic(test_api):
+    """Test a topic made only of whitespace is rejected."""
+    response = test_api.post('/topics', json={"topic_name": "   "})
+    assert response.status_code == 400
+
+
+def test_duplicate_post_shares_job(test_api, job_queue):
+    """Test posting a topic that is already being collected returns the running job."""
+    release = threading.Event()
+    with patch('api.main', side_effect=lambda topics: release.wait(5)) as mock_main:
+        first = test_api.post('/topics', json={"topic_name": "test"})
+        second = test_api.post('/topics', json={"topic_name": "Test"})
+        release.set()
+        job_queue.wait(first.json['job_id'], timeout=5)
+
+    assert second.status_code == 202
+    assert second.json['message'] == 'Topic is already being collected'
+    assert second.json['job_id'] == first.json['job_id']
+    assert second.headers['Location'] == first.headers['Location']
+    mock_main.assert_called_once()
+
+
+def test_post_attaches_to_batch_in_flight(test_api, job_queue):
+    """Test posting a topic that a batch is collecting reports the requested topic."""
+    release = threading.Event()
+    with patch('api.main', side_effect=lambda topics: release.wait(5)) as mock_main:
+        batch = test_api.post('/topics/batch', json={"topic_names": ["python", "rust"]})
+        response = test_api.post('/topics', json={"topic_name": " Rust "})
+        release.set()
+        job_queue.wait(batch.json['job_id'], timeout=5)
+
+    assert response.status_code == 202
+    assert response.json['topic'] == 'rust'
+    assert response.json['job_id'] == batch.json['job_id']
+    mock_main.assert_called_once()
+
+
+def test_fresh_topic_is_not_collected_again(test_api, job_queue):
+    """Test posting a topic refreshed within the freshness window returns its last job."""
+    with patch('api.main') as mock_main:
+        first = test_api.post('/topics', json={"topic_name": "test"})
+        job_queue.wait(first.json['job_id'], timeout=5)
+        second = test_api.post('/topics', json={"topic_name": "test"})
+
+    assert second.status_code == 200
+    assert second.json['message'] == 'Topic data is already up to date'
+    assert second.json['job_id'] == first.json['job_id']
+    mock_main.assert_called_once()
+
+
+def test_batch_post_runs_one_job(test_api, job_queue):
+    """Test a batch of topics is collected by a single ETL run."""
+    with patch('api.main') as mock_main:
+        response = test_api.post('/topics/batch',
+                                 json={"topic_names": ["Python", "java", "python"]})
+        assert response.status_code == 202
+        job_id = response.json['job_id']
+        assert response.headers['Location'] == f'/jobs/{job_id}'
+        assert [t['topic'] for t in response.json['topics']] == ['python', 'java']
+        assert all(t['job_id'] == job_id for t in response.json['topics'])
+
+        job_queue.wait(job_id, timeout=5)
+        mock_main.assert_called_once_with(['python', 'java'])
+
+
+def test_batch_post_attaches_topics_in_flight(test_api, job_queue):
+    """Test topics already being collected are left out of the batch job."""
+    release = threading.Event()
+    with patch('api.main', side_effect=lambda topics: release.wait(5)) as mock_main:
+        first = test_api.post('/topics', json={"topic_name": "python"}).json['job_id']
+        response = test_api.post('/topics/batch', json={"topic_names": ["python", "java"]})
+        release.set()
+        job_queue.wait(response.json['job_id'], timeout=5)
+
+    outcomes = {t['topic']: (t['job_id'], t['outcome']) for t in response.json['topics']}
+    assert outcomes['python'] == (first, 'attached')
+    assert outcomes['java'] == (response.json['job_id'], 'queued')
+    assert mock_main.call_args_list[1].args == (['java'],)
+
+
+def test_batch_post_all_topics_covered(test_api, job_queue):
+    """Test a batch whose topics are all fresh queues nothing."""
+    with patch('api.main') as mock_main:
+        job_queue.wait(test_api.post('/topics', json={"topic_name": "python"}).json['job_id'],
+                       timeout=5)
+        response = test_api.post('/topics/batch', json={"topic_names": ["python"]})
+
+    assert response.status_code == 200
+    assert response.json['job_id'] is None
+    assert response.json['topics'][0]['outcome'] == 'fresh'
+    mock_main.assert_called_once()
+
+
+def test_post_topic_refreshed_by_another_process(test_api, job_queue):
+    """Test a topic another process refreshed is not queued and has no job to link to."""
+    job_queue._refreshed_since = lambda topics, since: {'python'}
+    with patch('api.main') as mock_main:
+        response = test_api.post('/topics', json={"topic_name": " Python "})
+        batch = test_api.post('/topics/batch', json={"topic_names": ["python"]})
+
+    assert response.status_code == 200
+    assert response.json['topic'] == 'python'
+    assert response.json['job_id'] is None
+    assert 'Location' not in response.headers
+    assert batch.json['topics'][0]['status_url'] is None
+    mock_main.assert_not_called()
+
+
+@pytest.mark.parametrize('data', [{}, {"topic_names": []}, {"topic_names": "python"},
+                                  {"topic_names": ["python", " "]}])
+def test_batch_post_invalid(test_api, data):
+    """Test a batch without a list of topic names is rejected."""
+    response = test_api.post('/topics/batch', json=data)
+    assert response.status_code == 400
+    assert response.json['message'] == 'A list of topic names is required'
+
+
+def test_get_job_reports_status_and_timings(test_api, job_queue):
+    """Test a finished job reports its status and how long it queued and ran for."""
+    with patch('api.main'):
+        job_id = test_api.post('/topics', json={"topic_name": "test"}).json['job_id']
+        job_queue.wait(job_id, timeout=5)
+
+    response = test_api.get(f'/jobs/{job_id}')
+    assert response.status_code == 200
+    assert response.json['status'] == 'succeeded'
+    assert response.json['topics'] == ['test']
+    assert response.json['queued_seconds'] >= 0
+    assert response.json['run_seconds'] >= 0
+    assert response.json['finished_at'] is not None
+
+
+def test_get_job_failed(test_api, job_queue):
+    """Test a job whose ETL run raised is reported as failed with the error."""
+    with patch('api.main', side_effect=ValueError("No files found in the past 7 days.")):
+        job_id = test_api.post('/topics', json={"topic_name": "test"}).json['job_id']
+        job_queue.wait(job_id, timeout=5)
+
+    response = test_api.get(f'/jobs/{job_id}')
+    assert response.json['status'] == 'failed'
+    assert response.json['error'] == 'No files found in the past 7 days.'
+
+
+def test_get_unknown_job(test_api):
+    """Test asking for a job that does not exist returns 404."""
+    response = test_api.get('/jobs/unknown')
+    assert response.status_code == 404
+    assert response.json['message'] == 'Job not found'
+
+
+def test_metrics_endpoint(test_api, job_queue):
+    """Test stage timings of finished jobs are exposed in the Prometheus text format."""
+    with patch('etl.extract_main'), patch('etl.transform_main'), patch('etl.load_main'):
+        job_id = test_api.post('/topics', json={"topic_name": "metrics test"}).json['job_id']
+        job_queue.wait(job_id, timeout=5)
+
+    response = test_api.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE etl_stage_duration_seconds histogram' in response.text
+    assert 'etl_stage_duration_seconds_count{stage="load"}' in response.text
+
@@ -0,0 +1,72 @@
+"""Test script for async_etl python file."""
+# pylint: skip-file
+
+import asyncio
+import datetime
+import json
+import os
+from unittest.mock import patch
+import pytest
+from async_etl import critical_path, scan_s3, collect, DEPENDENCIES
+from local_s3 import LocalS3, AsyncLocalS3
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    """Local S3 with two hourly files today, and the environment pointing at it."""
+    s3 = LocalS3(str(tmp_path))
+    today = datetime.datetime.now().strftime("%Y-%m-%d")
+    for hour, text in (('00', 'python is great'), ('01', 'python is bad')):
+        s3.put_object(Bucket='bucket', Key=f'bluesky/{today}/{hour}.json',
+                      Body=json.dumps({text: {'Sentiment Score': {'compound': 0.5}}}))
+    with patch.dict(os.environ, {'S3_BUCKET_NAME': 'bucket'}), \
+            patch('async_etl.s3_client', return_value=AsyncLocalS3(str(tmp_path))):
+        yield today
+
+
+def test_critical_path_follows_last_dependency():
+    """Test the path runs through the dependency that finished last."""
+    spans = {'extract': (0, 3), 'suggestions': (0, 1), 'keyword_ids': (0, 0.5),
+             'transform': (3, 3.5), 'load': (3.5, 5)}
+
+    assert critical_path(spans, DEPENDENCIES) == [('extract', 3), ('transform', 0.5),
+                                                  ('load', 1.5)]
+
+
+def test_critical_path_when_suggestions_are_slowest():
+    """Test a slow suggestion lookup is on the critical path instead of S3."""
+    spans = {'extract': (0, 1), 'suggestions': (0, 4), 'keyword_ids': (0, 0.5),
+             'transform': (4, 4.5)}
+
+    assert [task for task, _ in critical_path(spans, DEPENDENCIES)] == [
+        'suggestions', 'transform']
+
+
+def test_scan_s3(bucket):
+    """Test every hourly file is read and scored."""
+    rows = asyncio.run(scan_s3(['python']))
+
+    assert sorted(row['Date and Hour'] for row in rows) == [f'{bucket} 00', f'{bucket} 01']
+    assert all(row['Total Mentions'] == 1 for row in rows)
+
+
+def test_scan_s3_no_files(tmp_path):
+    """Test a ValueError is raised when there are no files."""
+    with patch.dict(os.environ, {'S3_BUCKET_NAME': 'bucket'}), \
+            patch('async_etl.s3_client', return_value=AsyncLocalS3(str(tmp_path))):
+        with pytest.raises(ValueError):
+            asyncio.run(scan_s3(['python']))
+
+
+@patch('async_etl.load_main')
+@patch('async_etl.get_keyword_map', return_value={'python': 1})
+@patch('async_etl.related_terms', return_value={'python': 'python tutorial'})
+def test_collect(mock_terms, mock_keyword_map, mock_load, bucket):
+    """Test the scan, suggestions and keyword ids are combined and loaded once."""
+    hours, path = asyncio.run(collect(['python']))
+
+    assert hours == 2
+    assert [task for task, _ in path][-2:] == ['transform', 'load']
+    loaded = mock_load.call_args.args[1]
+    assert list(loaded['keyword_id']) == [1, 1]
+    assert list(loaded['Related Terms']) == ['python tutorial'] * 2
@@ -0,0 +1,83 @@
+"""Test script for backfill_rollups python file."""
+# pylint: skip-file
+
+import datetime
+from unittest.mock import MagicMock, patch
+import pandas as pd
+import pytest
+from backfill_rollups import read_archive, archive_rows, stage_recordings, main, STAGE_RECORDINGS_QUERIES
+
+
+def test_read_archive_folder(tmp_path):
+    """Test a copy of the archive folder reads the legacy CSV before the Parquet files."""
+    (tmp_path / 'keyword_recording.csv').write_text(
+        'keywords_id,total_mentions,avg_sentiment,date_and_hour\n3,10,0.5,2024-12-09 08:00:00\n')
+    partition = tmp_path / 'recordings' / 'date=2024-12-10' / 'keyword_bucket=03'
+    partition.mkdir(parents=True)
+    pd.DataFrame({'keywords_id': [3], 'total_mentions': [4], 'sentiment_sum': [1.0],
+                  'avg_sentiment': [0.25], 'date_and_hour': pd.to_datetime(['2024-12-10 08:00'])}
+                 ).to_parquet(partition / 'part-20241211T080000.parquet', index=False)
+
+    archive = read_archive(str(tmp_path))
+
+    assert archive['total_mentions'].tolist() == [10, 4]
+    assert archive_rows(archive) == [
+        (3, datetime.datetime(2024, 12, 9, 8), 10, 5.0, None),
+        (3, datetime.datetime(2024, 12, 10, 8), 4, 1.0, None)]
+
+
+def test_archive_rows_derives_missing_sums():
+    """Test hours archived with only an average get their sum from it."""
+    archive = pd.DataFrame({
+        'keyword_recordings_id': [1, 2],
+        'keywords_id': [3, 3],
+        'total_mentions': [10, 4],
+        'avg_sentiment': [0.5, -0.25],
+        'date_and_hour': ['2024-12-10 08:00:00', '2024-12-10 09:00:00']
+    })
+
+    assert archive_rows(archive) == [
+        (3, datetime.datetime(2024, 12, 10, 8), 10, 5.0, None),
+        (3, datetime.datetime(2024, 12, 10, 9), 4, -1.0, None)]
+
+
+def test_archive_rows_keeps_latest_of_repeated_hours():
+    """Test an hour archived twice is staged once, keeping the later copy and its sums."""
+    archive = pd.DataFrame({
+        'keywords_id': [3, 3, None],
+        'total_mentions': [10, 12, 1],
+        'sentiment_sum': [None, 3.0, 0.1],
+        'sentiment_sum_squares': [None, 2.5, 0.01],
+        'avg_sentiment': [0.5, 0.25, 0.1],
+        'date_and_hour': ['2024-12-10 08:00:00', '2024-12-10 08:00:00', '2024-12-10 08:00:00']
+    })
+
+    assert archive_rows(archive) == [(3, datetime.datetime(2024, 12, 10, 8), 12, 3.0, 2.5)]
+
+
+@patch('backfill_rollups.copy_rows')
+@patch('backfill_rollups.create_staging_tables')
+def test_stage_recordings_without_archive(mock_create, mock_copy):
+    """Test only keyword_recordings is staged when no archive is given."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'hours': 24}
+
+    assert stage_recordings(mock_curs) == 24
+    mock_copy.assert_not_called()
+    executed = [c.args[0] for c in mock_curs.execute.call_args_list]
+    assert executed[:len(STAGE_RECORDINGS_QUERIES)] == list(STAGE_RECORDINGS_QUERIES)
+
+
+@patch('backfill_rollups.borrow_connection')
+@patch('backfill_rollups.stage_recordings', return_value=24)
+@patch('backfill_rollups.update_rollups', side_effect=Exception('rollup failed'))
+def test_main_rolls_back_on_failure(mock_update, mock_stage, mock_borrow):
+    """Test a failed backfill leaves the rollups as they were."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+
+    with pytest.raises(Exception):
+        main()
+
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
@@ -0,0 +1,77 @@
+"""Test script for benchmark python file."""
+# pylint: skip-file
+
+import json
+import os
+import pytest
+from benchmark import (benchmark_keywords, generate_files, main, OfflineTrends,
+                       summarise, BENCHMARK_BUCKET)
+from local_s3 import LocalS3
+
+
+def test_benchmark_keywords_do_not_contain_each_other():
+    """Test no keyword is a substring of another, which would double count mentions."""
+    keywords = benchmark_keywords(20)
+
+    assert len(set(keywords)) == 20
+    assert not any(a in b for a in keywords for b in keywords if a != b)
+
+
+def test_generate_files(tmp_path):
+    """Test an hourly file is written for every hour of every day."""
+    keywords = benchmark_keywords(2)
+    written = generate_files(str(tmp_path), keywords, posts_per_hour=50, days=2)
+
+    s3 = LocalS3(str(tmp_path))
+    keys = [obj['Key'] for obj in s3.list_objects_v2(
+        Bucket=BENCHMARK_BUCKET, Prefix='bluesky/')['Contents']]
+    assert len(keys) == 48
+    assert written == sum(obj['Size'] for obj in s3.list_objects_v2(
+        Bucket=BENCHMARK_BUCKET, Prefix='bluesky/')['Contents'])
+
+    hour = json.loads(s3.get_object(Bucket=BENCHMARK_BUCKET, Key=keys[0])['Body'].read())
+    assert len(hour) == 50
+    assert all(-1 <= value['Sentiment Score']['compound'] <= 1 for value in hour.values())
+
+
+def test_generate_files_is_seeded(tmp_path):
+    """Test the same seed generates the same posts."""
+    keywords = benchmark_keywords(2)
+
+    assert generate_files(str(tmp_path / 'a'), keywords, 20, 1, seed=3) == \
+        generate_files(str(tmp_path / 'b'), keywords, 20, 1, seed=3)
+
+
+def test_offline_trends():
+    """Test the pytrends stand-in returns suggestions in the pytrends format."""
+    assert OfflineTrends().suggestions('python')[0] == {'title': 'python news'}
+
+
+def test_summarise():
+    """Test throughput is worked out from each stage's rows and the bytes scanned."""
+    stats = {"stage_seconds": {"extract": 2.0, "s3_scan": 1.0, "json_decode": 0.5},
+             "counters": {("etl_rows_total", (("stage", "extract"),)): 100,
+                          ("etl_s3_bytes_total", ()): 2 ** 21}}
+
+    summary = summarise(stats, 3.0, 2 ** 21, baseline_rss_mib=1.0)
+
+    assert summary["wall_seconds"] == 3.0
+    assert summary["input_mib"] == 2.0
+    assert summary["stages"]["extract"] == {"seconds": 2.0, "rows": 100,
+                                            "rows_per_second": 50.0}
+    assert summary["stages"]["s3_scan"]["mib_per_second"] == 2.0
+    assert summary["stages"]["json_decode"] == {"seconds": 0.5}
+    assert summary["peak_rss_mib"] > 0
+    assert summary["run_rss_mib"] == round(summary["peak_rss_mib"] - 1.0, 1)
+
+
+@pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database')
+def test_benchmark_against_local_postgres():
+    """Test a small benchmark runs end to end and loads a recording per keyword and hour."""
+    summary = main(posts_per_hour=20, days=1, keyword_count=3, reload_schema=True)
+
+    assert summary["stages"]["load"]["rows"] == 3 * 24
+    assert summary["bytes_read"] > 0
+    assert 0 <= summary["run_rss_mib"] <= summary["peak_rss_mib"]
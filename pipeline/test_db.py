@@ -0,0 +1,158 @@
+"""Test script for db python file."""
+# pylint: skip-file
+
+import os
+import logging
+from unittest.mock import MagicMock, patch
+import pytest
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+from psycopg2.pool import PoolError
+import db
+from db import (create_pool, get_pool, close_pool, is_healthy,
+                acquire_connection, release_connection, borrow_connection)
+
+
+@pytest.fixture()
+def configs():
+    """Configs for .env file"""
+    return {
+        "DB_USERNAME": "user",
+        "DB_PASSWORD": "password",
+        "DB_HOST": "localhost",
+        "DB_PORT": "1234",
+        "DB_NAME": "name",
+        "SCHEMA_NAME": "fake_schema",
+        "DB_POOL_MAX_SIZE": "2",
+        "DB_POOL_TIMEOUT": "0.01"
+    }
+
+
+@pytest.fixture(autouse=True)
+def env(configs):
+    """Fixture to mock environment variables and reset the shared pool."""
+    with patch.dict(os.environ, configs):
+        close_pool()
+        yield
+        close_pool()
+
+
+@pytest.fixture()
+def mock_pool():
+    """Fake pool handing out healthy connections."""
+    with patch('db.ThreadedConnectionPool') as mock_pool_class:
+        pool = mock_pool_class.return_value
+        pool.maxconn = 2
+        pool.closed = False
+        connection = MagicMock(closed=0)
+        connection.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+        pool.getconn.return_value = connection
+        yield pool
+
+
+@patch('db.ThreadedConnectionPool')
+def test_create_pool_sets_schema_and_size(mock_pool_class, caplog):
+    """Test the pool is sized from the environment and connections start in the schema."""
+    with caplog.at_level(logging.INFO):
+        pool = create_pool()
+
+    args, kwargs = mock_pool_class.call_args
+    assert args == (1, 2)
+    assert kwargs['options'] == '-c search_path=fake_schema'
+    assert kwargs['host'] == 'localhost'
+    assert pool == mock_pool_class.return_value
+    assert 'Connection pool established to database.' in caplog.text
+
+
+@patch('db.ThreadedConnectionPool')
+def test_create_pool_operational_error(mock_pool_class, caplog):
+    """Test unsuccessful connection to PostgreSQL due to OperationalError"""
+    mock_pool_class.side_effect = psycopg2.OperationalError()
+
+    with pytest.raises(psycopg2.OperationalError):
+        create_pool()
+    assert 'Operational error while connecting to the database:' in caplog.text
+
+
+def test_get_pool_is_shared(mock_pool):
+    """Test every caller gets the same pool."""
+    assert get_pool() is get_pool()
+
+
+def test_close_pool(mock_pool):
+    """Test closing the pool closes every connection."""
+    get_pool()
+    close_pool()
+    mock_pool.closeall.assert_called_once()
+
+
+def test_is_healthy_skips_recently_used_connection():
+    """Test connections used within the health check interval are not pinged."""
+    connection = MagicMock(closed=0)
+    with patch.dict(os.environ, {"DB_HEALTH_CHECK_INTERVAL": "60"}):
+        with patch.dict(db._last_used, {id(connection): 10**12}):
+            assert is_healthy(connection) is True
+    connection.cursor.assert_not_called()
+
+
+def test_is_healthy_broken_connection():
+    """Test a connection that fails the ping is reported as unhealthy."""
+    connection = MagicMock(closed=0)
+    connection.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        psycopg2.OperationalError('server closed the connection')
+    assert is_healthy(connection) is False
+
+
+def test_is_healthy_closed_connection():
+    """Test a closed connection is unhealthy."""
+    assert is_healthy(MagicMock(closed=1)) is False
+
+
+@patch('db.is_healthy', side_effect=[False, True])
+def test_acquire_connection_replaces_unhealthy(mock_healthy, mock_pool):
+    """Test a broken connection is discarded and replaced."""
+    broken = MagicMock(closed=0)
+    fresh = MagicMock(closed=0)
+    mock_pool.getconn.side_effect = [broken, fresh]
+
+    assert acquire_connection() is fresh
+    mock_pool.putconn.assert_called_once_with(broken, close=True)
+
+
+def test_acquire_connection_enforces_max_size(mock_pool):
+    """Test borrowing beyond the maximum pool size times out."""
+    first = acquire_connection()
+    second = acquire_connection()
+    with pytest.raises(PoolError):
+        acquire_connection()
+    release_connection(first)
+    release_connection(second)
+
+
+@patch('db.is_healthy', return_value=True)
+def test_release_connection_rolls_back_open_transaction(mock_healthy, mock_pool):
+    """Test a connection left mid-transaction is rolled back before reuse."""
+    connection = acquire_connection()
+    connection.get_transaction_status.return_value = TRANSACTION_STATUS_INERROR
+
+    release_connection(connection)
+    connection.rollback.assert_called_once()
+    mock_pool.putconn.assert_called_once_with(connection, close=False)
+
+
+def test_release_connection_discards_closed(mock_pool):
+    """Test a closed connection is not returned to the pool for reuse."""
+    connection = acquire_connection()
+    connection.closed = 1
+
+    release_connection(connection)
+    mock_pool.putconn.assert_called_once_with(connection, close=True)
+
+
+def test_borrow_connection_returns_connection(mock_pool):
+    """Test the connection goes back to the pool even when the block fails."""
+    with pytest.raises(ValueError):
+        with borrow_connection() as connection:
+            assert connection is mock_pool.getconn.return_value
+            raise ValueError()
+    mock_pool.putconn.assert_called_once()
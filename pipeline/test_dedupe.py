@@ -0,0 +1,222 @@
+"""Test script for dedupe python file."""
+# pylint: skip-file
+
+import logging
+import os
+from unittest.mock import MagicMock, patch
+import pytest
+from dedupe import (count_duplicate_recordings, delete_duplicate_recordings,
+                    delete_duplicate_related_terms, delete_duplicate_assignments,
+                    merge_duplicate_keywords, add_unique_constraint, compact_tables, main)
+
+
+@pytest.fixture()
+def mock_conn():
+    return MagicMock()
+
+
+@pytest.fixture()
+def mock_curs():
+    return MagicMock()
+
+
+def test_count_duplicate_recordings(mock_curs):
+    """Test the number of duplicate recordings is returned."""
+    mock_curs.fetchone.return_value = {'duplicates': 167}
+    assert count_duplicate_recordings(mock_curs) == 167
+    mock_curs.execute.assert_called_once()
+
+
+def test_delete_duplicate_recordings_keeps_latest(mock_curs):
+    """Test duplicates are deleted keeping the most recently inserted row per keyword and hour."""
+    mock_curs.rowcount = 5
+    assert delete_duplicate_recordings(mock_curs) == 5
+    query = mock_curs.execute.call_args.args[0]
+    assert 'PARTITION BY keywords_id, date_and_hour' in query
+    assert 'ORDER BY keyword_recordings_id DESC' in query
+    assert 'row_number > 1' in query
+
+
+def test_delete_duplicate_related_terms_repoints_assignments(mock_curs):
+    """Test assignments are moved to the kept related term before the copies are deleted."""
+    mock_curs.rowcount = 2
+    assert delete_duplicate_related_terms(mock_curs) == 2
+    update, delete = [call.args[0] for call in mock_curs.execute.call_args_list]
+    assert update.startswith('UPDATE related_term_assignment')
+    assert delete.startswith('DELETE FROM related_terms')
+
+
+def test_delete_duplicate_assignments(mock_curs):
+    """Test repeated keyword and related term pairs are deleted."""
+    mock_curs.rowcount = 7
+    assert delete_duplicate_assignments(mock_curs) == 7
+    assert 'PARTITION BY keywords_id, related_term_id' in mock_curs.execute.call_args.args[0]
+
+
+def test_merge_duplicate_keywords_repoints_every_reference(mock_curs):
+    """Test each table referencing a keyword is moved to the kept copy before the other copies are deleted."""
+    mock_curs.rowcount = 2
+    assert merge_duplicate_keywords(mock_curs) == 2
+    queries = [call.args[0] for call in mock_curs.execute.call_args_list]
+    assert 'PARTITION BY LOWER(keyword)' in queries[0]
+    for table in ('keyword_recordings', 'related_term_assignment', 'subscription',
+                  'keyword_refresh_tasks'):
+        assert any(query.startswith(f'UPDATE {table} ') for query in queries)
+    for table in ('keyword_refresh_schedule', 'keyword_rollups_1h'):
+        assert any(query.startswith(f'DELETE FROM {table} ') for query in queries)
+    delete_keywords = next(i for i, query in enumerate(queries)
+                           if query.startswith('DELETE FROM keywords'))
+    assert delete_keywords > max(i for i, query in enumerate(queries)
+                                 if query.startswith('UPDATE subscription'))
+
+
+def test_add_unique_constraint_when_missing(mock_curs):
+    """Test the unique key is added when it does not already exist."""
+    mock_curs.fetchone.return_value = None
+    assert add_unique_constraint(mock_curs, 'keyword_recordings') is True
+    mock_curs.execute.assert_called_with(
+        'ALTER TABLE keyword_recordings ADD CONSTRAINT keyword_recordings_keyword_hour_key '
+        'UNIQUE (keywords_id, date_and_hour)')
+
+
+def test_add_unique_constraint_already_exists(mock_curs):
+    """Test the unique key is not added twice."""
+    mock_curs.fetchone.return_value = {'?column?': 1}
+    assert add_unique_constraint(mock_curs, 'related_terms') is False
+    assert mock_curs.execute.call_count == 1
+
+
+def test_compact_tables_full(mock_conn, mock_curs):
+    """Test VACUUM FULL runs outside a transaction for each table and autocommit is restored."""
+    compact_tables(mock_conn, mock_curs, full=True)
+    mock_curs.execute.assert_any_call('VACUUM FULL ANALYZE keyword_recordings')
+    assert mock_curs.execute.call_count == 4
+    assert mock_conn.autocommit is False
+
+
+@patch('dedupe.compact_tables')
+@patch('dedupe.add_unique_constraint', return_value=True)
+@patch('dedupe.delete_duplicate_assignments', return_value=0)
+@patch('dedupe.delete_duplicate_related_terms', return_value=0)
+@patch('dedupe.delete_duplicate_recordings', return_value=10)
+@patch('dedupe.merge_duplicate_keywords', return_value=0)
+@patch('dedupe.count_duplicate_recordings', return_value=10)
+@patch('dedupe.borrow_connection')
+def test_main_success(mock_setup, mock_count, mock_merge, mock_delete, mock_delete_terms,
+                      mock_delete_assignments, mock_constraint, mock_compact,
+                      mock_conn, mock_curs, caplog):
+    """Test the dedupe runs in one transaction before compacting."""
+    mock_setup.return_value.__enter__.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_curs
+
+    with caplog.at_level(logging.INFO):
+        main()
+
+    mock_merge.assert_called_once_with(mock_curs)
+    mock_delete.assert_called_once_with(mock_curs)
+    mock_delete_terms.assert_called_once_with(mock_curs)
+    mock_delete_assignments.assert_called_once_with(mock_curs)
+    assert mock_constraint.call_count == 4
+    mock_conn.commit.assert_called_once()
+    mock_compact.assert_called_once_with(mock_conn, mock_curs, False)
+    mock_curs.close.assert_called_once()
+    assert 'Deleted 10 duplicate rows from keyword_recordings.' in caplog.text
+
+
+@patch('dedupe.delete_duplicate_recordings')
+@patch('dedupe.count_duplicate_recordings', return_value=3)
+@patch('dedupe.borrow_connection')
+def test_main_dry_run(mock_setup, mock_count, mock_delete, mock_conn, mock_curs):
+    """Test a dry run only counts duplicates."""
+    mock_setup.return_value.__enter__.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_curs
+    main(dry_run=True)
+    mock_delete.assert_not_called()
+    mock_conn.commit.assert_not_called()
+
+
+@patch('dedupe.add_unique_constraint')
+@patch('dedupe.delete_duplicate_recordings', side_effect=Exception('boom'))
+@patch('dedupe.count_duplicate_recordings', return_value=3)
+@patch('dedupe.borrow_connection')
+def test_main_rolls_back_on_error(mock_setup, mock_count, mock_delete, mock_constraint,
+                                  mock_conn, mock_curs):
+    """Test a failure part way through leaves the table untouched."""
+    mock_setup.return_value.__enter__.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_curs
+    with pytest.raises(Exception):
+        main()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+local_postgres = pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database loaded from schema.sql')
+
+
+@local_postgres
+def test_main_merges_duplicate_keywords_against_postgres():
+    """Test copies of a keyword with their own recordings, subscriptions and assignments are merged before its unique key is added."""
+    import db
+    db.close_pool()
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""TRUNCATE keyword_refresh_tasks, keyword_refresh_schedule, keyword_rollups_1h,
+                           subscription, related_term_assignment, related_terms, keyword_recordings,
+                           keywords, "user" RESTART IDENTITY CASCADE""")
+            cursor.execute("ALTER TABLE keywords DROP CONSTRAINT keywords_keyword_key")
+            cursor.execute("""INSERT INTO "user" (first_name, last_name, email)
+                           VALUES ('Ada', 'Lovelace', 'ada@example.com'),
+                                  ('Alan', 'Turing', 'alan@example.com')""")
+            cursor.execute("""INSERT INTO keywords (keyword)
+                           VALUES ('python'), ('Python'), ('python'), ('java')""")
+            cursor.execute("""SELECT create_keyword_recordings_partitions(
+                           '2024-12-10 08:00', '2024-12-10 09:00')""")
+            cursor.execute("""INSERT INTO keyword_recordings
+                           (keywords_id, total_mentions, sentiment_sum, date_and_hour)
+                           VALUES (1, 10, 1, '2024-12-10 08:00'), (2, 20, 2, '2024-12-10 08:00'),
+                                  (2, 30, 3, '2024-12-10 09:00'), (3, 40, 4, '2024-12-10 09:00'),
+                                  (4, 50, 5, '2024-12-10 08:00')""")
+            cursor.execute("""INSERT INTO subscription (user_id, keywords_id, subscription_status)
+                           VALUES (1, 1, TRUE), (1, 2, FALSE), (2, 3, TRUE)""")
+            cursor.execute("INSERT INTO related_terms (related_term) VALUES ('snake')")
+            cursor.execute("""INSERT INTO related_term_assignment (keywords_id, related_term_id)
+                           VALUES (1, 1), (2, 1), (3, 1)""")
+            cursor.execute("""INSERT INTO keyword_refresh_schedule
+                           (keywords_id, refresh_interval_hours, mentions_per_hour, volatility,
+                            notifications_enabled, next_refresh_at)
+                           VALUES (1, 1, 10, 0, TRUE, '2024-12-10 10:00'),
+                                  (2, 6, 20, 0, TRUE, '2024-12-10 14:00')""")
+            cursor.execute("""INSERT INTO keyword_rollups_1h
+                           (keywords_id, period_start, hours_recorded, total_mentions, sentiment_sum)
+                           VALUES (2, '2024-12-10 09:00', 1, 30, 3)""")
+        conn.commit()
+
+    main()
+
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT keywords_id, keyword FROM keywords ORDER BY keywords_id")
+            keywords = [(row['keywords_id'], row['keyword']) for row in cursor.fetchall()]
+            cursor.execute("""SELECT keywords_id, total_mentions FROM keyword_recordings
+                           ORDER BY keywords_id, date_and_hour""")
+            recordings = [(row['keywords_id'], row['total_mentions']) for row in cursor.fetchall()]
+            cursor.execute("SELECT user_id, keywords_id FROM subscription ORDER BY subscription_id")
+            subscriptions = [(row['user_id'], row['keywords_id']) for row in cursor.fetchall()]
+            cursor.execute("SELECT keywords_id FROM related_term_assignment")
+            assignments = [row['keywords_id'] for row in cursor.fetchall()]
+            cursor.execute("SELECT keywords_id FROM keyword_refresh_schedule")
+            schedules = [row['keywords_id'] for row in cursor.fetchall()]
+            cursor.execute("SELECT COUNT(*) AS rollups FROM keyword_rollups_1h")
+            rollups = cursor.fetchone()['rollups']
+            cursor.execute("SELECT 1 FROM pg_constraint WHERE conname = 'keywords_keyword_key'")
+            constraint = cursor.fetchone()
+    db.close_pool()
+
+    assert keywords == [(1, 'python'), (4, 'java')]
+    assert recordings == [(1, 20), (1, 40), (4, 50)]
+    assert subscriptions == [(1, 1), (2, 1)]
+    assert assignments == [1]
+    assert (schedules, rollups) == ([1], 0)
+    assert constraint is not None
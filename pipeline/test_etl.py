@@ -0,0 +1,90 @@
+"""Test script for etl python file."""
+# pylint: skip-file
+
+import os
+import threading
+from unittest.mock import patch
+import pytest
+import etl
+from etl import prefetch, run_streaming, streaming_enabled
+
+
+def test_streaming_enabled():
+    """Test ETL_STREAMING turns on the streaming pipeline."""
+    with patch.dict(os.environ, {"ETL_STREAMING": "true"}):
+        assert streaming_enabled()
+    with patch.dict(os.environ, {}, clear=True):
+        assert not streaming_enabled()
+
+
+def test_prefetch_keeps_order():
+    """Test prefetched items arrive in order."""
+    assert list(prefetch(iter(range(10)), 2)) == list(range(10))
+
+
+def test_prefetch_reads_on_a_background_thread():
+    """Test the producer runs ahead on another thread."""
+    threads = []
+
+    def produce():
+        for i in range(3):
+            threads.append(threading.current_thread())
+            yield i
+
+    assert list(prefetch(produce(), 1)) == [0, 1, 2]
+    assert threading.current_thread() not in threads
+
+
+def test_prefetch_raises_producer_errors():
+    """Test an error in the producer is raised to the consumer after the earlier items."""
+    def produce():
+        yield 1
+        raise ValueError("no files")
+
+    items = prefetch(produce(), 2)
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="no files"):
+        next(items)
+
+
+def test_prefetch_stops_producer_when_consumer_stops():
+    """Test the producer thread finishes when the consumer stops early."""
+    def produce():
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    items = prefetch(produce(), 1)
+    assert next(items) == 0
+    items.close()
+    assert not any(thread.name == "etl-prefetch" for thread in threading.enumerate())
+
+
+@patch.dict(os.environ, {"LOAD_CHUNK_HOURS": "2"})
+@patch('etl.load_main')
+@patch('etl.get_keyword_map', return_value={'python': 1})
+@patch('etl.extract_stream')
+def test_run_streaming_loads_in_chunks(mock_stream, mock_keyword_map, mock_load):
+    """Test streamed hours are matched with their keyword and loaded every chunk."""
+    mock_stream.return_value = iter([[{'Date and Hour': f'2024-12-10 0{hour}',
+                                       'Keyword': 'python'}] for hour in range(5)])
+    run = {"stage_seconds": {}, "counters": {}}
+
+    run_streaming(['python'], run)
+
+    assert [len(call.args[1]) for call in mock_load.call_args_list] == [2, 2, 1]
+    assert list(mock_load.call_args_list[0].args[1]['keyword_id']) == [1, 1]
+    assert run["hours_processed"] == 5
+
+
+@patch('etl.record_run')
+@patch('etl.run_streaming')
+@patch('etl.run_batch')
+def test_main_chooses_pipeline(mock_batch, mock_streaming, mock_record):
+    """Test the streaming pipeline runs only when asked for."""
+    etl.main(['python'], streaming=False)
+    etl.main(['python'], streaming=True)
+
+    mock_batch.assert_called_once()
+    mock_streaming.assert_called_once()
@@ -4,15 +4,16 @@
 import os
 import logging
 import json
-from unittest.mock import patch, MagicMock, ANY
+from unittest.mock import patch, MagicMock, ANY, call
 import datetime
 from io import BytesIO
 import pandas as pd
 import pandas.testing as pdt
 import pytest
 from botocore.config import Config
-from extract import (s3_connection, average_sentiment_analysis,
-                     extract_s3_data, initialize_trend_request, fetch_suggestions, main)
+from extract import (s3_connection, average_sentiment_analysis, sentiment_totals,
+                     extract_s3_data, initialize_trend_request, fetch_suggestions, main,
+                     stream)
 
 
 @pytest.fixture
@@ -106,7 +107,18 @@ def test_average_sentiment_analysis_file_empty():
     assert mentions == 0
 
 
-@patch('extract.average_sentiment_analysis')
+def test_sentiment_totals(file_data):
+    """Test the mentions and the sum and sum of squares of their sentiment."""
+    mentions, total, squares = sentiment_totals('python', file_data)
+
+    assert mentions == 3
+    assert total == pytest.approx(0.9)
+    assert squares == pytest.approx(sum(
+        s['Sentiment Score']['compound'] ** 2
+        for t, s in file_data.items() if 'python' in t))
+
+
+@patch('extract.sentiment_totals')
 @patch('extract.datetime')
 @patch('extract.client')
 def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis):
@@ -138,7 +150,7 @@ def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis)
     mock_client.get_object.side_effect = [
         {'Body': BytesIO(json.dumps(mock_json_content[i % 2]).encode('utf-8'))} for i in range(7)]
     mock_sentiment_analysis.side_effect = [
-        (0.6, 2) if i % 2 == 0 else (-0.45, 2) for i in range(7)
+        (2, 1.2, 0.74) if i % 2 == 0 else (2, -0.9, 0.45) for i in range(7)
     ]
 
     result = extract_s3_data(mock_client, bucket_name, topics)
@@ -146,11 +158,26 @@ def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis)
     assert isinstance(result, pd.DataFrame)
     assert len(result) == 2
     assert 'Keyword' in result.columns
-    assert 'Average Sentiment' in result.columns
     assert 'Total Mentions' in result.columns
+    assert 'Sentiment Sum' in result.columns
+    assert 'Sentiment Sum of Squares' in result.columns
     assert 'Date and Hour' in result.columns
 
 
+@patch('extract.inc')
+@patch('extract.client')
+def test_extract_s3_counts_requests_and_bytes(mock_client, mock_inc):
+    """Test S3 requests and the bytes read are counted."""
+    body = json.dumps({'python': {'Sentiment Score': {'compound': 0.5}}}).encode('utf-8')
+    mock_client.list_objects_v2.side_effect = lambda Bucket, Prefix, Delimiter: (
+        {'Contents': [{'Key': f'{Prefix}00.json'}]})
+    mock_client.get_object.side_effect = lambda Bucket, Key: {'Body': BytesIO(body)}
+
+    extract_s3_data(mock_client, 'bucket_name', ['python'])
+    assert call('etl_s3_requests_total', operation='list_objects_v2') in mock_inc.call_args_list
+    assert mock_inc.call_args_list.count(call('etl_s3_bytes_total', len(body))) == 7
+
+
 @patch('datetime.datetime')
 @patch('extract.client')
 def test_extract_s3_no_files(mock_client, mock_datetime, caplog):
@@ -205,6 +232,37 @@ def test_main_success(mock_s3_conn, mock_extract_s3, mock_pytrend, mock_suggesti
     pdt.assert_frame_equal(result, expected_df)
 
 
+@patch('extract.fetch_suggestions')
+@patch('extract.initialize_trend_request')
+@patch('extract.s3_connection')
+def test_stream_yields_each_hour(mock_s3_conn, mock_pytrend, mock_suggestions, aws_env_vars):
+    """Test the stream yields each hour's rows with their related terms."""
+    body = json.dumps({'python': {'Sentiment Score': {'compound': 0.5}}}).encode('utf-8')
+    mock_s3_conn.return_value.list_objects_v2.side_effect = lambda Bucket, Prefix, Delimiter: (
+        {'Contents': [{'Key': f'{Prefix}00.json'}, {'Key': f'{Prefix}01.json'}]})
+    mock_s3_conn.return_value.get_object.side_effect = lambda Bucket, Key: {
+        'Body': BytesIO(body)}
+    mock_suggestions.return_value = [{'title': 'python tutorial'}]
+
+    hours = list(stream(['python']))
+    assert len(hours) == 14
+    assert hours[0] == [{'Date and Hour': hours[0][0]['Date and Hour'], 'Keyword': 'python',
+                         'Total Mentions': 1, 'Sentiment Sum': 0.5,
+                         'Sentiment Sum of Squares': 0.25,
+                         'Related Terms': 'python tutorial'}]
+    mock_pytrend.assert_called_once()
+
+
+@patch('extract.initialize_trend_request')
+@patch('extract.s3_connection')
+def test_stream_no_files(mock_s3_conn, mock_pytrend, aws_env_vars):
+    """Test the stream raises a ValueError when there are no files."""
+    mock_s3_conn.return_value.list_objects_v2.return_value = {}
+
+    with pytest.raises(ValueError):
+        list(stream(['python']))
+
+
 @patch('extract.TrendReq')
 def test_fetch_suggestions(mock_trendreq):
     """Test function to ensure related words are returned successfully."""
@@ -0,0 +1,177 @@
+"""Test script for jobs python file."""
+# pylint: skip-file
+
+import logging
+import threading
+from unittest.mock import MagicMock
+import pytest
+from jobs import JobQueue, normalize_topic
+
+
+@pytest.fixture()
+def job_queue():
+    """Job queue with a single worker."""
+    queue = JobQueue(workers=1)
+    yield queue
+    queue.shutdown()
+
+
+def test_submit_returns_before_job_runs(job_queue):
+    """Test submitting a job does not wait for it to run."""
+    release = threading.Event()
+    job = job_queue.submit(lambda topics: release.wait(5), ['python'])
+
+    assert job['status'] in ('queued', 'running')
+    assert job['topics'] == ['python']
+    assert job['finished_at'] is None
+    release.set()
+    assert job_queue.wait(job['job_id'], timeout=5)['status'] == 'succeeded'
+
+
+def test_jobs_wait_for_a_free_worker(job_queue):
+    """Test a job queues while every worker is busy."""
+    release = threading.Event()
+    first = job_queue.submit(lambda topics: release.wait(5), ['python'])
+    second = job_queue.submit(MagicMock(), ['java'])
+
+    assert job_queue.get(second['job_id'])['status'] == 'queued'
+    release.set()
+    job_queue.wait(first['job_id'], timeout=5)
+    finished = job_queue.wait(second['job_id'], timeout=5)
+    assert finished['status'] == 'succeeded'
+    assert finished['queued_seconds'] >= 0
+
+
+def test_failed_job_records_error(job_queue, caplog):
+    """Test an exception inside a job marks it as failed."""
+    func = MagicMock(side_effect=RuntimeError('boom'))
+
+    with caplog.at_level(logging.ERROR):
+        job = job_queue.wait(job_queue.submit(func, ['python'])['job_id'], timeout=5)
+
+    assert job['status'] == 'failed'
+    assert job['error'] == 'boom'
+    assert 'failed: boom' in caplog.text
+
+
+def test_get_unknown_job(job_queue):
+    """Test unknown jobs return None."""
+    assert job_queue.get('missing') is None
+
+
+def test_finished_jobs_are_pruned():
+    """Test only the most recent finished jobs are remembered."""
+    queue = JobQueue(workers=1, max_history=2)
+    job_ids = []
+    for topic in ['a', 'b', 'c']:
+        job_id = queue.submit(MagicMock(), [topic])['job_id']
+        queue.wait(job_id, timeout=5)
+        job_ids.append(job_id)
+    queue.shutdown()
+
+    assert queue.get(job_ids[0]) is None
+    assert queue.get(job_ids[2]) is not None
+
+
+def test_normalize_topic():
+    """Test topics differing only by case and whitespace normalize to the same topic."""
+    assert normalize_topic('  Machine   Learning ') == 'machine learning'
+
+
+def test_duplicate_topic_attaches_to_job_in_flight(job_queue):
+    """Test a topic already queued or running shares the existing job."""
+    release = threading.Event()
+    func = MagicMock(side_effect=lambda topics: release.wait(5))
+    first, first_outcome = job_queue.submit_topic(func, 'Python')
+    second, second_outcome = job_queue.submit_topic(func, ' python ')
+
+    assert (first_outcome, second_outcome) == ('queued', 'attached')
+    assert second['job_id'] == first['job_id']
+    release.set()
+    job_queue.wait(first['job_id'], timeout=5)
+    func.assert_called_once_with(['python'])
+
+
+def test_recently_refreshed_topic_is_skipped(job_queue):
+    """Test a topic refreshed within the freshness window is not run again."""
+    func = MagicMock()
+    first, _ = job_queue.submit_topic(func, 'python')
+    job_queue.wait(first['job_id'], timeout=5)
+
+    job, outcome = job_queue.submit_topic(func, 'python')
+    assert outcome == 'fresh'
+    assert job['job_id'] == first['job_id']
+    assert job['status'] == 'succeeded'
+    func.assert_called_once()
+
+
+def test_topic_refreshed_by_another_process_is_skipped():
+    """Test a topic refreshed by another process within the freshness window is not run."""
+    refreshed_since = MagicMock(return_value={'python'})
+    queue = JobQueue(workers=1, freshness_seconds=60, refreshed_since=refreshed_since)
+    func = MagicMock()
+    job, covered = queue.submit_topics(func, ['Python', 'java'])
+    queue.wait(job['job_id'], timeout=5)
+    queue.shutdown()
+
+    assert covered['python'] == (None, 'fresh')
+    assert job['topics'] == ['java']
+    assert refreshed_since.call_args.args[0] == ['python', 'java']
+
+
+def test_failed_freshness_lookup_runs_topic(caplog):
+    """Test a topic is run when recent refreshes cannot be looked up."""
+    queue = JobQueue(workers=1, refreshed_since=MagicMock(side_effect=RuntimeError('down')))
+    with caplog.at_level(logging.WARNING):
+        job, outcome = queue.submit_topic(MagicMock(), 'python')
+    queue.wait(job['job_id'], timeout=5)
+    queue.shutdown()
+
+    assert outcome == 'queued'
+    assert 'down' in caplog.text
+
+
+def test_stale_refreshes_are_pruned():
+    """Test topics refreshed longer ago than the freshness window are forgotten."""
+    queue = JobQueue(workers=1, freshness_seconds=0)
+    job, _ = queue.submit_topic(MagicMock(), 'python')
+    queue.wait(job['job_id'], timeout=5)
+    queue.submit_topic(MagicMock(), 'java')
+    queue.shutdown()
+
+    assert 'python' not in queue._refreshed
+
+
+def test_stale_or_failed_topic_runs_again():
+    """Test topics outside the freshness window or whose last job failed are queued again."""
+    queue = JobQueue(workers=1, freshness_seconds=0)
+    func = MagicMock()
+    first, _ = queue.submit_topic(func, 'python')
+    queue.wait(first['job_id'], timeout=5)
+    second, outcome = queue.submit_topic(func, 'python')
+    queue.wait(second['job_id'], timeout=5)
+    queue.shutdown()
+    assert outcome == 'queued'
+
+    queue = JobQueue(workers=1)
+    failing = MagicMock(side_effect=RuntimeError('boom'))
+    queue.wait(queue.submit_topic(failing, 'java')[0]['job_id'], timeout=5)
+    _, outcome = queue.submit_topic(failing, 'java')
+    queue.shutdown()
+    assert outcome == 'queued'
+
+
+def test_submit_topics_queues_one_job_for_uncovered_topics(job_queue):
+    """Test a batch queues a single job for the topics not already in flight."""
+    release = threading.Event()
+    func = MagicMock(side_effect=lambda topics: release.wait(5))
+    running, _ = job_queue.submit_topic(func, 'python')
+    job, covered = job_queue.submit_topics(func, ['Python', 'java', 'rust', 'JAVA'])
+
+    assert job['topics'] == ['java', 'rust']
+    assert covered == {'python': (running['job_id'], 'attached'),
+                       'java': (job['job_id'], 'queued'),
+                       'rust': (job['job_id'], 'queued')}
+    release.set()
+    job_queue.wait(job['job_id'], timeout=5)
+    assert func.call_args_list[1].args == (['java', 'rust'],)
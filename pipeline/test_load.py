@@ -6,11 +6,11 @@ import pytest
 import os
 import logging
 import pandas as pd
-import psycopg2
-from unittest.mock import MagicMock, patch
-from psycopg2.extras import RealDictCursor
-from load import (setup_connection, insert_keywords, insert_keyword_recordings,
-                  insert_related_term_assignment, insert_related_terms, get_keyword_id, main)
+from unittest.mock import MagicMock, patch, call
+from load import (keyword_recording_rows, related_term_rows, create_staging_tables,
+                  copy_rows, add_keywords, merge_staged_rows, create_partitions, update_rollups,
+                  main, KEYWORDS_QUERY, KEYWORD_IDS_QUERY, MERGE_QUERIES, PARTITION_QUERY, ROLLUP_LOCK_QUERY, ROLLUP_DELTA_QUERY,
+                  HOURLY_ROLLUP_QUERY)
 
 
 @pytest.fixture()
@@ -38,10 +38,13 @@ def env(configs):
 @pytest.fixture()
 def mock_df():
     return pd.DataFrame({
-        'Hour': ['08:00', '09:00', '10:00'],
+        'Date and Hour': ['2024-12-10 08', '2024-12-10 09', '2024-12-10 10'],
+        'Keyword': ['python', 'python', 'python'],
         'Total Mentions': [15, 22, 18],
-        'Average Sentiment': [0.75, 0.60, 0.80],
-        'keyword_id': [1, 2, 3]
+        'Sentiment Sum': [11.25, 13.2, 14.4],
+        'Sentiment Sum of Squares': [8.5, 8.0, 11.6],
+        'Related Terms': ['Monty, Snake', 'Monty, Snake', 'Monty, Snake'],
+        'keyword_id': [1, 1, 1]
     })
 
 
@@ -50,205 +53,270 @@ def mock_df_2():
     return pd.DataFrame([{
         'Date and Hour': '2024-12-10 10',
         'Total Mentions': 18,
-        'Average Sentiment': 0.8,
+        'Sentiment Sum': 14.4,
+        'Sentiment Sum of Squares': 11.6,
         'keyword_id': 3
     }])
 
 
-@patch('load.psycopg2.connect')
-def test_setup_connection_success(mock_connect, env, caplog):
-    """Test successful connection and schema setting."""
+def test_keyword_recording_rows(mock_df_2):
+    """Test recordings are converted into rows for the staging table."""
+    assert keyword_recording_rows(mock_df_2) == [
+        (3, datetime.datetime(2024, 12, 10, 10, 0), 18, 14.4, 11.6)]
 
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_cursor = MagicMock(spec=RealDictCursor)
-    mock_conn.cursor.return_value = mock_cursor
 
-    with caplog.at_level(logging.INFO):
-        result = setup_connection()
-    assert result == (mock_conn, mock_cursor)
-    assert 'Connection successfully established to database.' in caplog.text
-    mock_cursor.execute.assert_called_once()
+def test_keyword_recording_rows_deduplicates_hours():
+    """Test a keyword and hour appearing twice in one run is only staged once, keeping the latest."""
+    df = pd.DataFrame([
+        {'Date and Hour': '2024-12-10 10', 'Total Mentions': 18,
+         'Sentiment Sum': 14.4, 'Sentiment Sum of Squares': 11.6, 'keyword_id': 3},
+        {'Date and Hour': '2024-12-10 10', 'Total Mentions': 20,
+         'Sentiment Sum': 10.0, 'Sentiment Sum of Squares': 5.5, 'keyword_id': 3},
+        {'Date and Hour': '2024-12-10 11', 'Total Mentions': 4,
+         'Sentiment Sum': 0.4, 'Sentiment Sum of Squares': 0.1, 'keyword_id': 3}
+    ])
 
+    assert keyword_recording_rows(df) == [
+        (3, datetime.datetime(2024, 12, 10, 10, 0), 20, 10.0, 5.5),
+        (3, datetime.datetime(2024, 12, 10, 11, 0), 4, 0.4, 0.1)]
 
-@patch('load.psycopg2.connect')
-def test_postgres_connection_operational_error(mock_connect, env, caplog):
-    """Test unsuccessful connection to PostgreSQL due to OperationalError"""
 
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_connect.side_effect = psycopg2.OperationalError()
+def test_keyword_recording_rows_skips_unknown_keywords(caplog):
+    """Test recordings without a keyword id are skipped."""
+    df = pd.DataFrame([{'Date and Hour': '2024-12-10 10', 'Keyword': 'mystery',
+                        'Total Mentions': 1, 'Sentiment Sum': 0.1,
+                        'Sentiment Sum of Squares': 0.01, 'keyword_id': None}])
 
-    with pytest.raises(psycopg2.OperationalError):
-        setup_connection()
-    assert 'Operational error while connecting to the database:' in caplog.text
-    for record in caplog.records:
-        assert record.levelname == 'ERROR'
+    with caplog.at_level(logging.WARNING):
+        assert keyword_recording_rows(df) == []
+    assert "Skipping recording for unknown keyword 'mystery'." in caplog.text
 
 
-@patch('load.psycopg2.connect')
-def test_postgres_connection_exception(mock_connect, env, caplog):
-    """Test general Exception raised when error setting up connection"""
+def test_keyword_recording_rows_new_keywords():
+    """Test recordings of keywords added by this load take their id from the keywords added."""
+    df = pd.DataFrame([{'Date and Hour': '2024-12-10 10', 'Keyword': 'Cactus',
+                        'Total Mentions': 1, 'Sentiment Sum': 0.1,
+                        'Sentiment Sum of Squares': 0.01, 'keyword_id': None}])
 
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_cursor = MagicMock(spec=RealDictCursor)
-    mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.execute.side_effect = Exception()
+    assert keyword_recording_rows(df, {'cactus': 7}) == [
+        (7, datetime.datetime(2024, 12, 10, 10, 0), 1, 0.1, 0.01)]
 
-    with pytest.raises(Exception):
-        setup_connection()
-    assert 'Error connecting to database:' in caplog.text
-    for record in caplog.records:
-        assert record.levelname == 'ERROR'
 
+def test_related_term_rows_deduplicates_terms():
+    """Test related terms repeated on every row of a keyword are only kept once."""
+    df = pd.DataFrame({
+        'Keyword': ['sleep', 'sleep', 'rest'],
+        'Related Terms': ['Nap, Bed, Night', 'Nap, Bed, Night', 'Bed']
+    })
 
-@patch('load.setup_connection')
-def test_successful_insert_keywords(mock_setup):
-    """Test successful insertion of keywords into keywords table from a list of topics when they don't already exist."""
-    mock_topics = ['python']
+    assert related_term_rows(df) == [('rest', 'Bed'), ('sleep', 'Bed'),
+                                     ('sleep', 'Nap'), ('sleep', 'Night')]
 
-    mock_conn = MagicMock()
-    mock_curs = MagicMock()
-    mock_setup.return_value = (mock_conn, mock_curs)
 
-    mock_curs.fetchone.return_value = None
-    insert_query = "INSERT INTO keywords (keyword) VALUES (%s)"
+def test_related_term_rows_no_suggestions():
+    """Test keywords without suggestions produce no related terms."""
+    df = pd.DataFrame({'Keyword': ['sleep'], 'Related Terms': ['']})
+    assert related_term_rows(df) == []
 
-    result = insert_keywords(mock_conn, mock_curs, mock_topics)
-    mock_curs.execute.assert_called_with(insert_query, ('python',))
-    assert result is None
-    assert mock_conn.commit.call_count == 1
 
+def test_create_staging_tables():
+    """Test the staging tables are temporary and dropped on commit."""
+    mock_curs = MagicMock()
+    create_staging_tables(mock_curs)
 
-@patch('load.setup_connection')
-def test_keyword_already_exists_no_insert(mock_setup):
-    """Test case when the topic keyword already exists so is not inserted into db."""
+    queries = [call.args[0] for call in mock_curs.execute.call_args_list]
+    assert len(queries) == 3
+    assert all(query.startswith('CREATE TEMPORARY TABLE') for query in queries)
+    assert all(query.endswith('ON COMMIT DROP') for query in queries)
 
-    mock_topics = ['python']
 
-    mock_conn = MagicMock()
+def test_copy_rows_in_batches(caplog):
+    """Test rows are copied as CSV in batches of the configured size."""
     mock_curs = MagicMock()
-    mock_setup.return_value = (mock_conn, mock_curs)
+    copied = []
+    mock_curs.copy_expert.side_effect = lambda query, buffer: copied.append(buffer.read())
+    rows = [(1, datetime.datetime(2024, 12, 10, 10), 18, 0.8),
+            (1, datetime.datetime(2024, 12, 10, 11), 2, -0.5),
+            (1, datetime.datetime(2024, 12, 10, 12), 0, 0)]
 
-    mock_curs.fetchone.return_value = 1
-    insert_keywords(mock_conn, mock_curs, mock_topics)
-    assert mock_curs.execute.call_count == 1
-    mock_conn.commit.assert_not_called()
+    with caplog.at_level(logging.INFO):
+        copy_rows(mock_curs, 'stage_keyword_recordings', rows, batch_size=2)
 
+    assert mock_curs.copy_expert.call_count == 2
+    assert mock_curs.copy_expert.call_args.args[0] == \
+        'COPY stage_keyword_recordings FROM STDIN WITH (FORMAT csv)'
+    assert copied[0] == '1,2024-12-10 10:00:00,18,0.8\r\n1,2024-12-10 11:00:00,2,-0.5\r\n'
+    assert copied[1] == '1,2024-12-10 12:00:00,0,0\r\n'
+    assert 'Copied 3 rows into stage_keyword_recordings' in caplog.text
+    assert 'rows/s' in caplog.text
 
-@patch('load.setup_connection')
-def test_insert_keyword_recordings_success(mock_setup, mock_df_2):
-    """Test successful insertion of data into keyword_recordings_table."""
 
-    mock_conn = MagicMock()
+def test_copy_rows_batch_size_from_env():
+    """Test the batch size is read from the environment."""
     mock_curs = MagicMock()
-    mock_setup.return_value = (mock_conn, mock_curs)
-
-    insert_keyword_recordings(mock_conn, mock_curs, mock_df_2)
 
-    mock_curs.execute.assert_any_call(
-        """INSERT INTO keyword_recordings
-                       (keywords_id, total_mentions, avg_sentiment, date_and_hour)
-                       VALUES (%s, %s, %s, %s)""",
-        (3, 18, 0.8, datetime.datetime(2024, 12, 10, 10, 0))
-    )
+    with patch.dict(os.environ, {"LOAD_BATCH_SIZE": "1"}):
+        copy_rows(mock_curs, 'stage_keywords', [('a',), ('b',)])
 
-    assert mock_conn.commit.call_count == 1
+    assert mock_curs.copy_expert.call_count == 2
 
 
-@patch('load.setup_connection')
-def test_successful_insert_related_terms(mock_setup):
-    """Test related terms can be inputted to the correct table."""
-    mock_conn = MagicMock()
+def test_add_keywords():
+    """Test new keywords are added on the unique key and the ids of every staged keyword are returned."""
     mock_curs = MagicMock()
-    mock_setup.return_value = (mock_conn, mock_curs)
+    mock_curs.rowcount = 1
+    mock_curs.fetchall.return_value = [{'keyword': 'python', 'keywords_id': 1},
+                                       {'keyword': 'cactus', 'keywords_id': 2}]
 
-    mock_df = pd.DataFrame({
-        'Keyword': ['Sleep'],
-        'Related Terms': ['Nap, Sleeping, Bed, Night, Doze']
-    })
+    assert add_keywords(mock_curs) == ({'python': 1, 'cactus': 2}, 1)
+    assert mock_curs.execute.call_args_list == [call(KEYWORDS_QUERY), call(KEYWORD_IDS_QUERY)]
+    assert 'ON CONFLICT (keyword) DO NOTHING' in KEYWORDS_QUERY
+    mock_curs.connection.commit.assert_not_called()
 
-    result = insert_related_terms(mock_conn, mock_curs, mock_df)
-    assert isinstance(result, dict)
-    assert mock_curs.fetchone.call_count == 5
-    assert mock_curs.execute.call_count == 5
-    assert mock_conn.commit.call_count == 5
-    mock_curs.execute.assert_any_call(
-        'SELECT related_term_id FROM related_terms\n                               WHERE related_term = %s', ('Nap',))
 
+def test_merge_staged_rows():
+    """Test each table is merged with one set-based statement."""
+    mock_curs = MagicMock()
+    mock_curs.rowcount = 4
+
+    written = merge_staged_rows(mock_curs)
+    assert written == {'keyword_recordings': 4,
+                       'related_terms': 4, 'related_term_assignment': 4}
+    assert mock_curs.execute.call_args_list == [
+        call(query) for query in MERGE_QUERIES.values()]
+    assert 'ON CONFLICT (keywords_id, date_and_hour) DO UPDATE' in MERGE_QUERIES['keyword_recordings']
+    assert 'ON CONFLICT (keywords_id, related_term_id) DO NOTHING' in \
+        MERGE_QUERIES['related_term_assignment']
+
+
+@patch('load.add_keywords', return_value=({'python': 1}, 1))
+@patch('load.merge_staged_rows')
+@patch('load.copy_rows')
+@patch('load.create_staging_tables')
+@patch('load.borrow_connection')
+def test_main_success(mock_setup, mock_create, mock_copy, mock_merge, mock_add, mock_df, env, caplog):
+    """Test the main load function stages and merges the run in one transaction."""
+    mock_topics = ['python']
 
-@patch('load.setup_connection')
-def test_get_keyword_id(mock_setup):
-    """Test successful retrieval of keyword_id"""
-    keyword = 'python'
     mock_conn = MagicMock()
     mock_curs = MagicMock()
-    mock_setup.return_value[0] = mock_conn
-    mock_setup.return_value[1] = mock_curs
+    mock_setup.return_value.__enter__.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_curs
+    mock_merge.return_value = {'keyword_recordings': 3}
 
-    mock_curs.fetchone.return_value = {'keywords_id': 24}
-    result = get_keyword_id(mock_curs, keyword)
-    mock_curs.execute.assert_called_with(
-        """SELECT keywords.keywords_id FROM keywords WHERE keyword = %s""", (keyword, ))
-    assert mock_curs.fetchone.call_count == 1
-    assert result == 24
-
-
-@patch('load.setup_connection')
-def test_keyword_id_not_found(mock_setup, caplog):
-    """Test error is raised when keyword id not found in RDS."""
-    keyword = 'python'
+    with caplog.at_level(logging.INFO):
+        main(mock_topics, mock_df)
+
+    mock_create.assert_called_once_with(mock_curs)
+    assert [c.args[1] for c in mock_copy.call_args_list] == [
+        'stage_keywords', 'stage_keyword_recordings', 'stage_related_terms']
+    assert mock_copy.call_args_list[0].args[2] == [('python',)]
+    assert mock_copy.call_args_list[2].args[2] == [('python', 'Monty'), ('python', 'Snake')]
+    mock_add.assert_called_once_with(mock_curs)
+    mock_merge.assert_called_once_with(mock_curs)
+    mock_conn.commit.assert_called_once()
+    mock_conn.rollback.assert_not_called()
+    mock_setup.return_value.__exit__.assert_called_once()
+    assert 'Loaded 1 rows into keywords, 3 rows into keyword_recordings' in caplog.text
+
+
+@patch('load.add_keywords', return_value=({}, 1))
+@patch('load.merge_staged_rows', side_effect=Exception('merge failed'))
+@patch('load.copy_rows')
+@patch('load.create_staging_tables')
+@patch('load.borrow_connection')
+def test_main_failure_writes_nothing(mock_setup, mock_create, mock_copy, mock_merge, mock_add,
+                                     mock_df, env, caplog):
+    """Test a failure part way through the load rolls back the whole run."""
     mock_conn = MagicMock()
-    mock_curs = MagicMock()
-    mock_setup.return_value[0] = mock_conn
-    mock_setup.return_value[1] = mock_curs
+    mock_setup.return_value.__enter__.return_value = mock_conn
 
-    mock_curs.fetchone.return_value = None
-    with caplog.at_level(logging.ERROR):
-        with pytest.raises(ValueError):
-            get_keyword_id(mock_curs, keyword)
-    assert "Keyword 'python' not found in the database." in caplog.text
+    with pytest.raises(Exception):
+        main(['python'], mock_df)
 
+    mock_conn.commit.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    assert 'Load failed, no data was written: merge failed' in caplog.text
 
-@patch('load.get_keyword_id', return_value=1)
-@patch('load.setup_connection')
-def test_insert_related_term_assignment(mock_setup, mock_get_id):
-    """Test successful insert of data into related term assignment table."""
-    mock_keywords_ids = {1: 'python'}
 
-    mock_conn = MagicMock()
+def test_create_partitions(caplog):
+    """Test partitions are created for the days of the staged recordings."""
     mock_curs = MagicMock()
-    mock_setup.return_value[0] = mock_conn
-    mock_setup.return_value[1] = mock_curs
-
-    insert_related_term_assignment(mock_conn, mock_curs, mock_keywords_ids)
-    assert mock_curs.execute.call_count == 1
-    assert mock_conn.commit.call_count == 1
+    mock_curs.fetchone.return_value = {'created': 2}
 
+    with caplog.at_level(logging.INFO):
+        assert create_partitions(mock_curs) == 2
+    mock_curs.execute.assert_called_once_with(PARTITION_QUERY)
+    assert 'Created 2 keyword_recordings partitions.' in caplog.text
 
-@patch('load.insert_related_term_assignment')
-@patch('load.insert_related_terms')
-@patch('load.insert_keyword_recordings')
-@patch('load.insert_keywords')
-@patch('load.setup_connection')
-def test_main_success(mock_setup, mock_insert_keywords, mock_insert_recordings, mock_insert_related, mock_insert_assignment, mock_df, env, caplog):
-    """Test the main load function of load will import data into RDS successfully."""
-    mock_topics = ['python']
 
-    mock_conn = MagicMock()
+def test_update_rollups_applies_deltas_to_every_grain():
+    """Test the hourly rollup is written before the deltas are added to coarser periods."""
     mock_curs = MagicMock()
-    mock_setup.return_value = (mock_conn, mock_curs)
+    mock_curs.rowcount = 4
 
-    mock_related_ids = MagicMock()
-    mock_insert_related.return_value = mock_related_ids
+    assert update_rollups(mock_curs) == {'keyword_rollups_1h': 4, 'keyword_rollups_6h': 4,
+                                         'keyword_rollups_1d': 4}
+    executed = [c.args[0] for c in mock_curs.execute.call_args_list]
+    assert executed[:3] == [ROLLUP_LOCK_QUERY, ROLLUP_DELTA_QUERY, HOURLY_ROLLUP_QUERY]
+    assert 'INTO keyword_rollups_6h' in executed[3]
+    assert "INTERVAL '6 hours'" in executed[3]
+    assert 'INTO keyword_rollups_1d' in executed[4]
+    assert "INTERVAL '1 day'" in executed[4]
 
-    main(mock_topics, mock_df)
-    mock_insert_keywords.assert_called_once_with(
-        mock_conn, mock_curs, mock_topics)
 
-    mock_insert_recordings.assert_called_once_with(
-        mock_conn, mock_curs, mock_df)
-    mock_insert_related.assert_called_once_with(mock_conn, mock_curs, mock_df)
-    mock_insert_assignment.assert_called_once_with(
-        mock_conn, mock_curs, mock_related_ids)
+def recordings(seed: int, hours: int) -> pd.DataFrame:
+    """Returns transformed recordings of two keywords, varying with the seed."""
+    return pd.DataFrame([{
+        'Date and Hour': (datetime.datetime(2024, 12, 9) +
+                          datetime.timedelta(hours=hour)).strftime('%Y-%m-%d %H'),
+        'Keyword': keyword, 'Total Mentions': (seed * 7 + hour * 3 + keyword_id) % 40,
+        'Sentiment Sum': ((seed + hour) % 9 - 4) / 2, 'Sentiment Sum of Squares': 1.5,
+        'Related Terms': '', 'keyword_id': keyword_id}
+        for hour in range(hours) for keyword_id, keyword in ((1, 'alpha'), (2, 'beta'))])
+
+
+@pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database loaded from schema.sql')
+def test_rollups_stay_exact_across_reloads():
+    """Test reloaded and deleted hours leave every rollup equal to a fresh rollup of the hours."""
+    import db
+    db.close_pool()
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""TRUNCATE keyword_rollups_1h, keyword_rollups_6h, keyword_rollups_1d,
+                           related_term_assignment, keyword_recordings, keywords
+                           RESTART IDENTITY CASCADE""")
+        conn.commit()
+
+    main(['alpha', 'beta'], recordings(1, 50))
+    main(['alpha', 'beta'], recordings(2, 50))
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM keyword_recordings")
+        conn.commit()
+    main(['alpha', 'beta'], recordings(3, 20))
+
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            for table, period in (('keyword_rollups_6h', '6 hours'), ('keyword_rollups_1d', '1 day')):
+                cursor.execute(f"""
+                    SELECT COUNT(*) AS differences
+                    FROM {table} AS rollup
+                    FULL JOIN (SELECT keywords_id,
+                                      DATE_BIN(INTERVAL '{period}', period_start,
+                                               TIMESTAMP '2000-01-01') AS period_start,
+                                      COUNT(*) AS hours, SUM(total_mentions) AS mentions,
+                                      SUM(sentiment_sum) AS sentiment
+                               FROM keyword_rollups_1h GROUP BY 1, 2) AS expected
+                        ON expected.keywords_id = rollup.keywords_id
+                        AND expected.period_start = rollup.period_start
+                    WHERE rollup.hours_recorded IS DISTINCT FROM expected.hours
+                    OR rollup.total_mentions IS DISTINCT FROM expected.mentions
+                    OR ABS(rollup.sentiment_sum - expected.sentiment) > 1e-9
+                    OR rollup.keywords_id IS NULL OR expected.keywords_id IS NULL""")
+                assert cursor.fetchone()['differences'] == 0
+            cursor.execute("SELECT total_mentions FROM keyword_rollups_1h "
+                           "WHERE keywords_id = 1 ORDER BY period_start LIMIT 1")
+            assert cursor.fetchone()['total_mentions'] == recordings(3, 1)['Total Mentions'][0]
@@ -0,0 +1,65 @@
+"""Test script for local_s3 python file."""
+# pylint: skip-file
+
+import asyncio
+from unittest.mock import patch
+from local_s3 import LocalS3, AsyncLocalS3
+
+
+def test_put_and_get_object(tmp_path):
+    """Test an object written to the local S3 can be read back."""
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(Bucket='bucket', Key='bluesky/2025-01-01/00.json', Body=b'{}')
+
+    assert s3.get_object(Bucket='bucket', Key='bluesky/2025-01-01/00.json')['Body'].read() == b'{}'
+
+
+def test_list_objects_with_delimiter(tmp_path):
+    """Test only keys directly under the prefix are listed, deeper ones as common prefixes."""
+    s3 = LocalS3(str(tmp_path))
+    for key in ('bluesky/2025-01-01/01.json', 'bluesky/2025-01-01/00.json',
+                'bluesky/2025-01-01/archive/00.json', 'bluesky/2025-01-02/00.json'):
+        s3.put_object(Bucket='bucket', Key=key, Body=b'{}')
+
+    response = s3.list_objects_v2(Bucket='bucket', Prefix='bluesky/2025-01-01/', Delimiter='/')
+
+    assert [obj['Key'] for obj in response['Contents']] == [
+        'bluesky/2025-01-01/00.json', 'bluesky/2025-01-01/01.json']
+    assert response['CommonPrefixes'] == [{'Prefix': 'bluesky/2025-01-01/archive/'}]
+    assert response['KeyCount'] == 2
+
+
+def test_list_objects_empty_prefix(tmp_path):
+    """Test a prefix with no objects has no Contents, like S3."""
+    response = LocalS3(str(tmp_path)).list_objects_v2(Bucket='bucket', Prefix='bluesky/',
+                                                      Delimiter='/')
+
+    assert 'Contents' not in response
+    assert response['KeyCount'] == 0
+
+
+@patch('local_s3.time.sleep')
+def test_latency_per_request(mock_sleep, tmp_path):
+    """Test every request waits for the configured latency."""
+    s3 = LocalS3(str(tmp_path), latency=0.02)
+    s3.put_object(Bucket='bucket', Key='a.json', Body=b'{}')
+    s3.list_objects_v2(Bucket='bucket', Prefix='')
+    s3.get_object(Bucket='bucket', Key='a.json')
+
+    assert mock_sleep.call_count == 2
+    mock_sleep.assert_called_with(0.02)
+
+
+def test_async_local_s3(tmp_path):
+    """Test the async stand-in lists and reads like the sync one."""
+    LocalS3(str(tmp_path)).put_object(Bucket='bucket', Key='bluesky/00.json', Body=b'{}')
+
+    async def read():
+        async with AsyncLocalS3(str(tmp_path)) as s3:
+            listing = await s3.list_objects_v2(Bucket='bucket', Prefix='bluesky/')
+            response = await s3.get_object(Bucket='bucket', Key='bluesky/00.json')
+            return listing, await response['Body'].read()
+
+    listing, body = asyncio.run(read())
+    assert listing['KeyCount'] == 1
+    assert body == b'{}'
@@ -0,0 +1,77 @@
+"""Test script for metrics python file."""
+# pylint: skip-file
+
+import pytest
+import metrics
+from metrics import inc, observe, timer, render, format_labels
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    """Start every test without recorded metrics."""
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_counters_add_up_per_label_set():
+    """Test counters are kept separately for each set of labels."""
+    inc('etl_s3_requests_total', operation='get_object')
+    inc('etl_s3_requests_total', 2, operation='get_object')
+    inc('etl_s3_requests_total', operation='list_objects_v2')
+
+    text = render()
+    assert 'etl_s3_requests_total{operation="get_object"} 3' in text
+    assert 'etl_s3_requests_total{operation="list_objects_v2"} 1' in text
+    assert '# TYPE etl_s3_requests_total counter' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    """Test histogram buckets count every observation at or below their bound."""
+    observe('etl_stage_duration_seconds', 0.2, stage='load')
+    observe('etl_stage_duration_seconds', 3, stage='load')
+
+    text = render()
+    assert 'etl_stage_duration_seconds_bucket{stage="load",le="0.1"} 0' in text
+    assert 'etl_stage_duration_seconds_bucket{stage="load",le="0.25"} 1' in text
+    assert 'etl_stage_duration_seconds_bucket{stage="load",le="5"} 2' in text
+    assert 'etl_stage_duration_seconds_bucket{stage="load",le="+Inf"} 2' in text
+    assert 'etl_stage_duration_seconds_sum{stage="load"} 3.2' in text
+    assert 'etl_stage_duration_seconds_count{stage="load"} 2' in text
+
+
+def test_timer_records_duration_and_errors():
+    """Test a timed stage is observed whether or not it raises, and errors are counted."""
+    with timer('extract'):
+        pass
+    with pytest.raises(ValueError):
+        with timer('extract'):
+            raise ValueError('no files')
+
+    text = render()
+    assert 'etl_stage_duration_seconds_count{stage="extract"} 2' in text
+    assert 'etl_stage_errors_total{stage="extract"} 1' in text
+
+
+def test_snapshot():
+    """Test the snapshot totals the time of each stage and copies the counters."""
+    observe('etl_stage_duration_seconds', 0.5, stage='load')
+    observe('etl_stage_duration_seconds', 0.25, stage='load')
+    inc('etl_s3_bytes_total', 10)
+
+    assert metrics.snapshot() == {
+        'stage_seconds': {'load': 0.75},
+        'counters': {('etl_s3_bytes_total', ()): 10}}
+
+
+def test_format_labels_escapes_values():
+    """Test quotes, backslashes and newlines in label values are escaped."""
+    assert format_labels((('stage', 'a"b\\c\nd'),)) == '{stage="a\\"b\\\\c\\nd"}'
+    assert format_labels(()) == ''
+
+
+def test_timed_times_each_item():
+    """Test the time taken to produce each item of an iterable is recorded as the stage."""
+    assert list(metrics.timed('extract', iter([1, 2, 3]))) == [1, 2, 3]
+
+    assert 'etl_stage_duration_seconds_count{stage="extract"} 4' in metrics.render()
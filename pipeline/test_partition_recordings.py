@@ -0,0 +1,112 @@
+"""Test script for partition_recordings python file."""
+# pylint: skip-file
+
+import logging
+import os
+import re
+from unittest.mock import MagicMock, patch
+import pytest
+from partition_recordings import (is_partitioned, rename_old_table, copy_recordings,
+                                  main, PARTITION_DDL, OLD_TABLE)
+
+
+@pytest.fixture()
+def mock_curs():
+    return MagicMock()
+
+
+def normalise(sql: str) -> str:
+    """Collapses whitespace so SQL can be compared regardless of layout."""
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def test_ddl_matches_schema():
+    """Test the migration creates the same table, index and functions as schema.sql."""
+    with open(os.path.join(os.path.dirname(__file__), 'schema.sql')) as file:
+        schema = normalise(file.read())
+
+    for statement in PARTITION_DDL:
+        assert normalise(statement) in schema
+
+
+def test_is_partitioned(mock_curs):
+    """Test an existing partitioned table is detected."""
+    mock_curs.fetchone.return_value = {'?column?': 1}
+    assert is_partitioned(mock_curs)
+    mock_curs.fetchone.return_value = None
+    assert not is_partitioned(mock_curs)
+
+
+def test_rename_old_table_renames_indexes_and_keys(mock_curs):
+    """Test the old table's indexes and foreign keys are renamed out of the way."""
+    mock_curs.fetchall.side_effect = [[{'name': 'keyword_recordings_pkey'}],
+                                      [{'name': 'keyword_recordings_keywords_id_fkey'}]]
+
+    rename_old_table(mock_curs)
+
+    executed = [c.args[0] for c in mock_curs.execute.call_args_list]
+    assert executed[0] == f"ALTER TABLE keyword_recordings RENAME TO {OLD_TABLE}"
+    assert ('ALTER INDEX keyword_recordings_pkey RENAME TO '
+            'keyword_recordings_pkey_unpartitioned') in executed
+    assert (f'ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT keyword_recordings_keywords_id_fkey '
+            'TO keyword_recordings_keywords_id_fkey_unpartitioned') in executed
+
+
+def test_copy_recordings_keeps_ids(mock_curs):
+    """Test recordings are copied with their ids and the identity continues after them."""
+    mock_curs.rowcount = 12
+
+    assert copy_recordings(mock_curs) == 12
+    executed = [normalise(c.args[0]) for c in mock_curs.execute.call_args_list]
+    assert 'create_keyword_recordings_partitions' in executed[0]
+    assert 'OVERRIDING SYSTEM VALUE' in executed[1]
+    assert 'setval' in executed[2]
+
+
+@patch('partition_recordings.borrow_connection')
+@patch('partition_recordings.is_partitioned', return_value=True)
+@patch('partition_recordings.rename_old_table')
+def test_main_skips_partitioned_table(mock_rename, mock_partitioned, mock_borrow, caplog):
+    """Test nothing changes when the table is already partitioned."""
+    with caplog.at_level(logging.INFO):
+        main()
+
+    mock_rename.assert_not_called()
+    assert 'keyword_recordings is already partitioned.' in caplog.text
+
+
+@patch('partition_recordings.borrow_connection')
+@patch('partition_recordings.is_partitioned', return_value=False)
+@patch('partition_recordings.count_duplicate_recordings', return_value=3)
+@patch('partition_recordings.rename_old_table')
+def test_main_stops_on_duplicate_recordings(mock_rename, mock_duplicates, mock_partitioned,
+                                            mock_borrow):
+    """Test the migration stops before changing anything while duplicate recordings are left."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+
+    with pytest.raises(ValueError, match='3 duplicate recordings .* Run dedupe.py first'):
+        main()
+
+    mock_rename.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+@patch('partition_recordings.borrow_connection')
+@patch('partition_recordings.is_partitioned', return_value=False)
+@patch('partition_recordings.count_duplicate_recordings', return_value=0)
+@patch('partition_recordings.rename_old_table')
+@patch('partition_recordings.create_partitioned_table')
+@patch('partition_recordings.copy_recordings', side_effect=Exception('copy failed'))
+def test_main_rolls_back_on_failure(mock_copy, mock_create, mock_rename, mock_duplicates,
+                                    mock_partitioned, mock_borrow):
+    """Test a failed migration leaves the original table in place."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+
+    with pytest.raises(Exception):
+        main()
+
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
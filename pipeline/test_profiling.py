@@ -0,0 +1,143 @@
+"""Test script for profiling python file."""
+# pylint: skip-file
+
+import cProfile
+import logging
+import os
+import pstats
+from unittest.mock import patch
+import pytest
+import profiling
+from profiling import profile_dir_for, frame_name, collapsed_stacks, profile
+
+
+def busy_leaf():
+    """Burns some time so it shows up in a profile."""
+    return sum(i * i for i in range(20000))
+
+
+def busy_parent():
+    """Calls the leaf twice."""
+    return busy_leaf() + busy_leaf()
+
+
+def test_profile_dir_from_env():
+    """Test runs are profiled when ETL_PROFILE_DIR is set."""
+    with patch.dict(os.environ, {"ETL_PROFILE_DIR": "/tmp/profiles"}, clear=True):
+        assert profile_dir_for(['python']) == '/tmp/profiles'
+    with patch.dict(os.environ, {}, clear=True):
+        assert profile_dir_for(['python']) is None
+
+
+def test_profile_dir_limited_to_topics():
+    """Test ETL_PROFILE_TOPICS limits profiling to runs including one of its topics."""
+    with patch.dict(os.environ, {"ETL_PROFILE_DIR": "/tmp/profiles",
+                                 "ETL_PROFILE_TOPICS": "Python, rust"}, clear=True):
+        assert profile_dir_for(['python', 'java']) == '/tmp/profiles'
+        assert profile_dir_for(['java']) is None
+
+
+def test_frame_name():
+    """Test pstats keys become readable frames without semicolons."""
+    assert frame_name(('/app/extract.py', 51, 'extract_s3_data')) == \
+        'extract_s3_data (extract.py:51)'
+    assert frame_name(('~', 0, "<method 'read' of '_io.BytesIO' objects>")) == \
+        "<method 'read' of '_io.BytesIO' objects>"
+    assert ';' not in frame_name(('/app/a;b.py', 1, 'f'))
+
+
+def test_collapsed_stacks_follow_the_call_graph():
+    """Test self time is attributed to stacks rebuilt from the caller graph."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    busy_parent()
+    profiler.disable()
+
+    stacks = collapsed_stacks(pstats.Stats(profiler))
+    leaf_stacks = [stack for stack in stacks if stack.split(';')[-1].startswith('busy_leaf')]
+    assert leaf_stacks
+    assert all('busy_parent' in stack.split(';')[-2] for stack in leaf_stacks)
+    assert all(value >= 0 for value in stacks.values())
+
+
+def test_profile_writes_results(tmp_path):
+    """Test a profiled block writes pstats, collapsed stacks and allocations."""
+    with profile(str(tmp_path), ['Vegan Protein']):
+        busy_parent()
+        kept = [bytearray(1024) for _ in range(100)]
+
+    files = sorted(os.listdir(tmp_path))
+    assert [name.split('-', 1)[1] for name in files] == [
+        'vegan-protein.allocations.txt', 'vegan-protein.collapsed', 'vegan-protein.pstats']
+    prefix = os.path.join(tmp_path, files[0].rsplit('.', 2)[0])
+
+    assert pstats.Stats(f'{prefix}.pstats').total_calls > 0
+    with open(f'{prefix}.collapsed', encoding='utf-8') as file:
+        lines = file.read().splitlines()
+    assert any('busy_leaf' in line for line in lines)
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    with open(f'{prefix}.allocations.txt', encoding='utf-8') as file:
+        allocations = file.read()
+    assert allocations.startswith('Peak traced memory:')
+    assert 'test_profiling.py' in allocations
+
+
+def test_concurrent_runs_are_not_profiled_twice(tmp_path, caplog):
+    """Test a run started while another is profiled runs without profiling."""
+    with caplog.at_level(logging.WARNING):
+        with profile(str(tmp_path / 'first'), ['python']):
+            with profile(str(tmp_path / 'second'), ['java']):
+                pass
+
+    assert not os.path.exists(tmp_path / 'second')
+    assert "running ['java'] without profiling" in caplog.text
+    assert not profiling._profile_lock.locked()
+
+
+def test_profile_still_writes_when_the_run_fails(tmp_path):
+    """Test a failing run is profiled and the error raised."""
+    with pytest.raises(ValueError):
+        with profile(str(tmp_path), ['python']):
+            raise ValueError('no files')
+
+    assert len(os.listdir(tmp_path)) == 3
+
+
+@patch('etl.record_run')
+@patch('etl.load_main')
+@patch('etl.transform_main')
+@patch('etl.extract_main')
+def test_etl_profile_dir(mock_extract, mock_transform, mock_load, mock_record, tmp_path):
+    """Test the ETL profiles a run into the given directory."""
+    import etl
+    etl.main(['python'], profile_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_worker_threads_are_profiled(tmp_path):
+    """Test work handed to the prefetch thread and asyncio.to_thread shows up in the profile."""
+    import asyncio
+    from etl import prefetch
+    from profiling import profiled_call
+
+    def produce():
+        yield busy_parent()
+
+    async def offload():
+        return await asyncio.to_thread(profiled_call, busy_leaf)
+
+    with profile(str(tmp_path), ['python']):
+        list(prefetch(produce(), 1))
+        asyncio.run(offload())
+
+    prefix = os.path.join(tmp_path, sorted(os.listdir(tmp_path))[0].rsplit('.', 2)[0])
+    stats = pstats.Stats(f'{prefix}.pstats').stats
+    calls = {name: stat[1] for (_, _, name), stat in stats.items()}
+    assert calls['busy_parent'] == 1
+    assert calls['busy_leaf'] == 3
+
+
+def test_profiled_call_outside_a_profiled_run():
+    """Test calls outside a profiled run just run the function."""
+    from profiling import profiled_call
+    assert profiled_call(busy_leaf) == busy_leaf()
@@ -0,0 +1,31 @@
+"""Test script for recordings_benchmark python file."""
+# pylint: skip-file
+
+import os
+from unittest.mock import MagicMock, patch
+from recordings_benchmark import execution_ms, schema_for, time_retention
+
+
+@patch.dict(os.environ, {'SCHEMA_NAME': 'trends'})
+def test_schema_for():
+    """Test each layout is built in its own scratch schema."""
+    assert schema_for('partitioned') == 'trends_bench_partitioned'
+
+
+def test_execution_ms():
+    """Test the server side execution time is read from the query plan."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'QUERY PLAN': [{'Execution Time': 12.5}]}
+
+    assert execution_ms(mock_curs, 'SELECT 1', {}) == 12.5
+    assert mock_curs.execute.call_args.args[0] == 'EXPLAIN (ANALYZE, FORMAT JSON) SELECT 1'
+
+
+@patch.dict(os.environ, {'SCHEMA_NAME': 'trends'})
+def test_time_retention_is_rolled_back():
+    """Test the removal of old recordings is timed and then rolled back."""
+    mock_conn, mock_curs = MagicMock(), MagicMock()
+
+    assert time_retention(mock_conn, mock_curs, 'partitioned') >= 0
+    assert 'drop_keyword_recordings_partitions' in mock_curs.execute.call_args_list[1].args[0]
+    mock_conn.rollback.assert_called_once()
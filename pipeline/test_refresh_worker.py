@@ -0,0 +1,231 @@
+"""Test script for refresh_worker python file."""
+# pylint: skip-file
+
+import os
+import threading
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+import pytest
+import db
+from refresh_worker import (enqueue_tasks, claim_tasks, extend_leases, complete_tasks,
+                            fail_tasks, heartbeat, run_in_transaction, run_worker,
+                            CLAIM_QUERY, ENQUEUE_QUERY)
+
+
+@pytest.fixture()
+def mock_curs():
+    return MagicMock()
+
+
+def test_enqueue_tasks(mock_curs):
+    """Test a task is added per subscribed keyword that is due, ignoring ones already queued."""
+    mock_curs.fetchone.return_value = {'added': 3}
+    assert enqueue_tasks(mock_curs, datetime(2024, 12, 10, 8)) == 3
+    assert mock_curs.execute.call_args.args == (
+        ENQUEUE_QUERY, {'run_hour': datetime(2024, 12, 10, 8)})
+    assert 'enqueue_keyword_refresh_tasks(' in ENQUEUE_QUERY
+
+
+def test_enqueue_tasks_defaults_to_current_hour(mock_curs):
+    """Test tasks are queued for the database's current hour when no hour is given."""
+    mock_curs.fetchone.side_effect = [{'run_hour': datetime(2024, 12, 10, 9)}, {'added': 0}]
+    enqueue_tasks(mock_curs)
+    assert mock_curs.execute.call_args.args[1] == {'run_hour': datetime(2024, 12, 10, 9)}
+
+
+def test_claim_tasks_skips_locked_rows(mock_curs):
+    """Test claiming expires exhausted leases, then leases tasks without waiting on other workers."""
+    mock_curs.fetchall.return_value = [{'refresh_task_id': 1, 'keyword': 'python'}]
+
+    assert claim_tasks(mock_curs, 'worker-1', 5, 60, 3) == [
+        {'refresh_task_id': 1, 'keyword': 'python'}]
+    assert mock_curs.execute.call_args_list[0].args[1] == (3,)
+    assert mock_curs.execute.call_args.args == (CLAIM_QUERY, {
+        'worker_id': 'worker-1', 'lease_seconds': 60, 'max_attempts': 3, 'claim_size': 5})
+    assert 'FOR UPDATE SKIP LOCKED' in CLAIM_QUERY
+    assert "lease_expires_at < NOW()" in CLAIM_QUERY
+
+
+def test_complete_tasks_moves_the_schedule_on(mock_curs):
+    """Test completing tasks advances their keywords' next refresh and counts the tasks."""
+    mock_curs.fetchone.return_value = {'completed': 2}
+    assert complete_tasks(mock_curs, [1, 2], 'worker-1') == 2
+    query = mock_curs.execute.call_args.args[0]
+    assert 'next_refresh_at = done.run_hour + make_interval' in query
+
+
+def test_lease_updates_only_touch_tasks_the_worker_holds(mock_curs):
+    """Test heartbeats, completions and failures are scoped to the worker's running tasks."""
+    for func, args in [(extend_leases, ([1, 2], 'worker-1', 60)),
+                       (complete_tasks, ([1, 2], 'worker-1')),
+                       (fail_tasks, ([1, 2], 'worker-1', 'boom', 3))]:
+        func(mock_curs, *args)
+        query = mock_curs.execute.call_args.args[0]
+        assert "worker_id = %s AND status = 'running'" in query
+
+
+def test_run_in_transaction_rolls_back():
+    """Test a failing queue operation is rolled back and the error raised."""
+    mock_conn = MagicMock()
+    with patch('refresh_worker.borrow_connection') as mock_borrow:
+        mock_borrow.return_value.__enter__.return_value = mock_conn
+        with pytest.raises(ValueError):
+            run_in_transaction(MagicMock(side_effect=ValueError('bad')))
+
+    mock_conn.commit.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+
+
+@patch('refresh_worker.run_in_transaction')
+def test_heartbeat_extends_leases_until_stopped(mock_run):
+    """Test the heartbeat thread keeps extending leases while the block runs."""
+    beaten = threading.Event()
+    mock_run.side_effect = lambda *args: beaten.set() or 2
+
+    with heartbeat([1, 2], 'worker-1', 0.03):
+        assert beaten.wait(2)
+
+    calls = mock_run.call_count
+    assert mock_run.call_args.args == (extend_leases, [1, 2], 'worker-1', 0.03)
+    threading.Event().wait(0.1)
+    assert mock_run.call_count == calls
+
+
+@patch('refresh_worker.heartbeat')
+@patch('refresh_worker.run_in_transaction')
+def test_run_worker_refreshes_claimed_batches(mock_run, mock_heartbeat):
+    """Test a worker refreshes each claimed batch and stops when the queue is empty."""
+    claims = [[{'refresh_task_id': 1, 'keyword': 'python'},
+               {'refresh_task_id': 2, 'keyword': 'java'}], []]
+
+    def run(func, *args):
+        return claims.pop(0) if func is claim_tasks else 2
+    mock_run.side_effect = run
+    refresh = MagicMock()
+
+    assert run_worker(refresh, worker_id='worker-1') == {'done': 2, 'failed': 0}
+    refresh.assert_called_once_with(['python', 'java'])
+    assert any(c.args[0] is complete_tasks for c in mock_run.call_args_list)
+
+
+@patch('refresh_worker.heartbeat')
+@patch('refresh_worker.run_in_transaction')
+def test_run_worker_returns_failed_tasks(mock_run, mock_heartbeat):
+    """Test a failed refresh hands its tasks back to the queue with the error."""
+    claims = [[{'refresh_task_id': 1, 'keyword': 'python'}], []]
+    mock_run.side_effect = lambda func, *args: claims.pop(0) if func is claim_tasks else 1
+
+    with patch.dict(os.environ, {'REFRESH_MAX_ATTEMPTS': '5'}):
+        counts = run_worker(MagicMock(side_effect=ValueError('no files')),
+                            worker_id='worker-1')
+
+    assert counts == {'done': 0, 'failed': 1}
+    assert mock_run.call_args_list[1].args == (fail_tasks, [1], 'worker-1', 'no files', 5)
+
+
+local_postgres = pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database loaded from schema.sql')
+
+
+@pytest.fixture()
+def local_db():
+    """Empties the queue and subscription tables of the local database and subscribes a user to twenty keywords."""
+    db.close_pool()
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""TRUNCATE keyword_refresh_tasks, keyword_refresh_schedule, subscription, related_term_assignment,
+                           keyword_recordings, keywords, "user" RESTART IDENTITY CASCADE""")
+            cursor.execute("""INSERT INTO "user" (first_name, last_name, email)
+                           VALUES ('Ada', 'Lovelace', 'ada@example.com')""")
+            cursor.execute("""INSERT INTO keywords (keyword)
+                           SELECT 'keyword ' || i FROM generate_series(1, 20) AS i""")
+            cursor.execute("""INSERT INTO subscription (user_id, keywords_id, subscription_status)
+                           SELECT 1, keywords_id, TRUE FROM keywords""")
+        conn.commit()
+    yield
+    db.close_pool()
+
+
+@local_postgres
+def test_workers_split_the_run_against_postgres(local_db):
+    """Test concurrent workers refresh every subscribed keyword exactly once."""
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 8)) == 20
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 8)) == 0
+
+    refreshed = []
+    lock = threading.Lock()
+
+    def refresh(keywords):
+        with lock:
+            refreshed.extend(keywords)
+
+    workers = [threading.Thread(target=run_worker, args=(refresh, f'worker-{i}', 3))
+               for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sorted(refreshed) == sorted(f'keyword {i}' for i in range(1, 21))
+    progress = run_in_transaction(lambda cursor: cursor.execute(
+        "SELECT * FROM keyword_refresh_progress") or cursor.fetchall())
+    assert [(row['tasks'], row['done'], row['pending']) for row in progress] == [(20, 20, 0)]
+
+
+@local_postgres
+def test_expired_lease_is_reclaimed_against_postgres(local_db):
+    """Test a task whose worker stopped heartbeating is picked up by another worker."""
+    run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 8))
+    stalled = run_in_transaction(claim_tasks, 'stalled', 1, 0, 3)
+    ids = [task['refresh_task_id'] for task in stalled]
+
+    claimed = run_in_transaction(claim_tasks, 'healthy', 20, 60, 3)
+    assert ids[0] in [task['refresh_task_id'] for task in claimed]
+    assert run_in_transaction(complete_tasks, ids, 'stalled') == 0
+    assert run_in_transaction(complete_tasks, ids, 'healthy') == 1
+
+
+@local_postgres
+def test_only_due_keywords_are_queued_against_postgres(local_db):
+    """Test keywords with a refresh interval are only queued when they are due."""
+    run_in_transaction(lambda cursor: cursor.execute(
+        """INSERT INTO keyword_refresh_schedule (keywords_id, refresh_interval_hours,
+           mentions_per_hour, volatility, notifications_enabled, next_refresh_at)
+           SELECT keywords_id, 6, 0, 0, FALSE, '2024-12-10 08:00' FROM keywords
+           WHERE keywords_id <= 5"""))
+
+    def refresh_all():
+        ids = [task['refresh_task_id']
+               for task in run_in_transaction(claim_tasks, 'worker-1', 20, 60, 3)]
+        return run_in_transaction(complete_tasks, ids, 'worker-1')
+
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 7)) == 15
+    assert refresh_all() == 15
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 8)) == 20
+    assert refresh_all() == 20
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 9)) == 15
+    assert refresh_all() == 15
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 14)) == 20
+
+
+@local_postgres
+def test_failed_refresh_is_queued_again_against_postgres(local_db):
+    """Test a keyword's schedule only moves on once its refresh completes."""
+    run_in_transaction(lambda cursor: cursor.execute(
+        """INSERT INTO keyword_refresh_schedule (keywords_id, refresh_interval_hours,
+           mentions_per_hour, volatility, notifications_enabled, next_refresh_at)
+           SELECT keywords_id, 6, 0, 0, FALSE, '2024-12-10 08:00' FROM keywords"""))
+
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 8)) == 20
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 9)) == 0
+    ids = [task['refresh_task_id']
+           for task in run_in_transaction(claim_tasks, 'worker-1', 20, 60, 1)]
+    run_in_transaction(fail_tasks, ids[:5], 'worker-1', 'boom', 1)
+    assert run_in_transaction(complete_tasks, ids[5:], 'worker-1') == 15
+
+    assert run_in_transaction(enqueue_tasks, datetime(2024, 12, 10, 9)) == 5
+    schedule = run_in_transaction(lambda cursor: cursor.execute(
+        "SELECT DISTINCT next_refresh_at FROM keyword_refresh_schedule WHERE last_refreshed_at IS NOT NULL")
+        or cursor.fetchall())
+    assert schedule == [{'next_refresh_at': datetime(2024, 12, 10, 14)}]
@@ -0,0 +1,152 @@
+"""Test script for run_history python file."""
+# pylint: skip-file
+
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+import pandas as pd
+import pytest
+import etl
+from metrics import inc, timer, track_run
+from run_history import run_row, record_run, flag_deviations, main, RECORD_QUERY
+
+
+def make_runs(costs):
+    """Successful runs that each loaded 100 rows at the given seconds per row."""
+    return [{'pipeline_run_id': i, 'started_at': datetime(2024, 12, 10) + timedelta(hours=i),
+             'keyword_count': 3, 'hours_processed': 168, 'rows_loaded': 100,
+             'duration_seconds': cost * 100, 'code_version': 'abc123'}
+            for i, cost in enumerate(costs)]
+
+
+def test_run_row_from_tracked_run():
+    """Test a tracked run's stage durations and counters become a pipeline_runs row."""
+    with track_run() as run:
+        with timer('extract'):
+            inc('etl_s3_bytes_total', 2048)
+        inc('etl_rows_loaded_total', 30, table='keyword_recordings')
+        inc('etl_rows_loaded_total', 4, table='related_terms')
+        run['hours_processed'] = 10
+
+    with patch.dict(os.environ, {'CODE_VERSION': 'abc123'}):
+        row = run_row(['python', 'java'], run, datetime(2024, 12, 10, 8),
+                      datetime(2024, 12, 10, 8, 0, 12), 'succeeded')
+
+    assert row['keyword_count'] == 2
+    assert row['topics'] == ['python', 'java']
+    assert row['hours_processed'] == 10
+    assert row['rows_loaded'] == 30
+    assert row['bytes_read'] == 2048
+    assert row['duration_seconds'] == 12
+    assert list(json.loads(row['stage_seconds'])) == ['extract']
+    assert row['code_version'] == 'abc123'
+
+
+def test_run_counters_are_kept_per_run():
+    """Test counters recorded outside a tracked run are not added to it."""
+    inc('etl_s3_bytes_total', 10)
+    with track_run() as run:
+        inc('etl_s3_bytes_total', 5)
+
+    assert run_row([], run, datetime(2024, 1, 1), datetime(2024, 1, 1), 'failed')['bytes_read'] == 5
+
+
+@patch('run_history.borrow_connection')
+def test_record_run(mock_borrow):
+    """Test a run is inserted and committed."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+
+    record_run({'status': 'succeeded'})
+    mock_conn.cursor.return_value.__enter__.return_value.execute.assert_called_once_with(
+        RECORD_QUERY, {'status': 'succeeded'})
+    mock_conn.commit.assert_called_once()
+
+
+@patch('run_history.borrow_connection', side_effect=Exception('database down'))
+def test_record_run_failure_is_logged(mock_borrow, caplog):
+    """Test failing to record a run does not raise."""
+    with caplog.at_level(logging.WARNING):
+        record_run({})
+    assert 'Could not record pipeline run: database down' in caplog.text
+
+
+def test_flag_deviations():
+    """Test runs far slower or faster per row than the trailing median are flagged."""
+    runs = make_runs([1.0, 1.1, 0.9, 1.0, 1.05, 2.0, 1.0, 0.5])
+    flagged = flag_deviations(runs, baseline_runs=5, threshold=1.5)
+
+    assert [run['pipeline_run_id'] for run in flagged] == [5, 7]
+    assert flagged[0]['ratio'] == pytest.approx(2.0 / 1.0)
+    assert flagged[0]['baseline_cost_per_row'] == 1.0
+
+
+def test_flag_deviations_needs_a_baseline():
+    """Test runs without enough earlier runs to compare against are not flagged."""
+    assert flag_deviations(make_runs([1.0, 5.0, 9.0]), baseline_runs=20, threshold=1.5) == []
+
+
+@patch('run_history.get_recent_runs')
+@patch('run_history.borrow_connection')
+def test_main_reports_only_checked_runs(mock_borrow, mock_recent, caplog):
+    """Test only the requested number of recent runs are reported."""
+    mock_recent.return_value = make_runs([1.0] * 5 + [3.0, 1.0, 1.0])
+
+    with caplog.at_level(logging.INFO):
+        assert main(runs=2, baseline_runs=5, threshold=1.5) == []
+        flagged = main(runs=3, baseline_runs=5, threshold=1.5)
+
+    assert [run['pipeline_run_id'] for run in flagged] == [5]
+    assert 'Run 5 at 2024-12-10 05:00:00 (abc123) took 3.0000s per row, 3.0x' in caplog.text
+    assert 'Checked 3 runs, 1 deviated from the baseline.' in caplog.text
+
+
+@patch('etl.record_run')
+@patch('etl.load_main')
+@patch('etl.transform_main')
+@patch('etl.extract_main')
+def test_etl_records_each_run(mock_extract, mock_transform, mock_load, mock_record):
+    """Test the ETL records succeeded and failed runs."""
+    mock_extract.return_value = pd.DataFrame(
+        {'Date and Hour': ['2024-12-10 08', '2024-12-10 09', '2024-12-10 09']})
+    etl.main(['python'])
+    row = mock_record.call_args.args[0]
+    assert row['status'] == 'succeeded'
+    assert row['hours_processed'] == 2
+    assert {'etl', 'extract', 'transform', 'load'} <= set(json.loads(row['stage_seconds']))
+
+    mock_load.side_effect = ValueError('load failed')
+    with pytest.raises(ValueError):
+        etl.main(['python'])
+    row = mock_record.call_args.args[0]
+    assert (row['status'], row['error']) == ('failed', 'load failed')
+
+
+local_postgres = pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database loaded from schema.sql')
+
+
+@local_postgres
+def test_refreshed_since_against_postgres():
+    """Test only topics of successful runs finished since the given time count as refreshed."""
+    import db
+    from run_history import refreshed_since
+    db.close_pool()
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("TRUNCATE pipeline_runs")
+        conn.commit()
+    with track_run() as run:
+        pass
+    record_run(run_row(['Python', 'rust'], run, datetime(2024, 12, 10, 8),
+                       datetime(2024, 12, 10, 9), 'succeeded'))
+    record_run(run_row(['java'], run, datetime(2024, 12, 10, 8),
+                       datetime(2024, 12, 10, 9), 'failed'))
+    record_run(run_row(['go'], run, datetime(2024, 12, 10, 6),
+                       datetime(2024, 12, 10, 7), 'succeeded'))
+
+    assert refreshed_since(['python', 'java', 'go', 'c'], datetime(2024, 12, 10, 8)) == {'python'}
+    db.close_pool()
@@ -0,0 +1,126 @@
+"""Test script for scheduler python file."""
+# pylint: skip-file
+
+import logging
+import os
+from unittest.mock import MagicMock, patch
+import pytest
+from scheduler import (get_bounds, refresh_interval, get_keyword_activity, save_schedule,
+                       compute_savings, main)
+
+
+def test_hot_keywords_refresh_every_hour():
+    """Test keywords at or above the hot mention rate refresh at the shortest interval."""
+    assert refresh_interval(30000, 50, False, 1, 24, 10) == 1
+    assert refresh_interval(10, 0, False, 1, 24, 10) == 1
+
+
+def test_quiet_keywords_refresh_less_often():
+    """Test quieter keywords refresh proportionally less often."""
+    assert refresh_interval(2, 0, False, 1, 24, 10) == 5
+    assert refresh_interval(1, 1, False, 1, 24, 10) == 5
+
+
+def test_dormant_keywords_refresh_at_the_longest_interval():
+    """Test keywords without mentions refresh at the longest interval."""
+    assert refresh_interval(0, 0, False, 1, 24, 10) == 24
+    assert refresh_interval(0.01, 0, False, 1, 24, 10) == 24
+
+
+def test_notifications_halve_the_interval():
+    """Test keywords watched for notifications refresh twice as often."""
+    assert refresh_interval(2, 0, True, 1, 24, 10) == 3
+    assert refresh_interval(0, 0, True, 1, 24, 10) == 12
+    assert refresh_interval(0.1, 0, True, 1, 24, 10) == 12
+
+
+def test_interval_respects_bounds():
+    """Test intervals stay within the configured bounds."""
+    assert refresh_interval(100, 0, True, 2, 6, 10) == 2
+    assert refresh_interval(0, 0, False, 2, 6, 10) == 6
+
+
+def test_get_bounds_from_env():
+    """Test the bounds are read from the environment and never cross."""
+    with patch.dict(os.environ, {"REFRESH_MIN_HOURS": "3", "REFRESH_MAX_HOURS": "2"}):
+        assert get_bounds() == (3, 3)
+
+
+def test_get_keyword_activity():
+    """Test activity is measured over the lookback window."""
+    mock_curs = MagicMock()
+    mock_curs.fetchall.return_value = [{'keywords_id': 1}]
+    assert get_keyword_activity(mock_curs, 48) == [{'keywords_id': 1}]
+    assert mock_curs.execute.call_args.args[1] == {'lookback_hours': 48}
+
+
+@patch('scheduler.execute_values')
+def test_save_schedule(mock_execute_values):
+    """Test the schedule is saved with one upsert and skipped when empty."""
+    mock_curs = MagicMock()
+    save_schedule(mock_curs, [])
+    mock_execute_values.assert_not_called()
+
+    save_schedule(mock_curs, [(1, 4, 2.0, 0.5, True)])
+    query = mock_execute_values.call_args.args[1]
+    assert 'ON CONFLICT (keywords_id) DO UPDATE' in query
+    assert 'rs.last_refreshed_at + make_interval' in query
+
+
+def test_compute_savings():
+    """Test the savings compare scheduled refreshes with refreshing every hour."""
+    assert compute_savings([1, 2, 24], 1) == {
+        'keywords': 3, 'baseline_refreshes_per_day': 72.0,
+        'scheduled_refreshes_per_day': 37.0, 'saved_percent': 48.6}
+    assert compute_savings([], 1)['saved_percent'] == 0.0
+
+
+@patch('scheduler.save_schedule')
+@patch('scheduler.get_keyword_activity')
+@patch('scheduler.borrow_connection')
+def test_main(mock_borrow, mock_activity, mock_save, caplog):
+    """Test main schedules every subscribed keyword and reports the savings."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+    mock_activity.return_value = [
+        {'keywords_id': 1, 'mentions_per_hour': 500, 'volatility': 20,
+         'notifications_enabled': True},
+        {'keywords_id': 2, 'mentions_per_hour': 0, 'volatility': 0,
+         'notifications_enabled': False}]
+
+    with caplog.at_level(logging.INFO):
+        savings = main()
+
+    assert mock_save.call_args.args[1] == [(1, 1, 500, 20, True), (2, 24, 0, 0, False)]
+    mock_conn.commit.assert_called_once()
+    assert savings['saved_percent'] == 47.9
+    assert '25.0 refreshes a day instead of 48.0 (47.9% saved)' in caplog.text
+
+
+@pytest.mark.skipif(
+    not os.environ.get('LOCAL_POSTGRES_TESTS'),
+    reason='Set LOCAL_POSTGRES_TESTS and point DB_* at a disposable database loaded from schema.sql')
+def test_activity_covers_only_recorded_hours_against_postgres():
+    """Test the mention rate is averaged over the hours rolled up, not the whole lookback."""
+    import db
+    db.close_pool()
+    with db.borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""TRUNCATE keyword_refresh_schedule, subscription, keyword_rollups_1h,
+                           keywords, "user" RESTART IDENTITY CASCADE""")
+            cursor.execute("""INSERT INTO "user" (first_name, last_name, email)
+                           VALUES ('Ada', 'Lovelace', 'ada@example.com')""")
+            cursor.execute("INSERT INTO keywords (keyword) VALUES ('python'), ('cobol')")
+            cursor.execute("""INSERT INTO subscription (user_id, keywords_id, subscription_status)
+                           VALUES (1, 1, FALSE), (1, 2, FALSE)""")
+            cursor.execute("""INSERT INTO keyword_rollups_1h (keywords_id, period_start,
+                           hours_recorded, total_mentions, sentiment_sum)
+                           SELECT 1, date_trunc('hour', NOW()) - make_interval(hours => i), 1, 12, 0
+                           FROM generate_series(1, 24) AS i""")
+            activity = {row['keywords_id']: row for row in get_keyword_activity(cursor, 168)}
+        conn.rollback()
+    db.close_pool()
+
+    assert activity[1]['mentions_per_hour'] == 12
+    assert activity[1]['volatility'] == 0
+    assert activity[2]['mentions_per_hour'] == 0
@@ -7,8 +7,8 @@ import pandas as pd
 import psycopg2
 from unittest.mock import MagicMock, patch, mock_open
 from psycopg2.extras import RealDictCursor
-from transform import (get_connection, get_cursor,
-                       ensure_keywords_in_db, keyword_matching, extract_keywords_from_csv, main)
+from transform import (get_cursor,
+                       find_keyword_ids, keyword_matching, extract_keywords_from_csv, main)
 
 
 @pytest.fixture()
@@ -24,37 +24,6 @@ def configs():
     }
 
 
-@patch('transform.psycopg2.connect')
-def test_postgres_connection_success(mock_connect, configs, caplog):
-    """Test successful connection to PostgreSQL using patch and MagicMock."""
-
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    with caplog.at_level('INFO'):
-        conn = get_connection(configs)
-
-    mock_connect.assert_called_once_with(
-        user="user", password='password', host="localhost", port=1234, database="name")
-
-    assert conn == mock_conn
-    assert 'Connection successfully established to database.' in caplog.text
-
-
-@patch('transform.psycopg2.connect')
-def test_postgres_connection_operational_error(mock_connect, configs, caplog):
-    """Test unsuccessful connection to PostgreSQL due to OperationalError"""
-
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-    mock_connect.side_effect = psycopg2.OperationalError()
-
-    with pytest.raises(psycopg2.OperationalError):
-        get_connection(configs)
-    assert 'Operational error while connecting to the database:' in caplog.text
-    for record in caplog.records:
-        assert record.levelname == 'ERROR'
-
-
 def test_get_cursor():
     """Test cursor is successfully returned from a connection."""
     mock_connection = MagicMock()
@@ -67,62 +36,17 @@ def test_get_cursor():
     assert result == mock_cursor
 
 
-@patch('transform.get_connection')
-@patch('transform.get_cursor')
-def test_successful_ensure_keywords_in_db(mock_conn, mock_curs):
-    """Test that all words given are already in db"""
-    mock_keywords = ['hello', 'goodbye']
-
-    mock_conn.cursor.return_value = mock_curs
-    mock_curs.fetchall.return_value = [
-        {'keyword': 'hello', 'keywords_id': 1},
-        {'keyword': 'goodbye', 'keywords_id': 2},
-        {'keyword': 'flower', 'keywords_id': 3}
-    ]
-    ensure_keywords_in_db(mock_keywords, mock_curs, mock_conn)
-    mock_curs.execute.call_count == 2
-    mock_conn.commit.assert_not_called()
-    mock_curs.fetchon.assert_not_called()
-
-
-@patch('transform.get_connection')
-@patch('transform.get_cursor')
-def test_add_missing_words_to_db(mock_conn, mock_curs):
-    """Test that words in keywords that aren't already in db are entered in."""
-    mock_keywords = ['cactus']
+def test_find_keyword_ids():
+    """Test the ids of keywords already in the db are looked up without adding or committing anything."""
+    mock_curs = MagicMock()
+    mock_curs.fetchall.return_value = [{'keyword': 'hello', 'keywords_id': 1}]
 
-    mock_conn.cursor.return_value = mock_curs
-    mock_curs.fetchall.return_value = [
-        {'keyword': 'hello', 'keywords_id': 1},
-        {'keyword': 'goodbye', 'keywords_id': 2},
-        {'keyword': 'flower', 'keywords_id': 3}
-    ]
+    result = find_keyword_ids(['Hello', 'cactus'], mock_curs)
 
-    mock_curs.fetchone.return_value = {'keyword': 'cactus', 'keywords_id': 4}
-
-    expected_result = {'cactus': 4, 'flower': 3, 'goodbye': 2, 'hello': 1}
-    result = ensure_keywords_in_db(mock_keywords, mock_curs, mock_conn)
-    mock_curs.execute.call_count == 3
-    mock_conn.commit.assert_called_once()
-    assert result == expected_result
-
-
-@patch('transform.get_connection')
-@patch('transform.get_cursor')
-def test_no_words_in_db(mock_conn, mock_curs):
-    """Test if no words are in the db, the word will still be added in gracefully."""
-    mock_keywords = ['cactus']
-
-    mock_conn.cursor.return_value = mock_curs
-    mock_curs.fetchall.return_value = []
-
-    mock_curs.fetchone.return_value = {'keyword': 'cactus', 'keywords_id': 1}
-
-    expected_result = {'cactus': 1}
-    result = ensure_keywords_in_db(mock_keywords, mock_curs, mock_conn)
-    mock_curs.execute.call_count == 3
-    mock_conn.commit.assert_called_once()
-    assert result == expected_result
+    assert result == {'hello': 1}
+    assert mock_curs.execute.call_args.args[1] == (['hello', 'cactus'],)
+    assert 'INSERT' not in mock_curs.execute.call_args.args[0]
+    mock_curs.connection.commit.assert_not_called()
 
 
 def test_keyword_matching_successful():
@@ -138,6 +62,23 @@ def test_keyword_matching_successful():
     pd.testing.assert_frame_equal(result, expected_df)
 
 
+def test_keyword_matching_whole_keywords():
+    """Test rows are only matched to their own keyword when keywords overlap."""
+    mock_df = pd.DataFrame({'Keyword': ['python', 'python programming']})
+    mock_keyword_map = {'python programming': 2, 'python': 1}
+
+    result = keyword_matching(mock_df, mock_keyword_map)
+    assert list(result['keyword_id']) == [1, 2]
+
+
+def test_keyword_matching_new_keyword():
+    """Test rows of a keyword not in the db yet are left for the load step to match."""
+    mock_df = pd.DataFrame({'Keyword': ['python', 'cactus']})
+
+    result = keyword_matching(mock_df, {'python': 1})
+    assert list(result['keyword_id']) == [1, None]
+
+
 def fake_data():
     """Fake csv data for testing."""
     return "Keyword,keyword_id\nhello,1\ngoodbye,2\nflower,3\ncactus,4\n"
@@ -174,9 +115,9 @@ def test_extract_keywords_exception(mock_open, mock_isfile, caplog):
     assert 'An error occurred while reading the file ' in caplog.text
 
 
-@patch('transform.get_connection')
+@patch('transform.borrow_connection')
 @patch('transform.get_cursor')
-@patch('transform.ensure_keywords_in_db')
+@patch('transform.find_keyword_ids')
 @patch('transform.keyword_matching')
 def test_main_success(mock_keyword_match, mock_ensure, mock_get_curs, mock_get_conn, configs, caplog):
     """Test that the main function functions well and returns expected dataframe."""
@@ -186,7 +127,7 @@ def test_main_success(mock_keyword_match, mock_ensure, mock_get_curs, mock_get_c
     })
 
     mock_conn = MagicMock()
-    mock_get_conn.return_value = mock_conn
+    mock_get_conn.return_value.__enter__.return_value = mock_conn
     mock_curs = MagicMock(spec=RealDictCursor)
     mock_get_curs.return_value = mock_curs
     mock_conn.cursor.return_value = mock_curs
@@ -209,6 +150,6 @@ def test_main_success(mock_keyword_match, mock_ensure, mock_get_curs, mock_get_c
     mock_get_conn.assert_called_once()
     mock_get_curs.assert_called_once()
     mock_ensure.assert_called_once_with(
-        ['cactus', 'flower', 'goodbye', 'hello'], mock_curs, mock_conn)
+        ['cactus', 'flower', 'goodbye', 'hello'], mock_curs)
     mock_keyword_match.assert_called_once_with(
         mock_df, {'cactus': 4, 'flower': 3, 'goodbye': 2, 'hello': 1})
@@ -0,0 +1,73 @@
+"""Test script for widen_recordings python file."""
+# pylint: skip-file
+
+import logging
+import os
+import re
+from unittest.mock import MagicMock, patch
+import pytest
+from widen_recordings import (is_widened, widen_recordings, main, AVERAGE_COLUMN,
+                              WIDEN_STATEMENTS)
+
+
+def normalise(sql: str) -> str:
+    """Collapses whitespace so SQL can be compared regardless of layout."""
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def test_average_column_matches_schema():
+    """Test the migration derives avg_sentiment the same way as schema.sql."""
+    with open(os.path.join(os.path.dirname(__file__), 'schema.sql')) as file:
+        schema = normalise(file.read())
+
+    assert normalise(AVERAGE_COLUMN) in schema
+    assert 'total_mentions BIGINT' in schema
+
+
+def test_is_widened():
+    """Test a table that already stores sentiment sums is detected."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'?column?': 1}
+    assert is_widened(mock_curs)
+    mock_curs.fetchone.return_value = None
+    assert not is_widened(mock_curs)
+
+
+def test_widen_recordings_backfills_sums_before_dropping_average():
+    """Test existing hours get their sentiment sum before avg_sentiment is replaced."""
+    mock_curs = MagicMock()
+
+    widen_recordings(mock_curs)
+
+    executed = [normalise(c.args[0]) for c in mock_curs.execute.call_args_list]
+    assert executed == [normalise(statement) for statement in WIDEN_STATEMENTS]
+    assert 'TYPE BIGINT' in executed[0]
+    assert 'sentiment_sum = avg_sentiment * total_mentions' in executed[1]
+    assert 'DROP COLUMN avg_sentiment' in executed[2]
+
+
+@patch('widen_recordings.borrow_connection')
+@patch('widen_recordings.is_widened', return_value=True)
+@patch('widen_recordings.widen_recordings')
+def test_main_skips_widened_table(mock_widen, mock_widened, mock_borrow, caplog):
+    """Test nothing changes when the table already stores sentiment sums."""
+    with caplog.at_level(logging.INFO):
+        main()
+
+    mock_widen.assert_not_called()
+    assert 'keyword_recordings already stores sentiment sums.' in caplog.text
+
+
+@patch('widen_recordings.borrow_connection')
+@patch('widen_recordings.is_widened', return_value=False)
+@patch('widen_recordings.widen_recordings', side_effect=Exception('alter failed'))
+def test_main_rolls_back_on_failure(mock_widen, mock_widened, mock_borrow):
+    """Test a failed migration leaves the table as it was."""
+    mock_conn = MagicMock()
+    mock_borrow.return_value.__enter__.return_value = mock_conn
+
+    with pytest.raises(Exception):
+        main()
+
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
@@ -9,7 +9,8 @@ import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import cursor as curs, connection as conn
 from dotenv import load_dotenv
-from os import environ as ENV
+from db import borrow_connection
+from metrics import inc
 
 
 logging.basicConfig(
@@ -21,61 +22,28 @@ logging.basicConfig(
 )
 
 
-def get_connection() -> conn:
-    """Importing the data into the database"""
-    try:
-        con = psycopg2.connect(
-            user=ENV["DB_USERNAME"],
-            password=ENV["DB_PASSWORD"],
-            host=ENV["DB_HOST"],
-            port=ENV["DB_PORT"],
-            database=ENV["DB_NAME"]
-        )
-    except psycopg2.OperationalError as e:
-        logging.error(
-            "Operational error while connecting to the database: %s", e)
-        raise
-    logging.info("Connection successfully established to database.")
-    return con
-
-
 def get_cursor(connection: conn) -> curs:
     """Returns the a psycopg2 cursor"""
     return connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
 
-def ensure_keywords_in_db(keywords: list, cursor: curs, connection: conn) -> dict:
-    """Ensure all keywords are present in the database. Add missing keywords."""
-    cursor.execute("SET search_path TO trendgineers;")
-    cursor.execute("SELECT keyword, keywords_id FROM keywords")
-    rows = cursor.fetchall()
-    # Convert rows into a dictionary
-    keyword_map = {row['keyword']: row['keywords_id'] for row in rows}
-
-    for keyword in keywords:
-        keyword_lower = keyword.lower()  # Normalize for case-insensitivity
-        if keyword_lower not in keyword_map:
-            cursor.execute(
-                "INSERT INTO keywords (keyword) VALUES (%s) RETURNING keywords_id",
-                (keyword_lower,)
-            )
-            connection.commit()
-            new_keyword_id = cursor.fetchone()['keywords_id']
-            keyword_map[keyword_lower] = new_keyword_id
-
-    return keyword_map
+def find_keyword_ids(keywords: list, cursor: curs) -> dict:
+    """Returns the ids of the keywords already in the database. Missing keywords are
+    added by the load step, inside its transaction, so a failed load leaves none behind."""
+    cursor.execute("SELECT keyword, keywords_id FROM keywords WHERE keyword = ANY(%s)",
+                   ([keyword.lower() for keyword in keywords],))
+    return {row['keyword']: row['keywords_id'] for row in cursor.fetchall()}
 
 
 def keyword_matching(cleaned_bluesky_data: pd.DataFrame, keyword_map: dict) -> pd.DataFrame:
-    """Assign keyword_id to rows in the DataFrame based on matching keywords in content."""
-
-    cleaned_bluesky_data['keyword_id'] = None
+    """Assign keyword_id to rows in the DataFrame based on their keyword."""
 
-    # Loop through the keywords and assign keyword_id to matching rows
-    for keyword, keyword_id in keyword_map.items():
-        mask = cleaned_bluesky_data['Keyword'].str.contains(
-            rf'\b{keyword}\b', case=False, na=False)
-        cleaned_bluesky_data.loc[mask, 'keyword_id'] = keyword_id
+    # Match whole keywords so "python" rows are not claimed by "python programming"
+    # when both are collected in the same batch
+    keyword_ids = {keyword.lower(): keyword_id for keyword, keyword_id in keyword_map.items()}
+    cleaned_bluesky_data['keyword_id'] = pd.Series(
+        [keyword_ids.get(keyword) for keyword in cleaned_bluesky_data['Keyword'].str.lower()],
+        index=cleaned_bluesky_data.index, dtype=object)
 
     return cleaned_bluesky_data
 
@@ -97,21 +65,28 @@ def extract_keywords_from_csv(csv_file) -> pd.Series:
         raise
 
 
-def main(dataframe: pd.DataFrame) -> pd.DataFrame:
-    """Main function to run transform.py"""
-    load_dotenv()
-
+def get_keyword_map(keywords: list) -> dict:
+    """Returns the id of each keyword already in the database"""
     logging.info("Connecting to the trends RDS")
-    connection = get_connection()
-    cursor = get_cursor(connection)
-    keywords_from_dataframe = list(dataframe['Keyword'])
+    with borrow_connection() as connection:
+        cursor = get_cursor(connection)
+        return find_keyword_ids(keywords, cursor)
 
-    keyword_map = ensure_keywords_in_db(
-        keywords_from_dataframe, cursor, connection)
-    matched_dataframe = keyword_matching(dataframe, keyword_map)
 
+def transform_batch(dataframe: pd.DataFrame, keyword_map: dict) -> pd.DataFrame:
+    """Matches a batch of extracted rows with their keyword ids"""
+    matched_dataframe = keyword_matching(dataframe, keyword_map)
+    inc("etl_rows_total", len(matched_dataframe), stage="transform")
     return matched_dataframe
 
 
+def main(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Main function to run transform.py"""
+    load_dotenv()
+
+    keyword_map = get_keyword_map(list(dataframe['Keyword'].unique()))
+    return transform_batch(dataframe, keyword_map)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
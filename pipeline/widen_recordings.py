@@ -0,0 +1,67 @@
+"""One-off migration that widens total_mentions and stores the sentiment sum and sum of
+squares of keyword_recordings, deriving avg_sentiment from them"""
+
+import logging
+from psycopg2.extensions import cursor as curs
+from dotenv import load_dotenv
+from db import borrow_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
+# This matches schema.sql, which creates the column for new databases
+AVERAGE_COLUMN = """avg_sentiment FLOAT GENERATED ALWAYS AS (
+        CASE WHEN total_mentions > 0 THEN sentiment_sum / total_mentions ELSE 0 END) STORED"""
+
+WIDEN_STATEMENTS = (
+    """ALTER TABLE keyword_recordings
+       ALTER COLUMN total_mentions TYPE BIGINT,
+       ADD COLUMN sentiment_sum FLOAT,
+       ADD COLUMN sentiment_sum_squares FLOAT""",
+    # The sum of squares of past hours cannot be recovered from their mean, so stays NULL
+    "UPDATE keyword_recordings SET sentiment_sum = avg_sentiment * total_mentions",
+    f"""ALTER TABLE keyword_recordings
+        DROP COLUMN avg_sentiment,
+        ADD COLUMN {AVERAGE_COLUMN}"""
+)
+
+
+def is_widened(cursor: curs, table: str = "keyword_recordings") -> bool:
+    """Returns whether a recordings table already stores its sentiment sum"""
+    cursor.execute("""SELECT 1 FROM pg_attribute
+                   WHERE attrelid = %s::regclass AND attname = 'sentiment_sum'
+                   AND NOT attisdropped""", (table,))
+    return cursor.fetchone() is not None
+
+
+def widen_recordings(cursor: curs) -> None:
+    """Widens keyword_recordings and fills in the sentiment sum of existing hours"""
+    for statement in WIDEN_STATEMENTS:
+        cursor.execute(statement)
+
+
+def main() -> None:
+    """Widens keyword_recordings in a single transaction"""
+    load_dotenv()
+    with borrow_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if is_widened(cursor):
+                logging.info("keyword_recordings already stores sentiment sums.")
+                return
+
+            widen_recordings(cursor)
+            conn.commit()
+            logging.info("keyword_recordings now stores sentiment sums.")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Benchmarks streaming a large synthetic export of expired recordings into the archive,
+against a local S3 stand-in, to check memory stays flat however big the export is"""
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet
+from dotenv import load_dotenv
+from etl_lambda import ArchiveStream, DEFAULT_KEYWORD_BUCKETS, DEFAULT_PART_SIZE, \
+    DEFAULT_BATCH_SIZE
+from local_s3 import LocalS3
+
+BENCHMARK_BUCKET = "benchmark"
+BENCHMARK_FOLDER = "long_term_keyword_data"
+DEFAULT_GIB = 2.0
+DEFAULT_DAYS = 7
+# Roughly the length of a CSV row copied out of keyword_recordings
+ROW_BYTES = 52
+BLOCK_KEYWORDS = 1000
+# Bytes handed to the stream per write, as COPY hands over a few rows at a time
+COPY_CHUNK = 8192
+
+
+def peak_rss_mib() -> float:
+    """Returns the peak resident memory of this process in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def synthetic_export(target_bytes: int, days: int, keyword_buckets: int):
+    """Yields blocks of CSV rows of about target_bytes in total, sorted in the order
+    copy_next_chunk copies them out of the database, with the number of rows
+    in each block"""
+    keywords = max(1, math.ceil(target_bytes / (ROW_BYTES * days * 24)))
+    recording_id = 0
+    for day in range(days):
+        hours = np.datetime64("2024-12-01T00", "h") + day * 24 + np.arange(24)
+        for keyword_bucket in range(keyword_buckets):
+            bucket_keywords = np.arange(keyword_bucket or keyword_buckets, keywords + 1,
+                                        keyword_buckets)
+            for block in np.array_split(bucket_keywords,
+                                        max(1, len(bucket_keywords) // BLOCK_KEYWORDS)):
+                rows = len(block) * 24
+                ids = recording_id + 1 + np.arange(rows)
+                mentions = ids * 7919 % 500
+                recording_id += rows
+                table = pa.table({
+                    "keyword_recordings_id": ids,
+                    "keywords_id": np.repeat(block, 24),
+                    "total_mentions": mentions,
+                    "sentiment_sum": mentions * 0.25,
+                    "sentiment_sum_squares": mentions * 0.125,
+                    "avg_sentiment": np.where(mentions > 0, 0.25, 0),
+                    "date_and_hour": pa.array(np.tile(hours, len(block)).astype("datetime64[s]"))
+                })
+                buffer = io.BytesIO()
+                pyarrow.csv.write_csv(table, buffer,
+                                      pyarrow.csv.WriteOptions(include_header=False))
+                yield buffer.getvalue(), rows
+
+
+def run_benchmark(root: str, target_bytes: int, days: int = DEFAULT_DAYS,
+                  keyword_buckets: int = DEFAULT_KEYWORD_BUCKETS,
+                  part_size: int = DEFAULT_PART_SIZE,
+                  batch_size: int = DEFAULT_BATCH_SIZE,
+                  s3: LocalS3 = None) -> dict:
+    """Streams a synthetic export into archive files in the local S3 root and returns the
+    throughput, memory and size of the run"""
+    s3 = s3 or LocalS3(root)
+    stream = ArchiveStream(s3, BENCHMARK_BUCKET, BENCHMARK_FOLDER, "benchmark",
+                           keyword_buckets, part_size, batch_size)
+    baseline_rss = peak_rss_mib()
+    export_bytes = rows = 0
+
+    started = time.perf_counter()
+    for block, block_rows in synthetic_export(target_bytes, days, keyword_buckets):
+        for start in range(0, len(block), COPY_CHUNK):
+            stream.write(block[start:start + COPY_CHUNK])
+        export_bytes += len(block)
+        rows += block_rows
+    entries = stream.close()
+    wall_seconds = time.perf_counter() - started
+
+    archived_rows = 0
+    for entry in entries:
+        with s3.get_object(Bucket=BENCHMARK_BUCKET, Key=entry["key"])["Body"] as body:
+            archived_rows += pyarrow.parquet.ParquetFile(body).metadata.num_rows
+    return {
+        "rows": rows,
+        "archived_rows": archived_rows,
+        "export_mib": round(export_bytes / 2 ** 20, 1),
+        "archive_mib": round(sum(entry["bytes"] for entry in entries) / 2 ** 20, 1),
+        "files": len(entries),
+        "parts": sum(max(1, math.ceil(entry["bytes"] / part_size)) for entry in entries),
+        "pending_uploads": len(s3.pending_uploads()),
+        "wall_seconds": round(wall_seconds, 2),
+        "mib_per_second": round(export_bytes / 2 ** 20 / wall_seconds, 1),
+        "rows_per_second": round(rows / wall_seconds),
+        "baseline_rss_mib": round(baseline_rss, 1),
+        "peak_rss_mib": round(peak_rss_mib(), 1)
+    }
+
+
+def main(gib: float, days: int, part_size_mib: int, batch_mib: int,
+         root: str = None) -> dict:
+    """Runs the benchmark in a temporary local S3 root and logs its summary"""
+    load_dotenv()
+    with tempfile.TemporaryDirectory() as temporary_root:
+        summary = run_benchmark(root or temporary_root, int(gib * 2 ** 30), days,
+                                int(os.environ.get("ARCHIVE_KEYWORD_BUCKETS",
+                                                   DEFAULT_KEYWORD_BUCKETS)),
+                                part_size_mib * 2 ** 20, batch_mib * 2 ** 20)
+
+    logging.info("Archived %s rows (%.1f MiB of CSV) into %s files and %s parts, %.1f MiB "
+                 "of Parquet, in %.2fs (%.1f MiB/s).", summary["rows"],
+                 summary["export_mib"], summary["files"], summary["parts"],
+                 summary["archive_mib"], summary["wall_seconds"], summary["mib_per_second"])
+    logging.info("Peak RSS was %.1f MiB, from %.1f MiB before the export.",
+                 summary["peak_rss_mib"], summary["baseline_rss_mib"])
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark archiving a synthetic export against a local S3.")
+    parser.add_argument("--gib", type=float, default=DEFAULT_GIB,
+                        help="Size of the synthetic CSV export in GiB.")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS,
+                        help="Days the export is spread over.")
+    parser.add_argument("--part-size-mib", type=int, default=DEFAULT_PART_SIZE // 2 ** 20,
+                        help="Size of each multipart upload part, at least 5.")
+    parser.add_argument("--batch-mib", type=int, default=DEFAULT_BATCH_SIZE // 2 ** 20,
+                        help="MiB of CSV rows converted to Parquet at a time.")
+    parser.add_argument("--root",
+                        help="Directory to write the archive to, a temporary one by default.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    args = parser.parse_args()
+    result = main(args.gib, args.days, args.part_size_mib, args.batch_mib, args.root)
+    if args.json:
+        print(json.dumps(result, indent=2))
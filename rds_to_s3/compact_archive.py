@@ -0,0 +1,225 @@
+"""This script merges the small files of the archive in the S3 bucket into larger ones"""
+
+import logging
+import time
+from os import environ as ENV
+from datetime import datetime, timezone, timedelta
+from typing import Callable
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.parquet
+import psycopg2
+import boto3
+from dotenv import load_dotenv
+from etl_lambda import (ARCHIVE_FOLDER, ARCHIVE_SCHEMA, PARTITION_LOCK_QUERY, MultipartUpload,
+                        archive_key, delete_objects, download_manifest, upload_manifest,
+                        get_time_margin, setup_connection, s3_connection)
+
+# Archive files are merged until they are about this size
+DEFAULT_TARGET_MIB = 64
+# Superseded files are kept this long after the manifest stops listing them, so readers
+# that downloaded the manifest before then can still read them
+DEFAULT_GRACE_MINUTES = 60
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.StreamHandler()
+    ]
+)
+
+
+def get_target_bytes() -> int:
+    """Returns the size archive files are merged up to"""
+    return int(float(ENV.get("ARCHIVE_COMPACTION_TARGET_MIB", DEFAULT_TARGET_MIB)) * 2 ** 20)
+
+
+def get_grace_period() -> timedelta:
+    """Returns how long superseded files are kept before they are removed"""
+    return timedelta(minutes=float(ENV.get("ARCHIVE_COMPACTION_GRACE_MINUTES",
+                                           DEFAULT_GRACE_MINUTES)))
+
+
+def plan_compaction(manifest: dict, target_bytes: int) -> list[list[dict]]:
+    """Returns the groups of small Parquet files to merge, each holding files of one day
+    and keyword bucket, in manifest order, up to the target size in total. Groups of a
+    single file are left alone, as merging them would change nothing."""
+    partitions = {}
+    for entry in manifest["files"]:
+        if entry.get("format") == "parquet" and entry["bytes"] < target_bytes:
+            partitions.setdefault((entry["date"], entry["keyword_bucket"]), []).append(entry)
+
+    groups = []
+    for entries in partitions.values():
+        group, group_bytes = [], 0
+        for entry in entries:
+            if group and group_bytes + entry["bytes"] > target_bytes:
+                groups.append(group)
+                group, group_bytes = [], 0
+            group.append(entry)
+            group_bytes += entry["bytes"]
+        groups.append(group)
+    return [group for group in groups if len(group) > 1]
+
+
+def read_group(s3: boto3.client, bucket_name: str, group: list[dict]) -> pa.Table:
+    """Reads the files of a group into one table, sorted by keyword and time, keeping
+    the row of the newest file for a keyword and hour archived twice"""
+    table = pa.concat_tables([
+        pyarrow.parquet.read_table(
+            pa.BufferReader(s3.get_object(Bucket=bucket_name,
+                                          Key=entry["key"])["Body"].read())).cast(ARCHIVE_SCHEMA)
+        for entry in group])
+    keyword_hours = np.stack([table["keywords_id"].fill_null(-1).to_numpy(),
+                              table["date_and_hour"].cast(pa.int64()).to_numpy()], axis=1)
+    _, last_from_end = np.unique(keyword_hours[::-1], axis=0, return_index=True)
+    table = table.take(np.sort(len(keyword_hours) - 1 - last_from_end))
+    return table.sort_by([("keywords_id", "ascending"), ("date_and_hour", "ascending")])
+
+
+def merge_group(s3: boto3.client, bucket_name: str, folder_name: str, group: list[dict],
+                run_id: str) -> dict:
+    """Writes the files of a group into a new archive file, which readers do not see
+    until the manifest lists it. Returns its manifest entry."""
+    table = read_group(s3, bucket_name, group)
+    date, keyword_bucket = group[0]["date"], group[0]["keyword_bucket"]
+    upload = MultipartUpload(s3, bucket_name,
+                             archive_key(folder_name, date, keyword_bucket, run_id))
+    try:
+        with pyarrow.parquet.ParquetWriter(upload, ARCHIVE_SCHEMA, compression="zstd") as writer:
+            writer.write_table(table)
+        upload.complete()
+    except Exception:
+        upload.abort()
+        raise
+
+    hours = pyarrow.compute.min_max(table["date_and_hour"])
+    return {"key": upload.key, "format": "parquet", "date": date,
+            "keyword_bucket": keyword_bucket, "rows": table.num_rows, "bytes": upload.size,
+            "min_date_and_hour": str(hours["min"].as_py()),
+            "max_date_and_hour": str(hours["max"].as_py())}
+
+
+def replace_files(manifest: dict, group: list[dict], entry: dict, now: datetime) -> bool:
+    """Lists the merged file in the manifest in place of the files of its group, where
+    the last of them was, and marks them as superseded. Returns False, leaving the
+    manifest alone, if any of them is no longer listed."""
+    keys = [file["key"] for file in group]
+    listed = {file["key"] for file in manifest["files"]}
+    if not all(key in listed for key in keys):
+        return False
+
+    manifest["files"] = [entry if file["key"] == keys[-1] else file
+                         for file in manifest["files"] if file["key"] not in keys[:-1]]
+    manifest.setdefault("superseded", []).extend(
+        {"key": key, "superseded_at": now.isoformat()} for key in keys)
+    return True
+
+
+def remove_superseded(s3: boto3.client, bucket_name: str, manifest: dict,
+                      now: datetime) -> int:
+    """Deletes the superseded files older than the grace period and drops them from the
+    manifest. Returns the number of files removed."""
+    expired_before = now - get_grace_period()
+    superseded = manifest.get("superseded", [])
+    expired = [file["key"] for file in superseded
+               if datetime.fromisoformat(file["superseded_at"]) <= expired_before]
+    if expired:
+        delete_objects(s3, bucket_name, expired)
+        manifest["superseded"] = [file for file in superseded if file["key"] not in expired]
+    return len(expired)
+
+
+def publish(conn: psycopg2.extensions.connection, cursor: psycopg2.extensions.cursor,
+            bucket_name: str, folder_name: str, change: Callable[[dict], bool]) -> bool:
+    """Applies a change to the manifest under the archive lock, so archive runs and other
+    compactions never overwrite it, and uploads it if the change returns True. The
+    upload replaces the manifest in one step, so readers see it before or after."""
+    try:
+        cursor.execute(PARTITION_LOCK_QUERY)
+        manifest = download_manifest(bucket_name, folder_name)
+        changed = change(manifest)
+        if changed:
+            upload_manifest(bucket_name, folder_name, manifest)
+        conn.commit()
+        return changed
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def compact_archive(bucket_name: str, folder_name: str, context=None) -> dict:
+    """Merges the small files of each day and keyword bucket of the archive into files of
+    about the target size, and removes files superseded more than the grace period ago.
+    Merged files are written before the manifest lists them in place of the files they
+    replace, which are only removed by a later run, so readers always find every file of
+    the manifest they read. With a lambda context, no merge is started without time for
+    it. Returns the number of files merged, written and removed and whether it finished."""
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    margin_ms = get_time_margin() * 1000
+    summary = {"merged": 0, "written": 0, "removed": 0, "complete": False}
+    s3 = s3_connection()
+
+    def remove(manifest: dict) -> bool:
+        """Removes the expired superseded files, counting them in the summary"""
+        summary["removed"] = remove_superseded(s3, bucket_name, manifest,
+                                               datetime.now(timezone.utc))
+        return summary["removed"] > 0
+
+    conn, cursor = setup_connection()
+    try:
+        publish(conn, cursor, bucket_name, folder_name, remove)
+
+        groups = plan_compaction(download_manifest(bucket_name, folder_name),
+                                 get_target_bytes())
+        longest_merge_ms = 0
+        for number, group in enumerate(groups):
+            if context is not None and (context.get_remaining_time_in_millis() - margin_ms
+                                        <= longest_merge_ms):
+                logging.info("Stopping with %s groups left, the next run merges them.",
+                             len(groups) - number)
+                break
+
+            started = time.perf_counter()
+            entry = merge_group(s3, bucket_name, folder_name, group,
+                                f"{run_id}-compacted-{number:04d}")
+            replaced = publish(conn, cursor, bucket_name, folder_name, lambda manifest: (
+                replace_files(manifest, group, entry, datetime.now(timezone.utc))))
+            if not replaced:
+                logging.warning("Files merged into %s were replaced by another run.",
+                                entry["key"])
+                delete_objects(s3, bucket_name, [entry["key"]])
+                continue
+            longest_merge_ms = max(longest_merge_ms, (time.perf_counter() - started) * 1000)
+            summary["merged"] += len(group)
+            summary["written"] += 1
+        else:
+            summary["complete"] = True
+    except Exception as e:
+        logging.error("Error while compacting the archive: %s", e)
+        raise
+    finally:
+        conn.close()
+
+    logging.info("Merged %s archive files into %s and removed %s superseded files%s.",
+                 summary["merged"], summary["written"], summary["removed"],
+                 "" if summary["complete"] else ", more are left for the next run")
+    return summary
+
+
+def lambda_handler(event, context):
+    """Compacts the archive in the S3 bucket"""
+    load_dotenv()
+    bucketname = ENV["S3_BUCKET_NAME"]
+
+    try:
+        return compact_archive(bucketname, ARCHIVE_FOLDER, context)
+    except Exception as e:
+        logging.error("Error compacting %s: %s", ARCHIVE_FOLDER, e)
+        return None
+
+
+if __name__ == "__main__":
+    lambda_handler(None, None)
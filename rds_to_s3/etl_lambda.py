@@ -1,31 +1,85 @@
 """This script updates the archive data files in the S3 bucket"""
 
-from json import load
+import io
+import json
 import os
 import logging
+import time
 from os import environ as ENV
-import pandas as pd
+from datetime import datetime, timezone
+from typing import BinaryIO
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.parquet
 import psycopg2
 import psycopg2.extras
 from psycopg2 import OperationalError, InterfaceError, DatabaseError
+from psycopg2.errors import QueryCanceled
 from dotenv import load_dotenv
 import boto3
 from botocore.exceptions import ClientError, EndpointConnectionError
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
 
 load_dotenv()
 SCHEMA_NAME = ENV['SCHEMA_NAME']
-UPDATE_QUERY = f"""
-        SELECT
-            *
-        FROM
-            {SCHEMA_NAME}.keyword_recordings kr
-        WHERE date_and_hour < NOW() - INTERVAL '24 HOURS'
-        """
-REMOVE_QUERY = f"""
-        DELETE FROM {SCHEMA_NAME}.keyword_recordings
-        WHERE date_and_hour < NOW() - INTERVAL '24 HOURS'
+ARCHIVE_FOLDER = "long_term_keyword_data"
+# The single CSV the archive used to be rewritten into. A new manifest lists it first so
+# its history stays readable.
+LEGACY_ARCHIVE_FILE = "keyword_recording.csv"
+MANIFEST_FILE = "manifest.json"
+DEFAULT_KEYWORD_BUCKETS = 8
+# S3 needs every part of a multipart upload but the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Bytes of CSV rows converted to Parquet at a time
+DEFAULT_BATCH_SIZE = 4 * 1024 * 1024
+# Time kept back from the lambda timeout to roll back a chunk and return cleanly
+DEFAULT_TIME_MARGIN_SECONDS = 30
+# S3 deletes at most this many objects per request
+DELETE_BATCH_SIZE = 1000
+ARCHIVE_COLUMNS = ("keyword_recordings_id", "keywords_id", "total_mentions", "sentiment_sum",
+                   "sentiment_sum_squares", "avg_sentiment", "date_and_hour")
+ARCHIVE_SCHEMA = pa.schema([("keyword_recordings_id", pa.int64()), ("keywords_id", pa.int64()),
+                            ("total_mentions", pa.int64()), ("sentiment_sum", pa.float64()),
+                            ("sentiment_sum_squares", pa.float64()),
+                            ("avg_sentiment", pa.float64()),
+                            ("date_and_hour", pa.timestamp("us"))])
+# Rows are copied out sorted by day and keyword bucket so each archive file is written
+# whole before the next one starts
+ARCHIVE_ORDER = "date_and_hour::DATE, keywords_id %% %(buckets)s, keywords_id, date_and_hour"
+# Taken by the load step while it creates partitions, so no load writes to keyword_recordings
+# while recordings are being archived
+PARTITION_LOCK_QUERY = """
+        SELECT pg_advisory_xact_lock(hashtext('keyword_recordings_partitions'))
+    """
+CUTOFF_QUERY = "SELECT (NOW() - INTERVAL '24 HOURS')::TIMESTAMP AS cutoff"
+# The oldest day whose partition has wholly expired, which is archived next
+EXPIRED_PARTITION_QUERY = """
+        SELECT child.relname AS partition,
+               (TO_DATE(RIGHT(child.relname, 8), 'YYYYMMDD') + 1)::TIMESTAMP AS partition_end
+        FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'keyword_recordings'::REGCLASS
+        AND child.relname ~ '^keyword_recordings_p[0-9]{8}$'
+        AND TO_DATE(RIGHT(child.relname, 8), 'YYYYMMDD') + 1 <= %(cutoff)s
+        ORDER BY child.relname
+        LIMIT 1
+    """
+COPY_PARTITION_QUERY = f"""
+        COPY (SELECT {{columns}} FROM {{partition}} ORDER BY {ARCHIVE_ORDER})
+        TO STDOUT WITH (FORMAT csv)
+    """
+DROP_PARTITIONS_QUERY = "SELECT drop_keyword_recordings_partitions(%(cutoff)s)"
+# The newest expired day shares its partition with recent hours, so its rows are deleted
+# by the statement that copies them out, which copies exactly the rows it deletes
+COPY_EXPIRED_QUERY = f"""
+        COPY (WITH expired AS (
+                  DELETE FROM keyword_recordings
+                  WHERE date_and_hour < %(cutoff)s
+                  RETURNING {{columns}})
+              SELECT {{columns}} FROM expired
+              ORDER BY {ARCHIVE_ORDER})
+        TO STDOUT WITH (FORMAT csv)
     """
 
 logging.basicConfig(
@@ -37,32 +91,6 @@ logging.basicConfig(
 )
 
 
-def setup_engine():
-    """Set up SQLAlchemy engine."""
-    try:
-        db_username = ENV['DB_USERNAME']
-        db_password = ENV['DB_PASSWORD']
-        db_host = ENV['DB_HOST']
-        db_port = ENV['DB_PORT']
-        db_name = ENV['DB_NAME']
-
-        if not all([db_username, db_password, db_host, db_port, db_name]):
-            raise EnvironmentError(
-                "One or more required environment variables are missing.")
-
-        engine = create_engine(
-            f"""postgresql+psycopg2://{db_username}:{db_password}@{
-                db_host}:{db_port}/{db_name}"""
-        )
-        return engine
-    except SQLAlchemyError as e:
-        logging.error("Failed to connect to database: %s", e)
-        raise
-    except Exception as e:
-        logging.error("An unexpected error occurred: %s", e)
-        raise
-
-
 def setup_connection() -> tuple:
     """Sets up a connection to the RDS"""
     try:
@@ -117,118 +145,416 @@ def s3_connection() -> boto3.client:
         raise
 
 
-def download_csv_from_s3(bucket_name: str, s3_file_path: str, file_name: str) -> pd.DataFrame:
-    """Downloads the files from the s3 bucket"""
-    tmp_file_name = f"/tmp/{file_name}"
+def get_time_margin() -> float:
+    """Returns the seconds kept back from the lambda timeout to finish cleanly"""
+    return float(ENV.get("ARCHIVE_TIME_MARGIN_SECONDS", DEFAULT_TIME_MARGIN_SECONDS))
+
+
+def check_time_left(context, step: str) -> None:
+    """Raises TimeoutError if the lambda has no more time left than the margin, so the
+    chunk is rolled back before a step the statement timeout does not cover"""
+    if context is None:
+        return
+    remaining_ms = context.get_remaining_time_in_millis()
+    if remaining_ms <= get_time_margin() * 1000:
+        raise TimeoutError(f"Only {remaining_ms / 1000:.0f}s left before {step}.")
+
+
+def copy_next_chunk(cursor: psycopg2.extensions.cursor, file: BinaryIO,
+                    cutoff: datetime, keyword_buckets: int) -> tuple[int, dict]:
+    """Copies the next chunk of recordings older than the cutoff out of keyword_recordings
+    into a file as CSV rows sorted by day and keyword bucket, reading each row once.
+    The next chunk is the oldest wholly expired day, copied out of its partition under a
+    SHARE lock, so it can still be read but not changed, and left for remove_chunk to
+    drop. Once there are none left, it is the rest of the expired recordings, which are
+    deleted as they are copied. Either way nothing is removed until the transaction
+    commits. Returns the number of rows copied and the partition copied, with its end,
+    or None for the last chunk."""
+    columns = ", ".join(ARCHIVE_COLUMNS)
+    params = {"cutoff": cutoff, "buckets": keyword_buckets}
+
+    cursor.execute(EXPIRED_PARTITION_QUERY, params)
+    expired = cursor.fetchone()
+    if expired is None:
+        cursor.copy_expert(cursor.mogrify(COPY_EXPIRED_QUERY.format(columns=columns),
+                                          params).decode(), file)
+        return cursor.rowcount, None
+
+    cursor.execute(f"LOCK TABLE {expired['partition']} IN SHARE MODE")
+    cursor.copy_expert(cursor.mogrify(COPY_PARTITION_QUERY.format(
+        columns=columns, partition=expired['partition']), params).decode(), file)
+    return cursor.rowcount, expired
+
+
+def remove_chunk(cursor: psycopg2.extensions.cursor, partition: dict, archived: int) -> None:
+    """Drops the partition of a chunk copied by copy_next_chunk, once it is archived,
+    after checking it holds as many rows as were archived. The last chunk's rows were
+    deleted as they were copied, so there is nothing left to remove."""
+    if partition is None:
+        return
+    cursor.execute(f"SELECT COUNT(*) AS recordings FROM {partition['partition']}")
+    recordings = cursor.fetchone()["recordings"]
+    if recordings != archived:
+        raise RuntimeError(f"{partition['partition']} holds {recordings} recordings but "
+                           f"{archived} were archived.")
+    # Older partitions have already been archived, so only this one is dropped
+    cursor.execute(DROP_PARTITIONS_QUERY, {"cutoff": partition["partition_end"]})
+
+
+def get_keyword_buckets() -> int:
+    """Returns the number of files each archived day is split into by keyword"""
+    return int(ENV.get("ARCHIVE_KEYWORD_BUCKETS", DEFAULT_KEYWORD_BUCKETS))
+
+
+def archive_key(folder_name: str, day: str, keyword_bucket: int, run_id: str) -> str:
+    """Returns the S3 key of an archive file, partitioned by day and keyword bucket"""
+    return (f"{folder_name}/recordings/date={day}/keyword_bucket={keyword_bucket:02d}/"
+            f"part-{run_id}.parquet")
+
+
+def delete_objects(s3: boto3.client, bucket_name: str, keys: list[str]) -> None:
+    """Deletes objects from S3 in batches"""
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        response = s3.delete_objects(Bucket=bucket_name, Delete={
+            "Objects": [{"Key": key} for key in keys[start:start + DELETE_BATCH_SIZE]],
+            "Quiet": True})
+        if response.get("Errors"):
+            raise RuntimeError(f"Failed to delete {len(response['Errors'])} archive files, "
+                               f"starting with {response['Errors'][0]['Key']}.")
+
+
+class MultipartUpload:
+    """Write-only file that uploads itself to S3 in parts as it is written, so no more
+    than one part is held in memory and nothing is written locally"""
+
+    def __init__(self, s3: boto3.client, bucket_name: str, key: str,
+                 part_size: int = DEFAULT_PART_SIZE):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=key)["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+        self.size = 0
+        self.closed = False
+
+    def writable(self) -> bool:
+        """Returns that the file can be written to"""
+        return True
+
+    def write(self, data: bytes) -> int:
+        """Adds data to the upload, sending each part once it is full"""
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        """Returns the number of bytes written"""
+        return self.size
+
+    def flush(self) -> None:
+        """Does nothing, as parts are only sent once they are full"""
+
+    def _upload_part(self, body: bytes) -> None:
+        """Uploads the next part"""
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.key,
+                                       UploadId=self.upload_id, PartNumber=number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    def complete(self) -> None:
+        """Uploads the last part and makes the object visible"""
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                          UploadId=self.upload_id,
+                                          MultipartUpload={"Parts": self.parts})
+        self.closed = True
+
+    def abort(self) -> None:
+        """Discards the parts uploaded so far"""
+        self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                       UploadId=self.upload_id)
+        self.closed = True
+
+
+class ArchiveStream:
+    """Write-only file that copy_next_chunk copies CSV rows into. The rows
+    arrive sorted by day and keyword bucket. Each batch is converted to a compressed
+    Parquet row group and streamed into one multipart upload per day and keyword bucket,
+    so memory stays the same however many rows are archived."""
+
+    def __init__(self, s3: boto3.client, bucket_name: str, folder_name: str, run_id: str,
+                 keyword_buckets: int, part_size: int = DEFAULT_PART_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.folder_name = folder_name
+        self.run_id = run_id
+        self.keyword_buckets = keyword_buckets
+        self.part_size = part_size
+        self.batch_size = batch_size
+        self.entries = []
+        self.completed = []
+        self.buffer = bytearray()
+        self.partition = None
+        self.upload = None
+        self.writer = None
+
+    def write(self, data: bytes) -> int:
+        """Buffers CSV rows, writing them out once a batch is full"""
+        self.buffer += data
+        if len(self.buffer) >= self.batch_size:
+            self._write_batch()
+        return len(data)
+
+    def _write_batch(self) -> None:
+        """Writes the complete rows buffered so far to the files of their partitions"""
+        end = self.buffer.rfind(b"\n") + 1
+        if not end:
+            return
+        table = pyarrow.csv.read_csv(
+            io.BytesIO(self.buffer[:end]),
+            read_options=pyarrow.csv.ReadOptions(column_names=ARCHIVE_COLUMNS),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=ARCHIVE_SCHEMA))
+        del self.buffer[:end]
+
+        days = table["date_and_hour"].to_numpy().astype("datetime64[D]")
+        keyword_buckets = table["keywords_id"].to_numpy() % self.keyword_buckets
+        changes = np.flatnonzero((days[1:] != days[:-1])
+                                 | (keyword_buckets[1:] != keyword_buckets[:-1])) + 1
+        for start, stop in zip(np.r_[0, changes], np.r_[changes, len(table)]):
+            partition = (str(days[start]), int(keyword_buckets[start]))
+            if partition != self.partition:
+                self._start_file(partition)
+            self._write_rows(table.slice(start, stop - start))
+
+    def _start_file(self, partition: tuple) -> None:
+        """Finishes the current archive file and starts the one for the next partition"""
+        if self.partition is not None and partition < self.partition:
+            raise ValueError(f"Archive rows for {partition} arrived after {self.partition}.")
+        self._finish_file()
+        day, keyword_bucket = partition
+        self.partition = partition
+        self.upload = MultipartUpload(
+            self.s3, self.bucket_name,
+            archive_key(self.folder_name, day, keyword_bucket, self.run_id), self.part_size)
+        self.writer = pyarrow.parquet.ParquetWriter(self.upload, ARCHIVE_SCHEMA,
+                                                    compression="zstd")
+        self.entries.append({"key": self.upload.key, "format": "parquet", "date": day,
+                             "keyword_bucket": keyword_bucket, "rows": 0, "bytes": 0,
+                             "min_date_and_hour": None, "max_date_and_hour": None})
+
+    def _write_rows(self, table: pa.Table) -> None:
+        """Writes rows of the current partition as a row group"""
+        self.writer.write_table(table)
+        entry = self.entries[-1]
+        hours = pyarrow.compute.min_max(table["date_and_hour"])
+        first, last = (str(hours[end].as_py()) for end in ("min", "max"))
+        entry["rows"] += table.num_rows
+        entry["min_date_and_hour"] = min(entry["min_date_and_hour"] or first, first)
+        entry["max_date_and_hour"] = max(entry["max_date_and_hour"] or last, last)
+
+    def _finish_file(self) -> None:
+        """Writes the footer of the current file and completes its upload"""
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.upload.complete()
+        self.completed.append(self.upload.key)
+        self.entries[-1]["bytes"] = self.upload.size
+        self.writer = self.upload = None
+
+    def close(self) -> list[dict]:
+        """Writes the last batch and completes the last archive file. Returns the manifest
+        entries of every file."""
+        if self.buffer and not self.buffer.endswith(b"\n"):
+            self.buffer += b"\n"
+        self._write_batch()
+        self._finish_file()
+        return self.entries
+
+    def abort(self) -> None:
+        """Discards the archive file being uploaded. Files already completed are kept in
+        completed for the caller to delete unless the manifest lists them."""
+        if self.upload is not None and not self.upload.closed:
+            self.upload.abort()
+        self.writer = self.upload = None
+
+
+def download_manifest(bucket_name: str, folder_name: str) -> dict:
+    """Downloads the manifest listing every archive file, oldest first. Without one a new
+    manifest is started, listing the legacy CSV archive if it exists."""
     s3 = s3_connection()
     try:
-        s3.download_file(bucket_name, s3_file_path, tmp_file_name)
-        logging.info("Downloaded %s from S3.", tmp_file_name)
-        return pd.read_csv(tmp_file_name)
-    except FileNotFoundError as fe:
-        logging.warning("File %s not found locally: %s", tmp_file_name, fe)
-        return pd.DataFrame()
-    except pd.errors.EmptyDataError as ede:
-        logging.warning("Downloaded file %s is empty: %s", tmp_file_name, ede)
-        return pd.DataFrame()
+        response = s3.get_object(Bucket=bucket_name, Key=f"{folder_name}/{MANIFEST_FILE}")
+        return json.loads(response["Body"].read())
     except ClientError as ce:
-        logging.error(
-            "Failed to download %s from S3 (AWS Client Error): %s", tmp_file_name, ce)
-        raise
-    except Exception as e:
-        logging.error(
-            "Unexpected error while downloading %s from S3: %s", tmp_file_name, e)
-        raise
-
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            logging.error("Failed to download the archive manifest: %s", ce)
+            raise
 
-def upload_to_s3(bucket_name: str, file_name: str, object_name: str) -> None:
-    """Uploads the updated archive files to the S3 bucket"""
-    s3 = s3_connection()
+    files = []
+    legacy_key = f"{folder_name}/{LEGACY_ARCHIVE_FILE}"
     try:
-        tmp_file_name = f"/tmp/{file_name}"
-        s3.upload_file(tmp_file_name, bucket_name, object_name)
-        logging.info("Uploaded %s to s3://%s/%s",
-                     file_name, bucket_name, object_name)
-    except FileNotFoundError as fe:
-        logging.error("Local file %s not found for upload: %s", file_name, fe)
-        raise
+        legacy = s3.head_object(Bucket=bucket_name, Key=legacy_key)
+        files.append({"key": legacy_key, "format": "csv", "bytes": legacy["ContentLength"]})
     except ClientError as ce:
-        logging.error(
-            "Failed to upload %s to S3 (AWS Client Error): %s", file_name, ce)
-        raise
-    except Exception as e:
-        logging.error(
-            "Unexpected error while uploading %s to S3: %s", file_name, e)
-        raise
+        if ce.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+    logging.info("Starting a new archive manifest with %s files.", len(files))
+    return {"files": files}
 
 
-def delete_local_file(file_name: str) -> None:
-    """Deletes the files from the lambda to keep it tidy"""
-    tmp_file_name = f"/tmp/{file_name}"
-    try:
-        if os.path.exists(tmp_file_name):
-            os.remove(tmp_file_name)
-            logging.info("Deleted local file: %s", tmp_file_name)
-        else:
-            logging.warning("File %s does not exist.", tmp_file_name)
-    except PermissionError as pe:
-        logging.error(
-            "Permission denied while trying to delete %s: %s", tmp_file_name, pe)
-        raise
-    except Exception as e:
-        logging.error("Unexpected error while deleting %s: %s",
-                      tmp_file_name, e)
-        raise
+def upload_manifest(bucket_name: str, folder_name: str, manifest: dict) -> None:
+    """Replaces the archive manifest. Readers only read the files it lists, so new files
+    become visible all at once when it is uploaded after them."""
+    s3 = s3_connection()
+    manifest["updated_at"] = datetime.now(timezone.utc).isoformat()
+    s3.put_object(Bucket=bucket_name, Key=f"{folder_name}/{MANIFEST_FILE}",
+                  Body=json.dumps(manifest, indent=2).encode("utf-8"),
+                  ContentType="application/json")
+    logging.info("Uploaded the archive manifest listing %s files.", len(manifest["files"]))
 
 
-def fetch_subscription_data_from_rds(query: str, file_name: str, bucket_name: str, folder_name: str) -> None:
-    """Fetches the latest data from RDS"""
-    engine = setup_engine()
+def remove_unlisted_files(s3: boto3.client, bucket_name: str, folder_name: str,
+                          keys: list[str]) -> None:
+    """Deletes the files of a rolled back chunk that the manifest does not list, so none
+    are left behind when the chunk is archived again. Files it lists are kept, as readers
+    may already have read them. A failure is only logged, as the chunk is rolled back."""
+    if not keys:
+        return
     try:
-        new_data = pd.read_sql(query, engine)
-    except Exception as e:
-        logging.error("Error while executing query: %s", e)
-        raise
+        listed = {file["key"] for file in download_manifest(bucket_name, folder_name)["files"]}
+        unlisted = [key for key in keys if key not in listed]
+        delete_objects(s3, bucket_name, unlisted)
+        logging.info("Deleted %s archive files of a rolled back chunk.", len(unlisted))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.warning("Could not delete the archive files of a rolled back chunk: %s", e)
 
-    s3_file_path = f"{folder_name}/{file_name}"
-    existing_data = download_csv_from_s3(bucket_name, s3_file_path, file_name)
 
-    combined_data = pd.concat([existing_data, new_data]).drop_duplicates(
-    ) if not existing_data.empty else new_data
-    tmp_file_name = f"/tmp/{file_name}"
+def archive_chunk(conn: psycopg2.extensions.connection, cursor: psycopg2.extensions.cursor,
+                  s3: boto3.client, bucket_name: str, folder_name: str, run_id: str,
+                  cutoff: datetime, timeout_ms: int = None, context=None) -> tuple[int, bool]:
+    """Archives the next chunk of expired recordings to S3 and removes them from the RDS in
+    one transaction. The removal only commits once the files and manifest are uploaded
+    and they hold every row removed, and no lock that blocks readers is held during an
+    upload. If the chunk is rolled back, files the manifest does not list are deleted again. The
+    manifest is read and replaced under the archive lock, so concurrent runs keep each
+    other's files, and its checkpoint records how far archiving has got. The statement
+    timeout only covers the database, so with a lambda context the chunk is rolled back
+    if the time left runs short before the last upload or the manifest. Returns the
+    number of rows archived and whether every expired recording has been archived."""
+    keyword_buckets = get_keyword_buckets()
+    stream = ArchiveStream(s3, bucket_name, folder_name, run_id, keyword_buckets)
+    try:
+        cursor.execute(f"SET LOCAL search_path TO {SCHEMA_NAME}")
+        if timeout_ms is not None:
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)",
+                           (str(timeout_ms),))
+        cursor.execute(PARTITION_LOCK_QUERY)
+        archived, partition = copy_next_chunk(cursor, stream, cutoff, keyword_buckets)
+        done = partition is None
+        check_time_left(context, "the last archive file is uploaded")
+        entries = stream.close()
+        written = sum(entry["rows"] for entry in entries)
+        if written != archived:
+            raise RuntimeError(f"Copied {archived} recordings but wrote {written} to the archive.")
 
-    combined_data.to_csv(tmp_file_name, index=False)
+        check_time_left(context, "the manifest is updated")
+        manifest = download_manifest(bucket_name, folder_name)
+        checkpoint = manifest.get("checkpoint", {})
+        if archived or checkpoint.get("complete") != done:
+            manifest["files"].extend(entries)
+            manifest["checkpoint"] = {
+                "run_id": run_id,
+                "cutoff": str(cutoff),
+                "archived_through": max((entry["max_date_and_hour"] for entry in entries),
+                                        default=checkpoint.get("archived_through")),
+                "complete": done
+            }
+            upload_manifest(bucket_name, folder_name, manifest)
+        remove_chunk(cursor, partition, archived)
+        conn.commit()
+        return archived, done
+    except Exception:
+        conn.rollback()
+        stream.abort()
+        remove_unlisted_files(s3, bucket_name, folder_name, stream.completed)
+        raise
 
-    upload_to_s3(bucket_name, file_name, s3_file_path)
-    delete_local_file(file_name)
 
+def archive_keyword_recordings(bucket_name: str, folder_name: str, context=None) -> dict:
+    """Adds the recordings older than 24 hours to the archive in S3 a chunk at a time,
+    streaming the rows from the database straight into new files. Each chunk is committed
+    on its own, so progress is kept if the run stops. With a lambda context, no chunk is
+    started without time for it, and a chunk that runs out of time is rolled back, so the
+    run stops cleanly and the next one carries on from there. A retried chunk can archive
+    a recording twice, so readers keep the last copy of each keyword and hour in
+    manifest order. Returns the number of rows and chunks archived and whether it
+    finished."""
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    margin_ms = get_time_margin() * 1000
+    summary = {"archived": 0, "chunks": 0, "complete": False}
+    s3 = s3_connection()
 
-def clear_keyword_recordings() -> None:
-    """Clears data older than 24 hours from keywords recording table"""
     conn, cursor = setup_connection()
     try:
-        cursor.execute(REMOVE_QUERY)
+        cursor.execute(CUTOFF_QUERY)
+        cutoff = cursor.fetchone()['cutoff']
         conn.commit()
+
+        longest_chunk_ms = 0
+        while not summary["complete"]:
+            timeout_ms = None
+            if context is not None:
+                remaining_ms = context.get_remaining_time_in_millis()
+                if remaining_ms - margin_ms <= longest_chunk_ms:
+                    logging.info("Stopping with %.0fs left, the next run carries on from here.",
+                                 remaining_ms / 1000)
+                    break
+                timeout_ms = int(remaining_ms - margin_ms)
+
+            started = time.perf_counter()
+            try:
+                archived, summary["complete"] = archive_chunk(
+                    conn, cursor, s3, bucket_name, folder_name, run_id, cutoff, timeout_ms,
+                    context)
+            except (QueryCanceled, TimeoutError):
+                logging.warning("Ran out of time during a chunk, which was rolled back for "
+                                "the next run to carry on from.")
+                break
+            longest_chunk_ms = max(longest_chunk_ms, (time.perf_counter() - started) * 1000)
+            summary["archived"] += archived
+            summary["chunks"] += 1
     except Exception as e:
-        logging.error("Error while executing query: %s", e)
+        logging.error("Error while archiving recordings, the current chunk was not "
+                      "removed: %s", e)
         raise
     finally:
         conn.close()
 
+    logging.info("Archived %s recordings older than 24 hours in %s chunks%s.",
+                 summary["archived"], summary["chunks"],
+                 "" if summary["complete"] else ", more are left for the next run")
+    return summary
+
 
 def lambda_handler(event, context):
     """The main function that joins all the script functions"""
     load_dotenv()
     bucketname = ENV["S3_BUCKET_NAME"]
-    foldername = "long_term_keyword_data"
-    filename = "keyword_recording.csv"
 
     try:
-        fetch_subscription_data_from_rds(
-            UPDATE_QUERY, filename, bucketname, foldername)
-        clear_keyword_recordings()
+        return archive_keyword_recordings(bucketname, ARCHIVE_FOLDER, context)
     except Exception as e:
-        logging.error("Error processing %s: %s", filename, e)
+        logging.error("Error processing %s: %s", ARCHIVE_FOLDER, e)
+        return None
 
 
 if __name__ == "__main__":
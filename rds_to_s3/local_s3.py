@@ -0,0 +1,103 @@
+"""Filesystem stand-in for the parts of the S3 client the archive lambda uses, including
+multipart uploads, so archiving can run offline against files on disk"""
+
+import hashlib
+import os
+import shutil
+import uuid
+from botocore.exceptions import ClientError
+
+# S3 rejects multipart uploads with a part other than the last smaller than this
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def client_error(code: str, operation: str) -> ClientError:
+    """Returns the error the S3 client raises for an error code"""
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class LocalS3:
+    """Serves objects from <root>/<bucket>/<key>. Parts of multipart uploads are kept
+    under <root>/.uploads until the upload is completed or aborted."""
+
+    def __init__(self, root: str, min_part_size: int = MIN_PART_SIZE):
+        self.root = root
+        self.min_part_size = min_part_size
+
+    def _path(self, bucket: str, key: str = "") -> str:
+        """Returns the file path of a key"""
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _upload_path(self, upload_id: str) -> str:
+        """Returns the directory holding the parts of a multipart upload"""
+        return os.path.join(self.root, ".uploads", upload_id)
+
+    def get_object(self, Bucket: str, Key: str, **_) -> dict:  # pylint: disable=invalid-name
+        """Returns an object's body, which is read from disk as it is read"""
+        if not os.path.isfile(self._path(Bucket, Key)):
+            raise client_error("NoSuchKey", "GetObject")
+        return {"Body": open(self._path(Bucket, Key), "rb"),  # pylint: disable=consider-using-with
+                "ContentLength": os.path.getsize(self._path(Bucket, Key))}
+
+    def head_object(self, Bucket: str, Key: str, **_) -> dict:  # pylint: disable=invalid-name
+        """Returns an object's size"""
+        if not os.path.isfile(self._path(Bucket, Key)):
+            raise client_error("404", "HeadObject")
+        return {"ContentLength": os.path.getsize(self._path(Bucket, Key))}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **_) -> dict:  # pylint: disable=invalid-name
+        """Writes an object"""
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(Body if isinstance(Body, bytes) else Body.encode("utf-8"))
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: dict, **_) -> dict:  # pylint: disable=invalid-name
+        """Deletes objects, ignoring those already gone like S3 does"""
+        for key in (item["Key"] for item in Delete["Objects"]):
+            if os.path.isfile(self._path(Bucket, key)):
+                os.remove(self._path(Bucket, key))
+        return {}
+
+    def create_multipart_upload(self, **_) -> dict:
+        """Starts a multipart upload"""
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_path(upload_id))
+        return {"UploadId": upload_id}
+
+    def upload_part(self, UploadId: str, PartNumber: int, Body: bytes,  # pylint: disable=invalid-name
+                    **_) -> dict:
+        """Stores a part of a multipart upload"""
+        if not os.path.isdir(self._upload_path(UploadId)):
+            raise client_error("NoSuchUpload", "UploadPart")
+        with open(os.path.join(self._upload_path(UploadId), f"{PartNumber:05d}"), "wb") as file:
+            file.write(Body)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str,  # pylint: disable=invalid-name
+                                  MultipartUpload: dict, **_) -> dict:
+        """Joins the listed parts into the object, checking their sizes like S3 does"""
+        parts = [os.path.join(self._upload_path(UploadId), f"{part['PartNumber']:05d}")
+                 for part in MultipartUpload["Parts"]]
+        if any(os.path.getsize(part) < self.min_part_size for part in parts[:-1]):
+            raise client_error("EntityTooSmall", "CompleteMultipartUpload")
+
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            for part in parts:
+                with open(part, "rb") as part_file:
+                    shutil.copyfileobj(part_file, file)
+        shutil.rmtree(self._upload_path(UploadId))
+        return {}
+
+    def abort_multipart_upload(self, UploadId: str, **_) -> dict:  # pylint: disable=invalid-name
+        """Discards the parts of a multipart upload"""
+        shutil.rmtree(self._upload_path(UploadId), ignore_errors=True)
+        return {}
+
+    def pending_uploads(self) -> list[str]:
+        """Returns the ids of the multipart uploads neither completed nor aborted"""
+        uploads = os.path.join(self.root, ".uploads")
+        return sorted(os.listdir(uploads)) if os.path.isdir(uploads) else []
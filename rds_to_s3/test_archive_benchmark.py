@@ -0,0 +1,37 @@
+"""Test script for archive_benchmark python file."""
+# pylint: skip-file
+
+import io
+import pyarrow.csv
+from archive_benchmark import synthetic_export, run_benchmark
+from etl_lambda import ARCHIVE_COLUMNS
+from local_s3 import LocalS3
+
+
+def test_synthetic_export_is_sorted_like_the_copy():
+    """Test the export is about the size asked for and sorted by day, keyword bucket, keyword and hour."""
+    blocks = list(synthetic_export(2 ** 20, 2, 4))
+    export = b''.join(block for block, _ in blocks)
+    table = pyarrow.csv.read_csv(io.BytesIO(export),
+                                 read_options=pyarrow.csv.ReadOptions(column_names=ARCHIVE_COLUMNS))
+    rows = table.to_pandas()
+    keys = list(zip(rows['date_and_hour'].dt.date, rows['keywords_id'] % 4, rows['keywords_id'],
+                    rows['date_and_hour']))
+
+    assert 0.8 * 2 ** 20 < len(export) < 1.2 * 2 ** 20
+    assert sum(block_rows for _, block_rows in blocks) == len(rows)
+    assert keys == sorted(keys)
+    assert rows['keyword_recordings_id'].is_unique
+
+
+def test_run_benchmark(tmp_path):
+    """Test every row of the export reaches the archive in several parts with no upload left pending."""
+    s3 = LocalS3(str(tmp_path), min_part_size=2 ** 16)
+
+    summary = run_benchmark(str(tmp_path), 4 * 2 ** 20, days=1, keyword_buckets=2, part_size=2 ** 16,
+                            batch_size=2 ** 18, s3=s3)
+
+    assert summary['archived_rows'] == summary['rows'] > 0
+    assert summary['files'] == 2
+    assert summary['parts'] > summary['files']
+    assert summary['pending_uploads'] == 0
@@ -0,0 +1,185 @@
+"""Test script for compact_archive python file."""
+# pylint: skip-file
+
+import glob
+import io
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+from unittest.mock import MagicMock, patch
+import pandas as pd
+import pytest
+from compact_archive import (plan_compaction, read_group, replace_files, remove_superseded,
+                             compact_archive, lambda_handler)
+from etl_lambda import ArchiveStream
+from local_s3 import LocalS3
+
+NOW = datetime(2024, 12, 12, 12, tzinfo=timezone.utc)
+
+
+def parquet_entry(key, date='2024-12-09', keyword_bucket=0, size=10):
+    """Returns a manifest entry of a Parquet archive file."""
+    return {'key': key, 'format': 'parquet', 'date': date, 'keyword_bucket': keyword_bucket,
+            'bytes': size}
+
+
+def archive_run(s3, run_id, rows):
+    """Archives CSV rows as an archive run would and returns their manifest entries."""
+    stream = ArchiveStream(s3, 'bucket', 'folder', run_id, 2)
+    stream.write(rows)
+    return stream.close()
+
+
+def read_archive(s3):
+    """Reads every file the manifest lists as the dashboard does."""
+    manifest = json.loads(s3.get_object(Bucket='bucket', Key='folder/manifest.json')['Body'].read())
+    frames = []
+    for entry in manifest['files']:
+        with s3.get_object(Bucket='bucket', Key=entry['key'])['Body'] as body:
+            frames.append(pd.read_parquet(io.BytesIO(body.read())))
+    archive = pd.concat(frames).drop_duplicates(['keywords_id', 'date_and_hour'], keep='last')
+    return manifest, archive.sort_values('keyword_recordings_id').reset_index(drop=True)
+
+
+@pytest.fixture()
+def local_s3(tmp_path):
+    """A local S3 holding an archive of three runs, which wrote four small files for two keyword buckets of a day."""
+    s3 = LocalS3(str(tmp_path), min_part_size=1)
+    files = (archive_run(s3, 'run1', b'1,2,5,2.5,1.5,0.5,2024-12-09 10:00:00\n'
+                                     b'2,3,1,0.1,0.01,0.1,2024-12-09 10:00:00\n')
+             + archive_run(s3, 'run2', b'3,2,4,2.0,1.0,0.5,2024-12-09 08:00:00\n'
+                                       b'4,4,2,0.2,0.02,0.1,2024-12-09 11:00:00\n')
+             + archive_run(s3, 'run3', b'5,3,2,0.4,0.08,0.2,2024-12-09 10:00:00\n'))
+    s3.put_object(Bucket='bucket', Key='folder/manifest.json', Body=json.dumps({'files': files}))
+    with patch('compact_archive.s3_connection', return_value=s3), \
+            patch('etl_lambda.s3_connection', return_value=s3), \
+            patch('compact_archive.setup_connection', return_value=(MagicMock(), MagicMock())):
+        yield s3
+
+
+def test_plan_compaction():
+    """Test small Parquet files are grouped by day and keyword bucket up to the target size."""
+    manifest = {'files': [
+        {'key': 'keyword_recording.csv', 'format': 'csv', 'bytes': 5},
+        parquet_entry('a'), parquet_entry('b', keyword_bucket=1), parquet_entry('c'),
+        parquet_entry('big', size=100), parquet_entry('d', size=50), parquet_entry('e'),
+        parquet_entry('f', date='2024-12-10')]}
+
+    groups = plan_compaction(manifest, 60)
+
+    assert [[entry['key'] for entry in group] for group in groups] == [['a', 'c'], ['d', 'e']]
+
+
+def test_read_group_sorts_and_keeps_last_copy(local_s3):
+    """Test merged rows are sorted by keyword and time, keeping the newest file's row for a keyword and hour."""
+    manifest = json.loads(local_s3.get_object(Bucket='bucket', Key='folder/manifest.json')['Body'].read())
+    group = [entry for entry in manifest['files'] if entry['keyword_bucket'] == 1]
+
+    table = read_group(local_s3, 'bucket', group)
+
+    assert table['keyword_recordings_id'].to_pylist() == [5]
+    assert table['total_mentions'].to_pylist() == [2]
+    group = [entry for entry in manifest['files'] if entry['keyword_bucket'] == 0]
+    assert read_group(local_s3, 'bucket', group)['keyword_recordings_id'].to_pylist() == [3, 1, 4]
+
+
+def test_replace_files():
+    """Test the merged file takes the place of the last file it replaces, which are marked as superseded."""
+    manifest = {'files': [parquet_entry('a'), parquet_entry('b'), parquet_entry('c')]}
+    merged = parquet_entry('merged')
+
+    assert replace_files(manifest, [manifest['files'][0], manifest['files'][2]], merged, NOW)
+
+    assert [entry['key'] for entry in manifest['files']] == ['b', 'merged']
+    assert manifest['superseded'] == [{'key': 'a', 'superseded_at': NOW.isoformat()},
+                                      {'key': 'c', 'superseded_at': NOW.isoformat()}]
+
+
+def test_replace_files_already_replaced():
+    """Test the manifest is left alone when a file to replace is no longer listed."""
+    manifest = {'files': [parquet_entry('a')]}
+
+    assert not replace_files(manifest, [parquet_entry('a'), parquet_entry('b')],
+                             parquet_entry('merged'), NOW)
+
+    assert manifest == {'files': [parquet_entry('a')]}
+
+
+def test_remove_superseded_after_grace_period():
+    """Test only files superseded longer ago than the grace period are deleted."""
+    s3 = MagicMock()
+    s3.delete_objects.return_value = {}
+    manifest = {'files': [], 'superseded': [
+        {'key': 'old', 'superseded_at': (NOW - timedelta(hours=2)).isoformat()},
+        {'key': 'new', 'superseded_at': (NOW - timedelta(minutes=5)).isoformat()}]}
+
+    assert remove_superseded(s3, 'bucket', manifest, NOW) == 1
+
+    s3.delete_objects.assert_called_once_with(
+        Bucket='bucket', Delete={'Objects': [{'Key': 'old'}], 'Quiet': True})
+    assert [file['key'] for file in manifest['superseded']] == ['new']
+
+
+def test_compact_archive_keeps_readers_consistent(local_s3):
+    """Test small files are merged without changing what readers see, and removed after the grace period."""
+    before, archive_before = read_archive(local_s3)
+
+    assert compact_archive('bucket', 'folder') == {'merged': 4, 'written': 2, 'removed': 0,
+                                                   'complete': True}
+
+    after, archive_after = read_archive(local_s3)
+    pd.testing.assert_frame_equal(archive_after, archive_before)
+    assert len(after['files']) == 2
+    merged = after['files'][0]
+    assert merged['keyword_bucket'] == 0 and merged['rows'] == 3
+    assert merged['min_date_and_hour'] == '2024-12-09 08:00:00'
+    superseded = [file['key'] for file in after['superseded']]
+    for key in superseded:
+        assert local_s3.head_object(Bucket='bucket', Key=key)
+    assert local_s3.pending_uploads() == []
+
+    with patch.dict('compact_archive.ENV', {'ARCHIVE_COMPACTION_GRACE_MINUTES': '0'}):
+        assert compact_archive('bucket', 'folder')['removed'] == 4
+
+    final, archive_final = read_archive(local_s3)
+    pd.testing.assert_frame_equal(archive_final, archive_before)
+    assert final['superseded'] == []
+    for key in superseded:
+        with pytest.raises(Exception):
+            local_s3.head_object(Bucket='bucket', Key=key)
+
+
+def test_compact_archive_replaced_by_another_run(local_s3, caplog):
+    """Test a merged file is discarded if another run replaced its files first."""
+    with patch('compact_archive.replace_files', return_value=False):
+        with caplog.at_level(logging.INFO):
+            summary = compact_archive('bucket', 'folder')
+
+    assert summary['written'] == 0
+    manifest, _ = read_archive(local_s3)
+    assert len(manifest['files']) == 4
+    assert 'were replaced by another run' in caplog.text
+    assert len(glob.glob(f'{local_s3.root}/bucket/**/*.parquet', recursive=True)) == 4
+
+
+def test_compact_archive_no_time_left(local_s3):
+    """Test no files are merged without more time left than the margin."""
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+
+    summary = compact_archive('bucket', 'folder', context)
+
+    assert summary == {'merged': 0, 'written': 0, 'removed': 0, 'complete': False}
+    manifest, _ = read_archive(local_s3)
+    assert len(manifest['files']) == 4
+
+
+@patch.dict('compact_archive.ENV', {"S3_BUCKET_NAME": "test_bucket"}, clear=True)
+@patch('compact_archive.compact_archive')
+def test_lambda_handler_exception(mock_compact, caplog):
+    """Test a compaction error is logged by the lambda handler."""
+    mock_compact.side_effect = Exception('failed')
+    with caplog.at_level(logging.INFO):
+        assert lambda_handler(MagicMock(), MagicMock()) is None
+
+    assert 'Error compacting long_term_keyword_data: failed' in caplog.text
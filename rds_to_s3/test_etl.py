@@ -2,18 +2,22 @@
 
 # pylint: skip-file
 
+import io
+import json
 import os
 import logging
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, patch, call
 import pytest
 import pandas as pd
 from psycopg2 import (OperationalError, InterfaceError, DatabaseError)
+from psycopg2.errors import QueryCanceled
 from botocore.exceptions import ClientError, EndpointConnectionError
 from psycopg2.extras import RealDictCursor
-from sqlalchemy.exc import SQLAlchemyError
 
-from etl_lambda import (setup_engine, setup_connection, s3_connection, download_csv_from_s3, upload_to_s3, delete_local_file,
-                        fetch_subscription_data_from_rds, clear_keyword_recordings, lambda_handler, REMOVE_QUERY, UPDATE_QUERY)
+from etl_lambda import (setup_connection, s3_connection, copy_next_chunk, remove_chunk, archive_key,
+                        MultipartUpload, ArchiveStream, download_manifest, upload_manifest,
+                        archive_keyword_recordings, lambda_handler,
+                        DROP_PARTITIONS_QUERY)
 
 
 @pytest.fixture()
@@ -40,42 +44,6 @@ def mock_env(configs):
         yield
 
 
-@patch('etl_lambda.create_engine')
-def test_setup_engine(mock_engine, mock_env):
-    """Test successful setup of sqlalchemy engine."""
-    engine = setup_engine()
-
-    expected_conn_str = f"""postgresql+psycopg2://{os.environ['DB_USERNAME']}:{
-        os.environ['DB_PASSWORD']}@{os.environ['DB_HOST']}:{os.environ['DB_PORT']}/{os.environ['DB_NAME']}"""
-
-    mock_engine.assert_called_once_with(expected_conn_str)
-    assert engine == mock_engine.return_value
-
-
-@patch('etl_lambda.create_engine')
-def test_sql_alchemy_error_setup_engine(mock_engine, caplog):
-    """Test SQLAlchemyError raised when something goes wrong with the SQLAlchemy library."""
-    mock_engine.side_effect = SQLAlchemyError('Simulated SQLAlchemyError')
-
-    with caplog.at_level(logging.INFO):
-        with pytest.raises(SQLAlchemyError):
-            setup_engine()
-
-    assert 'Failed to connect to database:' in caplog.text
-
-
-@patch('etl_lambda.create_engine')
-def test_exception_setup_engine(mock_engine, caplog):
-    """Test general exception catches any other wrong-goings."""
-    mock_engine.side_effect = Exception('Simulated Exception')
-
-    with caplog.at_level(logging.INFO):
-        with pytest.raises(Exception):
-            setup_engine()
-
-    assert 'An unexpected error occurred:' in caplog.text
-
-
 @patch('etl_lambda.psycopg2.connect')
 def test_setup_connection_success(mock_connect, caplog):
     """Test successful connection and schema setting."""
@@ -174,386 +142,490 @@ def test_s3_connection_raises_endpoint_connection_error(mock_client, caplog):
     mock_client.assert_called_once_with('s3')
 
 
-@patch('etl_lambda.pd.read_csv')
-@patch('etl_lambda.s3_connection')
-def test_successful_download_csv_s3(mock_s3_conn, mock_read_csv, caplog):
-    """Test the successful download of files from the S3 bucket."""
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
-    mock_read_csv.return_value = pd.DataFrame({
-        'keywords': ['python'],
-        'total mentions': [23],
-        'avg sentiment': [0.12]
-    })
-    file_name = 'test_file.csv'
-    with caplog.at_level(logging.INFO):
-        df = download_csv_from_s3('test_bucket', 'test/path/', file_name)
+def mogrify(query, params):
+    """Fills in query parameters as psycopg2 would, for checking copied queries."""
+    return query.replace('%(cutoff)s', f"'{params['cutoff']}'").replace(
+        '%(buckets)s', str(params['buckets'])).replace('%%', '%').encode()
 
-    mock_read_csv.assert_called_once_with(f'/tmp/{file_name}')
-    assert f'Downloaded /tmp/{file_name} from S3.' in caplog.text
-    mock_s3.download_file.assert_called_once()
-    assert isinstance(df, pd.DataFrame)
 
+def test_copy_next_chunk_expired_partition():
+    """Test the oldest expired day is copied out sorted under a lock that still lets it be read."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'partition': 'keyword_recordings_p20241208',
+                                       'partition_end': '2024-12-09 00:00:00'}
+    mock_curs.rowcount = 24
+    mock_curs.mogrify.side_effect = mogrify
 
-@patch('etl_lambda.pd.read_csv')
-@patch('etl_lambda.s3_connection')
-def test_download_csv_filenotfound(mock_s3_conn, mock_read_csv, caplog):
-    """Test if file was not downloaded correctly or unable to be found locally, FileNotFoundError will be raised."""
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
-    mock_s3.download_file.return_value = None
-    mock_read_csv.side_effect = FileNotFoundError()
-    file_name = 'test_file.csv'
-    with caplog.at_level(logging.WARNING):
-        download_csv_from_s3('test_bucket', 'test/path/', file_name)
+    assert copy_next_chunk(mock_curs, io.BytesIO(), '2024-12-10 08:00:00', 8) == (
+        24, {'partition': 'keyword_recordings_p20241208', 'partition_end': '2024-12-09 00:00:00'})
 
-    mock_s3.download_file.assert_called_once_with(
-        'test_bucket', 'test/path/', '/tmp/test_file.csv')
+    executed = [c.args[0] for c in mock_curs.execute.call_args_list]
+    assert executed[-1] == 'LOCK TABLE keyword_recordings_p20241208 IN SHARE MODE'
+    assert DROP_PARTITIONS_QUERY not in executed
+    copied = mock_curs.copy_expert.call_args.args[0]
+    assert 'FROM keyword_recordings_p20241208' in copied
+    assert 'ORDER BY date_and_hour::DATE, keywords_id % 8, keywords_id, date_and_hour' in copied
+    mock_curs.connection.commit.assert_not_called()
 
-    assert 'File /tmp/test_file.csv not found locally:' in caplog.text
 
+def test_copy_next_chunk_remaining_rows():
+    """Test the rest are deleted by the statement copying them out sorted, once no whole day is left."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = None
+    mock_curs.rowcount = 5
+    mock_curs.mogrify.side_effect = mogrify
 
-@patch('etl_lambda.pd.read_csv')
-@patch('etl_lambda.s3_connection')
-def test_download_csv_clienterror(mock_s3_conn, mock_read_csv, caplog):
-    """Test that if the file cannot be found in bucket, the appropriate error will be raised."""
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
+    assert copy_next_chunk(mock_curs, io.BytesIO(), '2024-12-10 08:00:00', 8) == (5, None)
 
-    error_response = {
-        'Error': {
-            'Code': 'NoSuchKey',
-            'Message': 'The specified key does not exist.'
-        }
-    }
-    mock_s3.download_file.side_effect = ClientError(
-        error_response=error_response,
-        operation_name="DownloadFile"
-    )
-    file_name = 'test_file.csv'
+    copied = mock_curs.copy_expert.call_args.args[0]
+    assert "DELETE FROM keyword_recordings" in copied
+    assert "WHERE date_and_hour < '2024-12-10 08:00:00'" in copied
+    assert "RETURNING keyword_recordings_id," in copied
+    assert 'ORDER BY date_and_hour::DATE, keywords_id % 8, keywords_id, date_and_hour' in copied
+    assert DROP_PARTITIONS_QUERY not in [c.args[0] for c in mock_curs.execute.call_args_list]
 
-    with caplog.at_level(logging.ERROR):
-        with pytest.raises(ClientError):
-            download_csv_from_s3('test_bucket', 'test/path/', file_name)
 
-    mock_s3.download_file.assert_called_once_with(
-        'test_bucket', 'test/path/', '/tmp/test_file.csv'
-    )
-    mock_read_csv.assert_not_called()
-    assert 'Failed to download /tmp/test_file.csv from S3 (AWS Client Error)' in caplog.text
+PARTITION = {'partition': 'keyword_recordings_p20241208', 'partition_end': '2024-12-09 00:00:00'}
 
 
-@patch('etl_lambda.pd.read_csv')
-@patch('etl_lambda.s3_connection')
-def test_download_csv_emptydataerror(mock_s3_conn, mock_read_csv, caplog):
-    """Test that if the file cannot be found in bucket, the appropriate error will be raised."""
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
+def test_remove_chunk():
+    """Test a copied partition is dropped on its own and the last chunk has nothing left to remove."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'recordings': 24}
+    remove_chunk(mock_curs, PARTITION, 24)
+    assert mock_curs.execute.call_args_list[0].args == (
+        'SELECT COUNT(*) AS recordings FROM keyword_recordings_p20241208',)
+    assert mock_curs.execute.call_args == ((DROP_PARTITIONS_QUERY, {'cutoff': '2024-12-09 00:00:00'}),)
 
-    bucket_name = 'test_bucket'
-    s3_file_path = 'test/path/test_file.csv'
-    file_name = 'test_file.csv'
+    mock_curs.reset_mock()
+    remove_chunk(mock_curs, None, 5)
+    mock_curs.execute.assert_not_called()
 
-    mock_read_csv.side_effect = pd.errors.EmptyDataError(
-        f'Downloaded file /tmp/{file_name} is empty')
-    with caplog.at_level(logging.WARNING):
-        result = download_csv_from_s3(bucket_name, s3_file_path, file_name)
 
-    mock_s3.download_file.assert_called_once_with(
-        bucket_name, s3_file_path, f'/tmp/{file_name}')
-    mock_read_csv.assert_called_once_with(f'/tmp/{file_name}')
-    assert 'Downloaded file /tmp/test_file.csv is empty' in caplog.text
-    assert isinstance(result, pd.DataFrame)
-    assert result.empty
+def test_remove_chunk_count_mismatch():
+    """Test a partition holding a different number of rows than were archived is not dropped."""
+    mock_curs = MagicMock()
+    mock_curs.fetchone.return_value = {'recordings': 25}
+    with pytest.raises(RuntimeError, match='holds 25 recordings but 24 were archived'):
+        remove_chunk(mock_curs, PARTITION, 24)
+    assert DROP_PARTITIONS_QUERY not in [c.args[0] for c in mock_curs.execute.call_args_list]
+
+
+def client_error(code: str) -> ClientError:
+    """Returns an S3 ClientError with the given error code."""
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'GetObject')
+
+
+def test_archive_key():
+    """Test archive files are partitioned by day and keyword bucket."""
+    assert archive_key('folder_name', '2024-12-09', 3, '20241210T080000') == (
+        'folder_name/recordings/date=2024-12-09/keyword_bucket=03/part-20241210T080000.parquet')
 
 
-@patch('etl_lambda.pd.read_csv')
 @patch('etl_lambda.s3_connection')
-def test_download_csv_Exception(mock_s3_conn, mock_read_csv, caplog):
-    """Test that if any exception occurs, it will be raised."""
+def test_download_manifest_existing(mock_s3_conn):
+    """Test an existing manifest is returned as it is."""
+    mock_s3 = mock_s3_conn.return_value
+    mock_s3.get_object.return_value = {'Body': io.BytesIO(b'{"files": [{"key": "a"}]}')}
 
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
+    assert download_manifest('test_bucket', 'folder_name') == {'files': [{'key': 'a'}]}
+    mock_s3.get_object.assert_called_once_with(Bucket='test_bucket', Key='folder_name/manifest.json')
 
-    mock_s3.download_file.side_effect = Exception()
 
-    bucket_name = "test_bucket"
-    s3_file_path = "test/path/test_file.csv"
-    file_name = "test_file.csv"
+@patch('etl_lambda.s3_connection')
+def test_download_manifest_starts_with_legacy_csv(mock_s3_conn):
+    """Test a new manifest lists the CSV the archive used to be kept in."""
+    mock_s3 = mock_s3_conn.return_value
+    mock_s3.get_object.side_effect = client_error('NoSuchKey')
+    mock_s3.head_object.return_value = {'ContentLength': 2048}
 
-    with caplog.at_level(logging.INFO):
-        with pytest.raises(Exception):
-            download_csv_from_s3(bucket_name, s3_file_path, file_name)
-    assert 'Unexpected error while downloading' in caplog.text
-    for record in caplog.records:
-        assert record.levelname == 'ERROR'
-    mock_read_csv.assert_not_called()
+    assert download_manifest('test_bucket', 'folder_name') == {'files': [
+        {'key': 'folder_name/keyword_recording.csv', 'format': 'csv', 'bytes': 2048}]}
 
 
 @patch('etl_lambda.s3_connection')
-def test_successful_upload_to_s3(mock_s3_conn, caplog):
-    """Test successful upload of file to s3 bucket."""
+def test_download_manifest_starts_empty(mock_s3_conn):
+    """Test a new manifest is empty when there is no legacy CSV."""
+    mock_s3 = mock_s3_conn.return_value
+    mock_s3.get_object.side_effect = client_error('NoSuchKey')
+    mock_s3.head_object.side_effect = client_error('404')
 
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
-    file_name = "test_file.csv"
-    object_name = "object_name"
-    bucket_name = "test_bucket"
+    assert download_manifest('test_bucket', 'folder_name') == {'files': []}
 
-    with caplog.at_level(logging.INFO):
-        upload_to_s3(bucket_name, file_name, object_name)
 
-    assert f'Uploaded {
-        file_name} to s3://{bucket_name}/{object_name}' in caplog.text
-    mock_s3.upload_file.assert_called_once()
+@patch('etl_lambda.s3_connection')
+def test_download_manifest_access_denied(mock_s3_conn, caplog):
+    """Test a manifest that cannot be read is not replaced by a new one."""
+    mock_s3_conn.return_value.get_object.side_effect = client_error('AccessDenied')
+
+    with pytest.raises(ClientError):
+        download_manifest('test_bucket', 'folder_name')
+    assert 'Failed to download the archive manifest' in caplog.text
 
 
 @patch('etl_lambda.s3_connection')
-def test_upload_s3_filenotfound(mock_s3_conn, caplog):
-    """Test if file is unable to be found locally, FileNotFoundError will be raised."""
+def test_upload_manifest(mock_s3_conn):
+    """Test the manifest is uploaded as JSON."""
+    mock_s3 = mock_s3_conn.return_value
+
+    upload_manifest('test_bucket', 'folder_name', {'files': [{'key': 'a'}]})
+
+    kwargs = mock_s3.put_object.call_args.kwargs
+    assert kwargs['Key'] == 'folder_name/manifest.json'
+    assert json.loads(kwargs['Body'])['files'] == [{'key': 'a'}]
+
+
+def mock_s3_client() -> MagicMock:
+    """Returns an S3 client that keeps the parts of multipart uploads in memory."""
     mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
+    mock_s3.objects = {}
+    mock_s3.parts = {}
+    mock_s3.create_multipart_upload.side_effect = lambda Bucket, Key: {'UploadId': Key}
+    mock_s3.upload_part.side_effect = lambda UploadId, PartNumber, Body, **_: (
+        mock_s3.parts.setdefault(UploadId, []).append(Body) or {'ETag': f'"{PartNumber}"'})
+    mock_s3.complete_multipart_upload.side_effect = lambda Key, UploadId, **_: (
+        mock_s3.objects.update({Key: b''.join(mock_s3.parts.pop(UploadId))}))
+    return mock_s3
 
-    mock_s3.upload_file.side_effect = FileNotFoundError()
-    file_name = 'test_file.csv'
-    with caplog.at_level(logging.WARNING):
-        with pytest.raises(FileNotFoundError):
-            upload_to_s3('test_bucket', file_name,  'object_name')
 
-    mock_s3.upload_file.assert_called_once_with(
-        f'/tmp/{file_name}', 'test_bucket', 'object_name')
+def test_multipart_upload_sends_full_parts():
+    """Test a part is only sent once it is full and the rest is sent on completion."""
+    mock_s3 = mock_s3_client()
+    upload = MultipartUpload(mock_s3, 'test_bucket', 'key', part_size=4)
 
-    assert f'Local file {file_name} not found for upload:' in caplog.text
+    upload.write(b'abc')
+    mock_s3.upload_part.assert_not_called()
+    upload.write(b'defghij')
+    assert mock_s3.parts['key'] == [b'abcd', b'efgh']
+    assert upload.tell() == 10
+    upload.complete()
 
+    assert mock_s3.objects['key'] == b'abcdefghij'
+    parts = mock_s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+    assert parts == [{'ETag': '"1"', 'PartNumber': 1}, {'ETag': '"2"', 'PartNumber': 2},
+                     {'ETag': '"3"', 'PartNumber': 3}]
 
-@patch('etl_lambda.s3_connection')
-def test_upload_s3_clienterror(mock_s3_conn, caplog):
-    """Test that if the file cannot be found in bucket, the appropriate error will be raised."""
-    mock_s3 = MagicMock()
-    mock_s3_conn.return_value = mock_s3
 
-    error_response = {
-        'Error': {
-            'Code': 'NoSuchKey',
-            'Message': 'The specified key does not exist.'
-        }
-    }
-    mock_s3.upload_file.side_effect = ClientError(
-        error_response=error_response,
-        operation_name='UploadFile'
-    )
+def test_multipart_upload_empty_file():
+    """Test an empty file is uploaded as a single empty part, as S3 needs one part."""
+    mock_s3 = mock_s3_client()
+    upload = MultipartUpload(mock_s3, 'test_bucket', 'key')
+
+    upload.complete()
+
+    assert mock_s3.objects['key'] == b''
+
+
+def test_archive_stream_writes_a_file_per_partition():
+    """Test rows are streamed into a Parquet file per day and keyword bucket without touching the disk."""
+    mock_s3 = mock_s3_client()
+    rows = (b'1,2,5,2.5,1.5,0.5,2024-12-09 10:00:00\n'
+            b'2,4,3,,,0,2024-12-09 08:00:00\n'
+            b'3,1,7,0.7,0.1,0.1,2024-12-09 09:00:00\n'
+            b'4,2,1,0.1,0.01,0.1,2024-12-10 00:00:00\n')
+
+    with patch('builtins.open', side_effect=AssertionError('wrote a local file')):
+        stream = ArchiveStream(mock_s3, 'test_bucket', 'folder_name', 'run', 2, batch_size=50)
+        for start in range(0, len(rows), 7):
+            stream.write(rows[start:start + 7])
+        entries = stream.close()
+
+    assert [(entry['date'], entry['keyword_bucket'], entry['rows']) for entry in entries] == [
+        ('2024-12-09', 0, 2), ('2024-12-09', 1, 1), ('2024-12-10', 0, 1)]
+    assert entries[0]['min_date_and_hour'] == '2024-12-09 08:00:00'
+    assert entries[0]['max_date_and_hour'] == '2024-12-09 10:00:00'
+    first = pd.read_parquet(io.BytesIO(mock_s3.objects[entries[0]['key']]))
+    assert first['keyword_recordings_id'].tolist() == [1, 2]
+    assert first['sentiment_sum'].isna().tolist() == [False, True]
+    assert entries[0]['bytes'] == len(mock_s3.objects[entries[0]['key']])
+    assert entries[0]['key'] == archive_key('folder_name', '2024-12-09', 0, 'run')
 
-    file_name = 'test_file.csv'
-    object_name = 'object_name'
-    bucket_name = 'test_bucket'
 
-    with caplog.at_level(logging.ERROR):
-        with pytest.raises(ClientError):
-            upload_to_s3(bucket_name, file_name, object_name)
+def test_archive_stream_rejects_unsorted_rows():
+    """Test rows for a partition that was already finished are not written over it."""
+    stream = ArchiveStream(mock_s3_client(), 'test_bucket', 'folder_name', 'run', 2)
+    stream.write(b'1,1,5,2.5,1.5,0.5,2024-12-10 10:00:00\n2,2,5,2.5,1.5,0.5,2024-12-09 10:00:00\n')
 
-    mock_s3.upload_file.assert_called_once_with(
-        f'/tmp/{file_name}', bucket_name, object_name)
+    with pytest.raises(ValueError):
+        stream.close()
 
-    assert f'Failed to upload {
-        file_name} to S3 (AWS Client Error): ' in caplog.text
 
+def test_archive_stream_abort():
+    """Test aborting discards the file being uploaded."""
+    mock_s3 = mock_s3_client()
+    stream = ArchiveStream(mock_s3, 'test_bucket', 'folder_name', 'run', 2, batch_size=1)
+    stream.write(b'1,1,5,2.5,1.5,0.5,2024-12-10 10:00:00\n')
 
+    stream.abort()
+
+    mock_s3.abort_multipart_upload.assert_called_once()
+    assert mock_s3.objects == {}
+
+
+def fake_export(cursor, file, cutoff, keyword_buckets):
+    """Writes two expired recordings as copy_next_chunk would for the last chunk."""
+    file.write(b'1,3,5,2.5,1.5,0.5,2024-12-09 10:00:00\n2,4,6,3.0,1.5,0.5,2024-12-09 11:00:00\n')
+    return 2, None
+
+
+def mock_database() -> tuple:
+    """Returns a connection and cursor whose cutoff query finds a cutoff."""
+    mock_conn, mock_curs = MagicMock(), MagicMock()
+    mock_curs.fetchone.return_value = {'cutoff': '2024-12-10 08:00:00'}
+    return mock_conn, mock_curs
+
+
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', return_value={'files': [{'key': 'old'}]})
+@patch('etl_lambda.copy_next_chunk', side_effect=fake_export)
+@patch('etl_lambda.setup_connection')
 @patch('etl_lambda.s3_connection')
-def test_upload_s3_exception(mock_s3_conn, caplog):
-    """Test if file is unable to be found locally, FileNotFoundError will be raised."""
-    mock_s3 = MagicMock()
+def test_archive_keyword_recordings_commits_after_manifest(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                           mock_download, mock_upload):
+    """Test the recordings are only removed once the files holding them are listed in the manifest."""
+    mock_s3 = mock_s3_client()
+    mock_s3_conn.return_value = mock_s3
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
+    order = MagicMock()
+    order.attach_mock(mock_s3.complete_multipart_upload, 'complete')
+    order.attach_mock(mock_upload, 'upload_manifest')
+    order.attach_mock(mock_conn.commit, 'commit')
+
+    with patch.dict('etl_lambda.ENV', {'ARCHIVE_KEYWORD_BUCKETS': '1'}), \
+            patch('etl_lambda.remove_chunk') as mock_remove:
+        order.attach_mock(mock_remove, 'remove_chunk')
+        summary = archive_keyword_recordings('test_bucket', 'folder_name')
+
+    assert summary == {'archived': 2, 'chunks': 1, 'complete': True}
+    assert [c[0] for c in order.mock_calls] == ['commit', 'complete', 'upload_manifest',
+                                                'remove_chunk', 'commit']
+    assert mock_remove.call_args.args[1:] == (None, 2)
+    manifest = mock_upload.call_args.args[2]
+    assert manifest['files'][0] == {'key': 'old'}
+    assert manifest['files'][1]['rows'] == 2
+    assert manifest['checkpoint']['archived_through'] == '2024-12-09 11:00:00'
+    assert manifest['checkpoint']['complete'] is True
+    assert mock_archive.call_args.args[2:] == ('2024-12-10 08:00:00', 1)
+    mock_conn.close.assert_called_once()
+
+
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', return_value={'files': []})
+@patch('etl_lambda.copy_next_chunk', side_effect=fake_export)
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_upload_failure_keeps_rows(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                              mock_download, mock_upload, caplog):
+    """Test a failed upload rolls back, leaving the recordings in the database and the manifest as it was."""
+    mock_s3 = mock_s3_client()
+    mock_s3.complete_multipart_upload.side_effect = Exception('upload failed')
     mock_s3_conn.return_value = mock_s3
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
 
-    mock_s3.upload_file.side_effect = Exception()
-    file_name = 'test_file.csv'
-    with caplog.at_level(logging.WARNING):
+    with caplog.at_level(logging.INFO):
         with pytest.raises(Exception):
-            upload_to_s3('test_bucket', file_name,  'object_name')
+            archive_keyword_recordings('test_bucket', 'folder_name')
 
-    mock_s3.upload_file.assert_called_once_with(
-        f'/tmp/{file_name}', 'test_bucket', 'object_name')
+    mock_s3.abort_multipart_upload.assert_called_once()
+    mock_s3.delete_objects.assert_not_called()
+    mock_upload.assert_not_called()
+    mock_conn.commit.assert_called_once()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.close.assert_called_once()
+    assert 'Error while archiving recordings, the current chunk was not removed: upload failed' in caplog.text
 
-    assert f'Unexpected error while uploading {
-        file_name} to S3: ' in caplog.text
 
+@patch('etl_lambda.upload_manifest', side_effect=Exception('manifest upload failed'))
+@patch('etl_lambda.download_manifest', side_effect=lambda *_: {'files': [{'key': 'old'}]})
+@patch('etl_lambda.copy_next_chunk', side_effect=fake_export)
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_rollback_deletes_unlisted_files(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                                    mock_download, mock_upload):
+    """Test files completed by a rolled back chunk are deleted unless the manifest lists them."""
+    mock_s3 = mock_s3_client()
+    mock_s3.delete_objects.return_value = {}
+    mock_s3_conn.return_value = mock_s3
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
 
-@patch('os.path.exists', return_value=True)
-@patch('os.remove')
-def test_delete_local_file_success(mock_remove, mock_exists, caplog):
-    """Test to ensure the specified file is deleted if it exists."""
-    file_name = 'keep_file.csv'
+    with patch.dict('etl_lambda.ENV', {'ARCHIVE_KEYWORD_BUCKETS': '1'}):
+        with pytest.raises(Exception):
+            archive_keyword_recordings('test_bucket', 'folder_name')
 
-    with caplog.at_level(logging.INFO):
-        delete_local_file(file_name)
+    [key] = mock_s3.objects
+    assert mock_s3.delete_objects.call_args.kwargs['Delete']['Objects'] == [{'Key': key}]
+    mock_conn.rollback.assert_called_once()
 
-    mock_exists.assert_called_once_with(f'/tmp/{file_name}')
-    mock_remove.assert_called_once_with(f'/tmp/{file_name}')
+    mock_s3.delete_objects.reset_mock()
+    mock_download.side_effect = lambda *_: {'files': [{'key': key} for key in mock_s3.objects]}
+    with patch.dict('etl_lambda.ENV', {'ARCHIVE_KEYWORD_BUCKETS': '1'}):
+        with pytest.raises(Exception):
+            archive_keyword_recordings('test_bucket', 'folder_name')
+    mock_s3.delete_objects.assert_not_called()
 
-    assert f'Deleted local file: /tmp/{file_name}' in caplog.text
 
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', side_effect=lambda *_: {'files': []})
+@patch('etl_lambda.copy_next_chunk')
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_rolls_back_rows_missing_from_the_archive(
+        mock_s3_conn, mock_setup_conn, mock_archive, mock_download, mock_upload, caplog):
+    """Test a chunk whose files hold fewer rows than were copied out is rolled back before the manifest lists them."""
+    def short_export(cursor, file, cutoff, keyword_buckets):
+        file.write(b'1,3,5,2.5,1.5,0.5,2024-12-09 10:00:00\n')
+        return 2, None
+
+    mock_archive.side_effect = short_export
+    mock_s3 = mock_s3_client()
+    mock_s3.delete_objects.return_value = {}
+    mock_s3_conn.return_value = mock_s3
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
 
-@patch('os.path.exists', return_value=False)
-@patch('os.remove')
-def test_delete_local_file_warning(mock_remove, mock_exists, caplog):
-    """Test to ensure the specified file is deleted if it exists."""
-    file_name = 'keep_file.csv'
+    with caplog.at_level(logging.INFO):
+        with pytest.raises(RuntimeError):
+            archive_keyword_recordings('test_bucket', 'folder_name')
 
-    with caplog.at_level(logging.WARNING):
-        delete_local_file(file_name)
+    mock_upload.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    assert mock_s3.delete_objects.call_count == 1
+    assert 'Copied 2 recordings but wrote 1 to the archive.' in caplog.text
 
-    mock_exists.assert_called_once_with(f'/tmp/{file_name}')
-    mock_remove.assert_not_called()
 
-    assert f'File /tmp/{file_name} does not exist.' in caplog.text
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', return_value={'files': [], 'checkpoint': {'complete': True}})
+@patch('etl_lambda.copy_next_chunk', return_value=(0, None))
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_nothing_expired(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                    mock_download, mock_upload):
+    """Test the archive is left alone when no recordings have expired."""
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
 
+    summary = archive_keyword_recordings('test_bucket', 'folder_name')
 
-@patch('os.path.exists', return_value=True)
-@patch('os.remove')
-def test_delete_local_file_permissionerror(mock_remove, mock_exists, caplog):
-    """Test to ensure the specified file is deleted if it exists."""
-    file_name = 'keep_file.csv'
-    mock_remove.side_effect = PermissionError()
+    assert summary == {'archived': 0, 'chunks': 1, 'complete': True}
+    mock_upload.assert_not_called()
+    mock_s3_conn.return_value.create_multipart_upload.assert_not_called()
+    assert mock_conn.commit.call_count == 2
 
-    with pytest.raises(PermissionError):
-        with caplog.at_level(logging.INFO):
-            delete_local_file(file_name)
-
-    mock_exists.assert_called_once_with(f'/tmp/{file_name}')
-    mock_remove.assert_called_once()
-
-    assert f'Permission denied while trying to delete /tmp/{
-        file_name}: ' in caplog.text
-
-
-@patch('etl_lambda.delete_local_file')
-@patch('etl_lambda.upload_to_s3')
-@patch('etl_lambda.pd.DataFrame.to_csv')
-@patch('etl_lambda.download_csv_from_s3')
-@patch('etl_lambda.pd.read_sql')
-@patch('etl_lambda.setup_engine')
-def test_fetch_sub_data_rds_success(mock_setup_engine, mock_read_sql, mock_download, mock_to_csv, mock_upload, mock_delete_file):
-    """Test that the latest data can be fetched from the RDS successfully."""
-    mock_engine = MagicMock()
-    mock_setup_engine.return_value = mock_engine
-
-    mock_new_data = pd.DataFrame({
-        'keywords': ['python'],
-        'total mentions': [23],
-        'avg sentiment': [0.12]
-    })
-    mock_read_sql.return_value = mock_new_data
-
-    mock_existing_data = pd.DataFrame({
-        'keywords': ['hello'],
-        'total mentions': [36],
-        'avg sentiment': [0.87]
-    })
-    mock_download.return_value = mock_existing_data
-
-    fake_query = 'fake query'
-    file_name = 'test_file.csv'
-    folder_name = 'folder_name'
-    bucket_name = 'test_bucket'
-    file_path = f'{folder_name}/{file_name}'
-
-    fetch_subscription_data_from_rds(
-        fake_query, file_name, bucket_name, folder_name)
-    mock_read_sql.assert_called_once_with(fake_query, mock_engine)
-    mock_download.assert_called_once_with(bucket_name, file_path, file_name)
-
-    mock_to_csv.assert_called_once_with(f'/tmp/{file_name}', index=False)
-    mock_upload.assert_called_once_with(
-        bucket_name, file_name, file_path)
-    mock_delete_file.assert_called_once_with(file_name)
-
-
-@patch('etl_lambda.download_csv_from_s3')
-@patch('etl_lambda.pd.read_sql')
-@patch('etl_lambda.setup_engine')
-def test_fetch_sub_data_rds_exception(mock_setup_engine, mock_read_sql, mock_download, caplog):
-    """Test that if the fetch query cannot be executed, exception is raised."""
-    mock_engine = MagicMock()
-    mock_setup_engine.return_value = mock_engine
-    fake_query = 'fake query'
-    file_name = 'test_file.csv'
-    folder_name = 'folder_name'
-    bucket_name = 'test_bucket'
-    mock_read_sql.side_effect = Exception()
-    with caplog.at_level(logging.INFO):
-        with pytest.raises(Exception):
-            fetch_subscription_data_from_rds(
-                fake_query, file_name, bucket_name, folder_name)
 
-    mock_read_sql.assert_called_once_with(fake_query, mock_engine)
-    assert 'Error while executing query:' in caplog.text
-    mock_download.assert_not_called()
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', side_effect=lambda *_: {'files': []})
+@patch('etl_lambda.copy_next_chunk', side_effect=[(0, PARTITION), (0, PARTITION), (0, None)])
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_commits_each_chunk(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                       mock_download, mock_upload):
+    """Test chunks are archived and committed one at a time until none are left."""
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
+
+    with patch('etl_lambda.remove_chunk'):
+        summary = archive_keyword_recordings('test_bucket', 'folder_name')
 
+    assert summary == {'archived': 0, 'chunks': 3, 'complete': True}
+    assert mock_conn.commit.call_count == 4
+    assert [c.args[2]['checkpoint']['complete'] for c in mock_upload.call_args_list] == [
+        False, False, True]
 
+
+@patch('etl_lambda.download_manifest')
+@patch('etl_lambda.copy_next_chunk')
 @patch('etl_lambda.setup_connection')
-def test_clear_keyword_recordings_success(mock_setup_conn):
-    """Test successful clearance of data older than 24 hours from the RDS."""
-    mock_conn = MagicMock()
-    mock_curs = MagicMock()
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_no_time_left(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                 mock_download, caplog):
+    """Test no chunk is started without more time left than the margin."""
+    mock_conn, mock_curs = mock_database()
     mock_setup_conn.return_value = mock_conn, mock_curs
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 20000
 
-    remove_query = REMOVE_QUERY
-    clear_keyword_recordings()
+    with caplog.at_level(logging.INFO):
+        summary = archive_keyword_recordings('test_bucket', 'folder_name', context)
 
-    mock_curs.execute.assert_called_once_with(remove_query)
-    mock_conn.commit.assert_called_once()
+    assert summary == {'archived': 0, 'chunks': 0, 'complete': False}
+    mock_archive.assert_not_called()
     mock_conn.close.assert_called_once()
+    assert 'Stopping with 20s left, the next run carries on from here.' in caplog.text
 
 
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', return_value={'files': []})
+@patch('etl_lambda.copy_next_chunk')
 @patch('etl_lambda.setup_connection')
-def test_clear_keyword_recordings_exception(mock_setup_conn, caplog):
-    """Test successful clearance of data older than 24 hours from the RDS."""
-    mock_conn = MagicMock()
-    mock_curs = MagicMock()
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_chunk_runs_out_of_time(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                           mock_download, mock_upload, caplog):
+    """Test a chunk that overruns its statement timeout is rolled back and the run stops cleanly."""
+    mock_archive.side_effect = QueryCanceled('canceling statement due to statement timeout')
+    mock_conn, mock_curs = mock_database()
     mock_setup_conn.return_value = mock_conn, mock_curs
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 90000
 
-    remove_query = REMOVE_QUERY
-    mock_curs.execute.side_effect = Exception()
     with caplog.at_level(logging.INFO):
-        with pytest.raises(Exception):
-            clear_keyword_recordings()
+        summary = archive_keyword_recordings('test_bucket', 'folder_name', context)
 
-    mock_curs.execute.assert_called_once_with(remove_query)
-    mock_conn.commit.assert_not_called()
+    assert summary == {'archived': 0, 'chunks': 0, 'complete': False}
+    assert call("SELECT set_config('statement_timeout', %s, true)", ('60000',)) in \
+        mock_curs.execute.call_args_list
+    mock_upload.assert_not_called()
+    mock_conn.rollback.assert_called_once()
     mock_conn.close.assert_called_once()
-    assert 'Error while executing query:' in caplog.text
+    assert 'Ran out of time during a chunk' in caplog.text
 
 
-@patch.dict('etl_lambda.ENV', {"S3_BUCKET_NAME": "test_bucket"}, clear=True)
-@patch('etl_lambda.clear_keyword_recordings')
-@patch('etl_lambda.fetch_subscription_data_from_rds')
-def test_lambda_handler_success(mock_fetch_rds, mock_clear_recs):
-    """Test successful lambda handler function."""
-    file_name = 'keyword_recording.csv'
-    folder_name = 'long_term_keyword_data'
-    bucket_name = 'test_bucket'
+@patch('etl_lambda.upload_manifest')
+@patch('etl_lambda.download_manifest', side_effect=lambda *_: {'files': []})
+@patch('etl_lambda.copy_next_chunk', side_effect=fake_export)
+@patch('etl_lambda.setup_connection')
+@patch('etl_lambda.s3_connection')
+def test_archive_keyword_recordings_out_of_time_before_manifest(mock_s3_conn, mock_setup_conn, mock_archive,
+                                                                mock_download, mock_upload, caplog):
+    """Test a chunk whose time runs short after its files upload is rolled back and its files deleted before the manifest lists them."""
+    mock_s3 = mock_s3_client()
+    mock_s3.delete_objects.return_value = {}
+    mock_s3_conn.return_value = mock_s3
+    mock_conn, mock_curs = mock_database()
+    mock_setup_conn.return_value = mock_conn, mock_curs
+    context = MagicMock()
+    context.get_remaining_time_in_millis.side_effect = [90000, 45000, 25000]
 
-    lambda_handler(MagicMock(), MagicMock())
+    with patch.dict('etl_lambda.ENV', {'ARCHIVE_KEYWORD_BUCKETS': '1'}):
+        with caplog.at_level(logging.INFO):
+            summary = archive_keyword_recordings('test_bucket', 'folder_name', context)
 
-    mock_fetch_rds.assert_called_once_with(
-        UPDATE_QUERY, file_name, bucket_name, folder_name)
-    mock_clear_recs.assert_called_once()
+    assert summary == {'archived': 0, 'chunks': 0, 'complete': False}
+    [key] = mock_s3.objects
+    assert mock_s3.delete_objects.call_args.kwargs['Delete']['Objects'] == [{'Key': key}]
+    mock_upload.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    assert 'Ran out of time during a chunk' in caplog.text
 
 
 @patch.dict('etl_lambda.ENV', {"S3_BUCKET_NAME": "test_bucket"}, clear=True)
-@patch('etl_lambda.clear_keyword_recordings')
-@patch('etl_lambda.fetch_subscription_data_from_rds')
-def test_lambda_handler_exception(mock_fetch_rds, mock_clear_recs, caplog):
+@patch('etl_lambda.archive_keyword_recordings')
+def test_lambda_handler_success(mock_archive):
     """Test successful lambda handler function."""
-    file_name = 'keyword_recording.csv'
-    folder_name = 'long_term_keyword_data'
-    bucket_name = 'test_bucket'
+    context = MagicMock()
+    assert lambda_handler(MagicMock(), context) == mock_archive.return_value
+
+    mock_archive.assert_called_once_with('test_bucket', 'long_term_keyword_data', context)
 
-    mock_fetch_rds.side_effect = Exception()
+
+@patch.dict('etl_lambda.ENV', {"S3_BUCKET_NAME": "test_bucket"}, clear=True)
+@patch('etl_lambda.archive_keyword_recordings')
+def test_lambda_handler_exception(mock_archive, caplog):
+    """Test an archiving error is logged by the lambda handler."""
+    mock_archive.side_effect = Exception()
     with caplog.at_level(logging.INFO):
         lambda_handler(MagicMock(), MagicMock())
 
-    mock_fetch_rds.assert_called_once_with(
-        UPDATE_QUERY, file_name, bucket_name, folder_name)
-    mock_clear_recs.assert_not_called()
-
-    assert f'Error processing {file_name}' in caplog.text
+    assert 'Error processing long_term_keyword_data' in caplog.text
@@ -0,0 +1,64 @@
+"""Test script for local_s3 python file."""
+# pylint: skip-file
+
+import pytest
+from botocore.exceptions import ClientError
+from local_s3 import LocalS3
+
+
+def test_put_and_get_object(tmp_path):
+    """Test an object written to the local S3 can be read back, and a missing one is reported like S3."""
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(Bucket='bucket', Key='long_term_keyword_data/manifest.json', Body=b'{}')
+
+    with s3.get_object(Bucket='bucket', Key='long_term_keyword_data/manifest.json')['Body'] as body:
+        assert body.read() == b'{}'
+    assert s3.head_object(Bucket='bucket', Key='long_term_keyword_data/manifest.json')['ContentLength'] == 2
+    with pytest.raises(ClientError) as error:
+        s3.get_object(Bucket='bucket', Key='long_term_keyword_data/missing.json')
+    assert error.value.response['Error']['Code'] == 'NoSuchKey'
+
+
+def test_multipart_upload(tmp_path):
+    """Test the parts of a completed upload are joined in order and nothing is left pending."""
+    s3 = LocalS3(str(tmp_path), min_part_size=2)
+    upload_id = s3.create_multipart_upload(Bucket='bucket', Key='key')['UploadId']
+    parts = [{'ETag': s3.upload_part(Bucket='bucket', Key='key', UploadId=upload_id, PartNumber=number,
+                                     Body=body)['ETag'], 'PartNumber': number}
+             for number, body in ((1, b'ab'), (2, b'cd'), (3, b'e'))]
+
+    s3.complete_multipart_upload(Bucket='bucket', Key='key', UploadId=upload_id,
+                                 MultipartUpload={'Parts': parts})
+
+    with s3.get_object(Bucket='bucket', Key='key')['Body'] as body:
+        assert body.read() == b'abcde'
+    assert s3.pending_uploads() == []
+
+
+def test_multipart_upload_rejects_small_parts(tmp_path):
+    """Test a part other than the last smaller than the minimum is rejected like S3 does."""
+    s3 = LocalS3(str(tmp_path), min_part_size=2)
+    upload_id = s3.create_multipart_upload(Bucket='bucket', Key='key')['UploadId']
+    for number, body in ((1, b'a'), (2, b'bc')):
+        s3.upload_part(Bucket='bucket', Key='key', UploadId=upload_id, PartNumber=number, Body=body)
+
+    with pytest.raises(ClientError) as error:
+        s3.complete_multipart_upload(Bucket='bucket', Key='key', UploadId=upload_id,
+                                     MultipartUpload={'Parts': [{'PartNumber': 1}, {'PartNumber': 2}]})
+    assert error.value.response['Error']['Code'] == 'EntityTooSmall'
+
+    s3.abort_multipart_upload(Bucket='bucket', Key='key', UploadId=upload_id)
+    assert s3.pending_uploads() == []
+
+
+def test_delete_objects(tmp_path):
+    """Test listed objects are deleted and missing ones are ignored like S3 does."""
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(Bucket='bucket', Key='a/one', Body=b'1')
+    s3.put_object(Bucket='bucket', Key='a/two', Body=b'2')
+
+    s3.delete_objects(Bucket='bucket', Delete={'Objects': [{'Key': 'a/one'}, {'Key': 'a/missing'}]})
+
+    with pytest.raises(ClientError):
+        s3.head_object(Bucket='bucket', Key='a/one')
+    assert s3.head_object(Bucket='bucket', Key='a/two')['ContentLength'] == 1
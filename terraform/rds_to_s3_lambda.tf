@@ -116,3 +116,72 @@ resource "aws_cloudwatch_event_target" "lambda_target" {
   target_id = "etl-lambda-daily-target"
   arn       = aws_lambda_function.rds_to_s3_etl_lambda.arn
 }
+
+resource "aws_cloudwatch_log_group" "compact_archive_lambda_log_group" {
+  name              = "/aws/lambda/c14-trendgineers-compact-archive-lambda"
+  retention_in_days = 7
+}
+
+# Compaction Lambda, from the same image as the ETL Lambda
+resource "aws_lambda_function" "compact_archive_lambda" {
+  function_name = "c14-trendgineers-compact-archive-lambda"
+  role          = aws_iam_role.rds_to_s3_lambda_role.arn
+
+  package_type  = "Image"
+  architectures = ["x86_64"]
+  image_uri     = aws_lambda_function.rds_to_s3_etl_lambda.image_uri
+
+  image_config {
+    command = ["compact_archive.lambda_handler"]
+  }
+
+  timeout       = 720
+  memory_size   = 1024
+  depends_on    = [aws_cloudwatch_log_group.compact_archive_lambda_log_group]
+
+  environment {
+    variables = {
+      SCHEMA_NAME    = var.SCHEMA_NAME
+      S3_BUCKET_NAME = var.S3_BUCKET_NAME
+      DB_USERNAME    = var.DB_USERNAME
+      DB_PASSWORD    = var.DB_PASSWORD
+      DB_HOST        = var.DB_HOST
+      DB_PORT        = var.DB_PORT
+      DB_NAME        = var.DB_NAME
+      ACCESS_KEY_ID = var.ACCESS_KEY_ID
+      SECRET_ACCESS_KEY = var.SECRET_ACCESS_KEY
+    }
+  }
+
+  logging_config {
+    log_format = "Text"
+    log_group  = "/aws/lambda/c14-trendgineers-compact-archive-lambda"
+  }
+  tracing_config {
+    mode = "PassThrough"
+  }
+
+}
+
+# EventBridge Rule for Weekly Schedule on Sunday at 3 AM
+resource "aws_cloudwatch_event_rule" "compact_archive_schedule_rule" {
+  name                = "c14-trendgineers-compact-archive-weekly-schedule"
+  description         = "Runs the archive compaction Lambda every Sunday at 3 AM"
+  schedule_expression = "cron(0 3 ? * SUN *)"  # Cron for 3:00 AM UTC on Sundays
+}
+
+# Lambda Permission for EventBridge Rule
+resource "aws_lambda_permission" "allow_eventbridge_compact_archive" {
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.compact_archive_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.compact_archive_schedule_rule.arn
+}
+
+# EventBridge Target for Lambda
+resource "aws_cloudwatch_event_target" "compact_archive_lambda_target" {
+  rule      = aws_cloudwatch_event_rule.compact_archive_schedule_rule.name
+  target_id = "compact-archive-lambda-weekly-target"
+  arn       = aws_lambda_function.compact_archive_lambda.arn
+}